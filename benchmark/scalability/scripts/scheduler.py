@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+#
+#    NEPI, a framework to manage network experiments
+#    Copyright (C) 2013 INRIA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Alina Quereilhac <alina.quereilhac@inria.fr>
+
+# Compares the HEAP and WHEEL schedulers.
+#
+# 1) Scheduler micro-benchmark: schedules a mix of tasks with the relative
+#    delays used by the dummy RMs ("0s", reschedule_delay, "1s"), cancels
+#    some of them, and drains the scheduler as the tasks become due.
+#
+# 2) Dummy experiment: deploys the experiment produced by dummy.py
+#    with each scheduler and measures the time to finish.
+#
+# Usage:
+#   PYTHONPATH=$PYTHONPATH:~/repos/nepi/src python scheduler.py -n 10 -a 10
+
+import datetime
+import imp
+import os
+import random
+import time
+
+from optparse import OptionParser
+
+from nepi.execution.scheduler import SchedulerType, create_scheduler, Task
+from nepi.util.timefuncs import stabssec, tclock
+
+def parse_args():
+    usage = ("usage: %prog -t <task_count> -n <node_count> -a <app_count> "
+            "-d <delay> ")
+
+    parser = OptionParser(usage = usage)
+    parser.add_option("-t", "--task-count", dest="task_count",
+            help="Number of tasks for the scheduler micro-benchmark",
+            type="int", default = 100000)
+    parser.add_option("-n", "--node-count", dest="node_count",
+            help="Number of simulated nodes in the experiment",
+            type="int", default = 10)
+    parser.add_option("-a", "--app-count", dest="app_count",
+            help="Number of simulated applications per node",
+            type="int", default = 10)
+    parser.add_option("-d", "--delay", dest="delay",
+            help="Re-scheduling delay", type="float", default = 0.5)
+
+    (options, args) = parser.parse_args()
+
+    return (options.task_count, options.node_count, options.app_count,
+            options.delay)
+
+def task_mix(task_count, delay):
+    # Task delays scheduled by the dummy RMs: deploy/start/stop tasks
+    # are scheduled "0s", deploy re-evaluations after the reschedule delay,
+    # and the group start check after "1s"
+    delays = ["0s"] * 6 + ["%0.1fs" % delay] * 3 + ["1s"]
+    return [random.choice(delays) for i in xrange(task_count)]
+
+def bench_scheduler(stype, delays):
+    scheduler = create_scheduler(stype)
+
+    start = time.time()
+    tasks = []
+    for delay in delays:
+        task = Task(stabssec(delay), None)
+        scheduler.schedule(task)
+        tasks.append(task)
+    tschedule = time.time() - start
+
+    # Cancel 10% of the tasks
+    start = time.time()
+    for task in random.sample(tasks, len(tasks) / 10):
+        scheduler.remove(task.id)
+    tremove = time.time() - start
+
+    # Drain the scheduler as the tasks become due, discounting idle time
+    count = 0
+    idle = 0
+    start = time.time()
+    while True:
+        task = scheduler.peek()
+        if not task:
+            break
+
+        now = tclock()
+        if now < task.timestamp:
+            t = time.time()
+            time.sleep(0.001)
+            idle += time.time() - t
+            continue
+
+        scheduler.next()
+        count += 1
+    tnext = time.time() - start - idle
+
+    return count, tschedule, tremove, tnext
+
+def bench_experiment(stype, node_count, app_count, delay):
+    dirpath = os.path.dirname(os.path.abspath(__file__))
+    dummy = imp.load_source("dummy", os.path.join(dirpath, "dummy.py"))
+
+    os.environ["NEPI_SCHEDULER"] = stype
+    (ec, apps, wait_rms) = dummy.make_experiment(node_count, app_count,
+            0, delay)
+
+    start = time.time()
+    ec.deploy()
+    ec.wait_finished(apps)
+    ttf = time.time() - start
+
+    ec.shutdown()
+
+    return ttf
+
+if __name__ == '__main__':
+    (task_count, node_count, app_count, delay) = parse_args()
+
+    delays = task_mix(task_count, delay)
+
+    print "SCHEDULER|TASKS|SCHEDULE(us/task)|REMOVE(us/task)|NEXT(us/task)"
+    for stype in [SchedulerType.HEAP, SchedulerType.WHEEL]:
+        count, tschedule, tremove, tnext = bench_scheduler(stype, delays)
+        print "%s|%d|%0.2f|%0.2f|%0.2f" % (stype, task_count,
+                tschedule * 1e6 / task_count,
+                tremove * 1e6 / (task_count / 10),
+                tnext * 1e6 / count)
+
+    print "SCHEDULER|NODES|APPS|TTF(s)"
+    for stype in [SchedulerType.HEAP, SchedulerType.WHEEL]:
+        ttf = bench_experiment(stype, node_count, app_count, delay)
+        print "%s|%d|%d|%0.2f" % (stype, node_count, node_count * app_count,
+                ttf)
+
@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+#
+#    NEPI, a framework to manage network experiments
+#    Copyright (C) 2013 INRIA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Alina Quereilhac <alina.quereilhac@inria.fr>
+
+# Measures the packets/s and bytes/s forwarded by tunchannel.tun_fwd.
+#
+# Two network namespaces are connected with a veth pair. Each namespace
+# has a TUN device and runs a tunnel forwarder, and both forwarders
+# exchange packets over UDP through the veth pair:
+#
+#   source -> tun-a -> tun_fwd -> veth-a ---> veth-b -> tun_fwd -> tun-b -> sink
+#    (10.99.0.1)         (10.98.0.1)         (10.98.0.2)            (10.99.0.2)
+#
+# With -Q, the TUN devices are multi-queue devices and each queue is
+# forwarded by its own process over its own UDP port, with
+# tunchannel.tun_fwd_parallel. The source sends from several UDP ports
+# so its flows are spread among the queues.
+#
+# The source sends UDP datagrams towards the sink for a while, as fast
+# as it can or at a fixed rate, and the sink counts what it receives.
+# The CPU time used by both forwarders is reported per received packet,
+# which is the meaningful figure when all the processes share few CPUs.
+#
+# Must be run as root, on Linux. Run instructions:
+#   cd ~/repos/nepi/benchmark/tunnel/scripts
+#   sudo python tun_fwd.py -i select -i epoll -s 64 -s 1400 -r 20000
+
+import ctypes
+import errno
+import fcntl
+import imp
+import multiprocessing
+import os
+import signal
+import socket
+import struct
+import subprocess
+import time
+
+from optparse import OptionParser
+
+IFF_TUN = 0x0001
+IFF_NO_PI = 0x1000
+IFF_MULTI_QUEUE = 0x0100
+TUNSETIFF = 0x400454ca
+CLONE_NEWNET = 0x40000000
+
+NETNS = ("nepi-bench-a", "nepi-bench-b")
+VETH = ("nepi-veth-a", "nepi-veth-b")
+TUN = ("nepi-tun-a", "nepi-tun-b")
+VETH_ADDR = ("10.98.0.1", "10.98.0.2")
+TUN_ADDR = ("10.99.0.1", "10.99.0.2")
+
+TUNNEL_PORT = 15000
+SINK_PORT = 14999
+
+# Number of UDP flows sent by the source
+SOURCE_FLOWS = 16
+
+def parse_args():
+    usage = ("usage: %prog -i <select|epoll> -s <packet-size> "
+            "-d <duration> -r <rate> -q <txqueuelen> -Q <queues> [-n] "
+            "[-k <cipher-key>]")
+
+    parser = OptionParser(usage = usage)
+    parser.add_option("-i", "--impl", dest="impls", action="append",
+            help="Forwarding loop to benchmark, select or epoll. "
+            "Can be repeated. Defaults to both.")
+    parser.add_option("-s", "--size", dest="sizes", action="append",
+            help="UDP payload size in bytes. Can be repeated. "
+            "Defaults to 64 and 1400.", type="int")
+    parser.add_option("-d", "--duration", dest="duration",
+            help="Seconds to send traffic", default=10, type="float")
+    parser.add_option("-r", "--rate", dest="rate",
+            help="Packets per second sent by the source, 0 for as fast as "
+            "possible", default=0, type="int")
+    parser.add_option("-q", "--txqueuelen", dest="txqueuelen", 
+            help="Transmission queue length of the forwarders",
+            default=1000, type="int")
+    parser.add_option("-Q", "--queues", dest="queues",
+            help="Number of queues of the TUN devices, each one forwarded "
+            "by its own process", default=1, type="int")
+    parser.add_option("-n", "--pi", dest="pi", action="store_true",
+            default=False, help="Enable PI headers on the TUN devices")
+    parser.add_option("-k", "--cipher-key", dest="cipher_key",
+            help="Encrypt the tunnel with AES and this key", default=None)
+
+    (options, args) = parser.parse_args()
+
+    impls = options.impls or ["select", "epoll"]
+    sizes = options.sizes or [64, 1400]
+
+    return (impls, sizes, options.duration, options.rate, options.txqueuelen,
+            options.queues, options.pi, options.cipher_key)
+
+def load_tunchannel():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+            "..", "..", "..", "src", "nepi", "resources", "linux", "scripts",
+            "tunchannel.py")
+    return imp.load_source("tunchannel", path)
+
+def run(command):
+    subprocess.check_call(command, shell = True)
+
+def setns(name):
+    libc = ctypes.CDLL("libc.so.6", use_errno = True)
+    fd = os.open("/var/run/netns/%s" % name, os.O_RDONLY)
+    if libc.setns(fd, CLONE_NEWNET) != 0:
+        raise OSError(ctypes.get_errno(), "setns %s failed" % name)
+    os.close(fd)
+
+def setup():
+    cleanup()
+
+    run("ip link add %s type veth peer name %s" % VETH)
+    for i in (0, 1):
+        run("ip netns add %s" % NETNS[i])
+        run("ip link set %s netns %s" % (VETH[i], NETNS[i]))
+        run("ip netns exec %s ip link set lo up" % NETNS[i])
+        run("ip netns exec %s ip addr add %s/24 dev %s" % (NETNS[i], 
+            VETH_ADDR[i], VETH[i]))
+        run("ip netns exec %s ip link set %s up" % (NETNS[i], VETH[i]))
+
+def cleanup():
+    for name in NETNS:
+        subprocess.call("ip netns del %s 2>/dev/null" % name, shell = True)
+    subprocess.call("ip link del %s 2>/dev/null" % VETH[0], shell = True)
+
+def forwarder(i, impl, txqueuelen, queues, pi, cipher_key, ready, done):
+    tunchannel = load_tunchannel()
+
+    TERMINATE = []
+    def _finalize(sig, frame):
+        TERMINATE.append(None)
+    signal.signal(signal.SIGTERM, _finalize)
+
+    setns(NETNS[i])
+
+    flags = IFF_TUN
+    if not pi:
+        flags |= IFF_NO_PI
+
+    if queues > 1:
+        flags |= IFF_MULTI_QUEUE
+
+    tuns = []
+    for q in xrange(queues):
+        fd = os.open("/dev/net/tun", os.O_RDWR)
+        fcntl.ioctl(fd, TUNSETIFF, struct.pack("16sH", TUN[i], flags))
+        tuns.append(os.fdopen(fd, 'r+b', 0))
+
+    run("ip addr add %s/24 dev %s" % (TUN_ADDR[i], TUN[i]))
+    run("ip link set %s txqueuelen %d up" % (TUN[i], txqueuelen))
+
+    socks = []
+    for q in xrange(queues):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 0)
+        sock.bind((VETH_ADDR[i], TUNNEL_PORT + q))
+        sock.connect((VETH_ADDR[1 - i], TUNNEL_PORT + q))
+        socks.append(sock)
+
+    ready.put(i)
+
+    tunchannel.tun_fwd_parallel(tuns, socks,
+        with_pi = pi,
+        ether_mode = False,
+        udp = True,
+        cipher_key = cipher_key,
+        cipher = "AES",
+        TERMINATE = TERMINATE,
+        SUSPEND = [],
+        stderr = None,
+        tunqueue = txqueuelen,
+        tunkqueue = 500,
+        use_epoll = (impl == "epoll"))
+
+    # Includes the forwarder processes of each queue
+    done.put(sum(os.times()[:4]))
+
+def sink(duration, results):
+    setns(NETNS[1])
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 0)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+    sock.bind((TUN_ADDR[1], SINK_PORT))
+    results.put("ready")
+
+    buf = bytearray(65536)
+    packets = nbytes = 0
+    first = last = None
+
+    sock.settimeout(duration + 5)
+    try:
+        while True:
+            n = sock.recv_into(buf)
+            last = time.time()
+            if first is None:
+                first = last
+                # Stop shortly after the source stops
+                sock.settimeout(1)
+            packets += 1
+            nbytes += n
+    except socket.timeout:
+        pass
+
+    results.put(("sink", packets, nbytes, (last or 0) - (first or 0)))
+
+def source(size, duration, rate, results):
+    setns(NETNS[0])
+
+    socks = []
+    for flow in xrange(SOURCE_FLOWS):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 0)
+        sock.connect((TUN_ADDR[1], SINK_PORT))
+        socks.append(sock)
+
+    payload = "x" * size
+    sends = [sock.send for sock in socks]
+    packets = 0
+
+    # Packets are sent in bursts of 'burst' packets
+    burst = 100
+    if rate:
+        burst = max(1, min(burst, rate / 1000))
+
+    start = time.time()
+    end = start + duration
+    while True:
+        if rate:
+            delay = start + float(packets) / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        for x in xrange(burst):
+            try:
+                sends[packets % SOURCE_FLOWS](payload)
+                packets += 1
+            except socket.error, e:
+                # The TUN device queue is full
+                if e.errno not in (errno.ENOBUFS, errno.EAGAIN):
+                    raise
+        if time.time() >= end:
+            break
+
+    results.put(("source", packets, packets * size, time.time() - start))
+
+def benchmark(impl, size, duration, rate, txqueuelen, queues, pi, 
+        cipher_key):
+    setup()
+
+    ready = multiprocessing.Queue()
+    done = multiprocessing.Queue()
+    forwarders = [multiprocessing.Process(target = forwarder, 
+        args = (i, impl, txqueuelen, queues, pi, cipher_key, ready, done)) 
+        for i in (0, 1)]
+    cputime = 0
+
+    for proc in forwarders:
+        proc.start()
+
+    try:
+        for proc in forwarders:
+            ready.get(timeout = 30)
+
+        results = multiprocessing.Queue()
+        sinkproc = multiprocessing.Process(target = sink, 
+                args = (duration, results))
+        sinkproc.start()
+        results.get(timeout = 30)
+
+        sourceproc = multiprocessing.Process(target = source, 
+                args = (size, duration, rate, results))
+        sourceproc.start()
+
+        stats = dict()
+        for i in (0, 1):
+            (name, packets, nbytes, seconds) = results.get(
+                    timeout = duration + 60)
+            stats[name] = (packets, nbytes, seconds)
+
+        sourceproc.join()
+        sinkproc.join()
+    finally:
+        for proc in forwarders:
+            if proc.is_alive():
+                os.kill(proc.pid, signal.SIGTERM)
+
+        for proc in forwarders:
+            try:
+                cputime += done.get(timeout = 5)
+            except:
+                pass
+            proc.join(5)
+            if proc.is_alive():
+                proc.terminate()
+        cleanup()
+
+    (sent, sentbytes, sentsecs) = stats["source"]
+    (received, recvbytes, recvsecs) = stats["sink"]
+
+    # Received rates are computed over the source sending time, the 
+    # sink might see the last packets later if the forwarders queue them
+    secs = max(sentsecs, recvsecs, 0.001)
+    loss = 100.0 * (sent - received) / sent if sent else 0
+
+    # CPU time used by the forwarders per received packet, in microseconds
+    cpu = 1e6 * cputime / received if received else 0
+
+    return (sent / sentsecs, received / secs, recvbytes * 8 / secs / 1e6, 
+            loss, cpu)
+
+if __name__ == '__main__':
+    (impls, sizes, duration, rate, txqueuelen, queues, pi, 
+            cipher_key) = parse_args()
+
+    print "%-8s %6s %12s %12s %12s %8s %12s" % ("impl", "size", "sent pps", 
+            "recv pps", "recv Mbps", "loss %", "fwd us/pkt")
+
+    for size in sizes:
+        for impl in impls:
+            (sentpps, recvpps, mbps, loss, cpu) = benchmark(impl, size, 
+                    duration, rate, txqueuelen, queues, pi, cipher_key)
+
+            print "%-8s %6d %12.0f %12.0f %12.2f %8.2f %12.2f" % (impl, size,
+                    sentpps, recvpps, mbps, loss, cpu)
@@ -40,12 +40,22 @@
 #               \   nid3
 #                        \ nid3.log
 #
+# Node directories are parsed in parallel, in a pool of processes.
+# The messages of each node are stored in columnar format, in a 
+# directory with one NumPy array file per column, so they can be 
+# loaded with memory mapping. Content names, nonces and peer node ids
+# are interned, and the columns store their index in the tables.
+#
 
+import array
 import collections
 import functools
+import multiprocessing
 import networkx
+import numpy
 import os
 import pickle
+import shutil
 import tempfile
 
 from nepi.util.timefuncs import compute_delay_ms
@@ -58,11 +68,32 @@ def is_control(content_name):
             content_name.startswith("ccnx:/...")
 
 
+# Message types, in the order of their code in the columnar format
+MESSAGE_TYPES = ["interest_from", "interest_to", "content_from", 
+        "content_to", "interest_dupnonce", "interest_expiry"]
+
+# Columns of the columnar format, and their NumPy types
+COLUMNS = [("timestamp", numpy.float64), 
+        ("message_type", numpy.int8),
+        ("content_name", numpy.int32), 
+        ("peer", numpy.int32),
+        ("nonce", numpy.int32),
+        ("size", numpy.int32)]
+
 def parse_file(filename):
     """ Parses message information from ccnd log files
 
         filename: path to ccndlog file
 
+    """
+    return list(iter_file(filename))
+
+def iter_file(filename):
+    """ Same as parse_file, but yields the messages one at a time while
+    reading the file
+
+        filename: path to ccndlog file
+
     """
 
     faces = dict()
@@ -70,8 +101,6 @@ def parse_file(filename):
 
     f = open(filename, "r")
 
-    data = []
-
     for line in f:
         cols =  line.strip().split(sep)
 
@@ -140,64 +169,167 @@ def parse_file(filename):
         if face_id in faces:
             peer, port = faces[face_id]
 
-        data.append((content_name, timestamp, message_type, peer, face_id, 
-            size, nonce, line))
+        yield (content_name, timestamp, message_type, peer, face_id, 
+            size, nonce)
 
     f.close()
 
-    return data
+class ContentHistoryWriter(object):
+    """ Stores the messages of a node in columnar format in the
+    directory 'path' """
+
+    def __init__(self, path, nid):
+        self.path = path
+        self.nid = nid
+
+        self._tables = dict(content_name = dict(), peer = dict(), 
+                nonce = dict())
+        self._columns = dict(
+                timestamp = array.array("d"),
+                message_type = array.array("b"),
+                content_name = array.array("i"),
+                peer = array.array("i"),
+                nonce = array.array("i"),
+                size = array.array("i"))
+
+    def _intern(self, table, value):
+        table = self._tables[table]
+        index = table.get(value)
+        if index is None:
+            index = table[value] = len(table)
+        return index
+
+    def append(self, timestamp, message_type, content_name, peernid, nonce, 
+            size):
+        columns = self._columns
+        columns["timestamp"].append(float(timestamp))
+        columns["message_type"].append(MESSAGE_TYPES.index(message_type))
+        columns["content_name"].append(self._intern("content_name", 
+            content_name))
+        columns["peer"].append(self._intern("peer", peernid))
+        columns["nonce"].append(self._intern("nonce", nonce))
+        columns["size"].append(size)
+
+    def close(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        for name, dtype in COLUMNS:
+            values = numpy.frombuffer(self._columns[name], 
+                    dtype = dtype) if self._columns[name] else \
+                            numpy.array([], dtype = dtype)
+            numpy.save(os.path.join(self.path, "%s.npy" % name), values)
+
+        # Interned values, ordered by index
+        tables = dict(nid = self.nid)
+        for name, table in self._tables.iteritems():
+            values = [None] * len(table)
+            for value, index in table.iteritems():
+                values[index] = value
+            tables[name] = values
+
+        f = open(os.path.join(self.path, "tables.pickle"), "wb")
+        pickle.dump(tables, f, pickle.HIGHEST_PROTOCOL)
+        f.close()
+
+def load_content_history(path, remove = True):
+    """ Loads the messages of a node stored in columnar format.
+
+    Returns a dictionary with a memory mapped NumPy array per column,
+    plus the tables of interned values ("content_names", "peers" and 
+    "nonces") and the node id ("nid").
+
+    If 'remove' is True the files are deleted, the memory mapped arrays
+    remain valid until released.
 
-def dump_content_history(content_history):
-    f = tempfile.NamedTemporaryFile(delete=False)
-    pickle.dump(content_history, f)
-    f.close()
-    return f.name
+    """
+    history = dict()
+    for name, dtype in COLUMNS:
+        history[name] = numpy.load(os.path.join(path, "%s.npy" % name), 
+                mmap_mode = "r")
 
-def load_content_history(fname):
-    f = open(fname, "r")
-    content_history = pickle.load(f)
+    f = open(os.path.join(path, "tables.pickle"), "rb")
+    tables = pickle.load(f)
     f.close()
 
-    os.remove(fname)
-    return content_history
+    history["nid"] = tables["nid"]
+    history["content_names"] = tables["content_name"]
+    history["peers"] = tables["peer"]
+    history["nonces"] = tables["nonce"]
 
-def annotate_cn_node(graph, nid, ips2nid, data, content_history):
-    for (content_name, timestamp, message_type, peer, face_id, 
-            size, nonce, line) in data:
+    if remove:
+        shutil.rmtree(path)
 
-        # Ignore control messages for the time being
-        if is_control(content_name):
-            continue
+    return history
 
-        if message_type == "interest_from" and \
-                peer == "localhost":
-            graph.node[nid]["ccn_consumer"] = True
-        elif message_type == "content_from" and \
-                peer == "localhost":
-            graph.node[nid]["ccn_producer"] = True
+def parse_node_logs(dirpath, fnames, nid, ips2nid, path):
+    """ Parses the ccnd logs of a node, and stores its messages in 
+    columnar format in the directory 'path'.
+
+    Returns a tuple (found_files, consumer, producer, peers), 
+    indicating if ccnd logs were found, if the node is a content consumer
+    or producer, and the set of nodes it exchanged messages with.
 
-        # Ignore local messages for the time being. 
-        # They could later be used to calculate the processing times
-        # of messages.
-        if peer == "localhost":
+    """
+    found_files = False
+    consumer = False
+    producer = False
+    peers = set()
+
+    writer = ContentHistoryWriter(path, nid)
+
+    for fname in fnames:
+        if not fname.endswith(".log"):
             continue
 
-        # remove digest
-        if message_type in ["content_from", "content_to"]:
-            content_name = "/".join(content_name.split("/")[:-1])
-           
-        if content_name not in content_history:
-            content_history[content_name] = list()
-      
-        peernid = ips2nid[peer]
-        graph.add_edge(nid, peernid)
+        found_files = True
+        filename = os.path.join(dirpath, fname)
+
+        for (content_name, timestamp, message_type, peer, face_id, 
+                size, nonce) in iter_file(filename):
+
+            # Ignore control messages for the time being
+            if is_control(content_name):
+                continue
+
+            if message_type == "interest_from" and \
+                    peer == "localhost":
+                consumer = True
+            elif message_type == "content_from" and \
+                    peer == "localhost":
+                producer = True
+
+            # Ignore local messages for the time being. 
+            # They could later be used to calculate the processing times
+            # of messages.
+            if peer == "localhost":
+                continue
+
+            # remove digest
+            if message_type in ["content_from", "content_to"]:
+                content_name = "/".join(content_name.split("/")[:-1])
+               
+            peernid = ips2nid[peer]
+            peers.add(peernid)
+
+            writer.append(timestamp, message_type, content_name, peernid, 
+                    nonce, size)
 
-        content_history[content_name].append((timestamp, message_type, nid, 
-            peernid, nonce, size, line))
+    writer.close()
 
-def annotate_cn_graph(logs_dir, graph, parse_ping_logs = False):
+    return (found_files, consumer, producer, peers)
+
+def _parse_node_logs(args):
+    # Entry point of the pool processes
+    return parse_node_logs(*args)
+
+def annotate_cn_graph(logs_dir, graph, parse_ping_logs = False, 
+        nprocs = None):
     """ Adds CCN content history for each node in the topology graph.
 
+    The logs of the nodes are parsed in parallel by 'nprocs' processes
+    (by default, as many as CPUs). 
+
     """
     
     # Make a copy of the graph to ensure integrity
@@ -212,6 +344,10 @@ def annotate_cn_graph(logs_dir, graph, parse_ping_logs = False):
 
     found_files = False
 
+    # Directory to store the columnar content history of each node
+    history_dir = tempfile.mkdtemp()
+    tasks = []
+
     # Now walk through the ccnd logs...
     for dirpath, dnames, fnames in os.walk(logs_dir):
         # continue if we are not at the leaf level (if there are subdirectories)
@@ -224,20 +360,32 @@ def annotate_cn_graph(logs_dir, graph, parse_ping_logs = False):
         # Cast to numeric nid if necessary
         if int(nid) in graph.nodes():
             nid = int(nid)
-    
-        content_history = dict()
 
-        for fname in fnames:
-            if fname.endswith(".log"):
-                found_files = True
-                filename = os.path.join(dirpath, fname)
-                data = parse_file(filename)
-                annotate_cn_node(graph, nid, ips2nid, data, content_history)
+        path = os.path.join(history_dir, str(len(tasks)))
+        tasks.append((nid, path, (dirpath, fnames, nid, ips2nid, path)))
+
+    pool = multiprocessing.Pool(processes = nprocs)
+    try:
+        results = pool.map(_parse_node_logs, [args for (nid, path, args) in tasks])
+    finally:
+        pool.close()
+        pool.join()
+
+    for (nid, path, args), (found, consumer, producer, peers) in zip(tasks, 
+            results):
+        found_files = found_files or found
+        
+        if consumer:
+            graph.node[nid]["ccn_consumer"] = True
+        if producer:
+            graph.node[nid]["ccn_producer"] = True
+
+        for peernid in peers:
+            graph.add_edge(nid, peernid)
 
-        # Avoid storing everything in memory, instead dump to a file
-        # and reference the file
-        fname = dump_content_history(content_history)
-        graph.node[nid]["history"] = fname
+        # Avoid storing everything in memory, instead reference the 
+        # directory with the columnar history
+        graph.node[nid]["history"] = path
 
     if not found_files:
         msg = "No CCND output files were found to parse at %s " % logs_dir
@@ -261,114 +409,183 @@ def ccn_consumers(graph):
 def process_content_history(graph):
     """ Compute CCN message counts and aggregates content historical 
     information in the content_names dictionary 
+
+    The columnar histories of the nodes are processed with NumPy array
+    operations: content names and node ids are mapped to global integer
+    ids, counts are computed with bincount, and messages are grouped by
+    content name by sorting them. 
     
     """
 
     ## Assume single source
     source = ccn_consumers(graph)[0]
 
-    interest_expiry_count = 0
-    interest_dupnonce_count = 0
-    interest_count = 0
-    content_count = 0
-    content_names = dict()
+    interest_from = MESSAGE_TYPES.index("interest_from")
+    interest_to = MESSAGE_TYPES.index("interest_to")
+    content_from = MESSAGE_TYPES.index("content_from")
+    content_to = MESSAGE_TYPES.index("content_to")
+
+    # Global tables of interned content names, node ids and nonces
+    names = _Interner()
+    nids = _Interner()
+    nonces = _Interner()
+
+    counts = numpy.zeros(len(MESSAGE_TYPES), dtype = numpy.int64)
+
+    # Columns of the messages of interest, for all nodes
+    interests = collections.defaultdict(list)
+    contents = collections.defaultdict(list)
+    consumer = collections.defaultdict(list)
+    seen_names = []
 
     # Collect information about exchanged messages by content name and
     # link delay info.
     for nid in graph.nodes():
         # Load the data collected from the node's ccnd log
-        fname = graph.node[nid]["history"]
-        history = load_content_history(fname)
-
-        for content_name in history.keys():
-            hist = history[content_name]
-
-            for (timestamp, message_type, nid1, nid2, nonce, size, line) in hist:
-                if message_type in ["content_from", "content_to"]:
-                    # The first Interest sent will not have a version or chunk number.
-                    # The first Content sent back in reply, will end in /=00 or /%00.
-                    # Make sure to map the first Content to the first Interest.
-                    if content_name.endswith("/=00"):
-                        content_name = "/".join(content_name.split("/")[0:-2])
-
-                # Add content name to dictionary
-                if content_name not in content_names:
-                    content_names[content_name] = dict()
-                    content_names[content_name]["interest"] = dict()
-                    content_names[content_name]["content"] = list()
-
-                # Classify interests by replica
-                if message_type in ["interest_from"] and \
-                        nonce not in content_names[content_name]["interest"]:
-                    content_names[content_name]["interest"][nonce] = list()
-     
-                # Add consumer history
-                if nid == source:
-                    if message_type in ["interest_to", "content_from"]:
-                        # content name history as seen by the source
-                        if "consumer_history" not in content_names[content_name]:
-                            content_names[content_name]["consumer_history"] = list()
-
-                        content_names[content_name]["consumer_history"].append(
-                                (timestamp, message_type)) 
-
-                # Add messages per content name and cumulate totals by message type
-                if message_type == "interest_dupnonce":
-                    interest_dupnonce_count += 1
-                elif message_type == "interest_expiry":
-                    interest_expiry_count += 1
-                elif message_type == "interest_from":
-                    interest_count += 1
-                    # Append to interest history of the content name
-                    content_names[content_name]["interest"][nonce].append(
-                            (timestamp, nid2, nid1))
-                elif message_type == "content_from":
-                    content_count += 1
-                    # Append to content history of the content name
-                    content_names[content_name]["content"].append((timestamp, nid2, nid1))
-                else:
-                    continue
-            del hist
+        path = graph.node[nid]["history"]
+        history = load_content_history(path)
+
+        message_type = numpy.asarray(history["message_type"])
+        timestamp = numpy.asarray(history["timestamp"])
+
+        counts += numpy.bincount(message_type, 
+                minlength = len(MESSAGE_TYPES))[:len(MESSAGE_TYPES)]
+
+        # The first Interest sent will not have a version or chunk number.
+        # The first Content sent back in reply, will end in /=00 or /%00.
+        # Make sure to map the first Content to the first Interest.
+        table = history["content_names"]
+        name_ids = names.intern_all(table)
+        content_name_ids = names.intern_all([
+            "/".join(name.split("/")[0:-2]) if name.endswith("/=00") \
+                    else name for name in table])
+
+        name = history["content_name"]
+        is_content = (message_type == content_from) | \
+                (message_type == content_to)
+        name = numpy.where(is_content, content_name_ids[name], 
+                name_ids[name])
+        seen_names.append(numpy.unique(name))
+
+        # Node ids
+        nid1 = nids.intern(history["nid"])
+        nid2 = nids.intern_all(history["peers"])[history["peer"]]
+
+        mask = message_type == interest_from
+        interests["name"].append(name[mask])
+        interests["nonce"].append(nonces.intern_all(
+            history["nonces"])[history["nonce"][mask]])
+        interests["timestamp"].append(timestamp[mask])
+        interests["nid2"].append(nid2[mask])
+        interests["nid1"].append(numpy.repeat(nid1, mask.sum()))
+
+        mask = message_type == content_from
+        contents["name"].append(name[mask])
+        contents["timestamp"].append(timestamp[mask])
+        contents["nid2"].append(nid2[mask])
+        contents["nid1"].append(numpy.repeat(nid1, mask.sum()))
+
+        # Add consumer history
+        if nid == source:
+            mask = (message_type == interest_to) | \
+                    (message_type == content_from)
+            consumer["name"].append(name[mask])
+            consumer["timestamp"].append(timestamp[mask])
+            consumer["message_type"].append(message_type[mask])
+
         del history
 
+    interests = _concatenate(interests, ["name", "nonce", "timestamp", 
+        "nid2", "nid1"])
+    contents = _concatenate(contents, ["name", "timestamp", "nid2", "nid1"])
+    consumer = _concatenate(consumer, ["name", "timestamp", "message_type"])
+
+    interest_dupnonce_count = int(counts[
+        MESSAGE_TYPES.index("interest_dupnonce")])
+    interest_expiry_count = int(counts[
+        MESSAGE_TYPES.index("interest_expiry")])
+    interest_count = int(counts[interest_from])
+    content_count = int(counts[content_from])
+
+    all_names = numpy.unique(numpy.concatenate(seen_names)) \
+            if seen_names else numpy.array([], dtype = numpy.int64)
+
+    nid_values = nids.values
+    nonce_values = nonces.values
+
+    content_names = dict()
+    for name_id in all_names:
+        content_names[names.values[name_id]] = dict(
+                interest = dict(), content = list(), consumer_history = list())
+
+    # order content and interest messages by timestamp, grouped 
+    # by content name (and by nonce)
+    for (name_id, nonce_id), rows in _groups(interests, 
+            ["name", "nonce"]):
+        content_name = names.values[name_id]
+        content_names[content_name]["interest"][nonce_values[nonce_id]] = \
+                [(t, nid_values[n2], nid_values[n1]) for (t, n2, n1) in 
+                        zip(*[rows[c].tolist() for c in 
+                            ["timestamp", "nid2", "nid1"]])]
+
+    for (name_id, ), rows in _groups(contents, ["name"]):
+        content_name = names.values[name_id]
+        content_names[content_name]["content"] = \
+                [(t, nid_values[n2], nid_values[n1]) for (t, n2, n1) in 
+                        zip(*[rows[c].tolist() for c in 
+                            ["timestamp", "nid2", "nid1"]])]
+
     # Compute the time elapsed between the time an interest is sent
-    # in the consumer node and when the content is received back
-    for content_name in content_names.keys():
-        # order content and interest messages by timestamp
-        content_names[content_name]["content"] = sorted(
-              content_names[content_name]["content"])
-        
-        for nonce, timestamps in content_names[content_name][
-                    "interest"].iteritems():
-              content_names[content_name]["interest"][nonce] = sorted(
-                        timestamps)
-      
-        history = sorted(content_names[content_name]["consumer_history"])
-        content_names[content_name]["consumer_history"] = history
-
-        # compute the rtt time of the message
-        rtt = None
-        waiting_content = False 
+    # in the consumer node and when the content is received back: 
+    # the first Content received after the first Interest sent
+    nnames = len(names.values)
+    first_interest = numpy.empty(nnames)
+    first_interest.fill(numpy.inf)
+    first_content = numpy.empty(nnames)
+    first_content.fill(numpy.inf)
+
+    mask = consumer["message_type"] == interest_to
+    numpy.minimum.at(first_interest, consumer["name"][mask], 
+            consumer["timestamp"][mask])
+
+    mask = (consumer["message_type"] == content_from) & \
+            (consumer["timestamp"] > first_interest[consumer["name"]])
+    numpy.minimum.at(first_content, consumer["name"][mask], 
+            consumer["timestamp"][mask])
+
+    # Same resolution as compute_delay_ms, microseconds.
+    # Names without interest or content give NaN, and are discarded below
+    with numpy.errstate(invalid = "ignore"):
+        rtts = (numpy.round(first_content * 1e6) - 
+                numpy.round(first_interest * 1e6)) / 1000.0
+
+    type_values = [MESSAGE_TYPES[code] for code in xrange(
+        len(MESSAGE_TYPES))]
+
+    for (name_id, ), rows in _groups(consumer, ["name"]):
+        content_name = names.values[name_id]
+        content_names[content_name]["consumer_history"] = \
+                [(t, type_values[m]) for (t, m) in zip(
+                    rows["timestamp"].tolist(), 
+                    rows["message_type"].tolist())]
+
+    for name_id in all_names:
+        content_name = names.values[name_id]
+
         interest_timestamp = None
-        content_timestamp = None
-        
-        for (timestamp, message_type) in history:
-            if not waiting_content and message_type == "interest_to":
-                waiting_content = True
-                interest_timestamp = timestamp
-                continue
+        if numpy.isfinite(first_interest[name_id]):
+            interest_timestamp = float(first_interest[name_id])
 
-            if waiting_content and message_type == "content_from":
-                content_timestamp = timestamp
-                break
-    
         # If we can't determine who sent the interest, discard it
         rtt = -1
-        if interest_timestamp and content_timestamp:
-            rtt = compute_delay_ms(content_timestamp, interest_timestamp)
+        content_timestamp = None
+        if interest_timestamp and numpy.isfinite(first_content[name_id]):
+            content_timestamp = float(first_content[name_id])
+            rtt = float(rtts[name_id])
 
         content_names[content_name]["rtt"] = rtt
-        content_names[content_name]["lapse"] = (interest_timestamp, content_timestamp)
+        content_names[content_name]["lapse"] = (interest_timestamp, 
+                content_timestamp)
 
     return (graph,
         content_names,
@@ -377,6 +594,53 @@ def process_content_history(graph):
         interest_count,
         content_count)
 
+class _Interner(object):
+    """ Maps values to consecutive integer ids """
+
+    def __init__(self):
+        self.ids = dict()
+        self.values = []
+
+    def intern(self, value):
+        index = self.ids.get(value)
+        if index is None:
+            index = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return index
+
+    def intern_all(self, values):
+        """ Returns an array with the ids of the values """
+        return numpy.array(map(self.intern, values), dtype = numpy.int64)
+
+def _concatenate(columns, names):
+    return dict((name, numpy.concatenate(columns[name]) \
+            if columns[name] else numpy.array([], dtype = numpy.int64)) 
+            for name in names)
+
+def _groups(columns, keys):
+    """ Sorts the rows by the 'keys' columns and by timestamp, and yields 
+    (key values, rows) for each group of rows with the same key values """
+    if not len(columns["timestamp"]):
+        return
+
+    order = numpy.lexsort([columns["timestamp"]] + 
+            [columns[key] for key in reversed(keys)])
+    columns = dict((name, values[order]) for name, values in 
+            columns.iteritems())
+
+    change = numpy.zeros(len(order), dtype = bool)
+    change[0] = True
+    for key in keys:
+        change[1:] |= columns[key][1:] != columns[key][:-1]
+
+    starts = numpy.flatnonzero(change)
+    ends = numpy.append(starts[1:], len(order))
+
+    for start, end in zip(starts, ends):
+        yield (tuple(int(columns[key][start]) for key in keys), 
+                dict((name, values[start:end]) for name, values in 
+                    columns.iteritems()))
+
 def process_content_history_logs(logs_dir, graph, parse_ping_logs = False):
     """ Parse CCN logs and aggregate content history information in graph.
     Returns annotated graph and message countn and content names history.
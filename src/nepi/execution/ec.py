@@ -18,11 +18,11 @@
 # Author: Alina Quereilhac <alina.quereilhac@inria.fr>
 
 from nepi.util import guid
-from nepi.util.parallel import ParallelRun
-from nepi.util.timefuncs import tnow, tdiffsec, stabsformat, tsformat 
+from nepi.util.parallel import KeyedParallelRun
+from nepi.util.timefuncs import tclock, stabssec, tsformat 
 from nepi.execution.resource import ResourceFactory, ResourceAction, \
-        ResourceState, ResourceState2str
-from nepi.execution.scheduler import HeapScheduler, Task, TaskStatus
+        ResourceState, ResourceState2str, ResourceManager
+from nepi.execution.scheduler import create_scheduler, Task, TaskStatus
 from nepi.execution.trace import TraceAttr
 from nepi.util.serializer import ECSerializer, SFormats
 from nepi.util.plotter import ECPlotter, PFormats
@@ -167,7 +167,7 @@ class ExperimentController(object):
 
     def __init__(self, exp_id = None, local_dir = None, persist = False,
             fm = None, add_node_callback = None, add_edge_callback = None, 
-            **kwargs):
+            scheduler_type = None, async_deploy = None, **kwargs):
         """ ExperimentController entity to model an execute a network 
         experiment.
         
@@ -194,6 +194,19 @@ class ExperimentController(object):
         when automatic topology creation mode is used 
         :type add_edge_callback: function
 
+        :param scheduler_type: Type of scheduler used to order tasks
+            (SchedulerType.HEAP or SchedulerType.WHEEL). If None is given,
+            the NEPI_SCHEDULER environmental variable is used, and the 
+            HEAP scheduler by default
+        :type scheduler_type: str
+
+        :param async_deploy: If True, RMs that support it (e.g. Linux RMs)
+            run the remote operations of their provisioning steps 
+            asynchronously, without blocking a thread per operation. 
+            If None is given, the NEPI_ASYNC_DEPLOY environmental variable
+            is used. Disabled by default
+        :type async_deploy: bool
+
         """
         super(ExperimentController, self).__init__()
 
@@ -232,11 +245,17 @@ class ExperimentController(object):
         # Scheduler. It a queue that holds tasks scheduled for
         # execution, and yields the next task to be executed 
         # ordered by execution and arrival time
-        self._scheduler = HeapScheduler()
+        self._scheduler = create_scheduler(scheduler_type)
 
         # Tasks
         self._tasks = dict()
 
+        # Asynchronous deployment mode
+        if async_deploy is None:
+            async_deploy = os.environ.get("NEPI_ASYNC_DEPLOY", "").lower() \
+                    in ["1", "yes", "true"]
+        self._async_deploy = async_deploy
+
         # RM groups (for deployment) 
         self._groups = dict()
 
@@ -265,6 +284,15 @@ class ExperimentController(object):
         self._nthreads = 20
         self._runner = None
 
+        # Condition and listeners used to notify threads waiting 
+        # for RMs to reach a certain state
+        self._state_cond = threading.Condition()
+        self._state_listeners = []
+
+        # Callbacks waiting for a RM to change state, indexed by guid
+        self._state_callbacks = dict()
+        self._state_wait_timeout = 0.5
+
         # Event processing thread
         self._cond = threading.Condition()
         self._thread = threading.Thread(target = self._process)
@@ -278,6 +306,13 @@ class ExperimentController(object):
         """
         return self._logger
 
+    @property
+    def async_deploy(self):
+        """ Returns True if RMs should provision resources asynchronously
+
+        """
+        return self._async_deploy
+
     @property
     def fm(self):
         """ Returns the failure manager
@@ -323,6 +358,18 @@ class ExperimentController(object):
         """
         return self._nthreads
 
+    @property
+    def runner_stats(self):
+        """ Returns statistics on the processing of tasks (number of queued
+        tasks, number of workers and busy workers, histograms of task queue 
+        latency and execution time)
+
+        """
+        if not self._runner:
+            return None
+
+        return self._runner.stats()
+
     @property
     def local_dir(self):
         """ Root local directory for experiment files
@@ -378,7 +425,13 @@ class ExperimentController(object):
 
         """
 
-        return self._fm.eval_failure(guid)
+        ret = self._fm.eval_failure(guid)
+
+        # Threads waiting for RMs may need to quit if the experiment
+        # must be aborted
+        self._notify_state_listeners()
+
+        return ret
 
     def wait_finished(self, guids):
         """ Blocking method that waits until all RMs in the 'guids' list 
@@ -452,35 +505,166 @@ class ExperimentController(object):
             :param guids: List of guids
             :type guids: list
         
+        .. note::
+
+        Instead of polling the RMs, the calling thread registers a listener 
+        and sleeps on the '_state_cond' condition. Every time a RM changes 
+        state the EC is informed (see inform_state_change), the guid is 
+        recorded in the listeners interested in it and the waiting threads 
+        are awaken. On each wake up only the guids that changed state 
+        are re-evaluated. Since some RMs only update their state when it 
+        is queried, if no state change is informed before the timeout 
+        all the pending guids are queried.
+
         """
         if isinstance(guids, int):
             guids = [guids]
 
         # Make a copy to avoid modifying the original guids list
-        guids = list(guids)
+        pending = set(guids)
 
-        while True:
-            # If there are no more guids to wait for
-            # or the quit function returns True, exit the loop
-            if len(guids) == 0 or quit():
-                break
+        # All guids need to be evaluated the first time
+        changed = set(pending)
+        listener = (pending, changed)
 
-            # If a guid reached one of the target states, remove it from list
-            guid = guids.pop()
-            rm = self.get_resource(guid)
-            rstate = rm.state
-            
-            if rstate >= state:
-                self.logger.debug(" %s guid %d DONE - state is %s, required is >= %s " % (
-                    rm.get_rtype(), guid, rstate, state))
-            else:
-                # Debug...
-                self.logger.debug(" WAITING FOR guid %d - state is %s, required is >= %s " % (
-                    guid, rstate, state))
+        with self._state_cond:
+            self._state_listeners.append(listener)
+
+        try:
+            while True:
+                with self._state_cond:
+                    evaluate = list(changed)
+                    changed.clear()
+
+                # The state is queried without holding the condition lock,
+                # since some RMs query the state of the remote resource 
+                for guid in evaluate:
+                    rm = self.get_resource(guid)
+                    rstate = rm.state
+
+                    # If a guid reached one of the target states, remove it 
+                    # from the pending set
+                    if rstate >= state:
+                        with self._state_cond:
+                            pending.discard(guid)
+                        self.logger.debug(" %s guid %d DONE - state is %s, required is >= %s " % (
+                            rm.get_rtype(), guid, rstate, state))
+                    else:
+                        # Debug...
+                        self.logger.debug(" WAITING FOR guid %d - state is %s, required is >= %s " % (
+                            guid, rstate, state))
+
+                # If there are no more guids to wait for
+                # or the quit function returns True, exit the loop
+                if len(pending) == 0 or quit():
+                    break
+
+                with self._state_cond:
+                    # Wait until a RM changes state. The timeout 
+                    # guarantees the wait can be interrupted (e.g. Ctrl-C)
+                    # and that the 'quit' callback is re-evaluated.
+                    if not changed:
+                        self._state_cond.wait(self._state_wait_timeout)
+
+                    # Some RMs only update their state when it is queried
+                    # (e.g. LinuxApplication checks the remote process).
+                    # If nothing changed, query all the pending guids.
+                    if not changed:
+                        changed.update(pending)
+        finally:
+            with self._state_cond:
+                self._state_listeners.remove(listener)
+
+    def inform_state_change(self, guid):
+        """ Reports a state change in a RM to the EC, and awakes
+        the threads waiting for RMs to reach a given state.
+
+            :param guid: Resource id
+            :type guid: int
+
+        """
+        with self._state_cond:
+            for (pending, changed) in self._state_listeners:
+                if guid in pending:
+                    changed.add(guid)
+
+            entries = self._state_callbacks.pop(guid, [])
+            callbacks = [entry.pop() for entry in entries if entry]
+
+            self._state_cond.notify_all()
+
+        # Schedule the actions that were waiting for the RM to change state
+        for callback in callbacks:
+            self.schedule("0s", callback)
 
-                guids.append(guid)
+    def register_state_listener(self, guid, state, callback, delay = None):
+        """ Schedules 'callback' for execution as soon as the RM with 
+        guid 'guid' is no longer in state 'state'. 
+        
+        If the RM already changed state, the callback is scheduled 
+        immediately. This allows RMs to wait for other RMs without
+        re-scheduling tasks periodically.
+
+        Some RMs only update their state when it is queried (e.g. 
+        LinuxApplication checks the remote process), so they never inform
+        the state change. If 'delay' is given, the callback is also 
+        scheduled after 'delay', whichever comes first. The callback is
+        scheduled only once.
+
+            :param guid: Resource id
+            :type guid: int
+
+            :param state: Last known state of the RM
+            :type state: ResourceState
 
-                time.sleep(0.5)
+            :param callback: Function to schedule upon state change
+            :type callback: function
+
+            :param delay: Time after which the callback is scheduled 
+                anyway (e.g. '1s', or a number of seconds)
+            :type delay: str or float
+
+        """
+        # The entry is emptied when the callback is scheduled
+        entry = [callback]
+
+        with self._state_cond:
+            self._state_callbacks.setdefault(guid, []).append(entry)
+
+        # The state is queried without holding the condition lock, since 
+        # some RMs query the state of the remote resource. The entry is 
+        # registered before, so no state change is missed.
+        rm = self.get_resource(guid)
+        if rm.state != state:
+            self._fire_state_listener(guid, entry)
+        elif delay is not None:
+            self.schedule(delay, functools.partial(self._fire_state_listener,
+                guid, entry))
+
+    def _fire_state_listener(self, guid, entry):
+        """ Schedules the callback of a state listener entry, unless 
+        it was already scheduled """
+        with self._state_cond:
+            if not entry:
+                return
+
+            callback = entry.pop()
+
+            entries = self._state_callbacks.get(guid)
+            if entries:
+                entries[:] = [e for e in entries if e is not entry]
+                if not entries:
+                    del self._state_callbacks[guid]
+
+        self.schedule("0s", callback)
+
+    def _notify_state_listeners(self):
+        """ Awakes threads blocked in the wait method, so they can re-evaluate
+        their 'quit' condition (e.g. after a failure)
+
+        """
+        with self._state_cond:
+            self._state_cond.notify_all()
 
     def plot(self, dirpath = None, format= PFormats.FIGURE, show = False):
         plotter = ECPlotter()
@@ -727,6 +911,58 @@ class ExperimentController(object):
         rm = self.get_resource(guid)
         return rm.trace(name, attr, block, offset)
 
+    def retrieve_trace(self, guid, name, path, compress = True):
+        """ Stores the content of a collected trace in the local file 'path',
+        without holding the whole trace in memory when the RM supports it
+
+            :param guid: Guid of the RM
+            :type guid: int
+
+            :param name: Name of the trace
+            :type name: str
+
+            :param path: Local file to store the trace in
+            :type path: str
+
+            :param compress: Compress the trace while transferring it
+            :type compress: bool
+
+        """
+        rm = self.get_resource(guid)
+        return rm.retrieve_trace(name, path, compress = compress)
+
+    def trace_follow(self, guid, name, callback = None, offset = 0):
+        """ Follows a trace as it grows, delivering only the newly 
+        appended content.
+
+        The returned TraceFollower can be iterated to obtain the new 
+        content in chunks. If 'callback' is given, callback(data) is 
+        instead invoked from a background thread for each chunk. 
+        Call 'stop' on the follower to stop following the trace.
+
+            :param guid: Guid of the RM
+            :type guid: int
+
+            :param name: Name of the trace
+            :type name: str
+
+            :param callback: Function invoked with each new chunk
+            :type callback: function
+
+            :param offset: Number of bytes of the trace to skip
+            :type offset: int
+
+            :rtype: TraceFollower
+
+        """
+        rm = self.get_resource(guid)
+        follower = rm.follow_trace(name, offset = offset)
+
+        if callback:
+            follower.start(callback)
+
+        return follower
+
     def get_traces(self, guid):
         """ Returns the list of the trace names of the RM with guid 'guid'
 
@@ -1002,13 +1238,18 @@ class ExperimentController(object):
             guids = self._groups[group]
 
             for guid in guids:
-                if self.state(guid) < ResourceState.READY:
+                state = self.state(guid)
+                if state < ResourceState.READY:
                     reschedule = True
                     break
 
             if reschedule:
+                # Re-evaluate only when the RM that is not READY 
+                # changes state
                 callback = functools.partial(wait_all_and_start, group)
-                self.schedule("1s", callback)
+                rm = self.get_resource(guid)
+                self.register_state_listener(guid, state, callback,
+                        delay = rm.reschedule_delay)
             else:
                 # If all resources are ready, we schedule the start
                 for guid in guids:
@@ -1030,18 +1271,22 @@ class ExperimentController(object):
             callback = functools.partial(wait_all_and_start, group)
             self.schedule("0s", callback)
 
+        callbacks = []
         for guid in guids:
             rm = self.get_resource(guid)
             rm.deployment_group = group
-            self.schedule("0s", rm.deploy_with_conditions)
+            callbacks.append(rm.deploy_with_conditions)
 
             if not wait_all_ready:
-                self.schedule("0s", rm.start_with_conditions)
+                callbacks.append(rm.start_with_conditions)
 
                 if rm.conditions.get(ResourceAction.STOP):
                     # Only if the RM has STOP conditions we
                     # schedule a stop. Otherwise the RM will stop immediately
-                    self.schedule("0s", rm.stop_with_conditions)
+                    callbacks.append(rm.stop_with_conditions)
+
+        # Schedule all deployment tasks at once
+        self.schedule_many("0s", callbacks)
 
     def release(self, guids = None):
         """ Releases all ResourceManagers in the guids list.
@@ -1090,6 +1335,10 @@ class ExperimentController(object):
         for tid in list(self._scheduler.pending):
             self._scheduler.remove(tid)
 
+        # Remove all tasks waiting for RM state changes
+        with self._state_cond:
+            self._state_callbacks.clear()
+
         # Remove pending tasks from the workers queue
         self._runner.empty()
 
@@ -1107,13 +1356,15 @@ class ExperimentController(object):
         if self._thread.is_alive():
            self._thread.join()
 
-    def schedule(self, date, callback, track = False):
+    def schedule(self, date, callback, track = False, key = None):
         """ Schedules a callback to be executed at time 'date'.
 
             :param date: string containing execution time for the task.
                     It can be expressed as an absolute time, using
                     timestamp format, or as a relative time matching
-                    ^\d+.\d+(h|m|s|ms|us)$
+                    ^\d+.\d+(h|m|s|ms|us)$. 
+                    A relative time can also be given as a number 
+                    of seconds.
 
             :param callback: code to be executed for the task. Must be a
                         Python function, and receives args and kwargs
@@ -1122,12 +1373,16 @@ class ExperimentController(object):
             :param track: if set to True, the task will be retrievable with
                     the get_task() method
 
+            :param key: guid of the RM the callback works on, when the
+                    callback is not a method of the RM (e.g. a closure).
+                    Tasks of a same RM are not executed concurrently.
+
             :return : The Id of the task
             :rtype: int
             
         """
-        timestamp = stabsformat(date)
-        task = Task(timestamp, callback)
+        timestamp = self._timestamp(date)
+        task = Task(timestamp, callback, key = key)
         task = self._scheduler.schedule(task)
 
         if track:
@@ -1138,6 +1393,41 @@ class ExperimentController(object):
 
         return task.id
      
+    def schedule_many(self, date, callbacks):
+        """ Schedules many callbacks to be executed at time 'date'.
+
+            :param date: string containing execution time for the tasks.
+                    Same format as for the schedule method.
+
+            :param callbacks: list of callbacks to be executed
+
+            :return : The Ids of the tasks
+            :rtype: list
+            
+        """
+        timestamp = self._timestamp(date)
+        tasks = [Task(timestamp, callback) for callback in callbacks]
+        tasks = self._scheduler.schedule_many(tasks)
+
+        # Notify condition to wake up the processing thread
+        self._notify()
+
+        return [task.id for task in tasks]
+     
+    def _timestamp(self, date):
+        """ Converts a task execution date into a timestamp in seconds
+        of the scheduler clock (see timefuncs.tclock)
+
+        """
+        if isinstance(date, (int, float)):
+            return tclock() + date
+
+        timestamp = stabssec(date)
+        if timestamp is None:
+            raise ValueError("Invalid task execution date %s" % date)
+
+        return timestamp
+
     def _process(self):
         """ Process scheduled tasks.
 
@@ -1158,9 +1448,11 @@ class ExperimentController(object):
         the number of threads used to process tasks. The default value is 
         50.
 
-        To execute tasks in parallel, a ParallelRunner (PR) object is used.
+        To execute tasks in parallel, a KeyedParallelRun (PR) object is used.
         This object keeps a pool of threads (workers), and a queue of tasks
-        scheduled for 'immediate' execution. 
+        scheduled for 'immediate' execution per RM. Tasks of a same RM 
+        are executed in order, one at a time. The pool grows with the 
+        number of RMs with pending tasks, up to NEPI_NTHREADS workers.
         
         On each iteration, the '_process' loop will take the next task that 
         is scheduled for 'future' execution from the '_scheduler' queue, 
@@ -1180,39 +1472,48 @@ class ExperimentController(object):
         """
 
         self._nthreads = int(os.environ.get("NEPI_NTHREADS", str(self._nthreads)))
-        self._runner = ParallelRun(maxthreads = self.nthreads)
+        self._runner = KeyedParallelRun(maxthreads = self.nthreads)
         self._runner.start()
 
         while not self._stop:
             try:
                 self._cond.acquire()
 
-                task = self._scheduler.next()
+                task = self._scheduler.peek()
                 
                 if not task:
                     # No task to execute. Wait for a new task to be scheduled.
-                    self._cond.wait()
+                    # The stop flag is checked while holding the condition,
+                    # to avoid missing the notification sent on shutdown.
+                    if not self._stop:
+                        self._cond.wait()
                 else:
                     # The task timestamp is in the future. Wait for timeout 
                     # or until another task is scheduled.
-                    now = tnow()
+                    now = tclock()
                     if now < task.timestamp:
                         # Calculate timeout in seconds
-                        timeout = tdiffsec(task.timestamp, now)
+                        timeout = task.timestamp - now
 
-                        # Re-schedule task with the same timestamp
-                        self._scheduler.schedule(task)
-                        
                         task = None
 
                         # Wait timeout or until a new task awakes the condition
                         self._cond.wait(timeout)
+                    else:
+                        task = self._scheduler.next()
+
+                        # The peeked task might have been removed meanwhile, 
+                        # and the next one might not be due yet
+                        if task and now < task.timestamp:
+                            self._scheduler.schedule(task)
+                            task = None
                
                 self._cond.release()
 
                 if task:
                     # Process tasks in parallel
-                    self._runner.put(self._execute, task)
+                    self._runner.put(self._task_key(task), self._execute, 
+                            task)
             except: 
                 import traceback
                 err = traceback.format_exc()
@@ -1224,11 +1525,36 @@ class ExperimentController(object):
                 # Set the FailureManager failure level to EC failure
                 self._fm.set_ec_failure()
 
+                self._notify_state_listeners()
+
         self.logger.debug("Exiting the task processing loop ... ")
         
         self._runner.sync()
         self._runner.destroy()
 
+    def _task_key(self, task):
+        """ Returns the guid of the RM the task operates on, or None
+        if the task is not bound to a RM. 
+        
+        Tasks of a same RM are not executed concurrently.
+
+            :param task: Object containing the callback to execute
+            :type task: Task
+
+        """
+        if task.key is not None:
+            return task.key
+
+        callback = task.callback
+        while isinstance(callback, functools.partial):
+            callback = callback.func
+
+        rm = getattr(callback, "im_self", None)
+        if isinstance(rm, ResourceManager):
+            return rm.guid
+
+        return None
+
     def _execute(self, task):
         """ Executes a single task. 
 
@@ -17,10 +17,11 @@
 #
 # Author: Alina Quereilhac <alina.quereilhac@inria.fr>
 
-from nepi.util.timefuncs import tnow, tdiff, tdiffsec, stabsformat
+from nepi.util import eventloop
+from nepi.util.timefuncs import tnow, tdiffsec, tdelaysec
 from nepi.util.logger import Logger
 from nepi.execution.attribute import Attribute, Flags, Types
-from nepi.execution.trace import TraceAttr
+from nepi.execution.trace import TraceAttr, PollingTraceFollower
 
 import copy
 import functools
@@ -122,6 +123,71 @@ def failtrap(func):
     
     return wrapped
 
+class CopyOnWriteDict(object):
+    """ Dictionary of per-instance objects (e.g. Attributes or Traces) that
+    shares the objects defined at class level until they are modified.
+
+    Indexing (store[name]) returns an instance-owned copy of the object, 
+    made on first access, so the caller can modify it. Read-only accesses
+    ('peek', iteration, 'values', etc) return the instance copy if there
+    is one, or the shared class object otherwise.
+
+    """
+    __slots__ = ("_shared", "_own")
+
+    def __init__(self, shared, copied = None):
+        """
+        :param shared: Class level dictionary of objects
+        :type shared: dict
+
+        :param copied: Names of the objects to copy right away 
+        :type copied: list
+        """
+        self._shared = shared
+        self._own = dict()
+
+        for name in copied or []:
+            self._own[name] = copy.copy(shared[name])
+
+    def __getitem__(self, name):
+        obj = self._own.get(name)
+        if obj is None:
+            obj = self._own[name] = copy.copy(self._shared[name])
+        return obj
+
+    def peek(self, name):
+        """ Returns the object without copying it. It must not be modified """
+        obj = self._own.get(name)
+        if obj is None:
+            obj = self._shared[name]
+        return obj
+
+    def __contains__(self, name):
+        return name in self._shared
+
+    def __iter__(self):
+        return iter(self._shared)
+
+    def __len__(self):
+        return len(self._shared)
+
+    def keys(self):
+        return self._shared.keys()
+
+    def iteritems(self):
+        for name in self._shared:
+            yield (name, self.peek(name))
+
+    def items(self):
+        return list(self.iteritems())
+
+    def itervalues(self):
+        for name in self._shared:
+            yield self.peek(name)
+
+    def values(self):
+        return list(self.itervalues())
+
 @clsinit
 class ResourceManager(Logger):
     """ Base clase for all ResourceManagers. 
@@ -331,11 +397,15 @@ class ResourceManager(Logger):
         self._connections = set()
         self._conditions = dict() 
 
-        # the resource instance gets a copy of all attributes
-        self._attrs = copy.deepcopy(self._attributes)
+        # the resource instance shares the class attributes, and gets its
+        # own copy of an attribute when it is modified. Global attributes
+        # are copied right away, to keep their value at creation time.
+        self._attrs = CopyOnWriteDict(self._attributes, 
+                [name for name, attr in self._attributes.iteritems()
+                    if attr.has_flag(Flags.Global)])
 
-        # the resource instance gets a copy of all traces
-        self._trcs = copy.deepcopy(self._traces)
+        # the same goes for the traces
+        self._trcs = CopyOnWriteDict(self._traces)
 
         # Each resource is placed on a deployment group by the EC
         # during deployment
@@ -605,7 +675,7 @@ class ResourceManager(Logger):
         :type name: str
         :rtype: str
         """
-        attr = self._attrs[name]
+        attr = self._attrs.peek(name)
 
         """
         A.Q. Commenting due to performance impact
@@ -623,7 +693,7 @@ class ResourceManager(Logger):
         :type name: str
         :rtype: str
         """
-        attr = self._attrs[name]
+        attr = self._attrs.peek(name)
         return attr.has_changed
 
     def has_flag(self, name, flag):
@@ -632,7 +702,7 @@ class ResourceManager(Logger):
         :param flag: Flag to be checked
         :type flag: Flags
         """
-        attr = self._attrs[name]
+        attr = self._attrs.peek(name)
         return attr.has_flag(flag)
 
     def has_attribute(self, name):
@@ -658,7 +728,7 @@ class ResourceManager(Logger):
         :param name: Name of the trace
         :type name: str
         """
-        trace = self._trcs[name]
+        trace = self._trcs.peek(name)
         return trace.enabled
  
     def trace(self, name, attr = TraceAttr.ALL, block = 512, offset = 0):
@@ -684,6 +754,45 @@ class ResourceManager(Logger):
         """
         pass
 
+    def retrieve_trace(self, name, path, compress = True):
+        """ Stores the content of a collected trace in the local file 'path'.
+
+        The default implementation retrieves the whole content with 'trace'.
+        Resource managers with remote traces should override it to stream 
+        the trace to the file.
+
+        :param name: Name of the trace
+        :type name: str
+
+        :param path: Local file to store the trace in
+        :type path: str
+
+        :param compress: Compress the trace while transferring it
+        :type compress: bool
+        """
+        content = self.trace(name)
+
+        f = open(path, "w")
+        f.write(content)
+        f.close()
+
+    def follow_trace(self, name, offset = 0):
+        """ Returns a TraceFollower that delivers the content appended to
+        the trace after 'offset' as it is produced.
+
+        The default implementation periodically polls the whole trace.
+        Resource managers with remote traces should override it.
+
+        :param name: Name of the trace
+        :type name: str
+
+        :param offset: Number of bytes of the trace to skip
+        :type offset: int
+
+        :rtype: TraceFollower
+        """
+        return PollingTraceFollower(self, name, offset = offset)
+
     def register_condition(self, action, group, state, time = None):
         """ Registers a condition on the resource manager to allow execution 
         of 'action' only after 'time' has elapsed from the moment all resources 
@@ -770,6 +879,41 @@ class ResourceManager(Logger):
             return True
         return False
 
+    def run_coroutine(self, gen):
+        """ Runs a generator based coroutine (see nepi.util.eventloop).
+
+        While the coroutine waits for the operations it yields, no
+        thread is blocked. The coroutine is resumed in the EC thread pool 
+        once the operations are done. If the coroutine raises an error,
+        the RM state is set to FAILED.
+
+        :param gen: Coroutine to run
+        :type gen: generator
+        :return: Future that is done when the coroutine finishes
+
+        """
+        # Steps are closures, the RM is given as the key so they are 
+        # serialized with the other tasks of the RM
+        def schedule(step):
+            self.ec.schedule("0s", step, key = self.guid)
+
+        future = eventloop.run_coroutine(gen, schedule)
+        future.add_done_callback(self._coroutine_done)
+        return future
+
+    def _coroutine_done(self, future):
+        exc_info = future.exc_info()
+        if not exc_info:
+            return
+
+        import traceback
+        err = "".join(traceback.format_exception(*exc_info))
+        logger = Logger(self._rtype)
+        logger.error(err)
+        logger.error("SETTING guid %d to state FAILED" % self.guid)
+
+        self.fail()
+
     @failtrap
     def _needs_reschedule(self, group, state, time):
         """ Internal method that verify if 'time' has elapsed since 
@@ -782,30 +926,40 @@ class ResourceManager(Logger):
         :param time: Time to wait after 'state' is reached on all RMs in group. (e.g. '2s')
         :type time: str
 
+        :return: A tuple (reschedule, delay, waited). If a RM in the group has
+            not yet reached the state, 'waited' is a tuple (guid, state) with
+            the guid of the RM and its current state. If the time restriction
+            is not satisfied, 'delay' is the time still to wait in seconds.
+        :rtype: tuple
+
         .. note : time should be written like "2s" or "3m" with s for seconds, m for minutes, h for hours, ...
         If for example, you need to wait 2min 30sec, time could be "150s" or "2.5m".
         For the moment, 2m30s is not a correct syntax.
 
         """
         reschedule = False
-        delay = self.reschedule_delay 
+        delay = None
+        waited = None
 
         # check state and time elapsed on all RMs
         for guid in group:
             rm = self.ec.get_resource(guid)
+            rstate = rm.state
             
             # If one of the RMs this resource needs to wait for has FAILED
             # and is critical we raise an exception
-            if rm.state == ResourceState.FAILED:
+            if rstate == ResourceState.FAILED:
                 if not rm.get('critical'):
                     continue
                 msg = "Resource can not wait for FAILED RM %d. Setting Resource to FAILED"
                 raise RuntimeError, msg
 
             # If the RM state is lower than the requested state we must
-            # reschedule (e.g. if RM is READY but we required STARTED).
-            if rm.state < state:
+            # wait for it to change (e.g. if RM is READY but we required 
+            # STARTED).
+            if rstate < state:
                 reschedule = True
+                waited = (guid, rstate)
                 break
 
             # If there is a time restriction, we must verify the
@@ -827,17 +981,42 @@ class ResourceManager(Logger):
                     break
 
                 # time already elapsed since RM changed state
-                waited = "%fs" % tdiffsec(tnow(), t)
+                waited_time = tdiffsec(tnow(), t)
 
                 # time still to wait
-                wait = tdiffsec(stabsformat(time), stabsformat(waited))
+                wait = tdelaysec(time) - waited_time
 
                 if wait > 0.001:
                     reschedule = True
-                    delay = "%fs" % wait
+                    delay = wait
                     break
 
-        return reschedule, delay
+        return reschedule, delay, waited
+
+    def _reschedule(self, callback, delay = None, waited = None):
+        """ Internal method to re-evaluate a conditioned action later on.
+
+        If 'waited' is given (a tuple (guid, state)), the callback will 
+        be scheduled when the RM with guid 'guid' changes from state 
+        'state', or after the reschedule delay, since some RMs only 
+        update their state when it is queried. Otherwise the callback 
+        is scheduled after 'delay'.
+
+        :param callback: Action to re-evaluate
+        :type callback: function
+        :param delay: Time to wait before re-evaluating (e.g. '2s', or 
+            a number of seconds)
+        :type delay: str or float
+        :param waited: Tuple (guid, state) of the RM to wait for
+        :type waited: tuple
+
+        """
+        if waited:
+            (guid, state) = waited
+            self.ec.register_state_listener(guid, state, callback,
+                    delay = self.reschedule_delay)
+        else:
+            self.ec.schedule(delay or self.reschedule_delay, callback)
 
     def set_with_conditions(self, name, value, group, state, time):
         """ Set value 'value' on attribute with name 'name' when 'time' 
@@ -857,20 +1036,24 @@ class ResourceManager(Logger):
         """
 
         reschedule = False
-        delay = self.reschedule_delay 
+        delay = None
+        waited = None
 
         ## evaluate if set conditions are met
 
         # only can set with conditions after the RM is started
-        if self.state != ResourceState.STARTED:
+        rstate = self.state
+        if rstate != ResourceState.STARTED:
             reschedule = True
+            waited = (self.guid, rstate)
         else:
-            reschedule, delay = self._needs_reschedule(group, state, time)
+            reschedule, delay, waited = self._needs_reschedule(group, state, 
+                    time)
 
         if reschedule:
             callback = functools.partial(self.set_with_conditions, 
                     name, value, group, state, time)
-            self.ec.schedule(delay, callback)
+            self._reschedule(callback, delay, waited)
         else:
             self.set(name, value)
 
@@ -879,20 +1062,20 @@ class ResourceManager(Logger):
         action 'START' are satisfied.
 
         """
-        #import pdb;pdb.set_trace()
-
         reschedule = False
-        delay = self.reschedule_delay 
-
+        delay = None
+        waited = None
 
         ## evaluate if conditions to start are met
         if self.ec.abort:
             return 
 
         # Can only start when RM is either STOPPED or READY
-        if self.state not in [ResourceState.STOPPED, ResourceState.READY]:
+        rstate = self.state
+        if rstate not in [ResourceState.STOPPED, ResourceState.READY]:
             reschedule = True
-            self.debug("---- RESCHEDULING START ---- state %s " % self.state )
+            waited = (self.guid, rstate)
+            self.debug("---- RESCHEDULING START ---- state %s " % rstate )
         else:
             start_conditions = self.conditions.get(ResourceAction.START, [])
             
@@ -908,12 +1091,13 @@ class ResourceManager(Logger):
                 #
                 #self.debug("---- WAITED STATES ---- %s" % unmet )
 
-                reschedule, delay = self._needs_reschedule(group, state, time)
+                reschedule, delay, waited = self._needs_reschedule(group, 
+                        state, time)
                 if reschedule:
                     break
 
         if reschedule:
-            self.ec.schedule(delay, self.start_with_conditions)
+            self._reschedule(self.start_with_conditions, delay, waited)
         else:
             self.debug("----- STARTING ---- ")
             self.start()
@@ -924,29 +1108,32 @@ class ResourceManager(Logger):
 
         """
         reschedule = False
-        delay = self.reschedule_delay 
+        delay = None
+        waited = None
 
         ## evaluate if conditions to stop are met
         if self.ec.abort:
             return 
 
         # only can stop when RM is STARTED
-        if self.state != ResourceState.STARTED:
+        rstate = self.state
+        if rstate != ResourceState.STARTED:
             reschedule = True
-            self.debug("---- RESCHEDULING STOP ---- state %s " % self.state )
+            waited = (self.guid, rstate)
+            self.debug("---- RESCHEDULING STOP ---- state %s " % rstate )
         else:
             self.debug(" ---- STOP CONDITIONS ---- %s" % 
                     self.conditions.get(ResourceAction.STOP))
 
             stop_conditions = self.conditions.get(ResourceAction.STOP, []) 
             for (group, state, time) in stop_conditions:
-                reschedule, delay = self._needs_reschedule(group, state, time)
+                reschedule, delay, waited = self._needs_reschedule(group, 
+                        state, time)
                 if reschedule:
                     break
 
         if reschedule:
-            callback = functools.partial(self.stop_with_conditions)
-            self.ec.schedule(delay, callback)
+            self._reschedule(self.stop_with_conditions, delay, waited)
         else:
             self.debug(" ----- STOPPING ---- ") 
             self.stop()
@@ -957,18 +1144,21 @@ class ResourceManager(Logger):
 
         """
         reschedule = False
-        delay = self.reschedule_delay 
+        delay = None
+        waited = None
 
         ## evaluate if conditions to deploy are met
         if self.ec.abort:
             return 
 
         # only can deploy when RM is either NEW, DISCOVERED or PROVISIONED 
-        if self.state not in [ResourceState.NEW, ResourceState.DISCOVERED, 
+        rstate = self.state
+        if rstate not in [ResourceState.NEW, ResourceState.DISCOVERED, 
                 ResourceState.PROVISIONED]:
             #### XXX: A.Q. IT SHOULD FAIL IF DEPLOY IS CALLED IN OTHER STATES!
             reschedule = True
-            self.debug("---- RESCHEDULING DEPLOY ---- state %s " % self.state )
+            waited = (self.guid, rstate)
+            self.debug("---- RESCHEDULING DEPLOY ---- state %s " % rstate )
         else:
             deploy_conditions = self.conditions.get(ResourceAction.DEPLOY, [])
             
@@ -984,12 +1174,13 @@ class ResourceManager(Logger):
                 
                 #self.debug("---- WAITED STATES ---- %s" % unmet )
 
-                reschedule, delay = self._needs_reschedule(group, state, time)
+                reschedule, delay, waited = self._needs_reschedule(group, 
+                        state, time)
                 if reschedule:
                     break
 
         if reschedule:
-            self.ec.schedule(delay, self.deploy_with_conditions)
+            self._reschedule(self.deploy_with_conditions, delay, waited)
         else:
             self.debug("----- DEPLOYING ---- ")
             self.deploy()
@@ -1097,6 +1288,11 @@ class ResourceManager(Logger):
         setattr(self, state_time_attr, time)
         self._state = state
 
+        # Inform the EC so that threads waiting for this RM wake up
+        ec = self.ec
+        if ec:
+            ec.inform_state_change(self.guid)
+
 class ResourceFactory(object):
     _resource_types = dict()
 
@@ -19,10 +19,14 @@
 
 from nepi.execution.ec import ExperimentController, ECState
 
+import cPickle
 import math
+import multiprocessing
 import numpy
 import os
+import Queue
 import time
+import traceback
 
 class ExperimentRunner(object):
     """ The ExperimentRunner entity is responsible of
@@ -35,7 +39,7 @@ class ExperimentRunner(object):
     
     def run(self, ec, min_runs = 1, max_runs = -1, wait_time = 0, 
             wait_guids = [], compute_metric_callback = None, 
-            evaluate_convergence_callback = None ):
+            evaluate_convergence_callback = None, parallel = 1):
         """ Run a same experiment independently multiple times, until the 
         evaluate_convergence_callback function returns True
 
@@ -86,6 +90,16 @@ class ExperimentRunner(object):
             
         :type evaluate_convergence_callback: function 
 
+        :param parallel: Number of independent runs to execute at the same
+            time. When greater than 1, each run is executed in a separate 
+            process, with its own run_id and run_dir, and the 
+            compute_metric_callback is invoked in that process. Metrics are
+            evaluated for convergence as runs finish, and new runs are 
+            launched until convergence or max_runs is reached. Runs already
+            started when the stop condition is met are completed, so more
+            than the strictly needed runs can be executed.
+        :type parallel: int
+
         """
 
         if (not max_runs or max_runs < 0) and not compute_metric_callback:
@@ -103,6 +117,11 @@ class ExperimentRunner(object):
 
         filepath = ec.save(dirpath = ec.exp_dir)
 
+        if parallel > 1:
+            return self._run_parallel(ec, filepath, min_runs, max_runs, 
+                    wait_time, wait_guids, compute_metric_callback, 
+                    evaluate_convergence_callback, parallel)
+
         samples = []
         run = 0
         stop = False
@@ -131,6 +150,117 @@ class ExperimentRunner(object):
 
         return run
 
+    def _run_parallel(self, ec, filepath, min_runs, max_runs, wait_time, 
+            wait_guids, compute_metric_callback, evaluate_convergence_callback,
+            parallel):
+        """ Executes up to 'parallel' runs at a time, each one in a separate
+        process. Returns the number of completed runs """
+        results = multiprocessing.Queue()
+        running = dict()
+
+        samples = []
+        launched = 0
+        done = 0
+        stop = False
+        errors = []
+
+        while True:
+            while not stop and len(running) < parallel and \
+                    (max_runs < 0 or launched < max_runs):
+                launched += 1
+                
+                proc = multiprocessing.Process(target = self._replica,
+                        args = (filepath, launched, wait_time, wait_guids,
+                            compute_metric_callback, results))
+                proc.daemon = True
+                proc.start()
+                running[launched] = proc
+
+            if not running:
+                break
+
+            try:
+                (run, metric, err) = results.get(timeout = 1)
+            except Queue.Empty:
+                # Detect runs whose process died without reporting. 
+                # Whatever the exit code, a result that was not read
+                # once the process is gone is lost (e.g. it could not
+                # be pickled), but it might have arrived since the 
+                # last read, so read once more first
+                dead = [run for run, proc in running.items() 
+                        if not proc.is_alive()]
+                if not dead:
+                    continue
+
+                try:
+                    (run, metric, err) = results.get(timeout = 1)
+                except Queue.Empty:
+                    for run in dead:
+                        proc = running.pop(run)
+                        errors.append(" RUN %d - process exited with code "
+                                "%s without reporting a result" % (
+                                    run, proc.exitcode))
+                    stop = True
+                    continue
+
+            if run not in running:
+                # Already reported as failed
+                continue
+
+            running.pop(run).join()
+
+            if err:
+                errors.append(" RUN %d - %s" % (run, err))
+                stop = True
+                continue
+
+            done += 1
+            ec.logger.info(" RUN %d done (%d runs completed) \n" % (run, done))
+
+            if compute_metric_callback and metric is not None:
+                samples.append(metric)
+
+                if not stop and done >= min_runs and \
+                        evaluate_convergence_callback:
+                    if evaluate_convergence_callback(ec, done, samples):
+                        stop = True
+
+            if done >= min_runs and max_runs > -1 and done >= max_runs:
+                stop = True
+
+        if errors:
+            msg = "Experiment failed: %s" % "\n".join(errors)
+            raise RuntimeError, msg
+
+        return done
+
+    def _replica(self, filepath, run, wait_time, wait_guids, 
+            compute_metric_callback, results):
+        """ Executes a run in a child process, and reports the 
+        (run, metric, error) result to the parent """
+        metric = None
+        err = None
+
+        try:
+            ec = self.run_experiment(filepath, wait_time, wait_guids)
+
+            ec.logger.info(" RUN %d - run_dir %s \n" % (run, ec.run_dir))
+
+            try:
+                if compute_metric_callback:
+                    metric = compute_metric_callback(ec, run)
+            finally:
+                ec.shutdown()
+
+            # The queue pickles the result in a separate thread, and 
+            # drops it if that fails
+            cPickle.dumps(metric, cPickle.HIGHEST_PROTOCOL)
+        except:
+            metric = None
+            err = traceback.format_exc()
+
+        results.put((run, metric, err))
+
     def evaluate_normal_convergence(self, ec, run, metrics):
         """ Returns True when the confidence interval of the sample mean is
         less than 5% of the mean value, for a 95% confidence level,
@@ -17,8 +17,12 @@
 #
 # Author: Alina Quereilhac <alina.quereilhac@inria.fr>
 
+from nepi.util.timefuncs import tclock
+
 import itertools
 import heapq
+import os
+import threading
 
 class TaskStatus:
     """ Execution state of the Task
@@ -32,37 +36,120 @@ class Task(object):
     ExperimentController scheduler
     """
 
-    def __init__(self, timestamp, callback):
+    def __init__(self, timestamp, callback, key = None):
         """
-        :param timestamp: Future execution date of the operation
-        :type timestamp: str
+        :param timestamp: Future execution date of the operation, in 
+            seconds of the timefuncs.tclock() clock 
+        :type timestamp: float
 
         :param callback: A function to invoke in order to execute the operation
         :type callback: function
 
+        :param key: Guid of the RM the operation works on, if it can't 
+            be found from the callback (see ExperimentController._task_key)
+        :type key: int
+
         """ 
         self.id = None 
         self.timestamp = timestamp
         self.callback = callback
+        self.key = key
         self.result = None
         self.status = TaskStatus.NEW
 
-class HeapScheduler(object):
+class SchedulerType:
+    """ Available scheduler implementations
+    """
+    HEAP = "heap"
+    WHEEL = "wheel"
+
+class Scheduler(object):
+    """ Base class for the ExperimentController schedulers.
+
+    A scheduler holds tasks ordered by execution time and arrival order.
+    Implementations must be thread safe.
+
+    """
+
+    @property
+    def pending(self):
+        """ Returns the set of pending task ids """
+        raise NotImplementedError
+
+    def schedule(self, task):
+        """ Add a task to the queue ordered by task.timestamp and arrival order
+
+        :param task: task to schedule
+        :type task: task
+        """
+        raise NotImplementedError
+
+    def schedule_many(self, tasks):
+        """ Add many tasks to the queue at once
+
+        :param tasks: tasks to schedule
+        :type tasks: list
+        """
+        for task in tasks:
+            self.schedule(task)
+        return tasks
+
+    def remove(self, tid):
+        """ Remove a task form the queue
+
+        :param tid: Id of the task to be removed
+        :type tid: int
+
+        """
+        raise NotImplementedError
+
+    def peek(self):
+        """ Get the next task in the queue by timestamp and arrival order,
+        without removing it from the queue
+        """
+        raise NotImplementedError
+
+    def next(self):
+        """ Get the next task in the queue by timestamp and arrival order
+        """
+        raise NotImplementedError
+
+class HeapScheduler(Scheduler):
     """ Create a Heap Scheduler
 
     .. note::
 
         This class is thread safe.
-        All calls to C Extensions are made atomic by the GIL in the CPython implementation.
-        heapq.heappush, heapq.heappop, and list access are therefore thread-safe.
+        Operations that modify the queue are serialized using a lock.
+
+        Removed tasks are not immediately deleted from the heap, they 
+        are only marked as invalid (lazy deletion). The number of invalid
+        entries in the heap is tracked, and the heap is compacted when
+        the invalid entries exceed 'compact_ratio' of the heap size.
 
     """
 
-    def __init__(self):
+    def __init__(self, compact_ratio = 0.5, compact_min = 1024):
+        """
+        :param compact_ratio: Maximum fraction of removed tasks allowed in 
+            the heap before it is compacted
+        :type compact_ratio: float
+
+        :param compact_min: Minimum number of removed tasks in the heap 
+            required to compact it 
+        :type compact_min: int
+
+        """
         super(HeapScheduler, self).__init__()
         self._queue = list() 
         self._valid = set()
         self._idgen = itertools.count(1)
+        self._lock = threading.Lock()
+
+        # Number of removed tasks still in the heap
+        self._removed = 0
+        self._compact_ratio = compact_ratio
+        self._compact_min = compact_min
 
     @property
     def pending(self):
@@ -75,14 +162,44 @@ class HeapScheduler(object):
         :param task: task to schedule
         :type task: task
         """
-        if task.id == None:
-            task.id = self._idgen.next()
+        with self._lock:
+            if task.id == None:
+                task.id = self._idgen.next()
 
-        entry = (task.timestamp, task.id, task)
-        self._valid.add(task.id)
-        heapq.heappush(self._queue, entry)
+            entry = (task.timestamp, task.id, task)
+            self._valid.add(task.id)
+            heapq.heappush(self._queue, entry)
+        
         return task
 
+    def schedule_many(self, tasks):
+        """ Add many tasks to the queue at once.
+        
+        When the number of tasks is large compared to the size of the
+        queue, the heap is rebuilt in linear time instead of pushing
+        the tasks one by one.
+
+        :param tasks: tasks to schedule
+        :type tasks: list
+        """
+        with self._lock:
+            entries = []
+            for task in tasks:
+                if task.id == None:
+                    task.id = self._idgen.next()
+
+                entries.append((task.timestamp, task.id, task))
+                self._valid.add(task.id)
+
+            if len(entries) > len(self._queue):
+                self._queue.extend(entries)
+                heapq.heapify(self._queue)
+            else:
+                for entry in entries:
+                    heapq.heappush(self._queue, entry)
+
+        return tasks
+
     def remove(self, tid):
         """ Remove a task form the queue
 
@@ -90,22 +207,303 @@ class HeapScheduler(object):
         :type tid: int
 
         """
-        try:
+        with self._lock:
+            if tid not in self._valid:
+                return
+
             self._valid.remove(tid)
-        except:
-            pass
+            self._removed += 1
+
+            if self._removed >= self._compact_min and \
+                    self._removed > len(self._queue) * self._compact_ratio:
+                self._compact()
+
+    def peek(self):
+        """ Get the next task in the queue by timestamp and arrival order,
+        without removing it from the queue
+        """
+        with self._lock:
+            self._discard_removed()
+
+            if self._queue:
+                timestamp, tid, task = self._queue[0]
+                return task
+
+        return None
 
     def next(self):
         """ Get the next task in the queue by timestamp and arrival order
         """
-        while self._queue:
-            try:
+        with self._lock:
+            self._discard_removed()
+
+            if self._queue:
                 timestamp, tid, task = heapq.heappop(self._queue)
-                if tid in self._valid:
-                    self.remove(tid)
-                    return task
-            except IndexError:
-                # heap empty
-                pass
+                self._valid.remove(tid)
+                return task
+
         return None
 
+    def _discard_removed(self):
+        """ Pops removed tasks from the head of the queue """
+        while self._queue and self._queue[0][1] not in self._valid:
+            heapq.heappop(self._queue)
+            self._removed -= 1
+
+    def _compact(self):
+        """ Deletes all removed tasks from the queue """
+        self._queue = [entry for entry in self._queue \
+                if entry[1] in self._valid]
+        heapq.heapify(self._queue)
+        self._removed = 0
+
+
+class TimerWheelScheduler(Scheduler):
+    """ Create a hierarchical Timing Wheel Scheduler
+
+    .. note::
+
+        Time is divided in ticks of 'resolution' seconds. Each level of 
+        the wheel has 'slots' slots, a slot in level 'l' covering 
+        slots^l ticks. Tasks are appended to the slot of the lowest level 
+        that covers their execution time, so insertion is O(1).
+        As time advances, the slots of the higher levels are cascaded into 
+        the lower levels, and the slots of the first level are expired into
+        a 'ready' heap ordered by timestamp and arrival order.
+        Tasks further in the future than the span of the wheel are kept
+        in an overflow heap.
+
+        Removed tasks are only marked as invalid and are discarded when
+        their slot is expired or cascaded.
+
+        This class is thread safe.
+
+    """
+
+    def __init__(self, resolution = 0.01, slots = 256, levels = 4):
+        """
+        :param resolution: Duration of a tick in seconds
+        :type resolution: float
+
+        :param slots: Number of slots per level 
+        :type slots: int
+
+        :param levels: Number of levels of the wheel 
+        :type levels: int
+
+        """
+        super(TimerWheelScheduler, self).__init__()
+        self._resolution = resolution
+        self._slots = slots
+        self._levels = levels
+        self._spans = [slots ** l for l in xrange(levels + 1)]
+        self._wheel = [[list() for i in xrange(slots)] \
+                for l in xrange(levels)]
+        self._overflow = list()
+        self._ready = list()
+        self._valid = set()
+        self._idgen = itertools.count(1)
+        self._lock = threading.Lock()
+
+        # Number of entries stored in the wheel slots
+        self._count = 0
+        self._tick = self._ticks(tclock())
+
+    @property
+    def pending(self):
+        """ Returns the list of pending task ids """
+        return self._valid
+
+    def schedule(self, task):
+        """ Add a task to the queue ordered by task.timestamp and arrival order
+
+        :param task: task to schedule
+        :type task: task
+        """
+        with self._lock:
+            self._schedule(task)
+
+        return task
+
+    def schedule_many(self, tasks):
+        """ Add many tasks to the queue at once
+
+        :param tasks: tasks to schedule
+        :type tasks: list
+        """
+        with self._lock:
+            for task in tasks:
+                self._schedule(task)
+
+        return tasks
+
+    def remove(self, tid):
+        """ Remove a task form the queue
+
+        :param tid: Id of the task to be removed
+        :type tid: int
+
+        """
+        with self._lock:
+            self._valid.discard(tid)
+
+    def peek(self):
+        """ Get the next task in the queue by timestamp and arrival order,
+        without removing it from the queue
+        """
+        with self._lock:
+            entry = self._first()
+            if entry:
+                return entry[2]
+
+        return None
+
+    def next(self):
+        """ Get the next task in the queue by timestamp and arrival order
+        """
+        with self._lock:
+            entry = self._first()
+            if entry:
+                timestamp, tid, task = entry
+                self._valid.remove(tid)
+
+                if self._ready and self._ready[0] is entry:
+                    heapq.heappop(self._ready)
+                
+                # Entries still in the wheel are discarded lazily
+                return task
+
+        return None
+
+    def _ticks(self, timestamp):
+        return int(timestamp / self._resolution)
+
+    def _schedule(self, task):
+        if task.id == None:
+            task.id = self._idgen.next()
+
+        self._valid.add(task.id)
+        self._insert((task.timestamp, task.id, task))
+
+    def _insert(self, entry):
+        tick = self._ticks(entry[0])
+        delta = tick - self._tick
+
+        # Task is due
+        if delta <= 0:
+            heapq.heappush(self._ready, entry)
+            return
+
+        for level in xrange(self._levels):
+            if delta < self._spans[level + 1]:
+                slot = (tick // self._spans[level]) % self._slots
+                self._wheel[level][slot].append(entry)
+                self._count += 1
+                return
+
+        heapq.heappush(self._overflow, entry)
+
+    def _advance(self):
+        """ Moves the wheel forward up to the current time, 
+        cascading and expiring slots """
+        now = self._ticks(tclock())
+
+        while self._tick < now:
+            if not self._count and not self._overflow:
+                # Nothing stored in the wheel. Jump directly to now
+                self._tick = now
+                break
+
+            self._tick += 1
+            tick = self._tick
+
+            # Refill the wheel from the overflow heap once per 
+            # turn of the highest level
+            if tick % self._spans[self._levels - 1] == 0:
+                limit = tick + self._spans[self._levels]
+                while self._overflow and \
+                        self._ticks(self._overflow[0][0]) < limit:
+                    entry = heapq.heappop(self._overflow)
+                    if entry[1] in self._valid:
+                        self._insert(entry)
+
+            # Cascade the slots of the higher levels that start now
+            for level in xrange(self._levels - 1, 0, -1):
+                span = self._spans[level]
+                if tick % span == 0:
+                    self._cascade(level, (tick // span) % self._slots)
+
+            # Expire the slot of the first level
+            self._cascade(0, tick % self._slots)
+
+    def _cascade(self, level, slot):
+        entries = self._wheel[level][slot]
+        if not entries:
+            return
+
+        self._wheel[level][slot] = list()
+        self._count -= len(entries)
+
+        for entry in entries:
+            if entry[1] in self._valid:
+                self._insert(entry)
+
+    def _first(self):
+        """ Returns the entry of the next task, without removing it """
+        self._advance()
+
+        # Discard removed tasks
+        while self._ready and self._ready[0][1] not in self._valid:
+            heapq.heappop(self._ready)
+
+        if self._ready:
+            return self._ready[0]
+
+        # No task is due. The first task is the earliest among the first 
+        # non empty slot of each level and the overflow heap.
+        candidates = []
+        
+        for level in xrange(self._levels):
+            if not self._count:
+                break
+
+            span = self._spans[level]
+            current = self._tick // span
+            for i in xrange(1, self._slots + 1):
+                slot = (current + i) % self._slots
+                entries = [entry for entry in self._wheel[level][slot] \
+                        if entry[1] in self._valid]
+                if entries:
+                    candidates.append(min(entries))
+                    break
+
+        while self._overflow and self._overflow[0][1] not in self._valid:
+            heapq.heappop(self._overflow)
+
+        if self._overflow:
+            candidates.append(self._overflow[0])
+
+        if candidates:
+            return min(candidates)
+
+        return None
+
+def create_scheduler(stype = None):
+    """ Creates a scheduler of type 'stype'. If no type is given,
+    the NEPI_SCHEDULER environmental variable is used, and if it is not
+    defined a HeapScheduler is created.
+
+    :param stype: Type of scheduler (see SchedulerType)
+    :type stype: str
+
+    :rtype: Scheduler
+    """
+    stype = stype or os.environ.get("NEPI_SCHEDULER", SchedulerType.HEAP)
+
+    if stype == SchedulerType.HEAP:
+        return HeapScheduler()
+    elif stype == SchedulerType.WHEEL:
+        return TimerWheelScheduler()
+    
+    raise RuntimeError("Unknown scheduler type %s" % stype)
+
@@ -17,6 +17,8 @@
 #
 # Author: Alina Quereilhac <alina.quereilhac@inria.fr>
 
+import threading
+
 class TraceAttr:
     """A Trace attribute defines information about a Trace that can
     be queried
@@ -56,3 +58,88 @@ class Trace(object):
         """ Returns the help of the trace """
         return self._help
 
+
+class TraceFollower(object):
+    """ A TraceFollower delivers the content appended to a trace as it
+    is produced, keeping track of the trace offset already delivered.
+
+    Iterating over a follower yields the new content in chunks, blocking
+    until content is available, until 'stop' is invoked. Alternatively,
+    'start' delivers the chunks to a callback from a background thread.
+
+    Subclasses implement '_read' and, if needed, '_close'.
+    """
+
+    def __init__(self, offset = 0):
+        """
+        :param offset: Number of bytes of the trace to skip
+        :type offset: int
+        """
+        self._offset = offset
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def offset(self):
+        """ Returns the position in the trace (in bytes) up to which 
+        content was delivered """
+        return self._offset
+
+    @property
+    def stopped(self):
+        return self._stopped.isSet()
+
+    def start(self, callback):
+        """ Invokes callback(data) for each new chunk of content, from a 
+        background thread """
+        def run():
+            for data in self:
+                callback(data)
+
+        self._thread = threading.Thread(target = run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stops following the trace """
+        self._stopped.set()
+        self._close()
+
+    def __iter__(self):
+        while not self.stopped:
+            data = self._read()
+            if not data:
+                break
+
+            self._offset += len(data)
+            yield data
+
+    def _read(self):
+        """ Returns the next chunk of content after the current offset, 
+        blocking until it is available. Returns an empty string when the
+        follower is stopped """
+        raise NotImplementedError
+
+    def _close(self):
+        pass
+
+class PollingTraceFollower(TraceFollower):
+    """ Follows a trace by periodically retrieving its whole content 
+    from a ResourceManager. Used for resources that don't provide a 
+    better way to follow their traces """
+
+    def __init__(self, rm, name, offset = 0, interval = 1):
+        super(PollingTraceFollower, self).__init__(offset)
+        self._rm = rm
+        self._name = name
+        self._interval = interval
+
+    def _read(self):
+        while not self.stopped:
+            content = self._rm.trace(self._name) or ""
+            if len(content) > self.offset:
+                return content[self.offset:]
+
+            self._stopped.wait(self._interval)
+
+        return ""
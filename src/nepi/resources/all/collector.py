@@ -21,6 +21,7 @@ from nepi.execution.attribute import Attribute, Flags, Types
 from nepi.execution.trace import Trace, TraceAttr
 from nepi.execution.resource import ResourceManager, clsinit_copy, \
         ResourceState, ResourceAction
+from nepi.util.parallel import ParallelRun
 from nepi.util.sshfuncs import ProcStatus
 
 import os
@@ -59,9 +60,23 @@ class Collector(ResourceManager):
                 "Name to give to the collected trace file", 
                 flags = Flags.Design)
 
+        max_transfers = Attribute("maxTransfers", 
+                "Maximum number of traces to retrieve concurrently", 
+                type = Types.Integer,
+                default = 8,
+                flags = Flags.Design)
+
+        compress = Attribute("compress", 
+                "Compress the traces while transferring them", 
+                type = Types.Bool,
+                default = True,
+                flags = Flags.Design)
+
         cls._register_attribute(trace_name)
         cls._register_attribute(sub_dir)
         cls._register_attribute(rename)
+        cls._register_attribute(max_transfers)
+        cls._register_attribute(compress)
 
     def __init__(self, ec, guid):
         super(Collector, self).__init__(ec, guid)
@@ -111,26 +126,32 @@ class Collector(ResourceManager):
             trace_name, self.store_path)
         self.info(msg)
 
+        # Traces are streamed to the local files concurrently. 
+        # Traces from a previous, interrupted, release are resumed.
+        runner = ParallelRun(maxthreads = self.get("maxTransfers"))
+        runner.start()
+
         rms = self.get_connected()
         for rm in rms:
             fpath = os.path.join(self.store_path, "%d.%s" % (rm.guid, 
                  rename))
+            runner.put(self._retrieve_trace, rm, trace_name, fpath)
 
-            try:
-                result = self.ec.trace(rm.guid, trace_name)
-                f = open(fpath, "w")
-                f.write(result)
-                f.close()
-            except:
-                import traceback
-                err = traceback.format_exc()
-                msg = "Couldn't retrieve trace %s for %d at %s " % (trace_name, 
-                        rm.guid, fpath)
-                self.error(msg, out = "", err = err)
-                continue
+        runner.destroy()
 
         super(Collector, self).do_release()
 
+    def _retrieve_trace(self, rm, trace_name, fpath):
+        try:
+            self.ec.retrieve_trace(rm.guid, trace_name, fpath, 
+                    compress = self.get("compress"))
+        except:
+            import traceback
+            err = traceback.format_exc()
+            msg = "Couldn't retrieve trace %s for %d at %s " % (trace_name, 
+                    rm.guid, fpath)
+            self.error(msg, out = "", err = err)
+
     def valid_connection(self, guid):
         # TODO: Validate!
         return True
@@ -0,0 +1,265 @@
+#
+#    NEPI, a framework to manage network experiments
+#    Copyright (C) 2013 INRIA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Alina Quereilhac <alina.quereilhac@inria.fr>
+
+from nepi.util import sshfuncs
+from nepi.util.eventloop import Future
+from nepi.util.sshfuncs import ProcStatus
+
+import base64
+import cPickle
+import itertools
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import weakref
+
+class AgentProcess(object):
+    """ Stands for the process of a command executed by the agent,
+    so that results look like the ones of sshfuncs.rexec """
+    def __init__(self, returncode):
+        self.returncode = returncode
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        return self.returncode
+
+class LinuxAgent(object):
+    """ Long-lived command agent running on a LinuxNode.
+
+    The agent (scripts/linux-agent.py) is started once on the host over
+    a single ssh channel. Requests are written to its standard input and
+    replies are read from its standard output, so many operations can be
+    pipelined without starting a new ssh session and remote shell for
+    each one. Requests are processed concurrently on the host, and
+    replies are matched to requests by id.
+
+    All operations return a Future (see nepi.util.eventloop).
+
+    """
+    script = os.path.join(os.path.dirname(__file__), "scripts",
+            "linux-agent.py")
+
+    def __init__(self, node):
+        self._node = weakref.ref(node)
+        self._proc = None
+        self._stderr = None
+        self._write_lock = threading.Lock()
+        self._futures = dict()
+        self._futures_lock = threading.Lock()
+        self._seq = itertools.count()
+        self._reader = None
+
+    @property
+    def node(self):
+        return self._node()
+
+    @property
+    def running(self):
+        return self._proc is not None and self._proc.poll() is None
+
+    def start(self, timeout = 60):
+        """ Uploads and starts the agent on the host, and waits until it
+        replies. Raises RuntimeError if the agent can't be started """
+        node = self.node
+        self._stderr = tempfile.TemporaryFile()
+
+        if node.localhost:
+            self._proc = subprocess.Popen([sys.executable, "-u", self.script],
+                    stdin = subprocess.PIPE,
+                    stdout = subprocess.PIPE,
+                    stderr = self._stderr,
+                    close_fds = True)
+        else:
+            dst = os.path.join(node.bin_dir, os.path.basename(self.script))
+            node.upload(self.script, dst, overwrite = True)
+
+            self._proc = sshfuncs.rpopen(
+                    "python -u %s" % dst,
+                    host = node.get("hostname"),
+                    user = node.get("username"),
+                    port = node.get("port"),
+                    gwuser = node.get("gatewayUser"),
+                    gw = node.get("gateway"),
+                    agent = True,
+                    identity = node.get("identity"),
+                    server_key = node.get("serverKey"),
+                    stderr = self._stderr,
+                    strict_host_checking = False)
+
+        self._reader = threading.Thread(target = self._read)
+        self._reader.setDaemon(True)
+        self._reader.start()
+
+        try:
+            self.call("ping").result(timeout)
+        except:
+            self.stop()
+            msg = "Couldn't start agent on host %s - ERROR: %s" % (
+                    node.get("hostname"), self._read_stderr())
+            raise RuntimeError, msg
+
+    def stop(self):
+        """ Stops the agent. Pending requests fail """
+        proc = self._proc
+        if not proc:
+            return
+
+        try:
+            proc.stdin.close()
+        except:
+            pass
+
+        if self._reader and self._reader != threading.current_thread():
+            self._reader.join(5)
+
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+    def call(self, op, *args, **kwargs):
+        """ Sends a request to the agent. Returns a Future for the result
+
+        :param op: Operation (ping, execute, stat, read, write, pid_status)
+        :type op: str
+
+        :rtype: Future
+
+        """
+        future = Future()
+
+        msg_id = str(self._seq.next())
+        msg = "%s|%s\n" % (msg_id,
+                "|".join(map(self._encode, [op, args, kwargs])))
+
+        with self._futures_lock:
+            self._futures[msg_id] = future
+
+        try:
+            with self._write_lock:
+                self._proc.stdin.write(msg)
+                self._proc.stdin.flush()
+        except:
+            with self._futures_lock:
+                self._futures.pop(msg_id, None)
+            future.set_exc_info(sys.exc_info())
+
+        return future
+
+    def execute(self, command, sudo = False, env = None, stdin = None):
+        """ Executes a command on the host.
+        Returns a Future for the ((out, err), proc) result """
+        if sudo:
+            command = "sudo " + command
+
+        future = Future()
+
+        def done(f):
+            if f.exc_info():
+                future.set_exc_info(f.exc_info())
+                return
+
+            out, err, returncode = f.result()
+            future.set_result(((out, err), AgentProcess(returncode)))
+
+        self.call("execute", command, env = env,
+                stdin = stdin).add_done_callback(done)
+
+        return future
+
+    def stat(self, path):
+        """ Returns a Future for the (size, mtime, mode) tuple of a
+        remote file, or None if it doesn't exist """
+        return self.call("stat", path)
+
+    def read_file(self, path):
+        """ Returns a Future for the content of a remote file,
+        or None if it doesn't exist """
+        return self.call("read", path)
+
+    def write_file(self, path, data, mode = None):
+        """ Writes a remote file """
+        return self.call("write", path, data, mode = mode)
+
+    def pid_status(self, pid):
+        """ Returns a Future for the ProcStatus of a remote process """
+        future = Future()
+
+        def done(f):
+            if f.exc_info():
+                future.set_exc_info(f.exc_info())
+                return
+
+            future.set_result(ProcStatus.RUNNING if f.result() else
+                    ProcStatus.FINISHED)
+
+        self.call("pid_status", pid).add_done_callback(done)
+        return future
+
+    def _read(self):
+        while True:
+            line = self._proc.stdout.readline()
+            if not line:
+                break
+
+            msg_id, reply = line.strip().split("|", 1)
+
+            with self._futures_lock:
+                future = self._futures.pop(msg_id, None)
+
+            if not future:
+                continue
+
+            try:
+                ok, result = self._decode(reply)
+            except:
+                future.set_exc_info(sys.exc_info())
+                continue
+
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exc_info((RuntimeError,
+                    RuntimeError("Agent request failed: %s" % result), None))
+
+        # The channel was closed, fail the pending requests
+        with self._futures_lock:
+            futures = self._futures.values()
+            self._futures.clear()
+
+        for future in futures:
+            future.set_exc_info((RuntimeError,
+                RuntimeError("Agent channel closed"), None))
+
+    def _read_stderr(self):
+        if not self._stderr:
+            return ""
+
+        self._stderr.seek(0)
+        return self._stderr.read()
+
+    def _encode(self, item):
+        return base64.b64encode(cPickle.dumps(item))
+
+    def _decode(self, item):
+        return cPickle.loads(base64.b64decode(item))
+
@@ -22,6 +22,9 @@ from nepi.execution.trace import Trace, TraceAttr
 from nepi.execution.resource import ResourceManager, clsinit_copy, \
         ResourceState
 from nepi.resources.linux.node import LinuxNode
+from nepi.resources.linux.distribution import get_distributor
+from nepi.resources.linux.buildcache import get_build_cache
+from nepi.util import execfuncs
 from nepi.util.sshfuncs import ProcStatus
 from nepi.util.timefuncs import tnow, tdiffsec
 
@@ -31,6 +34,53 @@ import subprocess
 # TODO: Resolve wildcards in commands!!
 # TODO: When a failure occurs during deployment, scp and ssh processes are left running behind!!
 
+def read_trace(rm, node, home, name, attr = TraceAttr.ALL, block = 512, 
+        offset = 0):
+    """ Returns the trace 'name' of the RM 'rm', stored in the directory
+    'home' of the LinuxNode 'node', as requested by 'attr' (see 
+    ResourceManager.trace) """
+    rm.info("Retrieving '%s' trace %s " % (name, attr))
+
+    path = os.path.join(home, name)
+    
+    command = "(test -f %s && echo 'success') || echo 'error'" % path
+    (out, err), proc = node.execute(command)
+
+    if (err and proc.poll()) or out.find("error") != -1:
+        msg = " Couldn't find trace %s " % name
+        rm.error(msg, out, err)
+        return None
+
+    if attr == TraceAttr.PATH:
+        return path
+
+    if attr == TraceAttr.ALL:
+        (out, err), proc = node.check_output(home, name)
+        
+        if proc.poll():
+            msg = " Couldn't read trace %s " % name
+            rm.error(msg, out, err)
+            return None
+
+        return out
+
+    if attr == TraceAttr.STREAM:
+        cmd = "dd if=%s bs=%d count=1 skip=%d" % (path, block, offset)
+    elif attr == TraceAttr.SIZE:
+        cmd = "stat -c%%s %s " % path
+
+    (out, err), proc = node.execute(cmd)
+
+    if proc.poll():
+        msg = " Couldn't find trace %s " % name
+        rm.error(msg, out, err)
+        return None
+    
+    if attr == TraceAttr.SIZE:
+        out = int(out.strip())
+
+    return out
+
 @clsinit_copy
 class LinuxApplication(ResourceManager):
     """
@@ -106,6 +156,14 @@ class LinuxApplication(ResourceManager):
                 "Sources are globally available for all experiments unless "
                 "cleanHome is set to True (This will delete all sources). ",
                 flags = Flags.Design)
+        distribute_sources = Attribute("distributeSources", 
+                "Distribute local sources to the nodes in a tree. Nodes that "
+                "already received a source relay it to other nodes, instead "
+                "of every node getting it from the controller. Useful when "
+                "the same large sources go to many nodes. ",
+                type = Types.Bool,
+                default = False,
+                flags = Flags.Design)
         files = Attribute("files", 
                 "semi-colon separated list of regular miscellaneous files to be uploaded "
                 "to ${SHARE} directory. "
@@ -140,6 +198,13 @@ class LinuxApplication(ResourceManager):
                 "Commands to transfer built files to their final destinations. "
                 "Install commands are executed after build commands. ",
                 flags = Flags.Design)
+        cached_paths = Attribute("cachedPaths", 
+                "semi-colon separated list of directories produced by the "
+                "build and install commands (e.g. ${BIN}/my-app). "
+                "When set, the directories are archived in a build cache "
+                "after building, and restored instead of building on nodes "
+                "with the same OS and compiler. ",
+                flags = Flags.Design)
         stdin = Attribute("stdin", "Standard input for the 'command'", 
                 flags = Flags.Design)
         tear_down = Attribute("tearDown", "Command to be executed just before " 
@@ -152,12 +217,14 @@ class LinuxApplication(ResourceManager):
         cls._register_attribute(sudo)
         cls._register_attribute(depends)
         cls._register_attribute(sources)
+        cls._register_attribute(distribute_sources)
         cls._register_attribute(code)
         cls._register_attribute(files)
         cls._register_attribute(bins)
         cls._register_attribute(libs)
         cls._register_attribute(build)
         cls._register_attribute(install)
+        cls._register_attribute(cached_paths)
         cls._register_attribute(stdin)
         cls._register_attribute(tear_down)
 
@@ -189,6 +256,12 @@ class LinuxApplication(ResourceManager):
 
         # timestamp of last state check of the application
         self._last_state_check = tnow()
+
+        # uploads issued concurrently while provisioning asynchronously
+        self._uploads = None
+
+        # whether build and install were restored from the build cache
+        self._build_cached = False
         
     def log_message(self, msg):
         return " guid %d - host %s - %s " % (self.guid, 
@@ -240,68 +313,181 @@ class LinuxApplication(ResourceManager):
         return os.path.join(self.run_home, filename)
 
     def trace(self, name, attr = TraceAttr.ALL, block = 512, offset = 0):
-        self.info("Retrieving '%s' trace %s " % (name, attr))
-
-        path = self.trace_filepath(name)
-        
-        command = "(test -f %s && echo 'success') || echo 'error'" % path
-        (out, err), proc = self.node.execute(command)
-
-        if (err and proc.poll()) or out.find("error") != -1:
+        return read_trace(self, self.node, self.run_home, name, attr = attr,
+                block = block, offset = offset)
+
+    def retrieve_trace(self, name, path, compress = True):
+        """ Streams the trace file from the node to the local file 'path'
+        (see LinuxNode.fetch) """
+        remote_path = self.trace(name, attr = TraceAttr.PATH)
+        if not remote_path:
             msg = " Couldn't find trace %s " % name
-            self.error(msg, out, err)
-            return None
-    
-        if attr == TraceAttr.PATH:
-            return path
-
-        if attr == TraceAttr.ALL:
-            (out, err), proc = self.node.check_output(self.run_home, name)
-            
-            if proc.poll():
-                msg = " Couldn't read trace %s " % name
-                self.error(msg, out, err)
-                return None
-
-            return out
-
-        if attr == TraceAttr.STREAM:
-            cmd = "dd if=%s bs=%d count=1 skip=%d" % (path, block, offset)
-        elif attr == TraceAttr.SIZE:
-            cmd = "stat -c%%s %s " % path
+            raise RuntimeError, msg
 
-        (out, err), proc = self.node.execute(cmd)
+        self.info("Fetching '%s' trace to %s " % (name, path))
+        self.node.fetch(remote_path, path, compress = compress)
 
-        if proc.poll():
-            msg = " Couldn't find trace %s " % name
-            self.error(msg, out, err)
-            return None
-        
-        if attr == TraceAttr.SIZE:
-            out = int(out.strip())
-
-        return out
+    def follow_trace(self, name, offset = 0):
+        """ Follows the trace file with a single 'tail' process on the
+        node (see LinuxTraceFollower) """
+        return self.node.follow(self.trace_filepath(name), offset = offset)
 
     def do_provision(self):
         # take a snapshot of the system if user is root
         # to ensure that cleanProcess will not kill
         # pre-existent processes
         if self.node.get("username") == 'root':
-            import pickle
-            procs = dict()
-            ps_aux = "ps aux |awk '{print $2,$11}'"
-            (out, err), proc = self.node.execute(ps_aux)
-            if len(out) != 0:
-                for line in out.strip().split("\n"):
-                    parts = line.strip().split(" ")
-                    procs[parts[0]] = parts[1]
-                pickle.dump(procs, open("/tmp/save.proc", "wb"))
+            (out, err), proc = self.node.execute(self._ps_aux)
+            self._save_procs(out)
             
         # create run dir for application
         self.node.mkdir(self.run_home)
+
+        build_key = self.build_cache_key
+        if build_key:
+            self._build_cached = bool(get_build_cache().restore(self.node,
+                build_key))
    
+        command = []
+
+        # Since provisioning takes a long time, before
+        # each step we check that the EC is still 
+        for step in self._provision_steps:
+            if self.ec.abort:
+                self.debug("Interrupting provisioning. EC says 'ABORT")
+                return
+            
+            ret = step()
+            if ret:
+                command.append(ret)
+
+        # upload deploy script
+        deploy_command = ";".join(command)
+        self.execute_deploy_command(deploy_command)
+
+        if build_key and not self._build_cached:
+            get_build_cache().store(self.node, build_key, 
+                    self.build_cache_paths)
+
+        # upload start script
+        self.upload_start_command()
+       
+        self.info("Provisioning finished")
+
+        super(LinuxApplication, self).do_provision()
+
+    def do_provision_async(self):
+        """ Coroutine version of do_provision, used in 'async_deploy' mode.
+        Uploads are issued concurrently, and no thread is blocked while
+        waiting for remote operations. 
+
+        Subclasses overriding do_provision should also override this 
+        method, or provision synchronously.
+
+        """
+        if self.node.get("username") == 'root':
+            (out, err), proc = yield self.node.execute_async(self._ps_aux)
+            self._save_procs(out)
+
+        yield self.node.mkdir_async(self.run_home)
+
+        build_key = self.build_cache_key
+        if build_key:
+            source = yield get_build_cache().restore_async(self.node, 
+                    build_key)
+            self._build_cached = bool(source)
+
+        command = []
+
+        # Steps invoking _upload or _upload_command only queue the upload
+        self._uploads = []
+        try:
+            for step in self._provision_steps:
+                if self.ec.abort:
+                    self.debug("Interrupting provisioning. EC says 'ABORT")
+                    return
+                
+                ret = step()
+                if ret:
+                    command.append(ret)
+
+            self.upload_start_command()
+
+            uploads = self._uploads
+        finally:
+            self._uploads = None
+
+        yield uploads
+
+        deploy_command = ";".join(command)
+        if deploy_command:
+            args, kwargs = self._deploy_command_args(deploy_command)
+            yield self.node.run_and_wait_async(*args, **kwargs)
+
+        if build_key and not self._build_cached:
+            yield get_build_cache().store_async(self.node, build_key,
+                    self.build_cache_paths)
+
+        self.info("Provisioning finished")
+
+        super(LinuxApplication, self).do_provision()
+
+    @property
+    def build_cache_paths(self):
+        """ Directories, with actual paths, to store in the build cache """
+        paths = self.get("cachedPaths")
+        if not paths:
+            return []
+
+        paths = filter(None, map(str.strip, paths.split(";")))
+        return map(self.replace_paths, paths)
+
+    @property
+    def build_cache_name(self):
+        """ Human readable name for the build cache entry """
+        paths = self.get("cachedPaths").split(";")
+        return os.path.basename(paths[0].strip().rstrip("/")) or "build"
+
+    @property
+    def build_cache_key(self):
+        """ Key of the build in the build cache, or None if the build
+        should not be cached. The key covers the build and install
+        commands, the dependencies and the content of local sources """
+        if not self.get("cachedPaths") or not (self.get("build") or 
+                self.get("install")):
+            return None
+
+        sources = []
+        for source in (self.get("sources") or "").split(";"):
+            source = source.strip()
+            if os.path.isfile(source):
+                source = execfuncs.ldigest(source)
+            sources.append(source)
+
+        return get_build_cache().key(self.node, self.build_cache_name,
+                self.get("build"), 
+                self.get("install"),
+                self.get("depends"),
+                ";".join(sources),
+                self.get("cachedPaths"))
+
+    @property
+    def _ps_aux(self):
+        return "ps aux |awk '{print $2,$11}'"
+
+    def _save_procs(self, out):
+        if len(out) != 0:
+            import pickle
+            procs = dict()
+            for line in out.strip().split("\n"):
+                parts = line.strip().split(" ")
+                procs[parts[0]] = parts[1]
+            pickle.dump(procs, open("/tmp/save.proc", "wb"))
+
+    @property
+    def _provision_steps(self):
         # List of all the provision methods to invoke
-        steps = [
+        return [
             # upload sources
             self.upload_sources,
             # upload files
@@ -321,29 +507,41 @@ class LinuxApplication(ResourceManager):
             # Install
             self.install]
 
-        command = []
+    def _upload(self, src, dst, **kwargs):
+        """ Uploads files to the node. While provisioning asynchronously 
+        the upload is only queued, to be performed concurrently with the
+        other uploads.
+        
+        """
+        if self._uploads is not None:
+            self._uploads.append(self.node.upload_async(src, dst, **kwargs))
+            return
 
-        # Since provisioning takes a long time, before
-        # each step we check that the EC is still 
-        for step in steps:
-            if self.ec.abort:
-                self.debug("Interrupting provisioning. EC says 'ABORT")
-                return
-            
-            ret = step()
-            if ret:
-                command.append(ret)
+        return self.node.upload(src, dst, **kwargs)
 
-        # upload deploy script
-        deploy_command = ";".join(command)
-        self.execute_deploy_command(deploy_command)
+    def _distribute(self, src, dst):
+        """ Copies a local file to the dst directory on the node, 
+        relaying it through the nodes that already received it 
+        (see nepi.resources.linux.distribution). While provisioning 
+        asynchronously the transfer is only queued, as in _upload.
 
-        # upload start script
-        self.upload_start_command()
-       
-        self.info("Provisioning finished")
+        """
+        distributor = get_distributor(src)
 
-        super(LinuxApplication, self).do_provision()
+        if self._uploads is not None:
+            self._uploads.append(distributor.distribute_async(self.node, dst))
+            return
+
+        return distributor.distribute(self.node, dst)
+
+    def _upload_command(self, command, **kwargs):
+        """ Uploads a command script to the node. See _upload """
+        if self._uploads is not None:
+            self._uploads.append(self.node.upload_command_async(command, 
+                **kwargs))
+            return
+
+        return self.node.upload_command(command, **kwargs)
 
     def upload_start_command(self, overwrite = False):
         # Upload command to remote bash script
@@ -362,31 +560,32 @@ class LinuxApplication(ResourceManager):
 
             shfile = os.path.join(self.app_home, "start.sh")
 
-            self.node.upload_command(command, 
+            self._upload_command(command, 
                     shfile = shfile,
                     env = env,
                     overwrite = overwrite)
 
     def execute_deploy_command(self, command, prefix="deploy"):
         if command:
-            # replace application specific paths in the command
-            command = self.replace_paths(command)
-            
-            # replace application specific paths in the environment
-            env = self.get("env")
-            env = env and self.replace_paths(env)
-
             # Upload the command to a bash script and run it
             # in background ( but wait until the command has
             # finished to continue )
-            shfile = os.path.join(self.app_home, "%s.sh" % prefix)
-            self.node.run_and_wait(command, self.run_home,
-                    shfile = shfile, 
-                    overwrite = False,
-                    pidfile = "%s_pidfile" % prefix, 
-                    ecodefile = "%s_exitcode" % prefix, 
-                    stdout = "%s_stdout" % prefix, 
-                    stderr = "%s_stderr" % prefix)
+            args, kwargs = self._deploy_command_args(command, prefix)
+            self.node.run_and_wait(*args, **kwargs)
+
+    def _deploy_command_args(self, command, prefix="deploy"):
+        # replace application specific paths in the command
+        command = self.replace_paths(command)
+        
+        shfile = os.path.join(self.app_home, "%s.sh" % prefix)
+
+        return (command, self.run_home), dict(
+                shfile = shfile, 
+                overwrite = False,
+                pidfile = "%s_pidfile" % prefix, 
+                ecodefile = "%s_exitcode" % prefix, 
+                stdout = "%s_stdout" % prefix, 
+                stderr = "%s_stderr" % prefix)
 
     def upload_sources(self, sources = None, src_dir = None):
         if not sources:
@@ -430,9 +629,14 @@ class LinuxApplication(ResourceManager):
             # replace application specific paths in the command
             command = self.replace_paths(command)
        
+            if sources and self.get("distributeSources"):
+                for source in filter(os.path.isfile, sources):
+                    sources.remove(source)
+                    self._distribute(source, src_dir)
+
             if sources:
                 sources = ';'.join(sources)
-                self.node.upload(sources, src_dir, overwrite = False)
+                self._upload(sources, src_dir, overwrite = False)
 
         return command
 
@@ -442,7 +646,7 @@ class LinuxApplication(ResourceManager):
 
         if files:
             self.info("Uploading files %s " % files)
-            self.node.upload(files, self.node.share_dir, overwrite = False)
+            self._upload(files, self.node.share_dir, overwrite = False)
 
     def upload_libraries(self, libs = None):
         if not libs:
@@ -450,7 +654,7 @@ class LinuxApplication(ResourceManager):
 
         if libs:
             self.info("Uploading libraries %s " % libaries)
-            self.node.upload(libs, self.node.lib_dir, overwrite = False)
+            self._upload(libs, self.node.lib_dir, overwrite = False)
 
     def upload_binaries(self, bins = None):
         if not bins:
@@ -458,7 +662,7 @@ class LinuxApplication(ResourceManager):
 
         if bins:
             self.info("Uploading binaries %s " % binaries)
-            self.node.upload(bins, self.node.bin_dir, overwrite = False)
+            self._upload(bins, self.node.bin_dir, overwrite = False)
 
     def upload_code(self, code = None):
         if not code:
@@ -468,7 +672,7 @@ class LinuxApplication(ResourceManager):
             self.info("Uploading code")
 
             dst = os.path.join(self.app_home, "code")
-            self.node.upload(code, dst, overwrite = False, text = True)
+            self._upload(code, dst, overwrite = False, text = True)
 
     def upload_stdin(self, stdin = None):
         if not stdin:
@@ -485,7 +689,7 @@ class LinuxApplication(ResourceManager):
             else:
                 dst = os.path.join(self.app_home, "stdin")
 
-            self.node.upload(stdin, dst, overwrite = False, text = True)
+            self._upload(stdin, dst, overwrite = False, text = True)
 
             # create "stdin" symlink on ${APP_HOME} directory
             command = "( cd %(app_home)s ; [ ! -f stdin ] &&  ln -s %(stdin)s stdin )" % ({
@@ -504,6 +708,10 @@ class LinuxApplication(ResourceManager):
 
     def build(self, build = None):
         if not build:
+            if self._build_cached:
+                self.info("Build restored from cache ")
+                return None
+
             build = self.get("build")
 
         if build:
@@ -514,6 +722,9 @@ class LinuxApplication(ResourceManager):
 
     def install(self, install = None):
         if not install:
+            if self._build_cached:
+                return None
+
             install = self.get("install")
 
         if install:
@@ -532,9 +743,21 @@ class LinuxApplication(ResourceManager):
             command = self.get("command") or ""
             self.info("Deploying command '%s' " % command)
             self.do_discover()
+
+            if self.ec.async_deploy:
+                self.run_coroutine(self._do_deploy_async())
+                return
+
             self.do_provision()
 
             super(LinuxApplication, self).do_deploy()
+
+    def _do_deploy_async(self):
+        yield self.do_provision_async()
+
+        # Provisioning might have been interrupted
+        if self.state == ResourceState.PROVISIONED:
+            super(LinuxApplication, self).do_deploy()
    
     def do_start(self):
         command = self.get("command")
@@ -0,0 +1,269 @@
+#
+#    NEPI, a framework to manage network experiments
+#    Copyright (C) 2013 INRIA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Alina Quereilhac <alina.quereilhac@inria.fr>
+
+from nepi.util import execfuncs
+from nepi.util.eventloop import Return, run_coroutine
+from nepi.resources.linux.distribution import can_relay, relay_async
+
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import weakref
+
+class BuildCache(object):
+    """ Cache of built trees (e.g. an ns-3 installation), stored as
+    tarballs so a build is done only once per platform.
+
+    Entries are identified by a key computed from a description of the
+    build (repository, version, build commands, ...) and from the OS and
+    the compiler version of the node.
+
+    Before building on a node, an entry is looked up:
+        1. on the node itself, under ${NEPI_HOME}/build-cache,
+        2. on the other nodes that stored the same entry during this
+           experiment (copied with scp from that node, as relays in
+           nepi.resources.linux.distribution),
+        3. in the controller store (~/.nepi/build-cache, or the
+           directory in the NEPI_BUILD_CACHE environment variable).
+
+    Trees are stored with paths relative to the ${USR} directory of the
+    node, so they can be restored under a different home directory.
+
+    """
+    def __init__(self, store_dir = None):
+        if not store_dir:
+            store_dir = os.environ.get("NEPI_BUILD_CACHE") or \
+                    os.path.join(os.path.expanduser("~"), ".nepi",
+                            "build-cache")
+
+        self._store_dir = store_dir
+
+        # nodes that hold an entry { key: { node ref: (path, digest) } }
+        self._peers = dict()
+        # compiler version of each node
+        self._compilers = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @property
+    def store_dir(self):
+        return self._store_dir
+
+    def key(self, node, prefix, *parts):
+        """ Returns the key of a build on the node.
+
+        'prefix' is a human readable name for the entry (e.g. ns-3.20),
+        and 'parts' are strings describing the build.
+
+        """
+        md5 = hashlib.md5()
+        for part in parts + (node.os, self._compiler(node)):
+            md5.update(str(part))
+            md5.update("\0")
+
+        prefix = re.sub(r"[^\w.-]", "_", prefix)
+        return "%s-%s" % (prefix, md5.hexdigest())
+
+    def archive_path(self, node, key):
+        return os.path.join(node.nepi_home, "build-cache", "%s.tar.gz" % key)
+
+    def restore(self, node, key):
+        """ Extracts the entry under the ${USR} directory of the node.
+        Returns the place it was found ("node", a peer hostname or
+        "controller"), or None if the entry is not cached """
+        return run_coroutine(self.restore_async(node, key)).result()
+
+    def store(self, node, key, paths):
+        """ Archives the directories in 'paths', built on the node, and
+        keeps a copy in the controller store. Returns True on success """
+        return run_coroutine(self.store_async(node, key, paths)).result()
+
+    def restore_async(self, node, key):
+        """ Coroutine version of 'restore' """
+        path = self.archive_path(node, key)
+        source = None
+
+        digest = yield self._remote_digest_async(node, path)
+        if digest:
+            source = "node"
+        else:
+            source = yield self._fetch_async(node, key, path)
+
+        if not source:
+            raise Return(None)
+
+        (out, err), proc = yield node.execute_async("tar xzf %s -C %s" % (
+            path, node.usr_dir))
+
+        if proc.poll():
+            node.warning("Failed to extract cached build %s" % key, out, err)
+            raise Return(None)
+
+        yield self._add_peer_async(node, key, path)
+
+        node.info("Restored build %s from %s cache" % (key, source))
+        raise Return(source)
+
+    def store_async(self, node, key, paths):
+        """ Coroutine version of 'store' """
+        usr_dir = node.usr_dir
+        relpaths = []
+        for path in paths:
+            relpath = os.path.relpath(path, usr_dir)
+            if relpath.startswith(".."):
+                node.warning("Can't cache %s, not under %s" % (path, usr_dir))
+                raise Return(False)
+            relpaths.append(relpath)
+
+        path = self.archive_path(node, key)
+
+        # Create the archive under a temporary name so an incomplete
+        # archive is never restored
+        (out, err), proc = yield node.execute_async(
+                "mkdir -p %(dir)s && "
+                "tar czf %(path)s.tmp -C %(usr_dir)s %(relpaths)s && "
+                "mv %(path)s.tmp %(path)s" % {
+                    "dir": os.path.dirname(path),
+                    "path": path,
+                    "usr_dir": usr_dir,
+                    "relpaths": " ".join(relpaths)
+                    })
+
+        if proc.poll():
+            node.warning("Failed to archive build %s" % key, out, err)
+            raise Return(False)
+
+        digest = yield self._add_peer_async(node, key, path)
+
+        local_path = os.path.join(self._store_dir, "%s.tar.gz" % key)
+        if not os.path.exists(local_path):
+            if not os.path.exists(self._store_dir):
+                os.makedirs(self._store_dir)
+
+            # Download under a temporary name, concurrent builds might
+            # store the same entry
+            fd, tmp_path = tempfile.mkstemp(suffix = ".tmp", 
+                    prefix = "%s." % key, dir = self._store_dir)
+            os.close(fd)
+
+            (out, err), proc = yield node.download_async(path, tmp_path,
+                    raise_on_error = False)
+
+            stored = False
+            if not proc.poll():
+                local_digest = yield execfuncs.ldigest_async(tmp_path)
+                stored = local_digest == digest
+
+            if not stored:
+                node.warning("Failed to store build %s in the controller "
+                        "cache" % key, out, err)
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            else:
+                os.rename(tmp_path, local_path)
+
+            execfuncs.forget_digest(tmp_path)
+
+        node.info("Stored build %s in cache" % key)
+        raise Return(True)
+
+    def _fetch_async(self, node, key, path):
+        """ Copies the archive to the node from a peer or from the
+        controller store """
+        yield node.mkdir_async(os.path.dirname(path))
+
+        if can_relay(node):
+            for peer, peer_path, digest in self._get_peers(key):
+                if peer is node or not can_relay(peer):
+                    continue
+
+                hostname = peer.get("hostname")
+                relayed = yield relay_async(peer, peer_path, node, path)
+                if relayed:
+                    remote_digest = yield self._remote_digest_async(node, 
+                            path)
+                    if remote_digest == digest:
+                        raise Return(hostname)
+
+                node.warning("Failed to copy cached build %s from %s" % (
+                    key, hostname))
+
+        local_path = os.path.join(self._store_dir, "%s.tar.gz" % key)
+        if os.path.exists(local_path):
+            yield node.upload_async(local_path, path)
+
+            remote_digest = yield self._remote_digest_async(node, path)
+            local_digest = yield execfuncs.ldigest_async(local_path)
+            if remote_digest == local_digest:
+                raise Return("controller")
+
+            node.warning("Checksum of cached build %s does not match "
+                    "after upload" % key)
+
+        raise Return(None)
+
+    def _add_peer_async(self, node, key, path):
+        digest = yield self._remote_digest_async(node, path)
+
+        with self._lock:
+            peers = self._peers.setdefault(key, dict())
+            peers[weakref.ref(node)] = (path, digest)
+
+        raise Return(digest)
+
+    def _get_peers(self, key):
+        with self._lock:
+            peers = self._peers.get(key, dict())
+            return [(ref(), path, digest)
+                    for ref, (path, digest) in peers.iteritems() if ref()]
+
+    def _remote_digest_async(self, node, path):
+        (out, err), proc = yield node.execute_async("md5sum < %s" % path, 
+                retry = 1)
+        if proc.poll():
+            raise Return(None)
+        raise Return(out.strip().split(" ")[0])
+
+    def _compiler(self, node):
+        with self._lock:
+            compiler = self._compilers.get(node)
+
+        if compiler is None:
+            (out, err), proc = node.execute(
+                    "gcc -dumpversion 2>/dev/null || echo none", retry = 1)
+            compiler = "gcc-%s" % out.strip()
+
+            with self._lock:
+                self._compilers[node] = compiler
+
+        return compiler
+
+_build_cache = None
+_build_cache_lock = threading.Lock()
+
+def get_build_cache():
+    """ Returns the BuildCache shared by all the resources """
+    global _build_cache
+
+    with _build_cache_lock:
+        if not _build_cache:
+            _build_cache = BuildCache()
+
+    return _build_cache
@@ -0,0 +1,329 @@
+#
+#    NEPI, a framework to manage network experiments
+#    Copyright (C) 2013 INRIA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Alina Quereilhac <alina.quereilhac@inria.fr>
+
+from nepi.util import execfuncs
+from nepi.util.eventloop import Future, Return, done_future
+
+import os
+import threading
+import time
+import weakref
+
+def can_relay(node):
+    """ True if the node can send and receive files from other nodes """
+    return not node.localhost and not node.get("gateway")
+
+def _relay_command(holder_path, node, path):
+    port = node.get("port")
+    return ("scp -q -o StrictHostKeyChecking=no -o BatchMode=yes "
+            "%(port)s %(src)s %(user)s@%(host)s:%(dst)s") % {
+                "port": "-P %d" % port if port else "",
+                "src": holder_path,
+                "user": node.get("username"),
+                "host": node.get("hostname"),
+                "dst": path
+                }
+
+def relay(holder, holder_path, node, path):
+    """ Copies a file from a node that has it (the holder) to another
+    node, with scp executed on the holder. Requires ssh agent forwarding.
+    Returns True if the copy succeeded """
+    command = _relay_command(holder_path, node, path)
+    (out, err), proc = holder.execute(command)
+    return proc.poll() == 0
+
+def relay_async(holder, holder_path, node, path):
+    """ Coroutine version of 'relay' """
+    command = _relay_command(holder_path, node, path)
+    (out, err), proc = yield holder.execute_async(command)
+    raise Return(proc.poll() == 0)
+
+# Maximum number of concurrent transfers served by the controller
+# and by each node
+DEFAULT_FANOUT = 4
+
+class ArtifactDistributor(object):
+    """ Distributes a local file (e.g. a sources tarball) to many
+    LinuxNodes.
+
+    The controller uploads the file to at most 'fanout' nodes at a time.
+    Nodes that already received the file relay it to other nodes, each
+    one serving at most 'fanout' nodes at a time, so the file spreads
+    as a tree and the uplink of the controller is not the bottleneck.
+
+    Relays are done with scp, executed on the relaying node. They rely
+    on ssh agent forwarding, so nodes must accept the same credentials.
+    Nodes behind a gateway and localhost always get the file from the
+    controller.
+
+    Every copy is verified against the md5 digest of the local file.
+    If a relay fails, the file is uploaded from the controller.
+
+    """
+    def __init__(self, path, fanout = DEFAULT_FANOUT):
+        self._path = path
+        self._name = os.path.basename(path)
+        self._digest = execfuncs.ldigest(path)
+        self._fanout = fanout
+
+        # nodes that have the file { node ref: remote path }
+        self._holders = dict()
+        # number of transfers served by each holder (None = controller)
+        self._serving = dict({None: 0})
+        self._cond = threading.Condition()
+        # coroutines waiting for a source [ (node, Future) ]
+        self._waiters = []
+
+        # (source, target, seconds) of each transfer
+        self._hops = []
+        # nodes the file was requested for
+        self._requested = set()
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def digest(self):
+        return self._digest
+
+    @property
+    def hops(self):
+        """ List of (source, target, seconds) tuples for each transfer.
+        The source is None when the file came from the controller """
+        with self._cond:
+            return list(self._hops)
+
+    def distribute(self, node, dst):
+        """ Copies the file to the directory dst on the node.
+        Blocks until the file is on the node and was verified.
+
+        :rtype: Hostname of the node the file came from, or None if it
+            came from the controller
+
+        """
+        path = os.path.join(dst, self._name)
+
+        with self._cond:
+            self._requested.add(weakref.ref(node))
+
+        # The node might have the file already
+        if self._verify(node, path):
+            self._add_holder(node, path, None, None)
+            return None
+
+        source = acquired = self._acquire_source(node)
+        start = time.time()
+
+        try:
+            if source:
+                (holder, holder_path) = source
+                if not (relay(holder, holder_path, node, path) and
+                        self._verify(node, path)):
+                    node.warning("Relay of %s from %s failed, uploading "
+                            "from the controller" % (self._name,
+                                holder.get("hostname")))
+                    source = None
+
+            if not source:
+                node.upload(self._path, path)
+
+                if not self._verify(node, path):
+                    msg = "Checksum of %s does not match after upload" % path
+                    node.error(msg)
+                    raise RuntimeError, msg
+
+            # The node becomes a holder before the source is released,
+            # so the nodes waiting for a source can get it from the node
+            hostname = source[0].get("hostname") if source else None
+            self._add_holder(node, path, hostname, time.time() - start)
+        finally:
+            self._release_source(acquired)
+
+        return hostname
+
+    def distribute_async(self, node, dst):
+        """ Coroutine version of 'distribute' """
+        path = os.path.join(dst, self._name)
+
+        with self._cond:
+            self._requested.add(weakref.ref(node))
+
+        # The node might have the file already
+        verified = yield self._verify_async(node, path)
+        if verified:
+            self._add_holder(node, path, None, None)
+            raise Return(None)
+
+        source = acquired = yield self._acquire_source_async(node)
+        start = time.time()
+
+        try:
+            if source:
+                (holder, holder_path) = source
+                verified = yield relay_async(holder, holder_path, node, path)
+                if verified:
+                    verified = yield self._verify_async(node, path)
+
+                if not verified:
+                    node.warning("Relay of %s from %s failed, uploading "
+                            "from the controller" % (self._name,
+                                holder.get("hostname")))
+                    source = None
+
+            if not source:
+                yield node.upload_async(self._path, path)
+
+                verified = yield self._verify_async(node, path)
+                if not verified:
+                    msg = "Checksum of %s does not match after upload" % path
+                    node.error(msg)
+                    raise RuntimeError, msg
+
+            hostname = source[0].get("hostname") if source else None
+            self._add_holder(node, path, hostname, time.time() - start)
+        finally:
+            self._release_source(acquired)
+
+        raise Return(hostname)
+
+    def _acquire_source(self, node):
+        """ Waits until the controller or a node that has the file can
+        serve one more transfer. Returns None for the controller, or the
+        (node, path) of the relaying node """
+        with self._cond:
+            while True:
+                (acquired, source) = self._try_acquire(node)
+                if acquired:
+                    return source
+
+                self._cond.wait(1)
+
+    def _acquire_source_async(self, node):
+        """ Same as '_acquire_source' but without blocking.
+        Returns a Future for the source """
+        with self._cond:
+            (acquired, source) = self._try_acquire(node)
+            if acquired:
+                return done_future(source)
+
+            future = Future()
+            self._waiters.append((node, future))
+            return future
+
+    def _try_acquire(self, node):
+        """ Returns (True, source) if the controller or a holder can 
+        serve one more transfer to node, and (False, None) otherwise. 
+        Must be invoked with the lock held """
+        if can_relay(node):
+            holders = [(self._serving.get(ref, 0), ref, path)
+                    for ref, path in self._holders.iteritems()
+                    if ref() and can_relay(ref())]
+            holders.sort()
+
+            if holders and holders[0][0] < self._fanout:
+                (serving, ref, path) = holders[0]
+                self._serving[ref] = serving + 1
+                return (True, (ref(), path))
+
+        if self._serving[None] < self._fanout:
+            self._serving[None] += 1
+            return (True, None)
+
+        return (False, None)
+
+    def _wake_waiters(self):
+        """ Gives the sources that became available to the waiting 
+        coroutines, in order """
+        ready = []
+
+        with self._cond:
+            waiters = []
+            for (node, future) in self._waiters:
+                (acquired, source) = self._try_acquire(node)
+                if acquired:
+                    ready.append((future, source))
+                else:
+                    waiters.append((node, future))
+
+            self._waiters = waiters
+            self._cond.notifyAll()
+
+        # Resume the coroutines without holding the lock
+        for (future, source) in ready:
+            future.set_result(source)
+
+    def _release_source(self, source):
+        with self._cond:
+            if source:
+                ref = weakref.ref(source[0])
+                self._serving[ref] = self._serving.get(ref, 1) - 1
+            else:
+                self._serving[None] -= 1
+
+        self._wake_waiters()
+
+    def _add_holder(self, node, path, source, seconds):
+        with self._cond:
+            self._holders[weakref.ref(node)] = path
+
+            if seconds is not None:
+                self._hops.append((source, node.get("hostname"), seconds))
+
+            done = len(self._holders)
+            requested = len(self._requested)
+
+        # The new holder might relay the file to waiting nodes
+        self._wake_waiters()
+
+        if seconds is None:
+            node.info("Already had %s ( %d/%d nodes )" % (
+                self._name, done, requested))
+        else:
+            node.info("Received %s from %s in %.2f s ( %d/%d nodes )" % (
+                self._name, source or "controller", seconds, done, 
+                requested))
+
+    def _verify(self, node, path):
+        (out, err), proc = node.execute("md5sum < %s" % path, retry = 1)
+        return out.strip().startswith(self._digest)
+
+    def _verify_async(self, node, path):
+        """ Coroutine version of '_verify' """
+        (out, err), proc = yield node.execute_async("md5sum < %s" % path, 
+                retry = 1)
+        raise Return(out.strip().startswith(self._digest))
+
+# distributors by file { (path, digest): ArtifactDistributor }
+_distributors = dict()
+_distributors_lock = threading.Lock()
+
+def get_distributor(path, fanout = DEFAULT_FANOUT):
+    """ Returns the ArtifactDistributor for the current content of the
+    local file path """
+    path = os.path.abspath(path)
+    key = (path, execfuncs.ldigest(path))
+
+    with _distributors_lock:
+        distributor = _distributors.get(key)
+        if not distributor:
+            distributor = ArtifactDistributor(path, fanout = fanout)
+            _distributors[key] = distributor
+
+    return distributor
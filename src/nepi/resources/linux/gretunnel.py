@@ -34,6 +34,22 @@ class LinuxGRETunnel(LinuxTunnel):
     _help = "Constructs a tunnel between two Linux endpoints using a UDP connection "
     _backend = "linux"
 
+    @classmethod
+    def _register_attributes(cls):
+        stats_interval = Attribute("statsInterval",
+                "Seconds between two samples of the traffic counters, "
+                "when the stats1 or stats2 traces are enabled. ",
+                default = 1.0,
+                type = Types.Double, 
+                flags = Flags.Design)
+
+        cls._register_attribute(stats_interval)
+
+    def __init__(self, ec, guid):
+        super(LinuxGRETunnel, self).__init__(ec, guid)
+        # pid and ppid of the stats sampler on each endpoint
+        self._stats_pids = dict()
+
     def log_message(self, msg):
         return " guid %d - GRE tunnel %s - %s - %s " % (self.guid, 
                 self.endpoint1.node.get("hostname"), 
@@ -58,8 +74,44 @@ class LinuxGRETunnel(LinuxTunnel):
         data = endpoint.gre_connect(remote_endpoint, 
                 connection_app_home,
                 connection_run_home) 
+
+        stats = self.stats_filepath(endpoint)
+        if stats:
+            self.start_stats(endpoint, stats)
+
         return data
 
+    def start_stats(self, endpoint, stats):
+        """ Samples the counters of the GRE device of the endpoint into 
+        the 'stats' file, until the device is removed.
+
+        GRE packets are forwarded by the kernel, so the counters are the 
+        ones of the device, from /sys/class/net/<dev>/statistics.
+        """
+        columns = ["rx_packets", "rx_bytes", "rx_dropped", 
+                "tx_packets", "tx_bytes", "tx_dropped"]
+        sysfs = "/sys/class/net/%s/statistics" % endpoint.get("deviceName")
+        sample = " ".join(["$(cat %s/%s)" % (sysfs, column) 
+            for column in columns])
+
+        command = []
+        command.append("echo '# time %s' >> %s" % (" ".join(columns), stats))
+        command.append("while test -d %s ; do "
+                "echo $(date +%%s.%%N) %s >> %s ; sleep %s ; done" % (
+                    sysfs, sample, stats, self.get("statsInterval")))
+        command = " ; ".join(command)
+
+        run_home = self.run_home(endpoint)
+        endpoint.node.run(command, run_home, 
+                pidfile = "stats_pidfile",
+                stdout = "stats_stdout", 
+                stderr = "stats_stderr")
+
+        pid, ppid = endpoint.node.wait_pid(run_home, 
+                pidfile = "stats_pidfile")
+        if pid and ppid:
+            self._stats_pids[endpoint.guid] = (pid, ppid)
+
     def establish_connection(self, endpoint, remote_endpoint, data):
         pass
 
@@ -77,7 +129,10 @@ class LinuxGRETunnel(LinuxTunnel):
              raise RuntimeError, msg
 
     def terminate_connection(self, endpoint, remote_endpoint):
-        pass
+        pids = self._stats_pids.pop(endpoint.guid, None)
+        if pids:
+            pid, ppid = pids
+            endpoint.node.kill(pid, ppid)
 
     def check_state_connection(self):
         pass
@@ -18,21 +18,28 @@
 # Author: Alina Quereilhac <alina.quereilhac@inria.fr>
 
 from nepi.execution.attribute import Attribute, Flags, Types
+from nepi.execution.trace import TraceFollower
 from nepi.execution.resource import ResourceManager, clsinit_copy, \
         ResourceState
 from nepi.resources.linux import rpmfuncs, debfuncs 
-from nepi.util import sshfuncs, execfuncs
+from nepi.resources.linux.agent import LinuxAgent, AgentProcess
+from nepi.util import sshfuncs, execfuncs, eventloop
+from nepi.util.eventloop import Return
 from nepi.util.sshfuncs import ProcStatus
 
 import collections
+import hashlib
 import os
+import pipes
 import random
 import re
 import socket
+import subprocess
 import tempfile
 import time
 import threading
 import traceback
+import zlib
 
 # TODO: Unify delays!!
 # TODO: Validate outcome of uploads!! 
@@ -58,6 +65,81 @@ class OSType:
     UBUNTU = "ubuntu"
     DEBIAN = "debian"
 
+class LinuxTraceFollower(TraceFollower):
+    """ Follows a file on a LinuxNode with a single 'tail -F' process,
+    through one ssh channel for remote nodes. Appended content is read 
+    as soon as it is available, in blocks of up to 64 KB """
+
+    def __init__(self, node, path, offset = 0):
+        super(LinuxTraceFollower, self).__init__(offset)
+
+        self._node = node
+        self._pid = None
+        self._stderr = None
+
+        # -F keeps following the file if it doesn't exist yet or is
+        # recreated
+        command = "exec tail -c +%d -F %s 2>/dev/null" % (offset + 1, path)
+
+        if node.localhost:
+            self._proc = subprocess.Popen(command, 
+                    shell = True,
+                    stdout = subprocess.PIPE,
+                    close_fds = True)
+        else:
+            # The remote tail doesn't notice when the ssh channel is
+            # closed, so its pid is printed first to kill it on _close
+            command = "echo $$ ; " + command
+            self._stderr = open(os.devnull, "w")
+            self._proc = sshfuncs.rpopen(command,
+                    host = node.get("hostname"),
+                    user = node.get("username"),
+                    port = node.get("port"),
+                    gwuser = node.get("gatewayUser"),
+                    gw = node.get("gateway"),
+                    agent = False,
+                    identity = node.get("identity"),
+                    server_key = node.get("serverKey"),
+                    stderr = self._stderr,
+                    strict_host_checking = False)
+            self._proc.stdin.close()
+            self._pid = self._read_pid()
+
+    def _read_pid(self):
+        line = ""
+        while not line.endswith("\n"):
+            try:
+                c = os.read(self._proc.stdout.fileno(), 1)
+            except OSError:
+                c = ""
+            if not c:
+                return None
+            line += c
+
+        try:
+            return int(line)
+        except ValueError:
+            return None
+
+    def _read(self):
+        try:
+            return os.read(self._proc.stdout.fileno(), 1 << 16)
+        except OSError:
+            return ""
+
+    def _close(self):
+        if self._pid:
+            self._node.execute("kill %d" % self._pid)
+            self._pid = None
+
+        if self._proc.poll() is None:
+            self._proc.kill()
+        self._proc.wait()
+
+        if self._stderr:
+            self._stderr.close()
+            self._stderr = None
+
 @clsinit_copy
 class LinuxNode(ResourceManager):
     """
@@ -141,6 +223,25 @@ class LinuxNode(ResourceManager):
                     the command has finished. (e.g. Package installation,
                     source compilation, file download, etc)
 
+        The methods with the '_async' suffix (e.g. 'execute_async',
+        'upload_async', 'run_and_wait_async') perform the same operations
+        without blocking the calling thread. They return either a Future 
+        or a coroutine to be yielded from another coroutine 
+        (see nepi.util.eventloop). They are used to provision the node
+        when the ExperimentController runs in 'async_deploy' mode.
+
+        When the 'useAgent' attribute is set, a long-lived command agent
+        is started on the host during provisioning (see 
+        nepi.resources.linux.agent). 'execute', 'run', 'getpid', 'status',
+        'kill' and text uploads are then sent to the agent over a single
+        ssh channel, instead of opening a new ssh session for each of them.
+
+        'upload' only copies the files whose content differs from the 
+        content already on the host. The md5 digests of the local files 
+        are compared with the digests computed on the host, and the 
+        digests of the files uploaded are kept in a per-node manifest, 
+        so files known to be up to date are not checked again.
+
     """
     _rtype = "linux::Node"
     _help = "Controls Linux host machines ( either localhost or a host " \
@@ -199,6 +300,13 @@ class LinuxNode(ResourceManager):
                    "Must not be modified by the user unless hostname is 'localhost'",
                     flags = Flags.Design)
 
+        use_agent = Attribute("useAgent", "Start a long-lived command agent "
+                "on the host, and send commands to it over a single ssh "
+                "channel instead of opening a new ssh session per command",
+                type = Types.Bool,
+                default = False,
+                flags = Flags.Design)
+
         cls._register_attribute(hostname)
         cls._register_attribute(username)
         cls._register_attribute(port)
@@ -212,6 +320,7 @@ class LinuxNode(ResourceManager):
         cls._register_attribute(gateway_user)
         cls._register_attribute(gateway)
         cls._register_attribute(ip)
+        cls._register_attribute(use_agent)
 
     def __init__(self, ec, guid):
         super(LinuxNode, self).__init__(ec, guid)
@@ -227,6 +336,17 @@ class LinuxNode(ResourceManager):
         # of a file or folder prior to its creation, and another 
         # application creating the same file or folder in between.
         self._node_lock = threading.Lock()
+
+        # persistent ssh session to the host (see sshfuncs.SSHSessionPool)
+        self._session = None
+
+        # remote command agent (see nepi.resources.linux.agent)
+        self._agent = None
+
+        # md5 digests of the files known to be on the host { key: digest }
+        # (see _upload_checks)
+        self._manifest = dict()
+        self._manifest_lock = threading.Lock()
     
     def log_message(self, msg):
         return " guid %d - host %s - %s " % (self.guid, 
@@ -340,7 +460,36 @@ class LinuxNode(ResourceManager):
     def localhost(self):
         return self.get("hostname") in ['localhost', '127.0.0.1', '::1']
 
+    @property
+    def ssh_stats(self):
+        """ Statistics of the commands executed through the persistent 
+        ssh session to the host (see sshfuncs.SSHSession.stats) """
+        if self._session:
+            return self._session.stats()
+        return None
+
+    def do_discover(self):
+        if not self._session and not self.localhost and \
+                self.get("hostname") and self.get("username") and \
+                sshfuncs.openssh_has_persist():
+            # Keep a persistent ssh session to the host while the 
+            # node is in use, shared by all its commands and copies
+            self._session = sshfuncs.session_pool.acquire(
+                    self.get("hostname"),
+                    self.get("username"),
+                    port = self.get("port"),
+                    identity = self.get("identity"),
+                    gwuser = self.get("gatewayUser"),
+                    gw = self.get("gateway"),
+                    server_key = self.get("serverKey"))
+
+        super(LinuxNode, self).do_discover()
+
     def do_provision(self):
+        if self.ec.async_deploy:
+            self.run_coroutine(self._do_provision_async())
+            return
+
         # check if host is alive
         if not self.is_alive():
             msg = "Deploy failed. Unresponsive node %s" % self.get("hostname")
@@ -359,14 +508,81 @@ class LinuxNode(ResourceManager):
             self.clean_experiment()
     
         # Create shared directory structure and node home directory
-        paths = [self.lib_dir, 
+        self.mkdir(self._provision_paths())
+
+        self._resolve_ip()
+
+        self.start_agent()
+
+        super(LinuxNode, self).do_provision()
+
+    def _do_provision_async(self):
+        """ Coroutine version of do_provision """
+        (out, err), proc = yield self.execute_async("echo 'ALIVE'")
+        if out.find("ALIVE") < 0:
+            msg = "Deploy failed. Unresponsive node %s" % self.get("hostname")
+            self.error(msg, out, err)
+            raise RuntimeError, msg
+
+        (out, err), proc = yield self.execute_async("echo ${HOME}")
+        self._home_dir = out.strip()
+        if not self._home_dir:
+            msg = "Impossible to retrieve HOME directory"
+            self.error(msg, out, err)
+            raise RuntimeError, msg
+
+        # The cleaning steps are seldom used, they still block a thread
+        if self.get("cleanProcesses"):
+            self.clean_processes()
+
+        if self.get("cleanHome"):
+            self.clean_home()
+ 
+        if self.get("cleanExperiment"):
+            self.clean_experiment()
+
+        yield self.mkdir_async(self._provision_paths())
+
+        self._resolve_ip()
+
+        self.start_agent()
+
+        super(LinuxNode, self).do_provision()
+
+    def start_agent(self):
+        if not self.get("useAgent"):
+            return
+
+        self.info("Starting command agent")
+        
+        agent = LinuxAgent(self)
+        agent.start()
+        self._agent = agent
+
+    def stop_agent(self):
+        if not self._agent:
+            return
+
+        agent = self._agent
+        self._agent = None
+        agent.stop()
+
+    @property
+    def agent(self):
+        """ The remote command agent, if it is running (see 'useAgent') """
+        if self._agent and self._agent.running:
+            return self._agent
+        return None
+
+    def _provision_paths(self):
+        # Shared directory structure and node home directory
+        return [self.lib_dir, 
             self.bin_dir, 
             self.src_dir, 
             self.share_dir, 
             self.node_home]
 
-        self.mkdir(paths)
-
+    def _resolve_ip(self):
         # Get Public IP address if possible
         if not self.get("ip"):
             ip = None
@@ -382,14 +598,19 @@ class LinuxNode(ResourceManager):
 
             self.set("ip", ip)
 
-        super(LinuxNode, self).do_provision()
-
     def do_deploy(self):
         if self.state == ResourceState.NEW:
             self.info("Deploying node")
             self.do_discover()
             self.do_provision()
 
+        if self.state < ResourceState.PROVISIONED:
+            # Provisioning is running asynchronously, deploy 
+            # again once it is over
+            self.ec.register_state_listener(self.guid, self.state, 
+                    self.deploy)
+            return
+
         # Node needs to wait until all associated interfaces are 
         # ready before it can finalize deployment
         from nepi.resources.linux.interface import LinuxInterface
@@ -410,13 +631,32 @@ class LinuxNode(ResourceManager):
                 self.ec.schedule(self.reschedule_delay, self.release)
                 return 
 
-        tear_down = self.get("tearDown")
-        if tear_down:
-            self.execute(tear_down)
+        try:
+            tear_down = self.get("tearDown")
+            if tear_down:
+                self.execute(tear_down)
 
-        self.clean_processes()
+            self.clean_processes()
+
+            super(LinuxNode, self).do_release()
+        finally:
+            self.stop_agent()
+            self._release_session()
+
+    def _release_session(self):
+        if not self._session:
+            return
+
+        session = self._session
+        self._session = None
+
+        stats = session.stats()
+        self.debug("SSH session - %d commands - mean latency %0.3fs - "
+                "max latency %0.3fs - opened %d times" % (stats["count"], 
+                    stats["mean"], stats["max"], stats["opens"]))
 
-        super(LinuxNode, self).do_release()
+        sshfuncs.session_pool.release(session.host, session.user,
+                port = session.port, identity = session.identity)
 
     def valid_connection(self, guid):
         # TODO: Validate!
@@ -465,6 +705,8 @@ class LinuxNode(ResourceManager):
         cmd = "cd %s ; find . -maxdepth 1 -name \.nepi -execdir rm -rf {} + " % (
                 self.home_dir )
 
+        self._forget_uploads([os.path.join(self.home_dir, ".nepi")])
+
         return self.execute(cmd, with_lock = True)
 
     def clean_experiment(self):
@@ -477,6 +719,8 @@ class LinuxNode(ResourceManager):
         cmd = "cd %s ; find . -maxdepth 1 -name '%s' -execdir rm -rf {} + " % (
                 self.exp_dir,
                 self.ec.exp_id )
+
+        self._forget_uploads([os.path.join(self.exp_dir, self.ec.exp_id)])
             
         return self.execute(cmd, with_lock = True)
 
@@ -496,7 +740,12 @@ class LinuxNode(ResourceManager):
         execution finishes. If this is not the desired behavior,
         use 'run' instead."""
 
-        if self.localhost:
+        agent = self.agent
+        if agent and blocking and not tty and not forward_x11:
+            (out, err), proc = agent.execute(command, 
+                    sudo = sudo,
+                    env = env).result()
+        elif self.localhost:
             (out, err), proc = execfuncs.lexec(command, 
                     user = self.get("username"), # still problem with localhost
                     sudo = sudo,
@@ -564,7 +813,17 @@ class LinuxNode(ResourceManager):
         
         self.debug("Running command '%s'" % command)
         
-        if self.localhost:
+        agent = self.agent
+        if agent and not tty:
+            cmd = sshfuncs.make_spawn_command(command, pidfile,
+                    home = home, 
+                    create_home = create_home, 
+                    stdin = stdin or '/dev/null',
+                    stdout = stdout or '/dev/null',
+                    stderr = stderr or '/dev/null',
+                    sudo = sudo)
+            (out, err), proc = agent.execute(cmd).result()
+        elif self.localhost:
             (out, err), proc = execfuncs.lspawn(command, pidfile,
                     home = home, 
                     create_home = create_home, 
@@ -598,7 +857,11 @@ class LinuxNode(ResourceManager):
         return (out, err), proc
 
     def getpid(self, home, pidfile = "pidfile"):
-        if self.localhost:
+        agent = self.agent
+        if agent:
+            out = agent.read_file(os.path.join(home, pidfile)).result()
+            pidtuple = sshfuncs.parse_pid(out, AgentProcess(0))
+        elif self.localhost:
             pidtuple =  execfuncs.lgetpid(os.path.join(home, pidfile))
         else:
             with self._node_lock:
@@ -618,7 +881,10 @@ class LinuxNode(ResourceManager):
         return pidtuple
 
     def status(self, pid, ppid):
-        if self.localhost:
+        agent = self.agent
+        if agent:
+            status = agent.pid_status(pid).result()
+        elif self.localhost:
             status = execfuncs.lstatus(pid, ppid)
         else:
             with self._node_lock:
@@ -643,7 +909,12 @@ class LinuxNode(ResourceManager):
         status = self.status(pid, ppid)
 
         if status == sshfuncs.ProcStatus.RUNNING:
-            if self.localhost:
+            agent = self.agent
+            if agent:
+                (out, err), proc = agent.execute(
+                        sshfuncs.make_kill_command(pid, ppid, sudo = sudo)
+                        ).result()
+            elif self.localhost:
                 (out, err), proc = execfuncs.lkill(pid, ppid, sudo)
             else:
                 with self._node_lock:
@@ -697,7 +968,17 @@ class LinuxNode(ResourceManager):
         text src is text input, it must be stored into a temp file before 
         uploading
         """
-        # If source is a string input 
+        agent = self.agent
+        if agent and text and not os.path.isfile(src):
+            # The agent writes the content directly, no need for scp.
+            # Skip it if the host already has the same content
+            if agent.read_file(dst).result() == src:
+                return ("", ""), None
+
+            agent.write_file(dst, src).result()
+            return ("", ""), AgentProcess(0)
+
+        # If source is a string input
         f = None
         if text and not os.path.isfile(src):
             # src is text input that should be uploaded as file
@@ -707,26 +988,40 @@ class LinuxNode(ResourceManager):
             f.close()
             src = f.name
 
-        # If dst files should not be overwritten, check that the files do not
-        # exits already
         if isinstance(src, str):
             src = map(str.strip, src.split(";"))
     
-        if overwrite == False:
-            src = self.filter_existing_files(src, dst)
-            if not src:
-                return ("", ""), None
+        # Skip the files that are already up to date on the host, and
+        # if dst files should not be overwritten, the files that exist
+        checks, command = self._upload_checks(src, dst, text, overwrite)
+
+        out = ""
+        if command:
+            (out, err), proc = self.execute(command, retry = 1, 
+                    with_lock = True)
+
+        src = self._filter_uploads(src, checks, out)
+        if not src:
+            if f:
+                execfuncs.forget_digest(f.name)
+                os.remove(f.name)
+            return ("", ""), None
 
+        rdst = dst
         if not self.localhost:
             # Build destination as <user>@<server>:<path>
-            dst = "%s@%s:%s" % (self.get("username"), self.get("hostname"), dst)
+            rdst = "%s@%s:%s" % (self.get("username"), self.get("hostname"), dst)
 
-        ((out, err), proc) = self.copy(src, dst)
+        ((out, err), proc) = self.copy(src, rdst)
 
         # clean up temp file
         if f:
+            execfuncs.forget_digest(f.name)
             os.remove(f.name)
 
+        if not err:
+            self._update_manifest(src, checks)
+
         if err:
             msg = " Failed to upload files - src: %s dst: %s" %  (";".join(src), dst) 
             self.error(msg, out, err)
@@ -753,6 +1048,128 @@ class LinuxNode(ResourceManager):
 
         return ((out, err), proc)
 
+    def fetch(self, src, dst, compress = True, resume = True):
+        """ Streams the remote file 'src' to the local file 'dst', 
+        without holding its content in memory. 
+
+        The content is gzip compressed in transit if 'compress' is True.
+
+        The file is written to 'dst'.part and renamed to 'dst' when
+        complete. If 'resume' is True and a partial file exists from an 
+        interrupted fetch, only the remaining bytes are transferred, 
+        provided that the partial file matches the beginning of 'src'.
+        Otherwise the partial file is discarded.
+
+        Returns the number of bytes transferred.
+        """
+        part = "%s.part" % dst
+
+        offset = 0
+        if resume and os.path.exists(part):
+            offset = os.path.getsize(part)
+
+            if offset and not self._fetch_resumable(src, part, offset):
+                self.debug("Discarding partial file %s, it doesn't match "
+                        "%s" % (part, src))
+                offset = 0
+
+        f = open(part, "ab" if offset else "wb")
+        try:
+            if self.localhost:
+                count = self._fetch_local(src, f, offset)
+            else:
+                count = self._fetch_remote(src, f, offset, compress)
+        finally:
+            f.close()
+
+        os.rename(part, dst)
+
+        return count
+
+    def follow(self, path, offset = 0):
+        """ Returns a TraceFollower for the content appended to the 
+        file 'path' after byte 'offset' """
+        return LinuxTraceFollower(self, path, offset = offset)
+
+    def _fetch_resumable(self, src, part, offset):
+        """ Returns True if the first 'offset' bytes of the remote file
+        'src' are the content of the local file 'part' """
+        (out, err), proc = self.execute(
+                "stat -c%%s %(src)s && head -c %(offset)d %(src)s | md5sum" % {
+                    "src": src,
+                    "offset": offset
+                    }, retry = 1)
+
+        parts = out.split()
+        if proc.poll() or len(parts) < 2 or int(parts[0]) < offset:
+            return False
+
+        md5 = hashlib.md5()
+        with open(part, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), ""):
+                md5.update(chunk)
+
+        return parts[1] == md5.hexdigest()
+
+    def _fetch_local(self, src, f, offset):
+        count = 0
+        with open(src, "rb") as sf:
+            sf.seek(offset)
+            for chunk in iter(lambda: sf.read(1 << 16), ""):
+                f.write(chunk)
+                count += len(chunk)
+
+        return count
+
+    def _fetch_remote(self, src, f, offset, compress):
+        command = "test -f %(src)s && tail -c +%(start)d %(src)s %(gzip)s" % {
+                "src": src,
+                "start": offset + 1,
+                "gzip": "| gzip -c" if compress else ""
+                }
+        
+        stderr = tempfile.TemporaryFile()
+        proc = sshfuncs.rpopen(command,
+                host = self.get("hostname"),
+                user = self.get("username"),
+                port = self.get("port"),
+                gwuser = self.get("gatewayUser"),
+                gw = self.get("gateway"),
+                agent = False,
+                identity = self.get("identity"),
+                server_key = self.get("serverKey"),
+                stderr = stderr,
+                strict_host_checking = False)
+        proc.stdin.close()
+
+        # 16 + MAX_WBITS to decode gzip streams
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) \
+                if compress else None
+
+        count = 0
+        try:
+            for chunk in iter(lambda: proc.stdout.read(1 << 16), ""):
+                if decompressor:
+                    chunk = decompressor.decompress(chunk)
+                f.write(chunk)
+                count += len(chunk)
+
+            if decompressor:
+                chunk = decompressor.flush()
+                f.write(chunk)
+                count += len(chunk)
+        finally:
+            proc.stdout.close()
+            proc.wait()
+
+        if proc.returncode:
+            stderr.seek(0)
+            msg = " Failed to fetch %s " % src
+            self.error(msg, "", stderr.read())
+            raise RuntimeError, msg
+
+        return count
+
     def install_packages_command(self, packages):
         command = ""
         if self.use_rpm:
@@ -841,6 +1258,8 @@ class LinuxNode(ResourceManager):
 
         cmd = " ; ".join(map(lambda path: "rm -rf %s" % path, paths))
 
+        self._forget_uploads(paths)
+
         return self.execute(cmd, with_lock = True)
         
     def run_and_wait(self, command, home, 
@@ -919,6 +1338,9 @@ class LinuxNode(ResourceManager):
         """
         (out, err), proc = self.check_output(home, ecodefile)
 
+        return self._parse_exitcode(out, proc)
+
+    def _parse_exitcode(self, out, proc):
         # Succeeded to open file, return exit code in the file
         if proc.wait() == 0:
             try:
@@ -943,6 +1365,11 @@ class LinuxNode(ResourceManager):
         forces to save the exit code of the command execution to the ecodefile
         """
 
+        command = self._command_script(command, ecodefile, env)
+
+        return self.upload(command, shfile, text = True, overwrite = overwrite)
+
+    def _command_script(self, command, ecodefile, env):
         if not (command.strip().endswith(";") or command.strip().endswith("&")):
             command += ";"
       
@@ -956,9 +1383,7 @@ class LinuxNode(ResourceManager):
         environ = self.format_environment(env)
 
         # Add environ to command
-        command = environ + command
-
-        return self.upload(command, shfile, text = True, overwrite = overwrite)
+        return environ + command
 
     def format_environment(self, env, inline = False):
         """ Formats the environment variables for a command to be executed
@@ -1107,6 +1532,13 @@ class LinuxNode(ResourceManager):
     def filter_existing_files(self, src, dst):
         """ Removes files that already exist in the Linux host from src list
         """
+        dests, command = self._filter_existing_command(src, dst)
+
+        (out, err), proc = self.execute(command, retry = 1, with_lock = True)
+
+        return self._filter_existing(dests, out)
+
+    def _filter_existing_command(self, src, dst):
         # construct a dictionary with { dst: src }
         dests = dict(map(lambda s: (os.path.join(dst, os.path.basename(s)), s), src)) \
                     if len(src) > 1 else dict({dst: src[0]})
@@ -1115,10 +1547,110 @@ class LinuxNode(ResourceManager):
         for d in dests.keys():
             command.append(" [ -f %(dst)s ] && echo '%(dst)s' " % {'dst' : d} )
 
-        command = ";".join(command)
+        return dests, ";".join(command)
 
-        (out, err), proc = self.execute(command, retry = 1, with_lock = True)
-    
+    def _upload_checks(self, src, dst, text = False, overwrite = True):
+        """ Returns the uploads that might be skipped, as a dictionary 
+        { src: (key, digest) }, and the command to check them on the host.
+
+        Files are skipped if their digest matches the digest of the
+        file on the host. Other sources (e.g. directories) are skipped
+        only if they exist and should not be overwritten.
+
+        """
+        checks = dict()
+        command = []
+
+        for s in src:
+            # destination path on the host
+            d = os.path.join(dst, os.path.basename(s)) if len(src) > 1 else dst
+
+            # dst might be an existing directory on the host. The name
+            # of the source is part of the key, except for text uploads 
+            # that are stored in temporary files
+            key = d if text or len(src) > 1 else \
+                    "%s|%s" % (d, os.path.basename(s))
+
+            digest = execfuncs.ldigest(s) if os.path.isfile(s) else None
+            if not digest and overwrite:
+                continue
+
+            checks[s] = (key, digest)
+
+            with self._manifest_lock:
+                if digest and self._manifest.get(key) == digest:
+                    continue
+
+            # Prints '<digest> <key>' for existing files, and ' <key>'
+            # for other existing paths. Keys might contain spaces.
+            command.append(" ( f=%(dst)s; [ -d \"$f\" ] && f=\"$f\"/%(name)s; "
+                    " [ -e \"$f\" ] && echo \"$( [ -f \"$f\" ] && "
+                    "md5sum < \"$f\" | cut -d' ' -f1 )\" %(key)s ) " % {
+                        "dst": pipes.quote(d),
+                        "name": pipes.quote(os.path.basename(s)),
+                        "key": pipes.quote(key)
+                        })
+
+        return checks, ";".join(command)
+
+    def _filter_uploads(self, src, checks, out):
+        """ Removes from src the uploads that can be skipped, given
+        the output of the command returned by _upload_checks """
+        remote = dict()
+        for line in out.splitlines():
+            parts = line.split(" ", 1)
+            if len(parts) == 2:
+                # files that exist, with their digest if they are files
+                digest, key = parts
+                remote[key] = digest
+
+        uploads = []
+
+        for s in src:
+            if s not in checks:
+                uploads.append(s)
+                continue
+
+            key, digest = checks[s]
+
+            with self._manifest_lock:
+                if digest and self._manifest.get(key) == digest:
+                    continue
+
+                if digest and remote.get(key) == digest:
+                    self._manifest[key] = digest
+                    continue
+
+            if not digest and key in remote:
+                # exists and should not be overwritten
+                continue
+
+            uploads.append(s)
+
+        return uploads
+
+    def _forget_uploads(self, paths):
+        """ Removes from the manifest the files under the given paths, 
+        when they are deleted from the host """
+        paths = [os.path.normpath(path) for path in paths]
+
+        with self._manifest_lock:
+            for key in self._manifest.keys():
+                d = os.path.normpath(key.split("|")[0])
+                for path in paths:
+                    if d == path or d.startswith(path.rstrip("/") + "/"):
+                        del self._manifest[key]
+                        break
+
+    def _update_manifest(self, src, checks):
+        """ Records the digests of uploaded files """
+        with self._manifest_lock:
+            for s in src:
+                key, digest = checks.get(s, (None, None))
+                if digest:
+                    self._manifest[key] = digest
+
+    def _filter_existing(self, dests, out):
         for d in dests.keys():
             if out.find(d) > -1:
                 del dests[d]
@@ -1128,3 +1660,322 @@ class LinuxNode(ResourceManager):
 
         return dests.values()
 
+    def execute_async(self, command,
+            sudo = False,
+            env = None,
+            retry = 3,
+            connect_timeout = 30,
+            strict_host_checking = False,
+            persistent = True):
+        """ Same as 'execute' but without blocking. 
+        Returns a Future for the ((out, err), proc) result """
+
+        agent = self.agent
+        if agent:
+            return agent.execute(command, sudo = sudo, env = env)
+
+        if self.localhost:
+            return execfuncs.lexec_async(command, 
+                    user = self.get("username"),
+                    sudo = sudo,
+                    env = env)
+
+        return sshfuncs.rexec_async(
+                command, 
+                host = self.get("hostname"),
+                user = self.get("username"),
+                port = self.get("port"),
+                gwuser = self.get("gatewayUser"),
+                gw = self.get("gateway"),
+                agent = True,
+                sudo = sudo,
+                identity = self.get("identity"),
+                server_key = self.get("serverKey"),
+                env = env,
+                retry = retry,
+                connect_timeout = connect_timeout,
+                persistent = persistent,
+                strict_host_checking = strict_host_checking
+                )
+
+    def copy_async(self, src, dst):
+        """ Same as 'copy' but without blocking. 
+        Returns a Future for the ((out, err), proc) result """
+        if self.localhost:
+            return execfuncs.lcopy_async(src, dst, recursive = True)
+
+        return sshfuncs.rcopy_async(
+                src, dst, 
+                port = self.get("port"),
+                gwuser = self.get("gatewayUser"),
+                gw = self.get("gateway"),
+                identity = self.get("identity"),
+                server_key = self.get("serverKey"),
+                recursive = True,
+                strict_host_checking = False)
+
+    def upload_async(self, src, dst, text = False, overwrite = True,
+            raise_on_error = True):
+        """ Coroutine version of 'upload' """
+        f = None
+        if text and not os.path.isfile(src):
+            f = tempfile.NamedTemporaryFile(delete=False)
+            f.write(src)
+            f.close()
+            src = f.name
+
+        if isinstance(src, str):
+            src = map(str.strip, src.split(";"))
+    
+        try:
+            checks, command = self._upload_checks(src, dst, text, overwrite)
+
+            out = ""
+            if command:
+                (out, err), proc = yield self.execute_async(command, retry = 1)
+
+            src = self._filter_uploads(src, checks, out)
+            if not src:
+                raise Return((("", ""), None))
+
+            if not self.localhost:
+                dst = "%s@%s:%s" % (self.get("username"), self.get("hostname"), dst)
+
+            (out, err), proc = yield self.copy_async(src, dst)
+
+            if not err:
+                self._update_manifest(src, checks)
+        finally:
+            if f:
+                execfuncs.forget_digest(f.name)
+                os.remove(f.name)
+
+        if err:
+            msg = " Failed to upload files - src: %s dst: %s" %  (";".join(src), dst) 
+            self.error(msg, out, err)
+            
+            msg = "%s out: %s err: %s" % (msg, out, err)
+            if raise_on_error:
+                raise RuntimeError, msg
+
+        raise Return(((out, err), proc))
+
+    def download_async(self, src, dst, raise_on_error = True):
+        """ Coroutine version of 'download' """
+        if not self.localhost:
+            # Build destination as <user>@<server>:<path>
+            src = "%s@%s:%s" % (self.get("username"), self.get("hostname"), src)
+
+        (out, err), proc = yield self.copy_async(src, dst)
+
+        if err:
+            msg = " Failed to download files - src: %s dst: %s" %  (src, dst) 
+            self.error(msg, out, err)
+
+            if raise_on_error:
+                raise RuntimeError, msg
+
+        raise Return(((out, err), proc))
+
+    def upload_command_async(self, command, 
+            shfile = "cmd.sh",
+            ecodefile = "exitcode",
+            overwrite = True,
+            env = None):
+        """ Coroutine version of 'upload_command' """
+        command = self._command_script(command, ecodefile, env)
+
+        return self.upload_async(command, shfile, text = True, 
+                overwrite = overwrite)
+
+    def mkdir_async(self, paths, clean = False):
+        """ Same as 'mkdir' but without blocking. 
+        Returns a Future for the ((out, err), proc) result """
+        if isinstance(paths, str):
+            paths = [paths]
+
+        cmd = " ; ".join(map(lambda path: "mkdir -p %s" % path, paths))
+
+        if clean:
+            cmd = " ; ".join(map(lambda path: "rm -rf %s" % path, paths) + 
+                    [cmd])
+            self._forget_uploads(paths)
+
+        return self.execute_async(cmd)
+
+    def run_async(self, command, home,
+            create_home = False,
+            pidfile = 'pidfile',
+            stdin = None, 
+            stdout = 'stdout', 
+            stderr = 'stderr', 
+            sudo = False):
+        """ Coroutine version of 'run' """
+        self.debug("Running command '%s'" % command)
+
+        cmd = sshfuncs.make_spawn_command(command, pidfile,
+                home = home, 
+                create_home = create_home, 
+                stdin = stdin or '/dev/null',
+                stdout = stdout or '/dev/null',
+                stderr = stderr or '/dev/null',
+                sudo = sudo) 
+
+        (out, err), proc = yield self.execute_async(cmd, retry = 1)
+
+        if proc.poll():
+            raise RuntimeError, "Failed to set up application on host %s: %s %s" % (
+                    self.get("hostname"), out, err)
+
+        raise Return(((out, err), proc))
+
+    def getpid_async(self, home, pidfile = "pidfile"):
+        """ Coroutine version of 'getpid' """
+        agent = self.agent
+        if agent:
+            out = yield agent.read_file(os.path.join(home, pidfile))
+            raise Return(sshfuncs.parse_pid(out, AgentProcess(0)))
+
+        (out, err), proc = yield self.execute_async("cat %s" % 
+                os.path.join(home, pidfile), retry = 1)
+
+        raise Return(sshfuncs.parse_pid(out, proc))
+
+    def status_async(self, pid, ppid):
+        """ Coroutine version of 'status' """
+        agent = self.agent
+        if agent:
+            status = yield agent.pid_status(pid)
+            raise Return(status)
+
+        (out, err), proc = yield self.execute_async(
+                sshfuncs.make_status_command(pid, ppid), retry = 1)
+
+        raise Return(sshfuncs.parse_status(out, err, proc))
+
+    def run_and_wait_async(self, command, home, 
+            shfile = "cmd.sh",
+            env = None,
+            overwrite = True,
+            pidfile = "pidfile", 
+            ecodefile = "exitcode", 
+            stdin = None, 
+            stdout = "stdout", 
+            stderr = "stderr", 
+            sudo = False,
+            raise_on_error = True):
+        """ Coroutine version of 'run_and_wait' """
+        if not shfile.startswith("/"):
+            shfile = os.path.join(home, shfile)
+
+        yield self.upload_command_async(command, 
+            shfile = shfile, 
+            ecodefile = ecodefile, 
+            env = env,
+            overwrite = overwrite)
+
+        command = "bash %s" % shfile
+        # run command in background in remote host
+        yield self.run_async(command, home, 
+                pidfile = pidfile,
+                stdin = stdin, 
+                stdout = stdout, 
+                stderr = stderr, 
+                sudo = sudo)
+
+        # Wait for pid file to be generated
+        pid, ppid = yield self.wait_pid_async(
+                home = home, 
+                pidfile = pidfile, 
+                raise_on_error = raise_on_error)
+
+        # wait until command finishes to execute
+        if pid:
+            yield self.wait_run_async(pid, ppid)
+      
+        (eout, err), proc = yield self.check_errors_async(home,
+            ecodefile = ecodefile,
+            stderr = stderr)
+
+        # Out is what was written in the stderr file
+        if err:
+            msg = " Failed to run command '%s' " % command
+            self.error(msg, eout, err)
+
+            if raise_on_error:
+                raise RuntimeError, msg
+
+        (out, oerr), proc = yield self.check_output_async(home, stdout)
+        
+        raise Return(((out, err), proc))
+
+    def wait_pid_async(self, home, pidfile = "pidfile", raise_on_error = False):
+        """ Coroutine version of 'wait_pid' """
+        pid = ppid = None
+        delay = 1.0
+
+        for i in xrange(2):
+            pidtuple = yield self.getpid_async(home = home, pidfile = pidfile)
+            
+            if pidtuple:
+                pid, ppid = pidtuple
+                break
+            else:
+                yield eventloop.sleep(delay)
+                delay = delay * 1.5
+        else:
+            msg = " Failed to get pid for pidfile %s/%s " % (
+                    home, pidfile )
+            self.error(msg)
+            
+            if raise_on_error:
+                raise RuntimeError, msg
+
+        raise Return((pid, ppid))
+
+    def wait_run_async(self, pid, ppid):
+        """ Coroutine version of 'wait_run' """
+        delay = 1.0
+
+        while True:
+            status = yield self.status_async(pid, ppid)
+            
+            if status is ProcStatus.FINISHED:
+                break
+            elif status is not ProcStatus.RUNNING:
+                delay = delay * 1.5
+                yield eventloop.sleep(delay)
+                # If it takes more than 20 seconds to start, then
+                # asume something went wrong
+                if delay > 20:
+                    break
+            else:
+                # The app is running, just wait...
+                yield eventloop.sleep(0.5)
+
+    def check_errors_async(self, home, 
+            ecodefile = "exitcode", 
+            stderr = "stderr"):
+        """ Coroutine version of 'check_errors' """
+        proc = None
+        err = ""
+
+        (out, oerr), eproc = yield self.check_output_async(home, ecodefile)
+        ecode = self._parse_exitcode(out, eproc)
+
+        if ecode in [ ExitCode.CORRUPTFILE, ExitCode.ERROR ]:
+            err = "Error retrieving exit code status from file %s/%s" % (home, ecodefile)
+        elif ecode > 0 or ecode == ExitCode.FILENOTFOUND:
+            (err, eerr), proc = yield self.check_output_async(home, stderr)
+
+            if ecode == ExitCode.FILENOTFOUND and proc.poll() == 1: 
+                err = "" 
+            
+        raise Return((("", err), proc))
+
+    def check_output_async(self, home, filename):
+        """ Same as 'check_output' but without blocking.
+        Returns a Future for the ((out, err), proc) result """
+        return self.execute_async("cat %s" % 
+            os.path.join(home, filename), retry = 1)
+
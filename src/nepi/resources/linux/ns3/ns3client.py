@@ -17,72 +17,220 @@
 #
 # Author: Alina Quereilhac <alina.quereilhac@inria.fr>
 
-import base64
-import cPickle
-import errno
+from nepi.util import sshfuncs
+from nepi.util.eventloop import Future
+
+import itertools
 import os
 import socket
-import time
-import weakref
+import subprocess
+import sys
+import tempfile
 import threading
-
-from optparse import OptionParser, SUPPRESS_HELP
+import weakref
 
 from nepi.resources.ns3.ns3client import NS3Client
-from nepi.resources.ns3.ns3server import NS3WrapperMessage
+from nepi.resources.ns3.ns3server import NS3WrapperMessage, \
+        FRAMED_HANDSHAKE, encode_frame, decode_frames
 
 class LinuxNS3Client(NS3Client):
+    """ Client for the ns3server.py running on a LinuxNode.
+
+    A single persistent connection to the server socket is kept open.
+    For remote nodes the connection is relayed by 'ns3server.py -R', 
+    started once over an ssh channel. Messages are sent as length 
+    prefixed frames carrying a request id, so many requests can be 
+    pipelined and replies of any size are received whole.
+
+    """
     def __init__(self, simulation):
         super(LinuxNS3Client, self).__init__()
         self._simulation = weakref.ref(simulation)
         self._socket_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._futures = dict()
+        self._futures_lock = threading.Lock()
+        self._seq = itertools.count()
+        self._sock = None
+        self._proc = None
+        self._stderr = None
+        self._reader = None
 
     @property
     def simulation(self):
         return self._simulation()
 
-    def send_msg(self, msg_type, *args, **kwargs):
-        msg = [msg_type, args, kwargs]
+    @property
+    def connected(self):
+        if self._proc:
+            return self._proc.poll() is None
+        return self._sock is not None
+
+    def connect(self):
+        """ Opens the persistent connection to the ns-3 server """
+        simulation = self.simulation
+        node = simulation.node
+
+        if node.get("hostname") in ['localhost', '127.0.0.1']:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.connect(simulation.remote_socket)
+        else:
+            self._stderr = tempfile.TemporaryFile()
 
-        def encode(item):
-            item = cPickle.dumps(item)
-            return base64.b64encode(item)
+            command = "python -u %s -S %s -R" % (
+                    os.path.join(node.src_dir, "ns3wrapper", "ns3server.py"),
+                    simulation.remote_socket)
 
-        encoded = "|".join(map(encode, msg))
+            self._proc = sshfuncs.rpopen(command,
+                    host = node.get("hostname"),
+                    user = node.get("username"),
+                    port = node.get("port"),
+                    gwuser = node.get("gatewayUser"),
+                    gw = node.get("gateway"),
+                    agent = True,
+                    identity = node.get("identity"),
+                    server_key = node.get("serverKey"),
+                    stderr = self._stderr,
+                    strict_host_checking = False)
 
+        self._write("%s\n" % FRAMED_HANDSHAKE)
+
+        self._reader = threading.Thread(target = self._read)
+        self._reader.setDaemon(True)
+        self._reader.start()
+
+    def close(self):
+        """ Closes the connection. Pending requests fail """
         with self._socket_lock:
-            if self.simulation.node.get("hostname") in ['localhost', '127.0.0.1']:
-                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-                sock.connect(self.simulation.remote_socket)
-                sock.send("%s\n" % encoded)
-                reply = sock.recv(1024)
-                sock.close()
+            sock = self._sock
+            proc = self._proc
+
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except:
+                pass
+
+        if proc:
+            try:
+                proc.stdin.close()
+            except:
+                pass
+
+        if self._reader and self._reader != threading.current_thread():
+            self._reader.join(5)
+
+        if proc and proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+    def send_msg_async(self, msg_type, *args, **kwargs):
+        """ Sends a message to the ns-3 server without waiting for 
+        the reply. Returns a Future for the reply 
+
+        :rtype: Future
+
+        """
+        future = Future()
+
+        with self._socket_lock:
+            if not self.connected:
+                try:
+                    self.connect()
+                except:
+                    future.set_exc_info(sys.exc_info())
+                    return future
+
+        msg_id = str(self._seq.next())
+
+        with self._futures_lock:
+            self._futures[msg_id] = future
+
+        try:
+            self._write(encode_frame(msg_id, [msg_type, args, kwargs]))
+        except:
+            with self._futures_lock:
+                self._futures.pop(msg_id, None)
+            future.set_exc_info(sys.exc_info())
+
+        return future
+
+    def send_msg(self, msg_type, *args, **kwargs):
+        future = self.send_msg_async(msg_type, *args, **kwargs)
+
+        try:
+            return future.result()
+        except:
+            msg = " Couldn't send message to remote socket %s - ERROR: %s " % (
+                    self.simulation.remote_socket, sys.exc_info()[1])
+            self.simulation.error(msg, "", self._read_stderr())
+            raise
+
+    def _write(self, data):
+        with self._write_lock:
+            if self._sock:
+                self._sock.sendall(data)
             else:
-                command = ( "python -c 'import socket;"
-                    "sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM);"
-                    "sock.connect(\"%(socket_addr)s\");"
-                    "msg = \"%(encoded_message)s\\n\";"
-                    "sock.send(msg);"
-                    "reply = sock.recv(1024);"
-                    "sock.close();"
-                    "print reply'") % {
-                        "encoded_message": encoded,
-                        "socket_addr": self.simulation.remote_socket,
-                        }
-
-                (reply, err), proc = self.simulation.node.execute(command, 
-                        with_lock = True) 
-
-                if (err and proc.poll()) or reply.strip() == "":
-                    msg = (" Couldn't connect to remote socket %s - REPLY: %s "
-                          "- ERROR: %s ") % (
-                            self.simulation.remote_socket, reply, err)
-                    self.simulation.error(msg, reply, err)
-                    raise RuntimeError(msg)
-                       
-        reply = cPickle.loads(base64.b64decode(reply))
-
-        return reply
+                self._proc.stdin.write(data)
+                self._proc.stdin.flush()
+
+    def _read(self):
+        sock = self._sock
+
+        if sock:
+            recv = lambda: sock.recv(65536)
+        else:
+            fd = self._proc.stdout.fileno()
+            recv = lambda: os.read(fd, 65536)
+
+        buf = ''
+
+        while True:
+            try:
+                chunk = recv()
+            except:
+                chunk = ''
+
+            if not chunk:
+                break
+
+            frames, buf = decode_frames(buf + chunk)
+
+            for msg_id, [(ok, reply)] in frames:
+                with self._futures_lock:
+                    future = self._futures.pop(msg_id, None)
+
+                if not future:
+                    continue
+
+                if ok:
+                    future.set_result(reply)
+                else:
+                    future.set_exc_info((RuntimeError,
+                        RuntimeError("ns-3 server error: %s" % reply), None))
+
+        # The connection was closed, fail the pending requests
+        if sock:
+            sock.close()
+
+        with self._socket_lock:
+            self._sock = None
+            self._proc = None
+
+        with self._futures_lock:
+            futures = self._futures.values()
+            self._futures.clear()
+
+        for future in futures:
+            future.set_exc_info((RuntimeError,
+                RuntimeError("Connection to the ns-3 server closed"), None))
+
+    def _read_stderr(self):
+        if not self._stderr:
+            return ""
+
+        self._stderr.seek(0)
+        return self._stderr.read()
 
     def create(self, *args, **kwargs):
         return self.send_msg(NS3WrapperMessage.CREATE, *args, **kwargs)
@@ -99,6 +247,9 @@ class LinuxNS3Client(NS3Client):
     def get(self, *args, **kwargs):
         return self.send_msg(NS3WrapperMessage.GET, *args, **kwargs)
 
+    def batch(self, *args, **kwargs):
+        return self.send_msg(NS3WrapperMessage.BATCH, *args, **kwargs)
+
     def flush(self, *args, **kwargs):
         return self.send_msg(NS3WrapperMessage.FLUSH, *args, **kwargs)
 
@@ -113,6 +264,8 @@ class LinuxNS3Client(NS3Client):
             return self.send_msg(NS3WrapperMessage.SHUTDOWN, *args, **kwargs)
         except:
             pass
+        finally:
+            self.close()
 
         return None
 
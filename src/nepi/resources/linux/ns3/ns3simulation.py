@@ -257,32 +257,7 @@ class LinuxNS3Simulation(LinuxApplication, NS3Simulation):
             # ccnd needs to wait until node is deployed and running
             self.ec.schedule(self.reschedule_delay, self.deploy)
         else:
-            if not self.get("command"):
-                self.set("command", self._start_command)
-            
-            if not self.get("depends"):
-                self.set("depends", self._dependencies)
-
-            if self.get("sources"):
-                sources = self.get("sources")
-                source = sources.split(" ")[0]
-                basename = os.path.basename(source)
-                version = ( basename.strip().replace(".tar.gz", "")
-                    .replace(".tar","")
-                    .replace(".gz","")
-                    .replace(".zip","") )
-
-                self.set("ns3Version", version)
-                self.set("sources", source)
-
-            if not self.get("build"):
-                self.set("build", self._build)
-
-            if not self.get("install"):
-                self.set("install", self._install)
-
-            if not self.get("env"):
-                self.set("env", self._environment)
+            self._set_defaults()
 
             self.do_discover()
             self.do_provision()
@@ -294,6 +269,41 @@ class LinuxNS3Simulation(LinuxApplication, NS3Simulation):
             
             self.set_ready()
 
+    def _set_defaults(self):
+        """ Sets the commands to build, install and run ns-3 that were
+        not set by the user """
+        if not self.get("command"):
+            self.set("command", self._start_command)
+        
+        if not self.get("depends"):
+            self.set("depends", self._dependencies)
+
+        if self.get("sources"):
+            sources = self.get("sources")
+            source = sources.split(" ")[0]
+            basename = os.path.basename(source)
+            version = ( basename.strip().replace(".tar.gz", "")
+                .replace(".tar","")
+                .replace(".gz","")
+                .replace(".zip","") )
+
+            self.set("ns3Version", version)
+            self.set("sources", source)
+
+        if not self.get("build"):
+            self.set("build", self._build)
+
+        if not self.get("install"):
+            self.set("install", self._install)
+
+        # Cache the ns-3 (and DCE) build, so it is only built once 
+        # per OS and compiler
+        if not self.get("cachedPaths"):
+            self.set("cachedPaths", self.ns3_build_location)
+
+        if not self.get("env"):
+            self.set("env", self._environment)
+
     def do_start(self):
         """ Starts simulation execution
 
@@ -384,6 +394,15 @@ class LinuxNS3Simulation(LinuxApplication, NS3Simulation):
             return ( " gcc g++ python python-dev mercurial bzr tcpdump socat gccxml python-pygccxml unzip")
         return ""
 
+    @property
+    def build_cache_name(self):
+        return "%(ns3_version)s%(dce_version)s-%(build_mode)s" % {
+                "ns3_version": self.get("ns3Version"),
+                "dce_version": "-%s" % self.get("dceVersion") \
+                        if self.enable_dce else "", 
+                "build_mode": self.get("buildMode"),
+                }
+
     @property
     def ns3_repo(self):
         return "http://code.nsnam.org"
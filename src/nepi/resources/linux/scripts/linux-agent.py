@@ -0,0 +1,194 @@
+import base64
+import cPickle
+import errno
+import os
+import Queue
+import subprocess
+import sys
+import tempfile
+import threading
+import traceback
+
+from optparse import OptionParser
+
+# Remote command agent.
+#
+# Reads requests from the standard input and writes the replies to the
+# standard output, one per line. Requests are processed concurrently,
+# so replies can arrive in any order.
+#
+# Request: <id>|<op>|<args>|<kwargs>
+# Reply:   <id>|<(ok, result)>
+#
+# All fields except the id are base64 encoded pickles. If ok is False,
+# result is a string describing the error.
+
+def encode(item):
+    return base64.b64encode(cPickle.dumps(item))
+
+def decode(item):
+    return cPickle.loads(base64.b64decode(item))
+
+def do_ping():
+    return "PONG"
+
+def do_execute(command, env = None, stdin = None):
+    """ Executes a command with bash and returns (out, err, returncode) """
+    environ = None
+    if env:
+        environ = dict(os.environ)
+        environ.update(env)
+
+    proc = subprocess.Popen(command,
+            shell = True,
+            executable = "/bin/bash",
+            env = environ,
+            stdin = subprocess.PIPE,
+            stdout = subprocess.PIPE,
+            stderr = subprocess.PIPE,
+            close_fds = True)
+
+    out, err = proc.communicate(stdin)
+    return (out, err, proc.returncode)
+
+def do_stat(path):
+    """ Returns (size, mtime, mode) of a file, or None if it doesn't exist """
+    try:
+        st = os.stat(os.path.expanduser(path))
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+
+    return (st.st_size, st.st_mtime, st.st_mode)
+
+def do_read(path):
+    """ Returns the content of a file, or None if it doesn't exist """
+    try:
+        f = open(os.path.expanduser(path), "rb")
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def do_write(path, data, mode = None):
+    """ Writes the content of a file. The file is replaced atomically """
+    path = os.path.expanduser(path)
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    fd, tmp = tempfile.mkstemp(dir = dirname or None)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+    if mode is not None:
+        os.chmod(tmp, mode)
+
+    os.rename(tmp, path)
+    return True
+
+def do_pid_status(pid):
+    """ Returns True if the process is running """
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        # The process exists but belongs to another user
+        return e.errno == errno.EPERM
+
+    return True
+
+OPS = dict(
+        ping = do_ping,
+        execute = do_execute,
+        stat = do_stat,
+        read = do_read,
+        write = do_write,
+        pid_status = do_pid_status,
+        )
+
+class Agent(object):
+    def __init__(self, infile, outfile, nworkers):
+        self._infile = infile
+        self._outfile = outfile
+        self._out_lock = threading.Lock()
+        self._queue = Queue.Queue()
+        self._nworkers = nworkers
+
+    def run(self):
+        workers = []
+        for i in xrange(self._nworkers):
+            worker = threading.Thread(target = self._work)
+            worker.setDaemon(True)
+            worker.start()
+            workers.append(worker)
+
+        while True:
+            line = self._infile.readline()
+            if not line:
+                # The channel was closed
+                break
+
+            line = line.strip()
+            if line:
+                self._queue.put(line)
+
+        for worker in workers:
+            self._queue.put(None)
+
+        for worker in workers:
+            worker.join()
+
+    def _work(self):
+        while True:
+            line = self._queue.get()
+            if line is None:
+                return
+
+            self._process(line)
+
+    def _process(self, line):
+        msg_id, rest = line.split("|", 1)
+
+        try:
+            op, args, kwargs = map(decode, rest.split("|"))
+            result = (True, OPS[op](*args, **kwargs))
+        except:
+            result = (False, traceback.format_exc())
+
+        reply = "%s|%s\n" % (msg_id, encode(result))
+
+        self._out_lock.acquire()
+        try:
+            self._outfile.write(reply)
+            self._outfile.flush()
+        finally:
+            self._out_lock.release()
+
+if __name__ == '__main__':
+    usage = "usage: %prog [-w <nworkers>]"
+
+    parser = OptionParser(usage = usage)
+    parser.add_option("-w", "--workers", dest="nworkers",
+            help = "Number of requests processed concurrently",
+            default = 8, type="int")
+
+    (options, args) = parser.parse_args()
+
+    # Do not leave the channel to the children processes
+    stdin = os.fdopen(os.dup(sys.stdin.fileno()), "r")
+    stdout = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    null = os.open(os.devnull, os.O_RDWR)
+    os.dup2(null, sys.stdin.fileno())
+    os.dup2(null, sys.stdout.fileno())
+
+    agent = Agent(stdin, stdout, options.nworkers)
+    agent.run()
+
@@ -12,6 +12,7 @@ from optparse import OptionParser
 IFF_TUN = 0x0001
 IFF_TAP     = 0x0002
 IFF_NO_PI   = 0x1000
+IFF_MULTI_QUEUE = 0x0100
 TUNSETIFF   = 0x400454ca
 
 # Trak SIGTERM, and set global termination flag instead of dying
@@ -35,13 +36,17 @@ def _resume(sig,frame):
         SUSPEND.remove(None)
 signal.signal(signal.SIGUSR2, _resume)
 
-def open_tap(vif_name, vif_type, pi):
+def open_tap(vif_name, vif_type, pi, multi_queue = False):
     flags = 0
     flags |= vif_type
 
     if not pi:
         flags |= IFF_NO_PI
 
+    if multi_queue:
+        # Each call attaches a new queue to the device
+        flags |= IFF_MULTI_QUEUE
+
     fd = os.open("/dev/net/tun", os.O_RDWR)
 
     err = fcntl.ioctl(fd, TUNSETIFF, struct.pack("16sH", vif_name, flags))
@@ -55,7 +60,8 @@ def get_options():
     usage = ("usage: %prog -N <vif_name> -t <vif-type> -p <pi> "
             "-b <bwlimit> -c <cipher> -k <cipher-key> -q <txqueuelen> " 
             "-l <local-port-file> -r <remote-port-file> -H <remote-host> "
-            "-R <ret-file> ")
+            "-R <ret-file> -Q <queues> -m -s <stats-file> "
+            "-i <stats-interval> ")
     
     parser = OptionParser(usage = usage)
 
@@ -109,6 +115,24 @@ def get_options():
         help = "File where to store return code (success of connection) ", 
         default = "ret_file", type="str")
 
+    parser.add_option("-Q", "--queues", dest="queues",
+        help = "Number of device queues to forward, each one by its own "
+            "process and over its own UDP port. Requires -m if more than 1",
+        default = 1, type="int")
+
+    parser.add_option("-m", "--multi-queue", dest="multi_queue", 
+            action="store_true", 
+            default = False,
+            help="The device is a multi-queue device")
+
+    parser.add_option("-s", "--stats-file", dest="stats_file",
+        help = "File where to append the traffic counters of the tunnel", 
+        default = None, type="str")
+
+    parser.add_option("-i", "--stats-interval", dest="stats_interval",
+        help = "Seconds between two writes of the traffic counters", 
+        default = 1.0, type="float")
+
     (options, args) = parser.parse_args()
        
     vif_type = IFF_TAP
@@ -118,27 +142,36 @@ def get_options():
     return ( options.vif_name, vif_type, options.pi, 
             options.local_port_file, options.remote_port_file, 
             options.remote_host, options.ret_file, options.bwlimit, 
-            options.cipher, options.cipher_key, options.txqueuelen )
+            options.cipher, options.cipher_key, options.txqueuelen,
+            options.queues, options.multi_queue, options.stats_file,
+            options.stats_interval )
 
 if __name__ == '__main__':
 
     ( vif_name, vif_type, pi, local_port_file, remote_port_file,
-      remote_host, ret_file, bwlimit, cipher, cipher_key, txqueuelen 
-         ) = get_options()
+      remote_host, ret_file, bwlimit, cipher, cipher_key, txqueuelen,
+      queues, multi_queue, stats_file, stats_interval ) = get_options()
    
-    # Get the file descriptor of the TAP device from the process
-    # that created it
-    fd = open_tap(vif_name, vif_type, pi)
+    # Open the TAP device, once per queue
+    tuns = []
+    for i in xrange(queues):
+        fd = open_tap(vif_name, vif_type, pi, multi_queue)
+        tuns.append(os.fdopen(fd, 'r+b', 0))
 
-    # Create a local socket to stablish the tunnel connection
+    # Create a local socket per queue to stablish the tunnel connection
     hostaddr = socket.gethostbyname(socket.gethostname())
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 0)
-    sock.bind((hostaddr, 0))
-    (local_host, local_port) = sock.getsockname()
+    socks = []
+    local_ports = []
+    for i in xrange(queues):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 0)
+        sock.bind((hostaddr, 0))
+        (local_host, local_port) = sock.getsockname()
+        socks.append(sock)
+        local_ports.append(str(local_port))
 
     # Save local port information to file
     f = open(local_port_file, 'w')
-    f.write("%d\n" % local_port)
+    f.write("%s\n" % " ".join(local_ports))
     f.close()
 
     # Wait until remote port information is available
@@ -162,12 +195,16 @@ if __name__ == '__main__':
         
         time.sleep(2)
     
-    remote_port = remote_port.strip()
-    remote_port = int(remote_port)
+    remote_ports = map(int, remote_port.split())
+    if len(remote_ports) != queues:
+        raise RuntimeError("Expected %d remote ports, got %r" % (queues, 
+            remote_port))
 
-    # Connect local socket to remote port
-    sock.connect((remote_host, remote_port))
-    remote = os.fdopen(sock.fileno(), 'r+b', 0)
+    # Connect each local socket to the remote port of the same queue
+    remotes = []
+    for sock, remote_port in zip(socks, remote_ports):
+        sock.connect((remote_host, remote_port))
+        remotes.append(os.fdopen(sock.fileno(), 'r+b', 0))
 
     # TODO: Test connectivity!    
 
@@ -177,8 +214,8 @@ if __name__ == '__main__':
     f.close()
 
     # Establish tunnel
-    tunchannel.tun_fwd(tun, remote,
-        with_pi = True, # Planetlab TAP devices add PI headers 
+    tunchannel.tun_fwd_parallel(tuns, remotes,
+        with_pi = pi,
         ether_mode = (vif_type == IFF_TAP),
         udp = True,
         cipher_key = cipher_key,
@@ -187,6 +224,8 @@ if __name__ == '__main__':
         SUSPEND = SUSPEND,
         tunqueue = txqueuelen,
         tunkqueue = 500,
-        bwlimit = bwlimit
+        bwlimit = bwlimit,
+        stats = stats_file,
+        stats_interval = stats_interval
     ) 
  
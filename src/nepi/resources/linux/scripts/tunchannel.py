@@ -21,6 +21,7 @@
 
 
 import select
+import signal
 import sys
 import os
 import struct
@@ -218,48 +219,254 @@ def nonblock(fd):
         # Just ignore
         return False
 
-def tun_fwd(tun, remote, with_pi, ether_mode, cipher_key, udp, TERMINATE, SUSPEND,
-        stderr = sys.stderr, reconnect = None, rwrite = None, rread = None,
-        tunqueue = 1000, tunkqueue = 1000, cipher = 'AES', accept_local = None, 
-        accept_remote = None, slowlocal = True, queueclass = None, 
-        bwlimit = None, len = len, max = max, min = min, buffer = buffer,
-        OSError = OSError, select = select.select, selecterror = select.error, 
-        os = os, socket = socket,
-        retrycodes=(os.errno.EWOULDBLOCK, os.errno.EAGAIN, os.errno.EINTR) ):
-    crypto_mode = False
-    crypter = None
+def get_crypter(cipher_key, cipher = 'AES'):
+    """ Returns the PyCrypto object used to encrypt and decrypt packets
+    with the given cipher, or None if packets are not encrypted """
+    if not (cipher_key and cipher):
+        return None
 
     try:
-        if cipher_key and cipher:
-            import Crypto.Cipher
-            import hashlib
-            __import__('Crypto.Cipher.'+cipher)
-            
-            ciphername = cipher
-            cipher = getattr(Crypto.Cipher, cipher)
-            hashed_key = hashlib.sha256(cipher_key).digest()
-
-            if ciphername == 'AES':
-                hashed_key = hashed_key[:16]
-            elif ciphername == 'Blowfish':
-                hashed_key = hashed_key[:24]
-            elif ciphername == 'DES':
-                hashed_key = hashed_key[:8]
-            elif ciphername == 'DES3':
-                hashed_key = hashed_key[:24]
-
-            crypter = cipher.new(
-                hashed_key, 
-                cipher.MODE_ECB)
-            crypto_mode = True
+        import Crypto.Cipher
+        import hashlib
+        __import__('Crypto.Cipher.'+cipher)
+        
+        ciphername = cipher
+        cipher = getattr(Crypto.Cipher, cipher)
+        hashed_key = hashlib.sha256(cipher_key).digest()
+
+        if ciphername == 'AES':
+            hashed_key = hashed_key[:16]
+        elif ciphername == 'Blowfish':
+            hashed_key = hashed_key[:24]
+        elif ciphername == 'DES':
+            hashed_key = hashed_key[:8]
+        elif ciphername == 'DES3':
+            hashed_key = hashed_key[:24]
+
+        return cipher.new(
+            hashed_key, 
+            cipher.MODE_ECB)
     except:
         # We don't want decription to work only on one side,
         # This could break things really bad
-        #crypto_mode = False
-        #crypter = None
         traceback.print_exc(file=sys.stderr)
         raise
 
+# Columns of the stats file written by the forwarders, after the
+# time and the forwarder queue index (see TunnelStats)
+STATS_COLUMNS = ("wakeups",
+        "tun_rx_packets", "tun_rx_bytes", 
+        "remote_tx_packets", "remote_tx_bytes", "remote_tx_drops",
+        "remote_rx_packets", "remote_rx_bytes", "remote_rx_drops",
+        "tun_tx_packets", "tun_tx_bytes", 
+        "bwlimit_waits", "buffer_full", "fw_queue", "bk_queue",
+        "tun_drops")
+
+TUNGETIFF = 0x800454d2
+
+class TunnelStats(object):
+    """ Writes the counters of a forwarder to a stats file, one line 
+    every 'interval' seconds.
+
+    Each line holds the time, the queue index of the forwarder, and the
+    values in STATS_COLUMNS, separated by spaces. Counters are totals
+    since the forwarder started, except fw_queue and bk_queue, which 
+    are the number of packets waiting to be forwarded. 
+    
+    tun_drops are the packets the kernel dropped because the device 
+    queue was full, as reported by /sys/class/net/<dev>/statistics. 
+    Since the device is shared by all the queues, it is the same in the 
+    lines of every forwarder.
+
+    Forwarders of the queues of a multi-queue device append to the same
+    file, lines are short enough to be written atomically.
+    """
+    def __init__(self, path, interval = 1.0, queue = 0, tunfd = None):
+        self.interval = interval
+        self.queue = queue
+        # The first line is written after one interval, well after the
+        # header is written by the forwarder of queue 0
+        self.next = time.time() + interval
+
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                0644)
+
+        if queue == 0:
+            os.write(self._fd, "# time queue %s\n" % " ".join(STATS_COLUMNS))
+
+        self._drops_path = None
+        if tunfd is not None:
+            try:
+                ifr = fcntl.ioctl(tunfd, TUNGETIFF, struct.pack("40x"))
+                dev = ifr[:16].rstrip("\0")
+                self._drops_path = os.path.join("/sys/class/net", dev, 
+                        "statistics", "tx_dropped")
+            except (IOError, OSError):
+                pass
+
+    def tun_drops(self):
+        if self._drops_path:
+            try:
+                f = open(self._drops_path)
+                try:
+                    return int(f.read())
+                finally:
+                    f.close()
+            except (IOError, OSError, ValueError):
+                self._drops_path = None
+        return 0
+
+    def write(self, now, counters):
+        """ Appends a line with 'counters', the values in STATS_COLUMNS
+        but tun_drops """
+        line = "%.3f %d %s %d\n" % (now, self.queue, 
+                " ".join(map(str, counters)), self.tun_drops())
+        try:
+            os.write(self._fd, line)
+        except OSError:
+            # Never stop forwarding because of the stats
+            pass
+        self.next = now + self.interval
+
+    def close(self):
+        os.close(self._fd)
+
+def tun_fwd(tun, remote, with_pi, ether_mode, cipher_key, udp, TERMINATE, SUSPEND,
+        stderr = sys.stderr, reconnect = None, rwrite = None, rread = None,
+        tunqueue = 1000, tunkqueue = 1000, cipher = 'AES', accept_local = None, 
+        accept_remote = None, slowlocal = True, queueclass = None, 
+        bwlimit = None, use_epoll = True, stats = None, stats_interval = 1.0,
+        stats_queue = 0):
+    """ Forwards packets between the TUN/TAP device 'tun' and the 'remote'
+    end of the tunnel until TERMINATE is not empty.
+
+    If 'stats' is given, the traffic counters of the forwarder are 
+    appended to that file every 'stats_interval' seconds (see TunnelStats).
+
+    UDP tunnels are forwarded with the batched epoll loop when the
+    platform supports it, unless use_epoll is False. Other tunnels, and
+    tunnels using custom remote read/write functions or queues, are
+    forwarded with the select loop.
+    """
+    if use_epoll and _epoll is not None and udp and reconnect is None \
+            and rread is None and rwrite is None and queueclass is None \
+            and hasattr(remote, 'fileno'):
+        fwd = _tun_fwd_epoll
+    else:
+        fwd = _tun_fwd_select
+
+    return fwd(tun, remote, with_pi, ether_mode, cipher_key, udp, 
+            TERMINATE, SUSPEND, 
+            stderr = stderr, 
+            reconnect = reconnect, 
+            rwrite = rwrite, 
+            rread = rread,
+            tunqueue = tunqueue, 
+            tunkqueue = tunkqueue, 
+            cipher = cipher, 
+            accept_local = accept_local, 
+            accept_remote = accept_remote, 
+            slowlocal = slowlocal, 
+            queueclass = queueclass, 
+            bwlimit = bwlimit,
+            stats = stats,
+            stats_interval = stats_interval,
+            stats_queue = stats_queue)
+
+def tun_fwd_parallel(tuns, remotes, TERMINATE, SUSPEND, stderr = sys.stderr,
+        **kw):
+    """ Forwards each queue of a multi-queue TUN/TAP device in 'tuns' to
+    the remote end of the tunnel with the same index in 'remotes', each
+    pair in its own process, until TERMINATE is not empty.
+
+    The kernel spreads the packets sent through the device among its
+    queues by flow hash, so each flow goes through a single forwarder
+    and packets of a flow are not reordered.
+
+    Changes of TERMINATE and SUSPEND in the calling process are
+    propagated to the forwarders with SIGTERM and SIGUSR1/SIGUSR2, as
+    the scripts using tunchannel do. If one forwarder exits, the others
+    are terminated. The remaining keyword arguments are passed to tun_fwd,
+    all forwarders append their counters to the same stats file.
+    """
+    if len(tuns) != len(remotes):
+        raise RuntimeError, "Each queue needs its own remote end"
+
+    if len(tuns) == 1:
+        return tun_fwd(tuns[0], remotes[0], TERMINATE = TERMINATE, 
+                SUSPEND = SUSPEND, stderr = stderr, **kw)
+
+    pids = []
+    for i, (tun, remote) in enumerate(zip(tuns, remotes)):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                try:
+                    tun_fwd(tun, remote, TERMINATE = TERMINATE, 
+                            SUSPEND = SUSPEND, 
+                            # Print the mode only once
+                            stderr = stderr if i == 0 else None, 
+                            stats_queue = i,
+                            **kw)
+                except:
+                    traceback.print_exc(file=sys.stderr)
+                    status = 1
+            finally:
+                os._exit(status)
+
+        pids.append(pid)
+
+    suspended = bool(SUSPEND)
+    terminated = False
+
+    while pids:
+        if not terminated and (TERMINATE or len(pids) < len(tuns)):
+            terminated = True
+            for pid in pids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+        if not terminated and suspended != bool(SUSPEND):
+            suspended = bool(SUSPEND)
+            sig = signal.SIGUSR1 if suspended else signal.SIGUSR2
+            for pid in pids:
+                os.kill(pid, sig)
+
+        # Wait only for our own forwarders, the caller may have others
+        exited = False
+        for pid in list(pids):
+            try:
+                (wpid, status) = os.waitpid(pid, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            if wpid == pid:
+                exited = True
+                pids.remove(pid)
+                if status and not terminated and stderr is not None:
+                    print >>stderr, "Forwarder %d exited with status %d" % (
+                            pid, status)
+
+        if not exited:
+            time.sleep(0.5)
+
+def _tun_fwd_select(tun, remote, with_pi, ether_mode, cipher_key, udp, TERMINATE, SUSPEND,
+        stderr = sys.stderr, reconnect = None, rwrite = None, rread = None,
+        tunqueue = 1000, tunkqueue = 1000, cipher = 'AES', accept_local = None, 
+        accept_remote = None, slowlocal = True, queueclass = None, 
+        bwlimit = None, stats = None, stats_interval = 1.0, stats_queue = 0,
+        len = len, max = max, min = min, buffer = buffer,
+        OSError = OSError, select = select.select, selecterror = select.error, 
+        os = os, socket = socket,
+        retrycodes=(os.errno.EWOULDBLOCK, os.errno.EAGAIN, os.errno.EINTR) ):
+    crypter = get_crypter(cipher_key, cipher)
+    crypto_mode = crypter is not None
+
     if stderr is not None:
         if crypto_mode:
             print >>stderr, "Packets are transmitted in CIPHER"
@@ -378,6 +585,14 @@ def tun_fwd(tun, remote, with_pi, ether_mode, cipher_key, udp, TERMINATE, SUSPEN
     
     remoteok = True
     
+    if stats is not None:
+        stats = TunnelStats(stats, stats_interval, stats_queue, tunfd)
+
+    # Counters, reported in the stats file
+    wakeups = 0
+    rt = rtbytes = wr = wrbytes = wrdrops = 0
+    rr = rrbytes = rrdrops = wt = wtbytes = 0
+    bwlimit_waits = buffer_full = 0
     
     while not TERMINATE:
         # The SUSPEND flag has been set. This means we need to wait on
@@ -388,14 +603,22 @@ def tun_fwd(tun, remote, with_pi, ether_mode, cipher_key, udp, TERMINATE, SUSPEN
         wset = []
         if packetReady(bkbuf):
             wset.append(tun)
-        if remoteok and fpacketReady(fwbuf) and (not bwlimit or bwfree > 0):
-            wset.append(remote)
+        if remoteok and fpacketReady(fwbuf):
+            if not bwlimit or bwfree > 0:
+                wset.append(remote)
+            else:
+                bwlimit_waits += 1
         
         rset = []
         if len(fwbuf) < maxfwbuf:
             rset.append(tun)
-        if remoteok and len(bkbuf) < maxbkbuf:
-            rset.append(remote)
+        else:
+            buffer_full += 1
+        if remoteok:
+            if len(bkbuf) < maxbkbuf:
+                rset.append(remote)
+            else:
+                buffer_full += 1
         
         if remoteok:
             eset = (tun,remote)
@@ -417,6 +640,8 @@ def tun_fwd(tun, remote, with_pi, ether_mode, cipher_key, udp, TERMINATE, SUSPEN
                 else:
                     raise
 
+        wakeups += 1
+
         # check for errors
         if errs:
             if reconnect is not None and remote in errs and tun not in errs:
@@ -437,7 +662,6 @@ def tun_fwd(tun, remote, with_pi, ether_mode, cipher_key, udp, TERMINATE, SUSPEN
             remoteok = True
         
         # check to see if we can write
-        #rr = wr = rt = wt = 0
         if remote in wrdy:
             sent = 0
             try:
@@ -450,7 +674,7 @@ def tun_fwd(tun, remote, with_pi, ether_mode, cipher_key, udp, TERMINATE, SUSPEN
                         
                         sentnow = rwrite(remote, packet)
                         sent += sentnow
-                        #wr += 1
+                        wr += 1
                         
                         if not udp and 0 <= sentnow < len(packet):
                             # packet partially sent
@@ -479,8 +703,11 @@ def tun_fwd(tun, remote, with_pi, ether_mode, cipher_key, udp, TERMINATE, SUSPEN
                 elif not udp:
                     # in UDP mode, we ignore errors - packet loss man...
                     raise
+                else:
+                    wrdrops += 1
                 #traceback.print_exc(file=sys.stderr)
             
+            wrbytes += sent
             if bwlimit:
                 bwfree -= sent
         if tun in wrdy:
@@ -488,7 +715,8 @@ def tun_fwd(tun, remote, with_pi, ether_mode, cipher_key, udp, TERMINATE, SUSPEN
                 for x in xrange(maxtbatch):
                     packet = pullPacket(bkbuf)
                     twrite(tunfd, packet)
-                    #wt += 1
+                    wt += 1
+                    wtbytes += len(packet)
                     
                     # Do not inject packets into the TUN faster than they arrive, unless we're falling
                     # behind. TUN devices discard packets if their queue is full (tunkqueue), but they
@@ -517,7 +745,8 @@ def tun_fwd(tun, remote, with_pi, ether_mode, cipher_key, udp, TERMINATE, SUSPEN
                     packet = tread(tunfd,2000) # tun.read blocks until it gets 2k!
                     if not packet:
                         continue
-                    #rt += 1
+                    rt += 1
+                    rtbytes += len(packet)
                     fwbuf.append(packet)
                     
                     if not tnonblock or len(fwbuf) >= maxfwbuf:
@@ -534,11 +763,10 @@ def tun_fwd(tun, remote, with_pi, ether_mode, cipher_key, udp, TERMINATE, SUSPEN
                     for x in xrange(maxbatch):
                         packet = rread(remote,2000)
                         
-                        #rr += 1
-                        
                         if crypto_mode:
                             packet = decrypt_(packet, crypter)
                             if not packet:
+                                rrdrops += 1
                                 continue
                         elif not packet:
                             if not udp and packet == "":
@@ -547,6 +775,8 @@ def tun_fwd(tun, remote, with_pi, ether_mode, cipher_key, udp, TERMINATE, SUSPEN
                             else:
                                 continue
 
+                        rr += 1
+                        rrbytes += len(packet)
                         bkbuf.append(packet)
                         
                         if not rnonblock or len(bkbuf) >= maxbkbuf:
@@ -567,6 +797,8 @@ def tun_fwd(tun, remote, with_pi, ether_mode, cipher_key, udp, TERMINATE, SUSPEN
                 elif not udp:
                     # in UDP mode, we ignore errors - packet loss man...
                     raise
+                else:
+                    rrdrops += 1
                 traceback.print_exc(file=sys.stderr)
 
         if bwlimit:
@@ -578,7 +810,433 @@ def tun_fwd(tun, remote, with_pi, ether_mode, cipher_key, udp, TERMINATE, SUSPEN
                     bwfree = min(bwfree+delta, maxbwfree)
                     lastbwtime = tnow
         
-        #print >>sys.stderr, "rr:%d\twr:%d\trt:%d\twt:%d" % (rr,wr,rt,wt)
+        if stats is not None:
+            tnow = tget()
+            if tnow >= stats.next:
+                stats.write(tnow, (wakeups, rt, rtbytes, wr, wrbytes, wrdrops,
+                    rr, rrbytes, rrdrops, wt, wtbytes, bwlimit_waits, 
+                    buffer_full, len(fwbuf), len(bkbuf)))
+
+    if stats is not None:
+        # Report the final counters
+        stats.write(tget(), (wakeups, rt, rtbytes, wr, wrbytes, wrdrops,
+            rr, rrbytes, rrdrops, wt, wtbytes, bwlimit_waits, 
+            buffer_full, len(fwbuf), len(bkbuf)))
+        stats.close()
+
+# Room left in front of the packets in the forwarding buffers, where
+# the PI header is written without copying the packet
+_HEADROOM = 16
+
+# Maximum size of the packets read from the TUN/TAP device or the
+# remote socket
+_MAXPACKET = 2000
+
+_epoll = getattr(select, 'epoll', None)
+
+class PacketPool(object):
+    """ Preallocated buffers for the packets waiting to be forwarded
+    in one direction.
+
+    Packets are read straight into free slots, and are queued as
+    (slot, start, end) tuples until they are written out, so the packet
+    data is never copied nor allocated per packet.
+    """
+    def __init__(self, size):
+        slotsize = _HEADROOM + _MAXPACKET
+        self.data = bytearray(size * slotsize)
+        data = memoryview(self.data)
+
+        self.slots = [ data[i*slotsize:(i+1)*slotsize] 
+                for i in xrange(size) ]
+        # The region of each slot where packets are read into
+        self.readviews = [ slot[_HEADROOM:_HEADROOM+_MAXPACKET] 
+                for slot in self.slots ]
+        self.free = range(size)
+        self.queue = collections.deque()
+
+def _tun_fwd_epoll(tun, remote, with_pi, ether_mode, cipher_key, udp, 
+        TERMINATE, SUSPEND, stderr = sys.stderr, tunqueue = 1000, 
+        tunkqueue = 1000, cipher = 'AES', accept_local = None, 
+        accept_remote = None, slowlocal = True, bwlimit = None, 
+        stats = None, stats_interval = 1.0, stats_queue = 0,
+        len = len, min = min, xrange = xrange, 
+        retrycodes = (errno.EWOULDBLOCK, errno.EAGAIN, errno.EINTR),
+        **kw):
+    """ Batched forwarding loop for UDP tunnels.
+
+    Each epoll wakeup drains up to 'maxbatch' packets from each file
+    descriptor into the preallocated buffers of a PacketPool, with
+    readinto on the TUN/TAP device and recv_into on the remote socket.
+    Queued packets are then written out from the same buffers. The PI
+    header, when needed, is written in the room left in front of each
+    packet.
+
+    Packet loss on the remote socket is ignored, as in the select loop,
+    but it is counted in the stats file, if any (see TunnelStats).
+    """
+    import io
+
+    crypter = get_crypter(cipher_key, cipher)
+
+    if stderr is not None:
+        if crypter:
+            print >>stderr, "Packets are transmitted in CIPHER"
+        else:
+            print >>stderr, "Packets are transmitted in PLAINTEXT"
+
+    tunfd = tun.fileno()
+    remotefd = remote.fileno()
+
+    nonblock(tunfd)
+    nonblock(remotefd)
+
+    tunio = io.FileIO(tunfd, 'r+', closefd = False)
+    tread = tunio.readinto
+    twrite = tunio.write
+
+    # The remote might be a file wrapping the socket, so the socket is
+    # accessed through a duplicate of its file descriptor
+    rsock = socket.fromfd(remotefd, socket.AF_INET, socket.SOCK_DGRAM)
+    rrecv_into = rsock.recv_into
+    rsend = rsock.send
+
+    maxbuf = max(10,tunqueue-tunkqueue)
+
+    # Let the socket buffers hold as many packets as the forwarding
+    # buffers, so bursts are not dropped while the other direction is
+    # being processed (the kernel caps the size to net.core.rmem_max)
+    for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+        try:
+            if rsock.getsockopt(socket.SOL_SOCKET, option) < maxbuf * 2048:
+                rsock.setsockopt(socket.SOL_SOCKET, option, maxbuf * 2048)
+        except socket.error:
+            pass
+
+    tunhurry = max(0,maxbuf/2)
+    maxbatch = 2000
+    maxtbatch = 50
+
+    fw = PacketPool(maxbuf)
+    bk = PacketPool(maxbuf)
+    fwslots = fw.slots
+    bkslots = bk.slots
+    fwqueue = fw.queue
+    bkqueue = bk.queue
+    fwfree = fw.free
+    bkfree = bk.free
+
+    EPOLLIN = select.EPOLLIN
+    EPOLLOUT = select.EPOLLOUT
+    EPOLLFAIL = select.EPOLLERR | select.EPOLLHUP
+
+    poller = _epoll()
+    tunmask = EPOLLIN
+    remotemask = EPOLLIN
+    poller.register(tunfd, tunmask)
+    poller.register(remotefd, remotemask)
+
+    # True when the last write would have blocked
+    tunblocked = False
+    remoteblocked = False
+
+    tget = time.time
+    maxbwfree = bwfree = 1500 * tunqueue
+    lastbwtime = tget()
+
+    piproto = "\x00\x00\x08\x00"
+
+    if stats is not None:
+        stats = TunnelStats(stats, stats_interval, stats_queue, tunfd)
+
+    # Counters, reported in the stats file
+    wakeups = 0
+    tun_rx_packets = tun_rx_bytes = 0
+    remote_tx_packets = remote_tx_bytes = remote_tx_drops = 0
+    remote_rx_packets = remote_rx_bytes = remote_rx_drops = 0
+    tun_tx_packets = tun_tx_bytes = 0
+    bwlimit_waits = buffer_full = 0
+
+    try:
+        while not TERMINATE:
+            # The SUSPEND flag has been set. This means we need to wait on
+            # the SUSPEND condition until it is released.
+            while SUSPEND and not TERMINATE:
+                time.sleep(0.5)
+
+            bwok = not bwlimit or bwfree > 0
+
+            mask = 0
+            if fwfree:
+                mask |= EPOLLIN
+            else:
+                buffer_full += 1
+            if bkqueue and tunblocked:
+                mask |= EPOLLOUT
+            if mask != tunmask:
+                poller.modify(tunfd, mask)
+                tunmask = mask
+
+            mask = 0
+            if bkfree:
+                mask |= EPOLLIN
+            else:
+                buffer_full += 1
+            if fwqueue and remoteblocked:
+                mask |= EPOLLOUT
+            if mask != remotemask:
+                poller.modify(remotefd, mask)
+                remotemask = mask
+
+            # Don't wait if there are packets that can be written now
+            if (bkqueue and not tunblocked) or \
+                    (fwqueue and not remoteblocked and bwok):
+                timeout = 0
+            elif fwqueue and not bwok:
+                timeout = min(1, max(0.001, float(1 - bwfree) / bwlimit))
+                bwlimit_waits += 1
+            else:
+                timeout = 1
+
+            try:
+                events = poller.poll(timeout)
+            except IOError, e:
+                if e.errno == errno.EINTR:
+                    # just retry
+                    continue
+                # If the SUSPEND flag has been set, then the TUN will be in
+                # a bad state and the error should be ignored.
+                if SUSPEND:
+                    continue
+                raise
+
+            wakeups += 1
+            tunready = remoteready = False
+            for fd, event in events:
+                if fd == tunfd:
+                    if event & EPOLLFAIL:
+                        if SUSPEND:
+                            continue
+                        return
+                    tunready = event & EPOLLIN
+                    if event & EPOLLOUT:
+                        tunblocked = False
+                else:
+                    if event & EPOLLFAIL:
+                        # In UDP mode, those are always transient errors.
+                        # Reading the socket error clears it.
+                        rsock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    remoteready = event & EPOLLIN
+                    if event & EPOLLOUT:
+                        remoteblocked = False
+
+            # check incoming packets from the TUN/TAP device
+            if tunready:
+                for x in xrange(maxbatch):
+                    if not fwfree:
+                        break
+
+                    slot = fwfree.pop()
+                    try:
+                        n = tread(fw.readviews[slot])
+                    except (IOError, OSError), e:
+                        fwfree.append(slot)
+                        if e.errno in retrycodes:
+                            break
+                        raise
+
+                    if n is None:
+                        # would block
+                        fwfree.append(slot)
+                        break
+                    
+                    start = _HEADROOM
+                    end = start + n
+                    if with_pi:
+                        # Strip the PI header
+                        start += 4
+
+                    if start >= end or (accept_local is not None and 
+                            not accept_local(fwslots[slot][start:end].tobytes(), 0)):
+                        fwfree.append(slot)
+                        continue
+                    
+                    fwqueue.append((slot, start, end))
+                    tun_rx_packets += 1
+                    tun_rx_bytes += end - start
+
+            # check incoming packets from the remote end
+            received = 0
+            if remoteready:
+                for x in xrange(maxbatch):
+                    if not bkfree:
+                        break
+
+                    slot = bkfree.pop()
+                    try:
+                        n = rrecv_into(bk.readviews[slot])
+                    except socket.error, e:
+                        bkfree.append(slot)
+                        if e.errno in retrycodes:
+                            break
+                        # in UDP mode, we ignore errors - packet loss man...
+                        remote_rx_drops += 1
+                        continue
+
+                    start = _HEADROOM
+                    end = start + n
+
+                    if n and crypter:
+                        view = bkslots[slot]
+                        try:
+                            packet = decrypt(view[start:end].tobytes(), crypter)
+                        except RuntimeError:
+                            traceback.print_exc(file=sys.stderr)
+                            packet = None
+
+                        if packet and (accept_remote is None or 
+                                accept_remote(packet, 1)):
+                            # The plain text is never longer than the
+                            # cipher text, write it back in place
+                            end = start + len(packet)
+                            view[start:end] = packet
+                        else:
+                            end = start
+                    elif n and accept_remote is not None and \
+                            not accept_remote(bkslots[slot][start:end].tobytes(), 1):
+                        end = start
+
+                    if start >= end:
+                        # Empty datagrams are keepalives, others could
+                        # not be decrypted or were not accepted
+                        if n:
+                            remote_rx_drops += 1
+                        bkfree.append(slot)
+                        continue
+
+                    bkqueue.append((slot, start, end))
+                    received += 1
+                    remote_rx_bytes += end - start
+
+                remote_rx_packets += received
+
+            # write packets to the remote end
+            if fwqueue and not remoteblocked and bwok:
+                sent = 0
+                for x in xrange(maxbatch):
+                    if not fwqueue or (bwlimit and bwfree - sent <= 0):
+                        break
+
+                    (slot, start, end) = fwqueue[0]
+                    if crypter:
+                        packet = encrypt(fwslots[slot][start:end].tobytes(), 
+                                crypter)
+                    else:
+                        packet = fwslots[slot][start:end]
+
+                    try:
+                        sent += rsend(packet)
+                        remote_tx_packets += 1
+                    except socket.error, e:
+                        if e.errno in retrycodes:
+                            remoteblocked = True
+                            break
+                        # in UDP mode, we ignore errors - packet loss man...
+                        remote_tx_drops += 1
+
+                    fwqueue.popleft()
+                    fwfree.append(slot)
+
+                remote_tx_bytes += sent
+                if bwlimit:
+                    bwfree -= sent
+
+            # write packets to the TUN/TAP device
+            if bkqueue and not tunblocked:
+                for x in xrange(maxtbatch):
+                    (slot, start, end) = bkqueue[0]
+                    view = bkslots[slot]
+
+                    if with_pi:
+                        # Write the PI header in front of the packet
+                        start -= 4
+                        if ether_mode and end - start > 18:
+                            if view[start+16:start+18].tobytes() == "\x81\x00":
+                                # tagged
+                                proto = view[start+20:start+22].tobytes()
+                            else:
+                                proto = view[start+16:start+18].tobytes()
+                            view[start:start+4] = "\x00\x00" + proto
+                        else:
+                            view[start:start+4] = piproto
+
+                    try:
+                        n = twrite(view[start:end])
+                    except (IOError, OSError), e:
+                        if e.errno in retrycodes:
+                            tunblocked = True
+                            break
+                        raise
+
+                    if n is None:
+                        # would block
+                        tunblocked = True
+                        break
+
+                    bkqueue.popleft()
+                    bkfree.append(slot)
+                    tun_tx_packets += 1
+                    tun_tx_bytes += n
+
+                    # Do not inject packets into the TUN faster than they
+                    # arrive, unless we're falling behind. TUN devices
+                    # discard packets if their queue is full (tunkqueue),
+                    # but they don't block either (they're always ready to
+                    # write), so if we flood the device we'll have high 
+                    # packet loss. Packets that arrived in the same batch
+                    # are written together.
+                    if not bkqueue or (slowlocal and x + 1 >= received and
+                            len(bkqueue) < tunhurry):
+                        break
+                else:
+                    if slowlocal:
+                        # Give some time for the kernel to process the packets
+                        time.sleep(0)
+
+            if bwlimit:
+                tnow = tget()
+                delta = tnow - lastbwtime
+                if delta > 0.001:
+                    delta = int(bwlimit * delta)
+                    if delta > 0:
+                        bwfree = min(bwfree+delta, maxbwfree)
+                        lastbwtime = tnow
+
+            if stats is not None:
+                tnow = tget()
+                if tnow >= stats.next:
+                    stats.write(tnow, (wakeups, 
+                        tun_rx_packets, tun_rx_bytes,
+                        remote_tx_packets, remote_tx_bytes, remote_tx_drops,
+                        remote_rx_packets, remote_rx_bytes, remote_rx_drops,
+                        tun_tx_packets, tun_tx_bytes,
+                        bwlimit_waits, buffer_full, 
+                        len(fwqueue), len(bkqueue)))
+    finally:
+        poller.close()
+        rsock.close()
+
+        if stats is not None:
+            # Report the final counters
+            stats.write(tget(), (wakeups, 
+                tun_rx_packets, tun_rx_bytes,
+                remote_tx_packets, remote_tx_bytes, remote_tx_drops,
+                remote_rx_packets, remote_rx_bytes, remote_rx_drops,
+                tun_tx_packets, tun_tx_bytes,
+                bwlimit_waits, buffer_full, 
+                len(fwqueue), len(bkqueue)))
+            stats.close()
+
 
 def udp_connect(TERMINATE, local_addr, local_port, peer_addr, peer_port):
     rsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 0)
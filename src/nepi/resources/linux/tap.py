@@ -79,6 +79,15 @@ class LinuxTap(LinuxApplication):
         pi = Attribute("pi", "Add PI (protocol information) header", 
                 default = False,
                 type = Types.Bool)
+
+        queues = Attribute("queues", 
+                "Number of queues of the device. With more than one queue "
+                "a multi-queue device is created, and UDP tunnels forward "
+                "each queue in a separate process over a separate UDP flow, "
+                "so they can use several cores", 
+                default = 1,
+                type = Types.Integer,
+                flags = Flags.Design)
  
         tear_down = Attribute("tearDown", 
                 "Bash script to be executed before releasing the resource",
@@ -95,6 +104,7 @@ class LinuxTap(LinuxApplication):
         cls._register_attribute(gre_key)
         cls._register_attribute(gre_remote)
         cls._register_attribute(pi)
+        cls._register_attribute(queues)
         cls._register_attribute(tear_down)
 
     def __init__(self, ec, guid):
@@ -285,16 +295,20 @@ class LinuxTap(LinuxApplication):
         return True
 
     def initiate_udp_connection(self, remote_endpoint, connection_app_home, 
-            connection_run_home, cipher, cipher_key, bwlimit, txqueuelen):
+            connection_run_home, cipher, cipher_key, bwlimit, txqueuelen,
+            queues = 1, stats = None, stats_interval = 1):
         port = self.udp_connect(remote_endpoint, connection_app_home, 
-            connection_run_home, cipher, cipher_key, bwlimit, txqueuelen)
+            connection_run_home, cipher, cipher_key, bwlimit, txqueuelen,
+            queues = queues, stats = stats, stats_interval = stats_interval)
         return port
 
     def udp_connect(self, remote_endpoint, connection_app_home, 
-            connection_run_home, cipher, cipher_key, bwlimit, txqueuelen):
+            connection_run_home, cipher, cipher_key, bwlimit, txqueuelen,
+            queues = 1, stats = None, stats_interval = 1):
         udp_connect_command = self._udp_connect_command(
                 remote_endpoint, connection_run_home,
-                cipher, cipher_key, bwlimit, txqueuelen)
+                cipher, cipher_key, bwlimit, txqueuelen, queues = queues,
+                stats = stats, stats_interval = stats_interval)
 
         # upload command to connect.sh script
         shfile = os.path.join(self.app_home, "udp-connect.sh")
@@ -331,7 +345,8 @@ class LinuxTap(LinuxApplication):
         return port
 
     def _udp_connect_command(self, remote_endpoint, connection_run_home, 
-            cipher, cipher_key, bwlimit, txqueuelen):
+            cipher, cipher_key, bwlimit, txqueuelen, queues = 1,
+            stats = None, stats_interval = 1):
 
         # Set the remote endpoint to the IP of the device
         self.set("pointopoint", remote_endpoint.get("ip"))
@@ -368,7 +383,9 @@ class LinuxTap(LinuxApplication):
         command.append("-N %s" % self.get("deviceName"))
         command.append("-t %s" % self.vif_type)
         if self.get("pi"):
-            command.append("-p")
+            command.append("-n")
+        if self.multi_queue:
+            command.append("-m -Q %d" % queues)
         command.append("-l %s " % local_port_file)
         command.append("-r %s " % remote_port_file)
         command.append("-H %s " % remote_ip)
@@ -381,6 +398,8 @@ class LinuxTap(LinuxApplication):
             command.append("-q %s " % txqueuelen)
         if bwlimit:
             command.append("-b %s " % bwlimit)
+        if stats:
+            command.append("-s %s -i %s " % (stats, stats_interval))
 
         command.append(")")
 
@@ -474,10 +493,11 @@ class LinuxTap(LinuxApplication):
             stop_command = self._stop_command
             
             start_command = []
-            start_command.append("sudo -S ip tuntap add %s mode %s %s" % (
+            start_command.append("sudo -S ip tuntap add %s mode %s %s %s" % (
                 self.get("deviceName"),
                 self.vif_prefix,
-                "pi" if self.get("pi") else ""))
+                "pi" if self.get("pi") else "",
+                "multi_queue" if self.multi_queue else ""))
             start_command.append("sudo -S ip link set %s up" % self.get("deviceName"))
             start_command.append("sudo -S ip addr add %s/%s dev %s" % (
                 self.get("ip"),
@@ -524,6 +544,10 @@ class LinuxTap(LinuxApplication):
 
         return ";".join(command)
 
+    @property
+    def multi_queue(self):
+        return (self.get("queues") or 1) > 1
+
     @property
     def vif_type(self):
         return "IFF_TAP"
@@ -18,7 +18,8 @@
 # Author: Alina Quereilhac <alina.quereilhac@inria.fr>
 
 from nepi.execution.resource import clsinit_copy, ResourceState
-from nepi.resources.linux.application import LinuxApplication
+from nepi.execution.trace import Trace, TraceAttr
+from nepi.resources.linux.application import LinuxApplication, read_trace
 from nepi.util.timefuncs import tnow, tdiffsec
 
 import os
@@ -32,6 +33,16 @@ class LinuxTunnel(LinuxApplication):
     _help = "Constructs a tunnel between two Linux endpoints"
     _backend = "linux"
 
+    @classmethod
+    def _register_traces(cls):
+        stats1 = Trace("stats1", "Traffic counters of the tunnel, "
+                "sampled periodically on the node of endpoint 1")
+        stats2 = Trace("stats2", "Traffic counters of the tunnel, "
+                "sampled periodically on the node of endpoint 2")
+
+        cls._register_trace(stats1)
+        cls._register_trace(stats2)
+
     def __init__(self, ec, guid):
         super(LinuxTunnel, self).__init__(ec, guid)
         self._home = "tunnel-%s" % self.guid
@@ -65,6 +76,66 @@ class LinuxTunnel(LinuxApplication):
     def run_home(self, endpoint):
         return os.path.join(self.app_home(endpoint), self.ec.run_id)
 
+    def trace_endpoint(self, name):
+        """ Returns the endpoint on which node the trace is collected """
+        if name == "stats1":
+            return self.endpoint1
+        if name == "stats2":
+            return self.endpoint2
+        return None
+
+    def stats_trace(self, endpoint):
+        """ Returns the name of the stats trace of the endpoint """
+        if endpoint == self.endpoint1:
+            return "stats1"
+        return "stats2"
+
+    def stats_filepath(self, endpoint):
+        """ Returns the path of the stats file on the node of the 
+        endpoint, or None if the stats trace is not enabled """
+        name = self.stats_trace(endpoint)
+        if not self.trace_enabled(name):
+            return None
+        return self.trace_filepath(name)
+
+    def trace_filepath(self, filename):
+        endpoint = self.trace_endpoint(filename)
+        if not endpoint:
+            return super(LinuxTunnel, self).trace_filepath(filename)
+        return os.path.join(self.run_home(endpoint), filename)
+
+    def trace(self, name, attr = TraceAttr.ALL, block = 512, offset = 0):
+        endpoint = self.trace_endpoint(name)
+        if not endpoint:
+            return super(LinuxTunnel, self).trace(name, attr = attr, 
+                    block = block, offset = offset)
+
+        return read_trace(self, endpoint.node, self.run_home(endpoint), name,
+                attr = attr, block = block, offset = offset)
+
+    def retrieve_trace(self, name, path, compress = True):
+        endpoint = self.trace_endpoint(name)
+        if not endpoint:
+            return super(LinuxTunnel, self).retrieve_trace(name, path,
+                    compress = compress)
+
+        remote_path = self.trace(name, attr = TraceAttr.PATH)
+        if not remote_path:
+            msg = " Couldn't find trace %s " % name
+            raise RuntimeError, msg
+
+        self.info("Fetching '%s' trace to %s " % (name, path))
+        endpoint.node.fetch(remote_path, path, compress = compress)
+
+    def follow_trace(self, name, offset = 0):
+        endpoint = self.trace_endpoint(name)
+        if not endpoint:
+            return super(LinuxTunnel, self).follow_trace(name, 
+                    offset = offset)
+
+        return endpoint.node.follow(self.trace_filepath(name), 
+                offset = offset)
+
     def initiate_connection(self, endpoint, remote_endpoint):
         raise NotImplementedError
 
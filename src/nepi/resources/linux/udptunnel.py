@@ -61,10 +61,18 @@ class LinuxUdpTunnel(LinuxTunnel):
                 type = Types.Integer, 
                 flags = Flags.Design)
 
+        stats_interval = Attribute("statsInterval",
+                "Seconds between two samples of the traffic counters, "
+                "when the stats1 or stats2 traces are enabled. ",
+                default = 1.0,
+                type = Types.Double, 
+                flags = Flags.Design)
+
         cls._register_attribute(cipher)
         cls._register_attribute(cipher_key)
         cls._register_attribute(txqueuelen)
         cls._register_attribute(bwlimit)
+        cls._register_attribute(stats_interval)
 
     def __init__(self, ec, guid):
         super(LinuxUdpTunnel, self).__init__(ec, guid)
@@ -87,6 +95,18 @@ class LinuxUdpTunnel(LinuxTunnel):
                 connected.append(rm)
         return connected
 
+    @property
+    def queues(self):
+        """ Number of UDP flows of the tunnel, one per device queue. 
+        Both endpoints must forward the same number of queues """
+        queues = []
+        for endpoint in self.get_endpoints():
+            if endpoint.has_attribute("queues"):
+                queues.append(endpoint.get("queues") or 1)
+            else:
+                queues.append(1)
+        return min(queues)
+
     def initiate_connection(self, endpoint, remote_endpoint):
         cipher = self.get("cipher")
         cipher_key = self.get("cipherKey")
@@ -95,11 +115,15 @@ class LinuxUdpTunnel(LinuxTunnel):
         connection_app_home = self.app_home(endpoint)
         connection_run_home = self.run_home(endpoint)
 
+        # The port is a space separated list of ports, one per queue
         port = endpoint.initiate_udp_connection(
                 remote_endpoint, 
                 connection_app_home,
                 connection_run_home, 
-                cipher, cipher_key, bwlimit, txqueuelen)
+                cipher, cipher_key, bwlimit, txqueuelen,
+                queues = self.queues,
+                stats = self.stats_filepath(endpoint),
+                stats_interval = self.get("statsInterval"))
 
         return port
 
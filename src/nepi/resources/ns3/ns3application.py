@@ -52,7 +52,7 @@ class NS3BaseApplication(NS3Base):
     def _connect_object(self):
         node = self.node
         if node.uuid not in self.connected:
-            self.simulation.invoke(node.uuid, "AddApplication", self.uuid)
+            self.simulation.defer_invoke(node.uuid, "AddApplication", self.uuid)
             self._connected.add(node.uuid)
 
     def do_stop(self):
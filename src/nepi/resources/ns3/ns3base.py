@@ -63,6 +63,25 @@ class NS3Base(ResourceManager):
 
         return self.simulation.trace(filename, attr, block, offset)
 
+    def retrieve_trace(self, name, path, compress = True):
+        filename = self._trace_filename.get(name)
+        if not filename:
+            msg = "Can not resolve trace %s. Did you enabled it?" % name
+            self.error(msg)
+            raise RuntimeError, msg
+
+        return self.simulation.retrieve_trace(filename, path, 
+                compress = compress)
+
+    def follow_trace(self, name, offset = 0):
+        filename = self._trace_filename.get(name)
+        if not filename:
+            msg = "Can not resolve trace %s. Did you enabled it?" % name
+            self.error(msg)
+            raise RuntimeError, msg
+
+        return self.simulation.follow_trace(filename, offset = offset)
+
     @property
     def _rms_to_wait(self):
         """ Returns the collection of ns-3 RMs that this RM needs to
@@ -88,7 +107,7 @@ class NS3Base(ResourceManager):
 
             kwargs[attr.name] = attr._value
 
-        self._uuid = self.simulation.factory(self.get_rtype(), **kwargs)
+        self._uuid = self.simulation.defer_factory(self.get_rtype(), **kwargs)
 
     def _configure_object(self):
         pass
@@ -96,7 +115,7 @@ class NS3Base(ResourceManager):
     def _connect_object(self):
         node = self.node
         if node and node.uuid not in self.connected:
-            self.simulation.invoke(node.uuid, "AggregateObject", self.uuid)
+            self.simulation.defer_invoke(node.uuid, "AggregateObject", self.uuid)
             self._connected.add(node.uuid)
 
     def _wait_rms(self):
@@ -107,9 +126,12 @@ class NS3Base(ResourceManager):
         return False
 
     def do_provision(self):
-        self._instantiate_object()
-        self._connect_object()
-        self._configure_object()
+        # Operations that don't need a reply are sent to the
+        # ns-3 server together, in a single message
+        with self.simulation.batch():
+            self._instantiate_object()
+            self._connect_object()
+            self._configure_object()
       
         self.info("Provisioning finished")
 
@@ -37,6 +37,9 @@ class NS3Client(object):
     def get(self, *args, **kwargs):
         pass
 
+    def batch(self, *args, **kwargs):
+        pass
+
     def flush(self, *args, **kwargs):
         pass
 
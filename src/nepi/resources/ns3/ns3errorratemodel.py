@@ -49,6 +49,6 @@ class NS3BaseErrorRateModel(NS3Base):
     def _connect_object(self):
         phy = self.phy
         if phy.uuid not in self.connected:
-            self.simulation.invoke(phy.uuid, "SetErrorRateModel", self.uuid)
+            self.simulation.defer_invoke(phy.uuid, "SetErrorRateModel", self.uuid)
             self._connected.add(phy.uuid)
 
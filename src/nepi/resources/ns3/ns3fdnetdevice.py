@@ -37,7 +37,7 @@ class NS3BaseFdNetDevice(NS3BaseNetDevice):
     def _connect_object(self):
         node = self.node
         if node and node.uuid not in self.connected:
-            self.simulation.invoke(node.uuid, "AddDevice", self.uuid)
+            self.simulation.defer_invoke(node.uuid, "AddDevice", self.uuid)
             self._connected.add(node.uuid)
 
     def _instantiate_object(self):
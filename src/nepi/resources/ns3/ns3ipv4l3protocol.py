@@ -51,15 +51,15 @@ class NS3BaseIpv4L3Protocol(NS3Base):
     def _configure_object(self):
         simulation = self.simulation
 
-        self.list_routing_uuid = simulation.create("Ipv4ListRouting")
-        simulation.invoke(self.uuid, "SetRoutingProtocol", self.list_routing_uuid)
+        self.list_routing_uuid = simulation.defer_create("Ipv4ListRouting")
+        simulation.defer_invoke(self.uuid, "SetRoutingProtocol", self.list_routing_uuid)
 
-        self.static_routing_uuid = simulation.create("Ipv4StaticRouting")
-        simulation.invoke(self.list_routing_uuid, "AddRoutingProtocol", 
+        self.static_routing_uuid = simulation.defer_create("Ipv4StaticRouting")
+        simulation.defer_invoke(self.list_routing_uuid, "AddRoutingProtocol", 
                 self.static_routing_uuid, 0)
 
-        self.global_routing_uuid = simulation.create("Ipv4GlobalRouting")
-        simulation.invoke(self.list_routing_uuid, "AddRoutingProtocol", 
+        self.global_routing_uuid = simulation.defer_create("Ipv4GlobalRouting")
+        simulation.defer_invoke(self.list_routing_uuid, "AddRoutingProtocol", 
                 self.global_routing_uuid, -10)
 
     def _connect_object(self):
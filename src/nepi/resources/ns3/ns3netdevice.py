@@ -146,11 +146,11 @@ class NS3BaseNetDevice(NS3Base):
     def _configure_mac_address(self):
         mac = self.get("mac")
         if mac:
-            mac_uuid = self.simulation.create("Mac48Address", mac)
+            mac_uuid = self.simulation.defer_create("Mac48Address", mac)
         else:
-            mac_uuid = self.simulation.invoke("singleton::Mac48Address", "Allocate")
+            mac_uuid = self.simulation.defer_invoke("singleton::Mac48Address", "Allocate")
 
-        self.simulation.invoke(self.uuid, "SetAddress", mac_uuid)
+        self.simulation.defer_invoke(self.uuid, "SetAddress", mac_uuid)
 
     def _configure_ip_address(self):
         ip = self.get("ip")
@@ -162,14 +162,14 @@ class NS3BaseNetDevice(NS3Base):
             ipv4 = self.node.ipv4
             ifindex_uuid = self.simulation.invoke(ipv4.uuid, "AddInterface", 
                     self.uuid)
-            ipv4_addr_uuid = self.simulation.create("Ipv4Address", ip)
-            ipv4_mask_uuid = self.simulation.create("Ipv4Mask", "/%s" % str(prefix))
-            inaddr_uuid = self.simulation.create("Ipv4InterfaceAddress", 
+            ipv4_addr_uuid = self.simulation.defer_create("Ipv4Address", ip)
+            ipv4_mask_uuid = self.simulation.defer_create("Ipv4Mask", "/%s" % str(prefix))
+            inaddr_uuid = self.simulation.defer_create("Ipv4InterfaceAddress", 
                     ipv4_addr_uuid, ipv4_mask_uuid)
-            self.simulation.invoke(ipv4.uuid, "AddAddress", ifindex_uuid, 
+            self.simulation.defer_invoke(ipv4.uuid, "AddAddress", ifindex_uuid, 
                     inaddr_uuid)
-            self.simulation.invoke(ipv4.uuid, "SetMetric", ifindex_uuid, 1)
-            self.simulation.invoke(ipv4.uuid, "SetUp", ifindex_uuid)
+            self.simulation.defer_invoke(ipv4.uuid, "SetMetric", ifindex_uuid, 1)
+            self.simulation.defer_invoke(ipv4.uuid, "SetUp", ifindex_uuid)
         else:
             # IPv6
             # TODO!
@@ -214,12 +214,12 @@ class NS3BaseNetDevice(NS3Base):
     def _connect_object(self):
         node = self.node
         if node and node.uuid not in self.connected:
-            self.simulation.invoke(node.uuid, "AddDevice", self.uuid)
+            self.simulation.defer_invoke(node.uuid, "AddDevice", self.uuid)
             self._connected.add(node.uuid)
 
         channel = self.channel
         if channel and channel.uuid not in self.connected:
-            self.simulation.invoke(self.uuid, "Attach", channel.uuid)
+            self.simulation.defer_invoke(self.uuid, "Attach", channel.uuid)
             self._connected.add(channel.uuid)
         
         # Verify that the device has a queue. If no queue is added a segfault 
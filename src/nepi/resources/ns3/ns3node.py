@@ -140,8 +140,8 @@ class NS3BaseNode(NS3Base):
 
     def _configure_object(self):
         if self.get("enableStack"):
-            uuid_stack_helper = self.simulation.create("InternetStackHelper")
-            self.simulation.invoke(uuid_stack_helper, "Install", self.uuid)
+            uuid_stack_helper = self.simulation.defer_create("InternetStackHelper")
+            self.simulation.defer_invoke(uuid_stack_helper, "Install", self.uuid)
 
             # Retrieve IPV4 object
             ipv4_uuid = self.simulation.invoke(self.uuid, "retrieveObject",
@@ -155,8 +155,8 @@ class NS3BaseNode(NS3Base):
             ipv4rm.set_started()
         else:
             ### node.AggregateObject(PacketSocketFactory())
-            uuid_packet_socket_factory = self.simulation.create("PacketSocketFactory")
-            self.simulation.invoke(self.uuid, "AggregateObject", uuid_packet_socket_factory)
+            uuid_packet_socket_factory = self.simulation.defer_create("PacketSocketFactory")
+            self.simulation.defer_invoke(self.uuid, "AggregateObject", uuid_packet_socket_factory)
 
         self._node_id = self.simulation.invoke(self.uuid, "GetId")
         
@@ -168,19 +168,19 @@ class NS3BaseNode(NS3Base):
         if not self.get("enableStack"):
             ipv4 = self.ipv4
             if ipv4:
-                self.simulation.invoke(self.uuid, "AggregateObject", ipv4.uuid)
+                self.simulation.defer_invoke(self.uuid, "AggregateObject", ipv4.uuid)
                 self._connected.add(ipv4.uuid)
                 ipv4._connected.add(self.uuid)
 
             arp = self.arp
             if arp:
-                self.simulation.invoke(self.uuid, "AggregateObject", arp.uuid)
+                self.simulation.defer_invoke(self.uuid, "AggregateObject", arp.uuid)
                 self._connected.add(arp.uuid)
                 arp._connected.add(self.uuid)
 
         mobility = self.mobility
         if mobility:
-            self.simulation.invoke(self.uuid, "AggregateObject", mobility.uuid)
+            self.simulation.defer_invoke(self.uuid, "AggregateObject", mobility.uuid)
             self._connected.add(mobility.uuid)
             mobility._connected.add(self.uuid)
 
@@ -49,6 +49,6 @@ class NS3BasePropagationDelayModel(NS3Base):
     def _connect_object(self):
         channel = self.channel
         if channel.uuid not in self.connected:
-            self.simulation.invoke(channel.uuid, "SetPropagationDelayModel", self.uuid)
+            self.simulation.defer_invoke(channel.uuid, "SetPropagationDelayModel", self.uuid)
             self._connected.add(channel.uuid)
 
@@ -49,7 +49,7 @@ class NS3BaseQueue(NS3Base):
     def _connect_object(self):
         device = self.device
         if device.uuid not in self.connected:
-            self.simulation.invoke(device.uuid, "SetQueue", self.uuid)
+            self.simulation.defer_invoke(device.uuid, "SetQueue", self.uuid)
             self._connected.add(device.uuid)
             device._connected.add(self.uuid)
 
@@ -22,8 +22,12 @@ import cPickle
 import errno
 import logging
 import os
+import select
 import socket
+import struct
 import sys
+import time
+import traceback
 
 from optparse import OptionParser, SUPPRESS_HELP
 
@@ -39,6 +43,7 @@ class NS3WrapperMessage:
     START = "START"
     STOP = "STOP"
     SHUTDOWN = "SHUTDOWN"
+    BATCH = "BATCH"
 
 def handle_message(ns3_wrapper, msg_type, args, kwargs):
     if msg_type == NS3WrapperMessage.SHUTDOWN:
@@ -87,6 +92,11 @@ def handle_message(ns3_wrapper, msg_type, args, kwargs):
 
         return ns3_wrapper.set(uuid, name, value)
 
+    if msg_type == NS3WrapperMessage.BATCH:
+        ops = args.pop(0)
+
+        return ns3_wrapper.batch(ops)
+
     if msg_type == NS3WrapperMessage.FLUSH:
         # Forces flushing output and error streams.
         # NS-3 output will stay unflushed until the program exits or 
@@ -130,6 +140,52 @@ def recv_msg(conn):
  
     msg = ''.join(msg).strip()
 
+    return decode_msg(msg)
+
+def send_reply(conn, reply):
+    encoded = base64.b64encode(cPickle.dumps(reply))
+    conn.send("%s\n" % encoded)
+
+# Persistent connections start with the FRAMED_HANDSHAKE line. Afterwards
+# messages are exchanged as frames, each one preceded by its length
+# (4 bytes, network order). Request frames contain:
+#   MESSAGE_ID|MESSAGE_TYPE|args|kwargs
+# and reply frames:
+#   MESSAGE_ID|(ok, reply)
+#
+# where all but the MESSAGE_ID are pickled and encoded in base64.
+# Replies carry the id of the request, so requests can be pipelined.
+FRAMED_HANDSHAKE = "FRAMED"
+
+# Seconds a new connection has to send its first line
+HANDSHAKE_TIMEOUT = 5
+
+def encode_frame(msg_id, items):
+    encoded = "|".join([str(msg_id)] + 
+            [base64.b64encode(cPickle.dumps(item)) for item in items])
+    return struct.pack("!I", len(encoded)) + encoded
+
+def decode_frames(buf):
+    """ Extracts the complete frames in buf. Returns a list of 
+    (msg_id, items) tuples and the remaining data """
+    frames = []
+
+    while len(buf) >= 4:
+        (length, ) = struct.unpack("!I", buf[:4])
+        if len(buf) < length + 4:
+            break
+
+        frame = buf[4:length + 4]
+        buf = buf[length + 4:]
+
+        parts = frame.split("|")
+        msg_id = parts.pop(0)
+        items = [cPickle.loads(base64.b64decode(item)) for item in parts]
+        frames.append((msg_id, items))
+
+    return frames, buf
+
+def decode_msg(msg):
     # The message is formatted as follows:
     #   MESSAGE_TYPE|args|kwargs
     #
@@ -139,7 +195,7 @@ def recv_msg(conn):
         item = base64.b64decode(item).rstrip()
         return cPickle.loads(item)
 
-    decoded = map(decode, msg.split("|"))
+    decoded = map(decode, msg.strip().split("|"))
 
     # decoded message
     dmsg_type = decoded.pop(0)
@@ -148,10 +204,6 @@ def recv_msg(conn):
 
     return (dmsg_type, dargs, dkwargs)
 
-def send_reply(conn, reply):
-    encoded = base64.b64encode(cPickle.dumps(reply))
-    conn.send("%s\n" % encoded)
-
 def get_options():
     usage = ("usage: %prog -S <socket-name> -L <ns-log>  -D <enable-dump> -v ")
     
@@ -171,6 +223,12 @@ def get_options():
         action = "store_true",
         default = False)
 
+    parser.add_option("-R", "--relay",
+        help="Relay standard input and output to the socket of a running "
+            "server, instead of starting a new server",
+        action="store_true",
+        dest="relay", default=False)
+
     parser.add_option("-v", "--verbose",
         help="Print debug output",
         action="store_true", 
@@ -179,7 +237,162 @@ def get_options():
     (options, args) = parser.parse_args()
     
     return (options.socket_name, options.verbose, options.ns_log,
-            options.enable_dump)
+            options.enable_dump, options.relay)
+
+def handle_legacy_message(ns3_wrapper, conn, msg):
+    """ Handles a connection that sends a single message. 
+    Returns True if the server must stop """
+    try:
+        (msg_type, args, kwargs) = decode_msg(msg)
+    except:
+        # Ignore - connection lost
+        close_socket(conn)
+        return False
+
+    try:
+        reply = handle_message(ns3_wrapper, msg_type, list(args), kwargs)  
+    except:
+        err = traceback.format_exc()
+        ns3_wrapper.logger.error(err) 
+        close_socket(conn)
+        raise
+
+    try:
+        send_reply(conn, reply)
+    except socket.error:
+        err = traceback.format_exc()
+        ns3_wrapper.logger.error(err) 
+        close_socket(conn)
+        raise
+    
+    close_socket(conn)
+
+    return msg_type == NS3WrapperMessage.SHUTDOWN
+
+def accept_connection(sock, handshakes):
+    """ Accepts a new connection. Its first line is read from the main
+    loop as it arrives (see read_handshake) """
+    conn, addr = sock.accept()
+    handshakes[conn] = ("", time.time() + HANDSHAKE_TIMEOUT)
+
+def read_handshake(ns3_wrapper, conn, handshakes, conns):
+    """ Reads the first line of a new connection, and either handles 
+    the legacy message or makes the connection persistent. 
+    Returns True if the server must stop """
+    data, deadline = handshakes[conn]
+
+    try:
+        chunk = conn.recv(4096)
+    except (OSError, socket.error), e:
+        if e[0] == errno.EINTR:
+            return False
+        chunk = ''
+
+    data += chunk
+    if chunk and '\n' not in data:
+        handshakes[conn] = (data, deadline)
+        return False
+
+    del handshakes[conn]
+
+    line, sep, rest = data.partition('\n')
+    if line.strip() != FRAMED_HANDSHAKE:
+        return handle_legacy_message(ns3_wrapper, conn, line)
+
+    conns[conn] = rest
+
+    # Frames might have arrived together with the handshake
+    return process_frames(ns3_wrapper, conn, conns)
+
+def expire_handshakes(handshakes):
+    """ Closes the new connections that didn't send their first line
+    in time """
+    now = time.time()
+
+    for conn, (data, deadline) in handshakes.items():
+        if deadline <= now:
+            # Ingore time-out
+            del handshakes[conn]
+            close_socket(conn)
+
+def serve_connection(ns3_wrapper, conn, conns):
+    """ Reads from a persistent connection and processes the complete
+    messages. Returns True if the server must stop """
+    try:
+        chunk = conn.recv(65536)
+    except (OSError, socket.error), e:
+        if e[0] == errno.EINTR:
+            return False
+        chunk = ''
+
+    if not chunk:
+        # Connection closed
+        del conns[conn]
+        close_socket(conn)
+        return False
+
+    conns[conn] += chunk
+
+    return process_frames(ns3_wrapper, conn, conns)
+
+def process_frames(ns3_wrapper, conn, conns):
+    frames, conns[conn] = decode_frames(conns[conn])
+
+    for msg_id, (msg_type, args, kwargs) in frames:
+        try:
+            reply = (True, handle_message(ns3_wrapper, msg_type, 
+                list(args), kwargs))
+        except:
+            err = traceback.format_exc()
+            ns3_wrapper.logger.error(err) 
+            reply = (False, err)
+
+        try:
+            conn.sendall(encode_frame(msg_id, [reply]))
+        except socket.error:
+            err = traceback.format_exc()
+            ns3_wrapper.logger.error(err) 
+            del conns[conn]
+            close_socket(conn)
+            return msg_type == NS3WrapperMessage.SHUTDOWN
+
+        if msg_type == NS3WrapperMessage.SHUTDOWN:
+            return True
+
+    return False
+
+def run_relay(socket_name):
+    """ Copies the standard input to the server socket, and the data 
+    received through the socket to the standard output. Used to keep 
+    a persistent connection to the server over a single ssh channel """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_name)
+
+    stdin = sys.stdin.fileno()
+    stdout = sys.stdout.fileno()
+
+    while True:
+        try:
+            rlist, wlist, xlist = select.select([stdin, sock], [], [])
+        except select.error, e:
+            if e[0] != errno.EINTR:
+                raise
+            continue
+
+        if stdin in rlist:
+            data = os.read(stdin, 65536)
+            if not data:
+                break
+            sock.sendall(data)
+
+        if sock in rlist:
+            data = sock.recv(65536)
+            if not data:
+                break
+            while data:
+                data = data[os.write(stdout, data):]
+
+    close_socket(sock)
 
 def run_server(socket_name, level = logging.INFO, ns_log = None, 
         enable_dump = False):
@@ -196,57 +409,61 @@ def run_server(socket_name, level = logging.INFO, ns_log = None,
 
     # create unix socket to receive instructions
     sock = open_socket(socket_name)
-    sock.listen(0)
+    sock.listen(5)
+
+    serve(ns3_wrapper, sock)
+
+    ns3_wrapper.logger.info("EXITING...")
+
+def serve(ns3_wrapper, sock):
+    """ Processes the messages received through the listening socket 
+    until a SHUTDOWN message arrives """
+
+    # new connections that didn't send their first line yet
+    handshakes = dict()
+
+    # persistent connections and the data received through them
+    conns = dict()
 
     # wait for messages to arrive and process them
     stop = False
 
     while not stop:
-        conn, addr = sock.accept()
-        conn.settimeout(5)
+        timeout = HANDSHAKE_TIMEOUT if handshakes else None
 
         try:
-            (msg_type, args, kwargs) = recv_msg(conn)
-        except socket.timeout, e:
-            # Ingore time-out
-            close_socket(conn)
+            rlist, wlist, xlist = select.select([sock] + handshakes.keys() + 
+                    conns.keys(), [], [], timeout)
+        except select.error, e:
+            if e[0] != errno.EINTR:
+                raise
             continue
 
-        if not msg_type:
-            # Ignore - connection lost
-            close_socket(conn)
-            continue
+        for s in rlist:
+            if s == sock:
+                accept_connection(sock, handshakes)
+            elif s in handshakes:
+                stop = read_handshake(ns3_wrapper, s, handshakes, conns)
+            else:
+                stop = serve_connection(ns3_wrapper, s, conns)
 
-        if msg_type == NS3WrapperMessage.SHUTDOWN:
-           stop = True
-  
-        try:
-            reply = handle_message(ns3_wrapper, msg_type, args, kwargs)  
-        except:
-            import traceback
-            err = traceback.format_exc()
-            ns3_wrapper.logger.error(err) 
-            close_socket(conn)
-            raise
+            if stop:
+                break
 
-        try:
-            send_reply(conn, reply)
-        except socket.error:
-            import traceback
-            err = traceback.format_exc()
-            ns3_wrapper.logger.error(err) 
-            close_socket(conn)
-            raise
-        
+        expire_handshakes(handshakes)
+
+    for conn in handshakes.keys() + conns.keys():
         close_socket(conn)
 
     close_socket(sock)
 
-    ns3_wrapper.logger.info("EXITING...")
-
 if __name__ == '__main__':
             
-    (socket_name, verbose, ns_log, enable_dump) = get_options()
+    (socket_name, verbose, ns_log, enable_dump, relay) = get_options()
+
+    if relay:
+        run_relay(socket_name)
+        sys.exit(0)
 
     ## configure logging
     FORMAT = "%(asctime)s %(name)s %(levelname)-4s %(message)s"
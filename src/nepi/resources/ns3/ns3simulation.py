@@ -17,35 +17,175 @@
 #
 # Author: Alina Quereilhac <alina.quereilhac@inria.fr>
 
+from contextlib import contextmanager
+from uuid import uuid4
+
+import threading
+
+class NS3Batch(object):
+    """ Operations queued to be sent to the ns-3 server in a single
+    BATCH message (see NS3Wrapper.batch) """
+    def __init__(self):
+        self.ops = []
+
 class NS3Simulation(object):
+    def __init__(self):
+        # batches opened by each thread (see 'batch')
+        self._batches = threading.local()
+
     @property
     def client(self):
         return self._client
 
+    def make_uuid(self):
+        """ Returns a new uuid for an ns-3 object. Uuids are chosen on 
+        the client side, so operations on the new object can be queued
+        before it is created """
+        return "uuid%s" % uuid4()
+
+    @contextmanager
+    def batch(self):
+        """ Queues the operations requested with the 'defer_' methods 
+        inside the block, and sends them to the ns-3 server in a single
+        BATCH message when the block ends. 
+        
+        Any other operation invoked by the same thread sends the queued 
+        operations first, so the order of the operations is kept.
+
+        """
+        if getattr(self._batches, "current", None):
+            # nested block, the operations are sent by the outer one
+            yield
+            return
+
+        self._batches.current = NS3Batch()
+        try:
+            yield
+            self.flush_batch()
+        finally:
+            self._batches.current = None
+
+    def flush_batch(self):
+        """ Sends the operations queued by the current thread """
+        batch = getattr(self._batches, "current", None)
+        if not batch or not batch.ops:
+            return
+
+        ops = batch.ops
+        batch.ops = []
+
+        self._execute_batch(ops)
+
+    def _execute_batch(self, ops):
+        results = self.client.batch(ops)
+
+        for (method, uuid, args, kwargs), (ok, result) in zip(ops, results):
+            if not ok:
+                msg = "ns-3 %s %s failed: %s" % (method, str(args), result)
+                raise RuntimeError, msg
+
+        return [result for (ok, result) in results]
+
+    def _defer(self, method, uuid, args, kwargs):
+        op = (method, uuid, args, kwargs)
+
+        batch = getattr(self._batches, "current", None)
+        if batch is None:
+            # No batch open, execute immediately
+            self._execute_batch([op])
+        else:
+            batch.ops.append(op)
+
+        return uuid
+
+    def defer_create(self, clazzname, *args):
+        """ Queues a 'create' operation. Returns the uuid of the new object """
+        return self._defer("create", self.make_uuid(), (clazzname, ) + args, 
+                dict())
+
+    def defer_factory(self, type_name, **kwargs):
+        """ Queues a 'factory' operation. Returns the uuid of the new object """
+        return self._defer("factory", self.make_uuid(), (type_name, ), kwargs)
+
+    def defer_invoke(self, uuid, operation, *args, **kwargs):
+        """ Queues an 'invoke' operation. Returns the uuid that will identify
+        the returned object, if the operation returns one """
+        return self._defer("invoke", self.make_uuid(), 
+                (uuid, operation) + args, kwargs)
+
+    def defer_set(self, uuid, name, value):
+        """ Queues a 'set' operation """
+        self._defer("set", None, (uuid, name, value), dict())
+
     def create(self, *args, **kwargs):
+        self.flush_batch()
         return self.client.create(*args, **kwargs)
 
     def factory(self, *args, **kwargs):
+        self.flush_batch()
         return self.client.factory(*args, **kwargs)
 
     def invoke(self, *args, **kwargs):
+        self.flush_batch()
         return self.client.invoke(*args, **kwargs)
 
     def ns3_set(self, *args, **kwargs):
+        self.flush_batch()
         return self.client.set(*args, **kwargs)
 
     def ns3_get(self, *args, **kwargs):
+        self.flush_batch()
         return self.client.get(*args, **kwargs)
 
+    def ns3_set_many(self, values):
+        """ Sets many attributes with a single message to the ns-3 server.
+        While the simulation is running, all values are set in the same
+        simulation event.
+
+        :param values: List of (uuid, name, value) tuples
+        :type values: list
+
+        """
+        self.flush_batch()
+        ops = [("set", None, (uuid, name, value), dict()) 
+                for (uuid, name, value) in values]
+        return self._execute_batch(ops)
+
+    def ns3_get_many(self, attrs):
+        """ Returns the values of many attributes, retrieved with a single 
+        message to the ns-3 server.
+
+        :param attrs: List of (uuid, name) tuples
+        :type attrs: list
+
+        """
+        self.flush_batch()
+        ops = [("get", None, (uuid, name), dict()) for (uuid, name) in attrs]
+        return self._execute_batch(ops)
+
+    def invoke_many(self, calls):
+        """ Invokes many operations with a single message to the ns-3 
+        server, and returns their results.
+
+        :param calls: List of (uuid, operation, arg1, arg2, ...) tuples
+        :type calls: list
+
+        """
+        self.flush_batch()
+        ops = [("invoke", None, tuple(call), dict()) for call in calls]
+        return self._execute_batch(ops)
+
     def flush(self, *args, **kwargs):
+        self.flush_batch()
         return self.client.flush(*args, **kwargs)
 
     def start(self, *args, **kwargs):
+        self.flush_batch()
         return self.client.start(*args, **kwargs)
 
     def stop(self, *args, **kwargs):
+        self.flush_batch()
         return self.client.stop(*args, **kwargs)
 
     def shutdown(self, *args, **kwargs):
         return self.client.shutdown(*args, **kwargs)
-
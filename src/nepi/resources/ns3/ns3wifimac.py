@@ -63,18 +63,18 @@ class NS3BaseWifiMac(NS3Base):
         if device.uuid not in self.connected:
             self._connected.add(device.uuid)
 
-            self.simulation.invoke(device.uuid, "SetMac", self.uuid)
+            self.simulation.defer_invoke(device.uuid, "SetMac", self.uuid)
 
             standard = self.get("Standard")
-            self.simulation.invoke(self.uuid, "ConfigureStandard", WIFI_STANDARDS[standard])
+            self.simulation.defer_invoke(self.uuid, "ConfigureStandard", WIFI_STANDARDS[standard])
 
             # Delayed configuration of MAC address
             mac = device.get("mac")
             if mac:
-                mac_uuid = self.simulation.create("Mac48Address", mac)
+                mac_uuid = self.simulation.defer_create("Mac48Address", mac)
             else:
-                mac_uuid = self.simulation.invoke("singleton::Mac48Address", "Allocate")
+                mac_uuid = self.simulation.defer_invoke("singleton::Mac48Address", "Allocate")
 
-            self.simulation.invoke(self.uuid, "SetAddress", mac_uuid)
+            self.simulation.defer_invoke(self.uuid, "SetAddress", mac_uuid)
 
 
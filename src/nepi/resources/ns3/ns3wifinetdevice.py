@@ -49,6 +49,6 @@ class NS3BaseWifiNetDevice(NS3BaseNetDevice):
     def _connect_object(self):
         node = self.node
         if node and node.uuid not in self.connected:
-            self.simulation.invoke(node.uuid, "AddDevice", self.uuid)
+            self.simulation.defer_invoke(node.uuid, "AddDevice", self.uuid)
             self._connected.add(node.uuid)
 
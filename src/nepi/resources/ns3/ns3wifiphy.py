@@ -75,14 +75,14 @@ class NS3BaseWifiPhy(NS3Base):
         if device.uuid not in self.connected:
             self._connected.add(device.uuid)
 
-            self.simulation.invoke(self.uuid, "SetMobility", self.node.uuid)
+            self.simulation.defer_invoke(self.uuid, "SetMobility", self.node.uuid)
 
             standard = self.get("Standard")
-            self.simulation.invoke(self.uuid, "ConfigureStandard", WIFI_STANDARDS[standard])
+            self.simulation.defer_invoke(self.uuid, "ConfigureStandard", WIFI_STANDARDS[standard])
 
-            self.simulation.invoke(self.uuid, "SetDevice", device.uuid)
+            self.simulation.defer_invoke(self.uuid, "SetDevice", device.uuid)
 
-            self.simulation.invoke(self.uuid, "SetChannel", self.channel.uuid)
+            self.simulation.defer_invoke(self.uuid, "SetChannel", self.channel.uuid)
             
-            self.simulation.invoke(device.uuid, "SetPhy", self.uuid)
+            self.simulation.defer_invoke(device.uuid, "SetPhy", self.uuid)
 
@@ -104,7 +104,7 @@ class NS3Wrapper(object):
     def __init__(self, loglevel = logging.INFO, enable_dump = False):
         super(NS3Wrapper, self).__init__()
         # Thread used to run the simulation
-        self._simulation_thread = None
+        self._simulator_thread = None
         self._condition = None
 
         # True if Simulator::Run was invoked
@@ -189,21 +189,44 @@ class NS3Wrapper(object):
     def is_finished(self):
         return self.ns3.Simulator.IsFinished()
 
+    @property
+    def must_schedule(self):
+        """ True if operations on objects must be scheduled as simulation
+        events. This is the case while the simulation is running, except 
+        for code that already executes inside an event """
+        return self.is_running and \
+                threading.current_thread() != self._simulator_thread
+
     def make_uuid(self):
         return "uuid%s" % uuid.uuid4()
 
     def get_object(self, uuid):
         return self._objects.get(uuid)
 
+    def _check_uuid(self, uuid):
+        """ Validates a uuid chosen by the client """
+        # arguments starting with 'uuid' are replaced by the
+        # corresponding objects (see replace_args)
+        if not str(uuid).startswith("uuid"):
+            raise ValueError("Invalid uuid %s, must start with 'uuid'" % uuid)
+
+        if uuid in self._objects:
+            raise ValueError("Duplicated uuid %s" % uuid)
+
     def factory(self, type_name, **kwargs):
         """ This method should be used to construct ns-3 objects
         that have a TypeId and related introspection information """
+        return self.factory_with_uuid(self.make_uuid(), type_name, **kwargs)
+
+    def factory_with_uuid(self, uuid, type_name, **kwargs):
+        """ Same as factory, but the new object is identified by
+        the uuid chosen by the client """
 
         if type_name not in self.allowed_types:
             msg = "Type %s not supported" % (type_name) 
             self.logger.error(msg)
 
-        uuid = self.make_uuid()
+        self._check_uuid(uuid)
         
         ### DEBUG
         self.logger.debug("FACTORY %s( %s )" % (type_name, str(kwargs)))
@@ -231,12 +254,17 @@ class NS3Wrapper(object):
     def create(self, clazzname, *args):
         """ This method should be used to construct ns-3 objects that
         do not have a TypeId (e.g. Values) """
+        return self.create_with_uuid(self.make_uuid(), clazzname, *args)
+
+    def create_with_uuid(self, uuid, clazzname, *args):
+        """ Same as create, but the new object is identified by
+        the uuid chosen by the client """
 
         if not hasattr(self.ns3, clazzname):
             msg = "Type %s not supported" % (clazzname) 
             self.logger.error(msg)
 
-        uuid = self.make_uuid()
+        self._check_uuid(uuid)
         
         ### DEBUG
         self.logger.debug("CREATE %s( %s )" % (clazzname, str(args)))
@@ -261,13 +289,20 @@ class NS3Wrapper(object):
         return uuid
 
     def invoke(self, uuid, operation, *args, **kwargs):
+        return self.invoke_with_uuid(None, uuid, operation, *args, **kwargs)
+
+    def invoke_with_uuid(self, newuuid, uuid, operation, *args, **kwargs):
+        """ Same as invoke, but if the operation returns an object
+        it will be identified by newuuid, chosen by the client """
+        if newuuid:
+            self._check_uuid(newuuid)
+
         ### DEBUG
         self.logger.debug("INVOKE %s -> %s( %s, %s ) " % (
             uuid, operation, str(args), str(kwargs)))
         ########
 
         result = None
-        newuuid = None
 
         if operation == "isRunning":
             result = self.is_running
@@ -301,7 +336,8 @@ class NS3Wrapper(object):
             self.debuger.dump_invoke(result, uuid, operation, args, kwargs)
        
         else:
-            newuuid = self.make_uuid()
+            if not newuuid:
+                newuuid = self.make_uuid()
 
             ### DUMP - result is a uuid that encoded an dynamically generated 
             ### object
@@ -328,6 +364,8 @@ class NS3Wrapper(object):
                     bool, float, long, str, int]):
                 self._objects[newuuid] = result
                 result = newuuid
+            else:
+                newuuid = None
 
         ### DEBUG
         self.logger.debug("RET INVOKE %s%s = %s -> %s(%s, %s) " % (
@@ -361,7 +399,7 @@ class NS3Wrapper(object):
         
         event_executed = [False]
 
-        if self.is_running:
+        if self.must_schedule:
             # schedule the event in the Simulator
             self._schedule_event(self._condition, event_executed, 
                     self._set_attr, obj, name, ns3_value)
@@ -391,7 +429,7 @@ class NS3Wrapper(object):
 
         event_executed = [False]
 
-        if self.is_running:
+        if self.must_schedule:
             # schedule the event in the Simulator
             self._schedule_event(self._condition, event_executed,
                     self._get_attr, obj, name, ns3_value)
@@ -406,6 +444,65 @@ class NS3Wrapper(object):
 
         return result
 
+    def batch(self, ops):
+        """ Executes a list of operations in order, and returns the
+        list of their results as (ok, result) tuples.
+
+        Each operation is a (method, uuid, args, kwargs) tuple, where 
+        method is one of 'create', 'factory', 'invoke', 'set' or 'get'.
+        For 'create' and 'factory' uuid identifies the new object, and 
+        for 'invoke' the object returned by the operation (if any). The 
+        uuids are chosen by the client, so operations can refer to 
+        objects created by previous operations in the same batch.
+
+        Execution stops at the first operation that fails. Its result
+        is the error, and the following operations are not executed.
+
+        While the simulation is running, all the operations are executed
+        within a single simulation event, so the cost of scheduling does
+        not depend on the number of operations.
+
+        """
+        results = []
+        event_executed = [False]
+
+        if self.must_schedule:
+            # schedule the event in the Simulator
+            self._schedule_event(self._condition, event_executed,
+                    self._batch, ops, results)
+
+        if not event_executed[0]:
+            self._batch(ops, results)
+
+        return results
+
+    def _batch(self, ops, results):
+        for i, (method, uuid, args, kwargs) in enumerate(ops):
+            try:
+                if method == "create":
+                    result = self.create_with_uuid(uuid, *args)
+                elif method == "factory":
+                    result = self.factory_with_uuid(uuid, *args, **kwargs)
+                elif method == "invoke":
+                    result = self.invoke_with_uuid(uuid, *args, **kwargs)
+                elif method == "set":
+                    result = self.set(*args)
+                elif method == "get":
+                    result = self.get(*args)
+                else:
+                    raise ValueError("Invalid batch operation %s" % method)
+            except:
+                import traceback
+                err = traceback.format_exc()
+                self.logger.error(err)
+                
+                results.append((False, err))
+                results.extend([(False, "Not executed")] * 
+                        (len(ops) - i - 1))
+                break
+
+            results.append((True, result))
+
     def start(self):
         ### DUMP
         self.debuger.dump_start()
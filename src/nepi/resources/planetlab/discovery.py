@@ -0,0 +1,254 @@
+#
+#    NEPI, a framework to manage network experiments
+#    Copyright (C) 2013 INRIA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Alina Quereilhac <alina.quereilhac@inria.fr>
+
+from nepi.util.execfuncs import lexec
+from nepi.util.parallel import ParallelRun
+from nepi.util import sshfuncs
+
+import random
+import re
+import threading
+import time
+import weakref
+
+class _Request(object):
+    def __init__(self, candidates):
+        self.candidates = list(candidates)
+        random.shuffle(self.candidates)
+        self.done = False
+        self.node_id = None
+
+class NodeDiscoverer(object):
+    """ Chooses alive PlanetLab nodes for the PlanetlabNode RMs that
+    share a same PLCAPI instance.
+
+    RMs that discover at the same time are served in batches. In each
+    round, a few random candidates of every pending RM are probed with
+    ping, all in parallel, and alive nodes are then assigned to the RMs
+    in one step, atomically reserving them in the PLCAPI. Nodes that don't
+    answer are blacklisted. Rounds are repeated until every RM in the
+    batch got a node, or ran out of candidates.
+
+    """
+    def __init__(self, plapi, maxthreads = 32, probes = 4,
+            batch_delay = 0.5, alive_timeout = 600):
+        """
+        :param plapi: PLCAPI instance shared by the RMs
+        :type plapi: PLCAPI
+
+        :param maxthreads: Maximum number of nodes probed concurrently
+        :type maxthreads: int
+
+        :param probes: Number of candidates of each RM probed per round
+        :type probes: int
+
+        :param batch_delay: Time in seconds to wait for other RMs to join
+            a batch
+        :type batch_delay: float
+
+        :param alive_timeout: Time in seconds after which the result of
+            probing a node expires, and the node is probed again
+        :type alive_timeout: float
+        """
+        self._plapi = weakref.ref(plapi)
+        self._maxthreads = maxthreads
+        self._probes = probes
+        self._batch_delay = batch_delay
+        self._alive_timeout = alive_timeout
+
+        self._cond = threading.Condition()
+        self._pending = []
+        self._processing = False
+
+        # results of previous probes { node_id: (alive, timestamp) }
+        self._alive = dict()
+
+    @property
+    def plapi(self):
+        return self._plapi()
+
+    def choose(self, candidates):
+        """ Returns the node id of an alive node among the candidates,
+        reserved in the PLCAPI, or None if no candidate is available.
+        Blocks until the batch the request was added to is processed """
+        request = _Request(candidates)
+
+        with self._cond:
+            self._pending.append(request)
+
+        while True:
+            with self._cond:
+                while not request.done and self._processing:
+                    self._cond.wait(1)
+
+                if request.done:
+                    return request.node_id
+
+                # This thread processes the next batch
+                self._processing = True
+
+            try:
+                time.sleep(self._batch_delay)
+
+                with self._cond:
+                    requests = self._pending
+                    self._pending = []
+
+                self._process(requests)
+            finally:
+                with self._cond:
+                    self._processing = False
+                    self._cond.notifyAll()
+
+    def _process(self, requests):
+        plapi = self.plapi
+
+        try:
+            while requests:
+                unavailable = plapi.unavailable()
+
+                # Remove candidates that are known not to be usable
+                for request in requests:
+                    request.candidates = [node_id for node_id in
+                            request.candidates if node_id not in unavailable
+                            and self._status(node_id) is not False]
+
+                # Probe a few candidates of each request
+                probe = set()
+                for request in requests:
+                    unknown = [node_id for node_id in request.candidates
+                            if self._status(node_id) is None]
+                    probe.update(unknown[:self._probes])
+
+                self._probe(probe)
+
+                # Assign alive nodes atomically
+                pending = []
+                for request in requests:
+                    alive = [node_id for node_id in request.candidates
+                            if self._status(node_id)]
+                    node_id = plapi.reserve_available(alive)
+
+                    if node_id is not None:
+                        request.node_id = node_id
+                        request.done = True
+                    elif not [node_id for node_id in request.candidates
+                            if self._status(node_id) is None]:
+                        # No candidates left to probe
+                        request.done = True
+                    else:
+                        pending.append(request)
+
+                requests = pending
+        finally:
+            # Don't leave requests waiting forever if an error occurs
+            for request in requests:
+                request.done = True
+
+    def reset(self):
+        """ Forgets the results of previous probes, e.g. when the
+        blacklist of the PLCAPI is reset """
+        self._alive.clear()
+
+    def _status(self, node_id):
+        """ Returns True or False if the node was found alive or not, or
+        None if it was not probed or the result expired """
+        entry = self._alive.get(node_id)
+        if entry is None:
+            return None
+
+        alive, timestamp = entry
+        if time.time() - timestamp > self._alive_timeout:
+            return None
+
+        return alive
+
+    def _probe(self, node_ids):
+        if not node_ids:
+            return
+
+        node_ids = list(node_ids)
+        hostnames = dict((node['node_id'], node['hostname']) for node in
+                self.plapi.get_nodes(node_ids, ['node_id', 'hostname']))
+
+        def probe(node_id):
+            alive = self._ping(hostnames.get(node_id))
+            self._alive[node_id] = (alive, time.time())
+            if not alive:
+                self.plapi.blacklist_host(node_id)
+
+        runner = ParallelRun(maxthreads = min(self._maxthreads,
+            len(node_ids)))
+        runner.start()
+
+        for node_id in node_ids:
+            runner.put(probe, node_id)
+
+        runner.destroy()
+
+        # Nodes that could not be probed are considered not alive
+        now = time.time()
+        for node_id in node_ids:
+            if self._status(node_id) is None:
+                self._alive[node_id] = (False, now)
+
+    def _ping(self, hostname):
+        if not hostname:
+            return False
+
+        try:
+            ip = sshfuncs.gethostbyname(hostname)
+        except:
+            return False
+
+        # Short timeout, the node is not usable if it is slow to answer
+        (out, err), proc = lexec("ping -c3 -i0.2 -w2 %s" % ip)
+
+        # ping exits with 0 if all the packets were answered, with 1 if
+        # some were lost, and with other codes on errors
+        if proc.returncode == 0:
+            return True
+
+        if proc.returncode != 1:
+            return False
+
+        m = re.search("(\d+)% packet loss", out)
+        return bool(m) and int(m.groups()[0]) < 50
+
+# discoverers by PLCAPI instance
+_discoverers = weakref.WeakKeyDictionary()
+_discoverers_lock = threading.Lock()
+
+def get_discoverer(plapi):
+    """ Returns the NodeDiscoverer shared by the RMs using plapi """
+    with _discoverers_lock:
+        discoverer = _discoverers.get(plapi)
+        if not discoverer:
+            discoverer = NodeDiscoverer(plapi)
+            _discoverers[plapi] = discoverer
+
+    return discoverer
+
+def reset_discoverer(plapi):
+    """ Forgets the probes of the NodeDiscoverer of plapi, if any """
+    with _discoverers_lock:
+        discoverer = _discoverers.get(plapi)
+
+    if discoverer:
+        discoverer.reset()
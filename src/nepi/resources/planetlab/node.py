@@ -23,10 +23,10 @@ from nepi.execution.resource import ResourceManager, clsinit_copy, \
         ResourceState 
 from nepi.resources.linux.node import LinuxNode
 from nepi.resources.planetlab.plcapi import PLCAPIFactory 
+from nepi.resources.planetlab.discovery import get_discoverer
 from nepi.util.execfuncs import lexec
 from nepi.util import sshfuncs
 
-from random import randint
 import re
 import os
 import time
@@ -258,23 +258,23 @@ class PlanetlabNode(LinuxNode):
 
             # check that the node is not blacklisted or being provisioned
             # by other RM
-            with PlanetlabNode.lock:
-                plist = self.plapi.reserved()
-                blist = self.plapi.blacklisted()
-                if node_id not in blist and node_id not in plist:
-                
-                    # check that is really alive, by performing ping
-                    ping_ok = self._do_ping(node_id)
-                    if not ping_ok:
-                        self._blacklist_node(node_id)
-                        self.fail_node_not_alive(hostname)
-                    else:
-                        if self._check_if_in_slice([node_id]):
-                            self._slicenode = True
-                        self._put_node_in_provision(node_id)
-                        self._node_to_provision = node_id
-                else:
-                    self.fail_node_not_available(hostname)
+            if node_id in self.plapi.unavailable():
+                self.fail_node_not_available(hostname)
+
+            # check that is really alive, by performing ping. The ping is
+            # done without holding any lock, the node is reserved afterwards
+            # only if no other RM took it in the meantime
+            ping_ok = self._do_ping(node_id)
+            if not ping_ok:
+                self._blacklist_node(node_id)
+                self.fail_node_not_alive(hostname)
+
+            if self.plapi.reserve_available([node_id]) is None:
+                self.fail_node_not_available(hostname)
+
+            if self._check_if_in_slice([node_id]):
+                self._slicenode = True
+            self._node_to_provision = node_id
             super(PlanetlabNode, self).do_discover()
         
         else:
@@ -306,8 +306,7 @@ class PlanetlabNode(LinuxNode):
                     self.info(" Selected node to provision ")
                     super(PlanetlabNode, self).do_discover()
                 except:
-                    with PlanetlabNode.lock:
-                        self._blacklist_node(node_id)
+                    self._blacklist_node(node_id)
                     self.do_discover()
             else:
                self.fail_not_enough_nodes() 
@@ -334,8 +333,7 @@ class PlanetlabNode(LinuxNode):
                     self.debug( "Node added to slice" )
                 else:
                     self.warning(" Could not add to slice ")
-                    with PlanetlabNode.lock:
-                        self._blacklist_node(node)
+                    self._blacklist_node(node)
                     self.do_discover()
                     continue
 
@@ -364,10 +362,9 @@ class PlanetlabNode(LinuxNode):
                 # the timeout was reach without establishing ssh connection
                 # the node is blacklisted, deleted from the slice, and a new
                 # node to provision is discovered
-                with PlanetlabNode.lock:
-                    self.warning(" Could not SSH login ")
-                    self._blacklist_node(node)
-                    #self._delete_node_from_slice(node)
+                self.warning(" Could not SSH login ")
+                self._blacklist_node(node)
+                #self._delete_node_from_slice(node)
                 self.do_discover()
                 continue
             
@@ -380,10 +377,9 @@ class PlanetlabNode(LinuxNode):
                 ((out2, err2), proc2) = self.execute(cmd)
                 if out1.find("/proc type proc") < 0 or \
                     "Read-only file system".lower() in err2.lower():
-                    with PlanetlabNode.lock:
-                        self.warning(" Corrupted file system ")
-                        self._blacklist_node(node)
-                        #self._delete_node_from_slice(node)
+                    self.warning(" Corrupted file system ")
+                    self._blacklist_node(node)
+                    #self._delete_node_from_slice(node)
                     self.do_discover()
                     continue
             
@@ -539,31 +535,17 @@ class PlanetlabNode(LinuxNode):
     def _choose_random_node(self, nodes):
         """
         From the possible nodes for provision, choose randomly to decrese the
-        probability of different RMs choosing the same node for provision
+        probability of different RMs choosing the same node for provision.
+
+        Candidates are probed by the NodeDiscoverer shared by all the RMs
+        using the same PLCAPI, which pings the candidates of concurrent RMs
+        in parallel and reserves the chosen node atomically
         """
-        size = len(nodes)
-        while size:
-            size = size - 1
-            index = randint(0, size)
-            node_id = nodes[index]
-            nodes[index] = nodes[size]
-
-            # check the node is not blacklisted or being provision by other RM
-            # and perform ping to check that is really alive
-            with PlanetlabNode.lock:
-
-                blist = self.plapi.blacklisted()
-                plist = self.plapi.reserved()
-                if node_id not in blist and node_id not in plist:
-                    ping_ok = self._do_ping(node_id)
-                    if not ping_ok:
-                        self._set_hostname_attr(node_id)
-                        self.warning(" Node not responding PING ")
-                        self._blacklist_node(node_id)
-                    else:
-                        # discovered node for provision, added to provision list
-                        self._put_node_in_provision(node_id)
-                        return node_id
+        node_id = get_discoverer(self.plapi).choose(nodes)
+        if node_id is None:
+            self.warning(" No responding node among %d candidates " % 
+                    len(nodes))
+        return node_id
 
     def _get_nodes_id(self, filters=None):
         return self.plapi.get_nodes(filters, fields=['node_id'])
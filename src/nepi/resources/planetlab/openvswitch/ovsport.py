@@ -152,8 +152,12 @@ class OVSPort(LinuxApplication):
                                              self.ovsswitch.get('bridge_name')))     
 	    
     def initiate_udp_connection(self, remote_endpoint, connection_app_home, 
-            connection_run_home, cipher, cipher_key, bwlimit, txqueuelen):
+            connection_run_home, cipher, cipher_key, bwlimit, txqueuelen,
+            queues = 1, stats = None, stats_interval = 1):
         """ Get the local_endpoint of the port
+
+        The port is forwarded by the switch, with a single queue and 
+        without a stats file.
         """
 
         self._remote_ip = remote_endpoint.node.get("ip")
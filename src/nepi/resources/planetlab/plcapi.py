@@ -17,6 +17,8 @@
 #
 # Author: Alina Quereilhac <alina.quereilhac@inria.fr>
 
+from nepi.resources.planetlab.discovery import reset_discoverer
+
 import functools
 import hashlib
 import socket
@@ -141,6 +143,8 @@ class PLCAPI(object):
 
         self._blacklist = set()
         self._reserved = set()
+        # protects the blacklisted and reserved hosts
+        self._hosts_lock = threading.RLock()
         self._nodes_cache = None
         self._already_cached = False
         self._ecobj = ec
@@ -474,29 +478,58 @@ class PLCAPI(object):
             return None
 
     def blacklist_host(self, node_id):
-        self._blacklist.add(node_id)
+        with self._hosts_lock:
+            self._blacklist.add(node_id)
 
     def blacklisted(self):
-        return self._blacklist 
+        with self._hosts_lock:
+            return set(self._blacklist)
 
     def unblacklist_host(self, node_id):
-        del self._blacklist[node_id]
+        with self._hosts_lock:
+            self._blacklist.discard(node_id)
 
     def reserve_host(self, node_id):
-        self._reserved.add(node_id)
+        with self._hosts_lock:
+            self._reserved.add(node_id)
 
     def reserved(self):
-        return self._reserved
+        with self._hosts_lock:
+            return set(self._reserved)
 
     def unreserve_host(self, node_id):
-        del self._reserved[node_id]
+        with self._hosts_lock:
+            self._reserved.discard(node_id)
+
+    def unavailable(self):
+        """ Returns the hosts that are either blacklisted or reserved """
+        with self._hosts_lock:
+            return self._blacklist | self._reserved
+
+    def reserve_available(self, node_ids):
+        """ Atomically reserves the first host in node_ids that is neither
+        blacklisted nor reserved. Returns its node id, or None if none of
+        them is available """
+        with self._hosts_lock:
+            for node_id in node_ids:
+                if node_id not in self._blacklist and \
+                        node_id not in self._reserved:
+                    self._reserved.add(node_id)
+                    return node_id
+
+        return None
 
     def release(self):
         self.count -= 1
         if self.count == 0:
-            blacklist = self._blacklist
-            self._blacklist = set()
-            self._reserved = set()
+            with self._hosts_lock:
+                blacklist = self._blacklist
+                self._blacklist = set()
+                self._reserved = set()
+
+            # Nodes found dead are not blacklisted anymore, they must be
+            # probed again
+            reset_discoverer(self)
             if self._ecobj.get_global('PlanetlabNode', 'persist_blacklist'):
                 if blacklist:
                     to_blacklist = list()
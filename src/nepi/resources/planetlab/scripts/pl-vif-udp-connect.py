@@ -63,7 +63,7 @@ def get_options():
     usage = ("usage: %prog -t <vif-type> -S <fd-socket-name> "
             "-b <bwlimit> -c <cipher> -k <cipher-key> -q <txqueuelen> " 
             "-l <local-port-file> -r <remote-port-file> -H <remote-host> "
-            "-R <ret-file> ")
+            "-R <ret-file> -s <stats-file> -i <stats-interval> ")
     
     parser = OptionParser(usage = usage)
 
@@ -102,6 +102,12 @@ def get_options():
     parser.add_option("-R", "--ret-file", dest="ret_file",
         help = "File where to store return code (success of connection) ", 
         default = "ret_file", type="str")
+    parser.add_option("-s", "--stats-file", dest="stats_file",
+        help = "File where to append the traffic counters of the tunnel", 
+        default = None, type="str")
+    parser.add_option("-i", "--stats-interval", dest="stats_interval",
+        help = "Seconds between two writes of the traffic counters", 
+        default = 1.0, type="float")
 
     (options, args) = parser.parse_args()
        
@@ -112,13 +118,13 @@ def get_options():
     return ( vif_type, options.fd_socket_name, options.local_port_file,
             options.remote_port_file, options.remote_host, options.ret_file, 
             options.bwlimit, options.cipher, options.cipher_key,
-            options.txqueuelen )
+            options.txqueuelen, options.stats_file, options.stats_interval )
 
 if __name__ == '__main__':
 
     ( vif_type, socket_name, local_port_file, remote_port_file,
-      remote_host, ret_file, bwlimit, cipher, cipher_key, txqueuelen 
-         ) = get_options()
+      remote_host, ret_file, bwlimit, cipher, cipher_key, txqueuelen,
+      stats_file, stats_interval ) = get_options()
    
     # Get the file descriptor of the TAP device from the process
     # that created it
@@ -182,7 +188,9 @@ if __name__ == '__main__':
         SUSPEND = SUSPEND,
         tunqueue = txqueuelen,
         tunkqueue = 500,
-        bwlimit = bwlimit
+        bwlimit = bwlimit,
+        stats = stats_file,
+        stats_interval = stats_interval
     ) 
  
 
@@ -342,16 +342,21 @@ class PlanetlabTap(LinuxApplication):
         return True
 
     def initiate_udp_connection(self, remote_endpoint, connection_app_home, 
-            connection_run_home, cipher, cipher_key, bwlimit, txqueuelen):
+            connection_run_home, cipher, cipher_key, bwlimit, txqueuelen,
+            queues = 1, stats = None, stats_interval = 1):
+        # The TAP devices created through vsys have a single queue
         port = self.udp_connect(remote_endpoint, connection_app_home, 
-            connection_run_home, cipher, cipher_key, bwlimit, txqueuelen)
+            connection_run_home, cipher, cipher_key, bwlimit, txqueuelen,
+            stats = stats, stats_interval = stats_interval)
         return port
 
     def udp_connect(self, remote_endpoint, connection_app_home, 
-            connection_run_home, cipher, cipher_key, bwlimit, txqueuelen):
+            connection_run_home, cipher, cipher_key, bwlimit, txqueuelen,
+            stats = None, stats_interval = 1):
         udp_connect_command = self._udp_connect_command(
                 remote_endpoint, connection_run_home,
-                cipher, cipher_key, bwlimit, txqueuelen)
+                cipher, cipher_key, bwlimit, txqueuelen,
+                stats = stats, stats_interval = stats_interval)
 
         # upload command to connect.sh script
         shfile = os.path.join(self.app_home, "udp-connect.sh")
@@ -388,7 +393,8 @@ class PlanetlabTap(LinuxApplication):
         return port
 
     def _udp_connect_command(self, remote_endpoint, connection_run_home, 
-            cipher, cipher_key, bwlimit, txqueuelen):
+            cipher, cipher_key, bwlimit, txqueuelen, stats = None, 
+            stats_interval = 1):
 
         # Set the remote endpoint, (private) IP of the device
         self.set("pointopoint", remote_endpoint.get("ip"))
@@ -431,6 +437,8 @@ class PlanetlabTap(LinuxApplication):
             command.append("-q %s " % txqueuelen)
         if bwlimit:
             command.append("-b %s " % bwlimit)
+        if stats:
+            command.append("-s %s -i %s " % (stats, stats_interval))
 
         command.append(")")
 
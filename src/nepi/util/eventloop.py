@@ -0,0 +1,567 @@
+#
+#    NEPI, a framework to manage network experiments
+#    Copyright (C) 2013 INRIA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Alina Quereilhac <alina.quereilhac@inria.fr>
+
+""" Event driven execution of child processes (e.g. ssh and scp).
+
+A single ProcessLoop thread multiplexes the pipes of all the processes
+it spawns, so waiting for a remote command to finish does not block a
+thread per command. Completion is reported through Future objects.
+
+Generator based coroutines can be used to chain operations. A coroutine
+yields Futures (or other coroutines, or lists of them to wait for all)
+and is resumed with their result once they are done::
+
+    def provision(node):
+        (out, err), proc = yield node.execute_async("echo ${HOME}")
+        yield node.mkdir_async(os.path.join(out.strip(), "nepi"))
+        raise Return(out.strip())
+
+    future = run_coroutine(provision(node))
+
+"""
+
+import errno
+import functools
+import heapq
+import itertools
+import logging
+import os
+import select
+import subprocess
+import sys
+import threading
+import time
+
+logger = logging.getLogger("eventloop")
+
+class Return(Exception):
+    """ Raised by a coroutine to finish with a return value """
+    def __init__(self, value = None):
+        super(Return, self).__init__(value)
+        self.value = value
+
+class Future(object):
+    """ Result of an operation that will complete in the future """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self, timeout = None):
+        """ Returns the result of the operation, blocking until it
+        is done. Re-raises the exception if the operation failed.
+
+        :param timeout: Maximum number of seconds to wait
+        :type timeout: float
+
+        """
+        with self._cond:
+            if not self._done:
+                self._cond.wait(timeout)
+
+            if not self._done:
+                raise RuntimeError, "Operation timed out"
+
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+        return self._result
+
+    def exc_info(self):
+        """ Returns the sys.exc_info() tuple of the exception raised
+        by the operation, or None if it succeeded """
+        return self._exc_info
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exc_info(self, exc_info):
+        self._finish(None, exc_info)
+
+    def add_done_callback(self, callback):
+        """ Invokes callback(future) once the future is done.
+        If the future is already done the callback is invoked immediately.
+
+        """
+        with self._cond:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+
+        callback(self)
+
+    def _finish(self, result, exc_info):
+        with self._cond:
+            if self._done:
+                return
+
+            self._result = result
+            self._exc_info = exc_info
+            self._done = True
+            self._cond.notify_all()
+
+            callbacks = self._callbacks
+            self._callbacks = []
+
+        for callback in callbacks:
+            try:
+                callback(self)
+            except:
+                logger.exception("Error in future callback")
+
+class _Process(object):
+    """ Book keeping of a process driven by the ProcessLoop """
+
+    def __init__(self, proc, future, input):
+        self.proc = proc
+        self.future = future
+        self.input = input or ""
+        self.offset = 0
+        self.out = []
+        self.err = []
+        self.fds = dict()
+        self.last_read = time.time()
+
+        if proc.stdout:
+            self.fds[proc.stdout.fileno()] = (proc.stdout, self.out)
+
+        if proc.stderr:
+            self.fds[proc.stderr.fileno()] = (proc.stderr, self.err)
+
+class ProcessLoop(object):
+    """ Drives child processes and timers from a single thread.
+
+    Processes are started with pipes for stdin, stdout and stderr. The
+    loop feeds stdin, collects the output and resolves the Future
+    returned by spawn with ((stdout, stderr), process) when the process
+    exits.
+
+    """
+    # Seconds without output after which a process that exited is 
+    # considered finished, even if its pipes are still open
+    exit_grace = 1.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._readers = dict()
+        self._writers = dict()
+        self._reaping = []
+        self._timers = []
+        self._seq = itertools.count()
+        self._thread = None
+        self._last_check = time.time()
+
+        # Pipe used to wake the loop up when new work arrives
+        self._wakeup_r, self._wakeup_w = os.pipe()
+
+    @property
+    def pending(self):
+        """ Number of processes not finished yet """
+        with self._lock:
+            procs = set(self._readers.values())
+            procs.update(self._writers.values())
+            return len(procs) + len(self._reaping)
+
+    def spawn(self, args, input = None, env = None, shell = False):
+        """ Starts a process and returns a Future for its completion.
+
+        :param args: Command to execute (list of arguments, or a string
+            if shell is True)
+        :type args: list
+
+        :param input: Data to write to the process standard input
+        :type input: str
+
+        :param env: Environment for the process
+        :type env: dict
+
+        :param shell: Execute the command through the shell
+        :type shell: bool
+
+        :rtype: Future
+
+        """
+        future = Future()
+
+        try:
+            proc = subprocess.Popen(args,
+                    env = env,
+                    shell = shell,
+                    stdin = subprocess.PIPE,
+                    stdout = subprocess.PIPE,
+                    stderr = subprocess.PIPE,
+                    close_fds = True)
+        except:
+            future.set_exc_info(sys.exc_info())
+            return future
+
+        p = _Process(proc, future, input)
+
+        with self._lock:
+            if input:
+                self._writers[proc.stdin.fileno()] = p
+            else:
+                proc.stdin.close()
+
+            for fd in p.fds.keys():
+                self._readers[fd] = p
+
+            self._start()
+
+        self._wakeup()
+        return future
+
+    def sleep(self, delay):
+        """ Returns a Future that is done after delay seconds
+
+        :param delay: Seconds to wait
+        :type delay: float
+
+        :rtype: Future
+
+        """
+        future = Future()
+
+        with self._lock:
+            heapq.heappush(self._timers,
+                    (time.time() + delay, self._seq.next(), future))
+            self._start()
+
+        self._wakeup()
+        return future
+
+    def _start(self):
+        if not self._thread:
+            self._thread = threading.Thread(target = self._run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def _wakeup(self):
+        os.write(self._wakeup_w, "x")
+
+    def _run(self):
+        try:
+            self._loop()
+        except:
+            # Don't leave the callers waiting forever
+            logger.exception("Process loop failed")
+            self._fail(sys.exc_info())
+
+    def _loop(self):
+        # poll is used instead of select, since select can not handle 
+        # file descriptors >= FD_SETSIZE (e.g. with many concurrent 
+        # processes)
+        rmask = select.POLLIN | select.POLLPRI | select.POLLHUP | \
+                select.POLLERR
+        wmask = select.POLLOUT | select.POLLHUP | select.POLLERR
+
+        while True:
+            with self._lock:
+                rfds = self._readers.keys()
+                wfds = self._writers.keys()
+                timeout = 1.0
+
+                if self._reaping:
+                    timeout = 0.05
+                if self._timers:
+                    timeout = max(0, min(timeout,
+                        self._timers[0][0] - time.time()))
+
+            poller = select.poll()
+            poller.register(self._wakeup_r, select.POLLIN)
+            for fd in rfds:
+                poller.register(fd, rmask)
+            for fd in wfds:
+                poller.register(fd, wmask)
+
+            try:
+                events = poller.poll(timeout * 1000)
+            except select.error, e:
+                if e[0] != errno.EINTR:
+                    raise
+                continue
+
+            rlist = []
+            wlist = []
+            for fd, event in events:
+                if fd == self._wakeup_r:
+                    os.read(self._wakeup_r, 4096)
+                elif fd in self._writers:
+                    wlist.append(fd)
+                elif fd in self._readers:
+                    rlist.append(fd)
+
+            for fd in wlist:
+                self._write(fd)
+
+            for fd in rlist:
+                self._read(fd)
+
+            self._check_exited()
+            self._reap()
+            self._expire()
+
+    def _fail(self, exc_info):
+        """ Fails the futures of all pending processes and timers, and
+        lets the next spawn or sleep start a new loop thread """
+        with self._lock:
+            procs = set(self._readers.values())
+            procs.update(self._writers.values())
+            procs.update(self._reaping)
+            futures = [p.future for p in procs]
+            futures.extend([timer[2] for timer in self._timers])
+
+            self._readers.clear()
+            self._writers.clear()
+            self._reaping = []
+            self._timers = []
+            self._thread = None
+
+        for future in futures:
+            future.set_exc_info(exc_info)
+
+    def _write(self, fd):
+        p = self._writers[fd]
+
+        try:
+            # Up to PIPE_BUF bytes can be written without blocking.
+            # POSIX defines PIPE_BUF >= 512
+            n = os.write(fd, buffer(p.input, p.offset, 512))
+            p.offset += n
+            done = p.offset >= len(p.input)
+        except OSError:
+            # The process closed its standard input
+            done = True
+
+        if done:
+            p.proc.stdin.close()
+            with self._lock:
+                del self._writers[fd]
+
+    def _read(self, fd):
+        p = self._readers[fd]
+        f, data = p.fds[fd]
+
+        chunk = os.read(fd, 65536)
+        if chunk:
+            data.append(chunk)
+            p.last_read = time.time()
+            return
+
+        self._close(p, fd)
+
+    def _close(self, p, fd):
+        f, data = p.fds.pop(fd)
+        f.close()
+
+        with self._lock:
+            del self._readers[fd]
+            if not p.fds and not p.proc.stdin.closed:
+                self._writers.pop(p.proc.stdin.fileno(), None)
+                p.proc.stdin.close()
+
+            if not p.fds:
+                self._reaping.append(p)
+
+    def _check_exited(self):
+        # A process might exit leaving its pipes open in a child process
+        # (e.g. ssh forking a ControlPersist master). Like
+        # sshfuncs._communicate, consider those processes finished when 
+        # they exited and no output arrived for a while.
+        now = time.time()
+        if now - self._last_check < self.exit_grace:
+            return
+        self._last_check = now
+
+        with self._lock:
+            procs = set(self._readers.values())
+
+        for p in procs:
+            if now - p.last_read > self.exit_grace and \
+                    p.proc.poll() is not None:
+                for fd in p.fds.keys():
+                    self._close(p, fd)
+
+    def _reap(self):
+        with self._lock:
+            finished = filter(lambda p: p.proc.poll() is not None,
+                    self._reaping)
+            for p in finished:
+                self._reaping.remove(p)
+
+        for p in finished:
+            p.future.set_result(
+                    (("".join(p.out), "".join(p.err)), p.proc))
+
+    def _expire(self):
+        expired = []
+
+        with self._lock:
+            now = time.time()
+            while self._timers and self._timers[0][0] <= now:
+                expired.append(heapq.heappop(self._timers)[2])
+
+        for future in expired:
+            future.set_result(None)
+
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+
+def get_loop():
+    """ Returns the ProcessLoop shared by the whole process.
+    
+    A forked process (e.g. an experiment replica) gets a new loop, since
+    the loop thread of the parent does not exist in the child.
+    """
+    global _loop, _loop_pid
+
+    with _loop_lock:
+        pid = os.getpid()
+        if not _loop or _loop_pid != pid:
+            _loop = ProcessLoop()
+            _loop_pid = pid
+        return _loop
+
+def spawn(args, input = None, env = None, shell = False):
+    """ Starts a process in the shared ProcessLoop. See ProcessLoop.spawn """
+    return get_loop().spawn(args, input = input, env = env, shell = shell)
+
+def sleep(delay):
+    """ Returns a Future that is done after delay seconds """
+    return get_loop().sleep(delay)
+
+def done_future(result = None):
+    """ Returns a Future that is already done with the given result """
+    future = Future()
+    future.set_result(result)
+    return future
+
+def gather(futures):
+    """ Returns a Future that is done when all the given futures are done.
+    Its result is the list of their results. If any of the futures failed,
+    the exception of the first failed one is raised.
+
+    :param futures: Futures to wait for
+    :type futures: list
+
+    :rtype: Future
+
+    """
+    futures = list(futures)
+    future = Future()
+    pending = [len(futures)]
+    lock = threading.Lock()
+
+    def finished(f):
+        with lock:
+            pending[0] -= 1
+            if pending[0] > 0:
+                return
+
+        for f in futures:
+            if f.exc_info():
+                future.set_exc_info(f.exc_info())
+                return
+
+        future.set_result([f.result() for f in futures])
+
+    if not futures:
+        future.set_result([])
+
+    for f in futures:
+        f.add_done_callback(finished)
+
+    return future
+
+def as_future(obj, schedule = None):
+    """ Converts what a coroutine yields into a Future.
+    Accepts Futures, coroutines (generators), lists of those (to wait
+    for all of them), and None (to simply give way to other tasks).
+
+    """
+    if isinstance(obj, Future):
+        return obj
+    if hasattr(obj, "send") and hasattr(obj, "throw"):
+        return run_coroutine(obj, schedule)
+    if isinstance(obj, (list, tuple)):
+        return gather([as_future(o, schedule) for o in obj])
+    if obj is None:
+        return done_future()
+
+    raise TypeError, "Coroutine yielded an unsupported object %r" % (obj, )
+
+def run_coroutine(gen, schedule = None):
+    """ Drives a generator based coroutine.
+
+    Each time the coroutine yields, it is suspended until the yielded
+    operation is done, and then resumed with its result (or with the
+    exception raised by the operation).
+
+    :param gen: Coroutine to run
+    :type gen: generator
+
+    :param schedule: Function invoked with a callable that resumes the
+        coroutine. It allows to choose which thread runs the coroutine
+        code. By default the coroutine is resumed by the thread that
+        completes the operation.
+    :type schedule: function
+
+    :rtype: Future that is done when the coroutine finishes
+
+    """
+    future = Future()
+
+    def step(previous):
+        try:
+            if previous is None:
+                yielded = gen.next()
+            elif previous.exc_info():
+                yielded = gen.throw(*previous.exc_info())
+            else:
+                yielded = gen.send(previous.result())
+
+            yielded = as_future(yielded, schedule)
+        except StopIteration:
+            future.set_result(None)
+            return
+        except Return, e:
+            future.set_result(e.value)
+            return
+        except:
+            future.set_exc_info(sys.exc_info())
+            return
+
+        yielded.add_done_callback(resume)
+
+    def resume(previous):
+        if schedule:
+            schedule(functools.partial(step, previous))
+        else:
+            step(previous)
+
+    resume(None)
+    return future
+
@@ -17,11 +17,22 @@
 #
 # Author: Alina Quereilhac <alina.quereilhac@inria.fr>
 
+from nepi.util import eventloop
 from nepi.util.sshfuncs import ProcStatus, STDOUT, log, shell_escape
 
+import hashlib
 import logging
+import os
 import shlex
 import subprocess
+import sys
+import threading
+
+# cache of local file digests { path: (size, mtime, digest) }
+_digests = dict()
+_digests_lock = threading.Lock()
+# maximum number of digests kept in the cache
+_digests_max = 1024
 
 def lexec(command, 
         user = None, 
@@ -60,6 +71,31 @@ def lexec(command,
 
     return ((out, err), proc)
 
+def lexec_async(command, 
+        user = None, 
+        sudo = False,
+        env = None):
+    """
+    Executes a local command without blocking the calling thread,
+    returns a Future for the ((stdout,stderr),process) result
+    """
+    if env:
+        export = ''
+        for envkey, envval in env.iteritems():
+            export += '%s=%s ' % (envkey, envval)
+        command = "%s %s" % (export, command)
+
+    if sudo:
+        command = "sudo %s" % command
+
+    log_msg = "lexec - command %s " % command
+
+    future = eventloop.spawn(command, shell = True)
+    future.add_done_callback(lambda f: f.exc_info() or 
+            log(log_msg, logging.DEBUG, *f.result()[0]))
+
+    return future
+
 def lcopy(source, dest, recursive = False):
     """
     Copies from/to localy.
@@ -96,6 +132,114 @@ def lcopy(source, dest, recursive = False):
 
     return ((out, err), proc)
    
+def ldigest(path):
+    """
+    Returns the md5 digest of a local file, as printed by md5sum. 
+    Digests are cached until the size or modification time of the 
+    file change.
+    """
+    st = os.stat(path)
+
+    digest = _cached_digest(path, st)
+    if digest:
+        return digest
+
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), ""):
+            md5.update(chunk)
+
+    digest = md5.hexdigest()
+
+    with _digests_lock:
+        if len(_digests) >= _digests_max:
+            # Drop the entries of files that no longer exist, and
+            # start over if that is not enough
+            for p in _digests.keys():
+                if not os.path.exists(p):
+                    del _digests[p]
+
+            if len(_digests) >= _digests_max:
+                _digests.clear()
+
+        _digests[path] = (st.st_size, st.st_mtime, digest)
+
+    return digest
+
+def ldigest_async(path):
+    """
+    Returns the md5 digest of a local file without blocking the calling
+    thread (e.g. the ProcessLoop thread), returns a Future for the 
+    digest. Files that are not in the cache are hashed by a worker 
+    thread.
+    """
+    future = eventloop.Future()
+
+    try:
+        digest = _cached_digest(path, os.stat(path))
+    except:
+        future.set_exc_info(sys.exc_info())
+        return future
+
+    if digest:
+        future.set_result(digest)
+        return future
+
+    def run():
+        try:
+            future.set_result(ldigest(path))
+        except:
+            future.set_exc_info(sys.exc_info())
+
+    worker = threading.Thread(target = run)
+    worker.setDaemon(True)
+    worker.start()
+
+    return future
+
+def _cached_digest(path, st):
+    with _digests_lock:
+        cached = _digests.get(path)
+
+    if cached and cached[:2] == (st.st_size, st.st_mtime):
+        return cached[2]
+
+    return None
+
+def forget_digest(path):
+    """
+    Removes the cached digest of a local file, e.g. before deleting it.
+    """
+    with _digests_lock:
+        _digests.pop(path, None)
+
+def lcopy_async(source, dest, recursive = False):
+    """
+    Copies from/to localy without blocking the calling thread,
+    returns a Future for the ((stdout,stderr),process) result
+    """
+    args = ["cp"]
+    if recursive:
+        args.append("-r")
+  
+    if isinstance(source, list):
+        args.extend(source)
+    else:
+        args.append(source)
+
+    if isinstance(dest, list):
+        args.extend(dest)
+    else:
+        args.append(dest)
+
+    log_msg = " lcopy - command %s " % " ".join(args)
+
+    future = eventloop.spawn(args)
+    future.add_done_callback(lambda f: f.exc_info() or 
+            log(log_msg, logging.DEBUG, *f.result()[0]))
+
+    return future
+
 def lspawn(command, pidfile, 
         stdout = '/dev/null', 
         stderr = STDOUT, 
@@ -19,7 +19,10 @@
 #         Alina Quereilhac <alina.quereilhac@inria.fr>
 #
 
+import collections
+import itertools
 import threading
+import time
 import Queue
 import traceback
 import sys
@@ -162,3 +165,214 @@ class ParallelRun(object):
                     except Queue.Empty:
                         raise StopIteration
             
+
+class KeyedParallelRun(object):
+    """ Pool of threads that executes tasks in parallel, except for tasks 
+    that share the same key, which are executed one at a time in FIFO 
+    order (e.g. all the tasks of a same ResourceManager).
+
+    .. note::
+
+        Each key has its own FIFO queue. Keys with pending tasks and no 
+        task in execution are placed in a 'ready' queue, from which idle 
+        workers take their next task. A worker that becomes idle will 
+        therefore take work from any key, instead of waiting behind tasks 
+        bound to other keys.
+
+        Workers are created on demand, when there are more ready keys than
+        idle workers, up to 'maxthreads'. Workers exit when they find no 
+        work and there are already 'minthreads' idle workers.
+
+        Tasks with key None are never serialized.
+
+    """
+    
+    # Upper bounds (in seconds) of the latency histogram buckets
+    latency_buckets = (0.001, 0.01, 0.1, 1, 10, 60)
+
+    def __init__(self, maxthreads = None, minthreads = 1):
+        self.maxthreads = maxthreads or 4
+        self.minthreads = min(minthreads, self.maxthreads)
+
+        self.delayed_exceptions = []
+        
+        self._cond = threading.Condition()
+        self._queues = dict()
+        self._ready = collections.deque()
+        self._running = set()
+        self._workers = set()
+        self._idle = 0
+        self._busy = 0
+        self._queued = 0
+        self._started = False
+        self._quit = False
+        self._unkeyed = itertools.count()
+
+        # Histograms of the time tasks wait in queue before execution, 
+        # and of the task execution time
+        self._latency = [0] * (len(self.latency_buckets) + 1)
+        self._duration = [0] * (len(self.latency_buckets) + 1)
+
+    def put(self, key, callable, *args, **kwargs):
+        """ Queues a task for execution. Tasks with the same key are 
+        never executed concurrently.
+
+        :param key: Serialization key (e.g. guid of a RM). None if 
+            the task does not need to be serialized
+        :type key: hashable object
+
+        :param callable: Function to execute
+        :type callable: function
+
+        """
+        if key is None:
+            key = (KeyedParallelRun, self._unkeyed.next())
+
+        with self._cond:
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = collections.deque()
+
+            queue.append((callable, args, kwargs, time.time()))
+            self._queued += 1
+
+            if len(queue) == 1 and key not in self._running:
+                self._ready.append(key)
+                self._cond.notify_all()
+                self._grow()
+
+    def start(self):
+        with self._cond:
+            self._started = True
+            self._grow()
+
+    def empty(self):
+        """ Removes all the tasks that were not yet executed """
+        with self._cond:
+            for key in list(self._queues.keys()):
+                if key not in self._running:
+                    del self._queues[key]
+                else:
+                    self._queues[key].clear()
+
+            self._ready.clear()
+            self._queued = 0
+
+    def join(self):
+        """ Waits until all queued tasks have been processed, and
+        stops the workers """
+        with self._cond:
+            while self._queued or self._busy:
+                self._cond.wait()
+
+            self._quit = True
+            self._cond.notify_all()
+
+            workers = list(self._workers)
+
+        for worker in workers:
+            worker.join()
+
+    def destroy(self):
+        self.join()
+
+    def sync(self):
+        if self.delayed_exceptions:
+            typ,val,loc = self.delayed_exceptions[0]
+            del self.delayed_exceptions[:]
+            raise typ,val,loc
+
+    def stats(self):
+        """ Returns a dictionary with the current number of queued tasks,
+        ready keys, workers and busy workers, and the histograms of task
+        queue latency and execution time. 
+        
+        Histograms are lists of counters, one per bucket in 
+        'latency_buckets' plus one for larger values.
+
+        """
+        with self._cond:
+            return dict(
+                    queued = self._queued,
+                    ready = len(self._ready),
+                    workers = len(self._workers),
+                    busy = self._busy,
+                    latency = list(self._latency),
+                    duration = list(self._duration),
+                    )
+
+    def _grow(self):
+        # Must be called holding the condition
+        if not self._started:
+            return
+
+        missing = len(self._ready) - self._idle
+        while missing > 0 and len(self._workers) < self.maxthreads:
+            worker = threading.Thread(target = self._work)
+            worker.setDaemon(True)
+            self._workers.add(worker)
+            worker.start()
+            missing -= 1
+
+    def _record(self, histogram, value):
+        for i, bound in enumerate(self.latency_buckets):
+            if value < bound:
+                histogram[i] += 1
+                return
+        histogram[-1] += 1
+
+    def _next(self):
+        """ Waits for the next task to execute. Returns None if the 
+        worker must exit """
+        while not self._ready:
+            if self._quit or self._idle >= self.minthreads:
+                return None
+            
+            self._idle += 1
+            self._cond.wait()
+            self._idle -= 1
+
+        key = self._ready.popleft()
+        (callable, args, kwargs, queued) = self._queues[key].popleft()
+        
+        self._queued -= 1
+        self._busy += 1
+        self._running.add(key)
+        self._record(self._latency, time.time() - queued)
+
+        return (key, callable, args, kwargs)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                task = self._next()
+                
+                if task is None:
+                    self._workers.discard(threading.current_thread())
+                    self._cond.notify_all()
+                    break
+
+            (key, callable, args, kwargs) = task
+
+            start = time.time()
+            try:
+                callable(*args, **kwargs)
+            except:
+                traceback.print_exc(file = sys.stderr)
+                self.delayed_exceptions.append(sys.exc_info())
+
+            with self._cond:
+                self._record(self._duration, time.time() - start)
+                self._busy -= 1
+                self._running.remove(key)
+
+                if self._queues[key]:
+                    self._ready.append(key)
+                    self._cond.notify_all()
+                else:
+                    del self._queues[key]
+
+                if not self._queued and not self._busy:
+                    # Wake up threads waiting in join
+                    self._cond.notify_all()
+
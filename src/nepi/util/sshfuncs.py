@@ -20,6 +20,7 @@
 
 ## TODO: This code needs reviewing !!!
 
+import atexit
 import base64
 import errno
 import hashlib
@@ -35,6 +36,8 @@ import threading
 import time
 import tempfile
 
+from nepi.util import eventloop
+
 logger = logging.getLogger("sshfuncs")
 
 def log(msg, level, out = None, err = None):
@@ -205,6 +208,267 @@ def eintr_retry(func):
             return func(*p, **kw)
     return rv
 
+class SSHSession(object):
+    """ Persistent ssh connection (ControlMaster) to a host.
+
+    The control master is started in background with ControlPersist=yes,
+    so it does not expire while the session is in use. The rexec and
+    rcopy invocations to the same host multiplex their ssh sessions
+    over it.
+
+    """
+    def __init__(self, host, user, 
+            port = None,
+            identity = None,
+            gwuser = None,
+            gw = None,
+            agent = True,
+            server_key = None,
+            strict_host_checking = False):
+        self.host = host
+        self.user = user
+        self.port = port
+        self.identity = identity
+        self.gwuser = gwuser
+        self.gw = gw
+        self.agent = agent
+        self.server_key = server_key
+        self.strict_host_checking = strict_host_checking
+
+        # Number of users of the session
+        self.refcount = 0
+
+        self._lock = threading.Lock()
+        self._open_lock = threading.Lock()
+        self._count = 0
+        self._total = 0.0
+        self._max = 0.0
+        self._opens = 0
+
+    @property
+    def key(self):
+        return (self.host, self.user, self.port, self.identity)
+
+    @property
+    def control_path(self):
+        # The path is expanded here, so that scp (which names the 
+        # host differently than rexec) finds the same control socket
+        host = self.host if self.gw else gethostbyname(self.host)
+        path = make_control_path(self.agent, False)
+        return path.replace("%r", self.user).replace("%h", host).replace(
+                "%p", str(self.port or 22))
+
+    def open(self, connect_timeout = 30):
+        """ Starts the control master. Returns True on success """
+        args, tmp_known_hosts = self._args("-f", "-N",
+                "-o", "ControlMaster=yes",
+                "-o", "ControlPersist=yes",
+                connect_timeout = connect_timeout)
+
+        # The master stays in background holding the standard output 
+        # and error, so they can't be pipes we wait on
+        with open(DEV_NULL, "r+") as null:
+            err = tempfile.TemporaryFile()
+            proc = subprocess.Popen(args, 
+                    stdin = null,
+                    stdout = null,
+                    stderr = err)
+            proc.wait()
+            err.seek(0)
+            err = err.read()
+
+        with self._lock:
+            self._opens += 1
+
+        log_msg = " ssh session - host %s - open %s " % (str(self.host), 
+                " ".join(map(str, args)))
+
+        if proc.returncode:
+            log(log_msg, logging.ERROR, err = err)
+            return False
+
+        log(log_msg, logging.DEBUG, err = err)
+        return True
+
+    def check(self):
+        """ Returns True if the control master is running """
+        return self._control("check") == 0
+
+    def close(self):
+        """ Stops the control master """
+        self._control("exit")
+
+    def ensure(self):
+        """ Re-opens the control master if it is not running. 
+        Returns True if the master is running """
+        with self._open_lock:
+            return self.check() or self.open()
+
+    def record(self, latency):
+        """ Records the latency of a command executed on the host """
+        with self._lock:
+            self._count += 1
+            self._total += latency
+            self._max = max(self._max, latency)
+
+    def stats(self):
+        """ Returns a dictionary with the number of commands executed
+        through the session, their mean and max latency in seconds,
+        and the number of times the master was (re-)opened """
+        with self._lock:
+            return dict(count = self._count,
+                    mean = self._total / self._count if self._count else 0.0,
+                    max = self._max,
+                    opens = self._opens)
+
+    def _control(self, cmd):
+        args, tmp_known_hosts = self._args("-O", cmd)
+
+        with open(DEV_NULL, "r+") as null:
+            proc = subprocess.Popen(args,
+                    stdin = null,
+                    stdout = null,
+                    stderr = null)
+            return proc.wait()
+
+    def _args(self, *options, **kwargs):
+        args, tmp_known_hosts = _rexec_args("", self.host, self.user,
+                port = self.port,
+                gwuser = self.gwuser,
+                gw = self.gw,
+                agent = self.agent,
+                identity = self.identity,
+                server_key = self.server_key,
+                connect_timeout = kwargs.get("connect_timeout", 30),
+                persistent = False,
+                strict_host_checking = self.strict_host_checking)
+
+        # Remove the command
+        args.pop()
+
+        args[1:1] = list(options)
+        args.extend(["-o", "ControlPath=%s" % self.control_path])
+
+        return args, tmp_known_hosts
+
+class SSHSessionPool(object):
+    """ Keeps the persistent ssh sessions (see SSHSession), indexed by
+    (host, user, port, identity).
+
+    Sessions are reference counted. The first acquire opens the session
+    and the last release closes it. While there are open sessions, a 
+    monitor thread health-checks them every 'check_interval' seconds
+    and re-opens the ones that died.
+
+    """
+    def __init__(self, check_interval = 30):
+        self.check_interval = check_interval
+        self._sessions = dict()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def acquire(self, host, user, port = None, identity = None, **kwargs):
+        """ Returns the session to the host, opening it if needed.
+        Each acquire must be matched by a release.
+
+        Extra arguments (gwuser, gw, agent, server_key, 
+        strict_host_checking) are used to open the session.
+
+        """
+        key = (host, user, port, identity)
+
+        with self._cond:
+            session = self._sessions.get(key)
+            if not session:
+                session = SSHSession(host, user, port = port, 
+                        identity = identity, **kwargs)
+                self._sessions[key] = session
+
+            session.refcount += 1
+
+            if not self._thread:
+                self._thread = threading.Thread(target = self._monitor)
+                self._thread.setDaemon(True)
+                self._thread.start()
+
+        session.ensure()
+        return session
+
+    def release(self, host, user, port = None, identity = None):
+        """ Releases a session obtained with acquire """
+        key = (host, user, port, identity)
+
+        with self._cond:
+            session = self._sessions.get(key)
+            if not session:
+                return
+
+            session.refcount -= 1
+            if session.refcount > 0:
+                return
+
+            del self._sessions[key]
+            self._cond.notify()
+
+        session.close()
+
+    def get(self, host, user, port = None, identity = None):
+        """ Returns the session to the host, or None """
+        with self._cond:
+            return self._sessions.get((host, user, port, identity))
+
+    def record(self, host, user, port, identity, latency):
+        """ Records the latency of a command, if there is a session to
+        the host """
+        session = self.get(host, user, port, identity)
+        if session:
+            session.record(latency)
+
+    def check(self):
+        """ Health-checks all sessions, re-opening the dead ones """
+        with self._cond:
+            sessions = self._sessions.values()
+
+        for session in sessions:
+            if not session.ensure():
+                msg = " ssh session - host %s - failed to re-open " % (
+                        session.host)
+                log(msg, logging.ERROR)
+
+    def stats(self):
+        """ Returns a dictionary with the statistics of each session,
+        indexed by (host, user, port, identity) """
+        with self._cond:
+            sessions = self._sessions.values()
+
+        return dict((session.key, session.stats()) for session in sessions)
+
+    def close(self):
+        """ Closes all sessions """
+        with self._cond:
+            sessions = self._sessions.values()
+            self._sessions.clear()
+            self._cond.notify()
+
+        for session in sessions:
+            session.close()
+
+    def _monitor(self):
+        while True:
+            with self._cond:
+                self._cond.wait(self.check_interval)
+
+                if not self._sessions:
+                    self._thread = None
+                    return
+
+            self.check()
+
+session_pool = SSHSessionPool()
+
+# Don't leave control masters behind
+atexit.register(session_pool.close)
+
 def rexec(command, host, user, 
         port = None,
         gwuser = None,
@@ -224,7 +488,153 @@ def rexec(command, host, user,
     """
     Executes a remote command, returns ((stdout,stderr),process)
     """
+    args, tmp_known_hosts = _rexec_args(command, host, user,
+            port = port,
+            gwuser = gwuser,
+            gw = gw,
+            agent = agent,
+            sudo = sudo,
+            identity = identity,
+            server_key = server_key,
+            tty = tty,
+            connect_timeout = connect_timeout,
+            persistent = persistent,
+            forward_x11 = forward_x11,
+            strict_host_checking = strict_host_checking)
+
+    log_msg = " rexec - host %s - command %s " % (str(host), " ".join(map(str, args))) 
+
+    stdout = stderr = stdin = subprocess.PIPE
+    if forward_x11:
+        stdout = stderr = stdin = None
+
+    start = time.time()
+
+    result = _retry_rexec(args, log_msg, 
+            stderr = stderr,
+            stdin = stdin,
+            stdout = stdout,
+            env = env, 
+            retry = retry, 
+            tmp_known_hosts = tmp_known_hosts,
+            blocking = blocking)
+
+    if blocking:
+        session_pool.record(host, user, port, identity, time.time() - start)
+
+    return result
+
+def rexec_async(command, host, user, 
+        port = None,
+        gwuser = None,
+        gw = None, 
+        agent = True,
+        sudo = False,
+        identity = None,
+        server_key = None,
+        env = None,
+        connect_timeout = 30,
+        retry = 3,
+        persistent = True,
+        strict_host_checking = True):
+    """
+    Executes a remote command without blocking the calling thread.
+    The ssh process is driven by the shared eventloop.ProcessLoop.
+
+    Returns a Future for the ((stdout,stderr),process) result
+    """
+    args, tmp_known_hosts = _rexec_args(command, host, user,
+            port = port,
+            gwuser = gwuser,
+            gw = gw,
+            agent = agent,
+            sudo = sudo,
+            identity = identity,
+            server_key = server_key,
+            connect_timeout = connect_timeout,
+            persistent = persistent,
+            strict_host_checking = strict_host_checking)
+
+    log_msg = " rexec - host %s - command %s " % (str(host), " ".join(map(str, args))) 
+
+    start = time.time()
+
+    future = eventloop.run_coroutine(_retry_rexec_async(args, log_msg, 
+            env = env, 
+            retry = retry, 
+            tmp_known_hosts = tmp_known_hosts))
+
+    future.add_done_callback(lambda f: session_pool.record(host, user, 
+        port, identity, time.time() - start))
+
+    return future
+
+def rpopen(command, host, user, 
+        port = None,
+        gwuser = None,
+        gw = None, 
+        agent = True,
+        sudo = False,
+        identity = None,
+        server_key = None,
+        connect_timeout = 30,
+        persistent = True,
+        stderr = subprocess.PIPE,
+        strict_host_checking = True):
+    """
+    Starts a remote command and returns immediately, leaving its
+    standard input and output connected to the returned process pipes.
+    Used to keep long-lived channels to remote processes.
+
+    The standard error is a pipe too, unless other file is given in 
+    'stderr'.
+
+    :rtype: subprocess.Popen
+    """
+    args, tmp_known_hosts = _rexec_args(command, host, user,
+            port = port,
+            gwuser = gwuser,
+            gw = gw,
+            agent = agent,
+            sudo = sudo,
+            identity = identity,
+            server_key = server_key,
+            connect_timeout = connect_timeout,
+            persistent = persistent,
+            strict_host_checking = strict_host_checking)
+
+    log_msg = " rpopen - host %s - command %s " % (str(host), " ".join(map(str, args))) 
+    log(log_msg, logging.DEBUG)
+
+    proc = subprocess.Popen(args,
+            stdin = subprocess.PIPE,
+            stdout = subprocess.PIPE,
+            stderr = stderr,
+            close_fds = True)
+
+    # attach tempfile object to the process, to make sure the file stays
+    # alive until the process is finished with it
+    proc._known_hosts = tmp_known_hosts
 
+    return proc
+
+def _rexec_args(command, host, user, 
+        port = None,
+        gwuser = None,
+        gw = None, 
+        agent = True,
+        sudo = False,
+        identity = None,
+        server_key = None,
+        tty = False,
+        connect_timeout = 30,
+        persistent = True,
+        forward_x11 = False,
+        strict_host_checking = True):
+    """
+    Builds the ssh command line to execute a remote command, 
+    returns (args, tmp_known_hosts)
+    """
     tmp_known_hosts = None
     if not gw:
         hostip = gethostbyname(host)
@@ -284,20 +694,7 @@ def rexec(command, host, user,
 
     args.append(command)
 
-    log_msg = " rexec - host %s - command %s " % (str(host), " ".join(map(str, args))) 
-
-    stdout = stderr = stdin = subprocess.PIPE
-    if forward_x11:
-        stdout = stderr = stdin = None
-
-    return _retry_rexec(args, log_msg, 
-            stderr = stderr,
-            stdin = stdin,
-            stdout = stdout,
-            env = env, 
-            retry = retry, 
-            tmp_known_hosts = tmp_known_hosts,
-            blocking = blocking)
+    return args, tmp_known_hosts
 
 def rcopy(source, dest,
         port = None,
@@ -318,7 +715,77 @@ def rcopy(source, dest,
     (in which case it is advised that the destination be a folder),
     or a single file in a string.
     """
+    args, user, host, tmp_known_hosts = _rcopy_args(source, dest, 
+            port = port,
+            gwuser = gwuser,
+            gw = gw,
+            recursive = recursive,
+            identity = identity,
+            server_key = server_key,
+            strict_host_checking = strict_host_checking)
 
+    log_msg = " rcopy - host %s - command %s " % (str(host), " ".join(map(str, args)))
+    
+    start = time.time()
+
+    result = _retry_rexec(args, log_msg, env = None, retry = retry, 
+            tmp_known_hosts = tmp_known_hosts,
+            blocking = True)
+
+    session_pool.record(host, user, port, identity, time.time() - start)
+
+    return result
+
+def rcopy_async(source, dest,
+        port = None,
+        gwuser = None,
+        gw = None,
+        recursive = False,
+        identity = None,
+        server_key = None,
+        retry = 3,
+        strict_host_checking = True):
+    """
+    Copies from/to remote sites without blocking the calling thread.
+    Same arguments as rcopy.
+
+    Returns a Future for the ((stdout,stderr),process) result
+    """
+    args, user, host, tmp_known_hosts = _rcopy_args(source, dest, 
+            port = port,
+            gwuser = gwuser,
+            gw = gw,
+            recursive = recursive,
+            identity = identity,
+            server_key = server_key,
+            strict_host_checking = strict_host_checking)
+
+    log_msg = " rcopy - host %s - command %s " % (str(host), " ".join(map(str, args)))
+    
+    start = time.time()
+
+    future = eventloop.run_coroutine(_retry_rexec_async(args, log_msg, 
+            env = None, 
+            retry = retry, 
+            tmp_known_hosts = tmp_known_hosts))
+
+    future.add_done_callback(lambda f: session_pool.record(host, user, 
+        port, identity, time.time() - start))
+
+    return future
+
+def _rcopy_args(source, dest,
+        port = None,
+        gwuser = None,
+        gw = None,
+        recursive = False,
+        identity = None,
+        server_key = None,
+        strict_host_checking = True):
+    """
+    Builds the scp command line to copy from/to remote sites, 
+    returns (args, user, host, tmp_known_hosts)
+    """
     # Parse destination as <user>@<server>:<path>
     if isinstance(dest, str) and ':' in dest:
         remspec, path = dest.split(':',1)
@@ -327,6 +794,8 @@ def rcopy(source, dest,
     else:
         raise ValueError, "Both endpoints cannot be local"
     user,host = remspec.rsplit('@',1)
+
+    session = session_pool.get(host, user, port, identity)
     
     # plain scp
     tmp_known_hosts = None
@@ -368,10 +837,17 @@ def rcopy(source, dest,
         # Do not check for Host key. Unsafe.
         args.extend(['-o', 'StrictHostKeyChecking=no'])
     
+    if session:
+        # Multiplex over the persistent session to the host
+        args.extend([
+            '-o', 'ControlMaster=no',
+            '-o', 'ControlPath=%s' % (session.control_path,)
+            ])
+
     if isinstance(source, list):
         args.extend(source)
     else:
-        if openssh_has_persist():
+        if not session and openssh_has_persist():
             args.extend([
                 '-o', 'ControlMaster=auto',
                 '-o', 'ControlPath=%s' % (make_control_path(False, False),)
@@ -383,11 +859,7 @@ def rcopy(source, dest,
     else:
         args.append(dest)
 
-    log_msg = " rcopy - host %s - command %s " % (str(host), " ".join(map(str, args)))
-    
-    return _retry_rexec(args, log_msg, env = None, retry = retry, 
-            tmp_known_hosts = tmp_known_hosts,
-            blocking = True)
+    return args, user, host, tmp_known_hosts
 
 def rspawn(command, pidfile, 
         stdout = '/dev/null', 
@@ -447,6 +919,45 @@ def rspawn(command, pidfile,
         Of the spawning process, which only captures errors at spawning time.
         Usually only useful for diagnostics.
     """
+    cmd = make_spawn_command(command, pidfile,
+            stdout = stdout,
+            stderr = stderr,
+            stdin = stdin,
+            home = home,
+            create_home = create_home,
+            sudo = sudo)
+
+    (out,err),proc = rexec(
+        cmd,
+        host = host,
+        port = port,
+        user = user,
+        gwuser = gwuser,
+        gw = gw,
+        agent = agent,
+        identity = identity,
+        server_key = server_key,
+        tty = tty,
+        strict_host_checking = strict_host_checking ,
+        )
+    
+    if proc.wait():
+        raise RuntimeError, "Failed to set up application on host %s: %s %s" % (host, out,err,)
+
+    return ((out, err), proc)
+
+def make_spawn_command(command, pidfile, 
+        stdout = '/dev/null', 
+        stderr = STDOUT, 
+        stdin = '/dev/null',
+        home = None, 
+        create_home = False, 
+        sudo = False):
+    """
+    Returns the shell command used by rspawn to run a command detached, 
+    in background, saving its pid and ppid in the pidfile. 
+    See rspawn for the meaning of the arguments.
+    """
     # Start process in a "daemonized" way, using nohup and heavy
     # stdin/out redirection to avoid connection issues
     if stderr is STDOUT:
@@ -470,24 +981,7 @@ def rspawn(command, pidfile,
             'create' : 'mkdir -p %s ; ' % (shell_escape(home),) if create_home and home else '',
         }
 
-    (out,err),proc = rexec(
-        cmd,
-        host = host,
-        port = port,
-        user = user,
-        gwuser = gwuser,
-        gw = gw,
-        agent = agent,
-        identity = identity,
-        server_key = server_key,
-        tty = tty,
-        strict_host_checking = strict_host_checking ,
-        )
-    
-    if proc.wait():
-        raise RuntimeError, "Failed to set up application on host %s: %s %s" % (host, out,err,)
-
-    return ((out, err), proc)
+    return cmd
 
 @eintr_retry
 def rgetpid(pidfile,
@@ -531,6 +1025,13 @@ def rgetpid(pidfile,
         strict_host_checking = strict_host_checking
         )
         
+    return parse_pid(out, proc)
+
+def parse_pid(out, proc):
+    """
+    Parses the output of reading a pidfile, returns a (pid, ppid) tuple
+    or None if the pidfile isn't valid yet
+    """
     if proc.wait():
         return None
     
@@ -565,11 +1066,7 @@ def rstatus(pid, ppid,
     
     """
     (out,err),proc = rexec(
-        # Check only by pid. pid+ppid does not always work (especially with sudo) 
-        " (( ps --pid %(pid)d -o pid | grep -c %(pid)d && echo 'wait')  || echo 'done' ) | tail -n 1" % {
-            'ppid' : ppid,
-            'pid' : pid,
-        },
+        make_status_command(pid, ppid),
         host = host,
         port = port,
         user = user,
@@ -581,6 +1078,24 @@ def rstatus(pid, ppid,
         strict_host_checking = strict_host_checking
         )
     
+    return parse_status(out, err, proc)
+
+def make_status_command(pid, ppid):
+    """
+    Returns the shell command used by rstatus to check if a process 
+    is still running
+    """
+    # Check only by pid. pid+ppid does not always work (especially with sudo) 
+    return " (( ps --pid %(pid)d -o pid | grep -c %(pid)d && echo 'wait')  || echo 'done' ) | tail -n 1" % {
+            'ppid' : ppid,
+            'pid' : pid,
+        }
+
+def parse_status(out, err, proc):
+    """
+    Parses the output of the status command, returns one of 
+    NOT_STARTED, RUNNING, FINISHED
+    """
     if proc.wait():
         return ProcStatus.NOT_STARTED
     
@@ -622,6 +1137,30 @@ def rkill(pid, ppid,
         :param sudo: Flag indicating if sudo should be used to kill the process
         :type sudo: bool
         
+    """
+    cmd = make_kill_command(pid, ppid, sudo = sudo, nowait = nowait)
+
+    (out,err),proc = rexec(
+        cmd,
+        host = host,
+        port = port,
+        user = user,
+        gwuser = gwuser,
+        gw = gw,
+        agent = agent,
+        identity = identity,
+        server_key = server_key,
+        strict_host_checking = strict_host_checking
+        )
+    
+    # wait, don't leave zombies around
+    proc.wait()
+
+    return (out, err), proc
+
+def make_kill_command(pid, ppid, sudo = False, nowait = False):
+    """
+    Returns the shell command used by rkill to kill a process
     """
     subkill = "$(ps --ppid %(pid)d -o pid h)" % { 'pid' : pid }
     cmd = """
@@ -646,28 +1185,12 @@ fi
     if nowait:
         cmd = "( %s ) >/dev/null 2>/dev/null </dev/null &" % (cmd,)
 
-    (out,err),proc = rexec(
-        cmd % {
+    return cmd % {
             'ppid' : ppid,
             'pid' : pid,
             'sudo' : 'sudo -S' if sudo else '',
             'subkill' : subkill,
-        },
-        host = host,
-        port = port,
-        user = user,
-        gwuser = gwuser,
-        gw = gw,
-        agent = agent,
-        identity = identity,
-        server_key = server_key,
-        strict_host_checking = strict_host_checking
-        )
-    
-    # wait, don't leave zombies around
-    proc.wait()
-
-    return (out, err), proc
+        }
 
 def _retry_rexec(args,
         log_msg,
@@ -738,6 +1261,45 @@ def _retry_rexec(args,
 
     return ((out, err), proc)
 
+def _retry_rexec_async(args,
+        log_msg,
+        env = None,
+        retry = 3,
+        tmp_known_hosts = None):
+    """ Coroutine version of _retry_rexec. Instead of blocking, 
+    it waits for the process and the retry delays in the event loop """
+
+    for x in xrange(max(retry, 1)):
+        (out, err), proc = yield eventloop.spawn(args, env = env)
+
+        # attach tempfile object to the process, to make sure the file stays
+        # alive until the process is finished with it
+        proc._known_hosts = tmp_known_hosts
+
+        log(log_msg, logging.DEBUG, out, err)
+
+        if proc.poll():
+            skip = False
+
+            if err.strip().startswith('ssh: ') or err.strip().startswith('mux_client_hello_exchange: '):
+                # SSH error, can safely retry
+                skip = True 
+            elif retry:
+                # Probably timed out or plain failed but can retry
+                skip = True 
+            
+            if skip and x < retry - 1:
+                t = x*2
+                msg = "SLEEPING %d ... ATEMPT %d - command %s " % ( 
+                        t, x, " ".join(args))
+                log(msg, logging.DEBUG)
+
+                yield eventloop.sleep(t)
+                continue
+        break
+
+    raise eventloop.Return(((out, err), proc))
+
 # POSIX
 # Don't remove. The method communicate was re implemented for performance issues
 def _communicate(proc, input, timeout=None, err_on_timeout=True):
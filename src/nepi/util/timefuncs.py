@@ -20,6 +20,7 @@
 
 import datetime
 import re
+import time
 
 _strf = "%Y%m%d%H%M%S%f"
 _reabs = re.compile("^\d{20}$")
@@ -113,6 +114,89 @@ def stabsformat(sdate, dbase = None):
 
     return None
 
+# Clock used to timestamp scheduled tasks. Monotonic if available.
+_clock = getattr(time, "monotonic", time.time)
+
+# Cache of parsed relative times (e.g. '0.5s') in seconds
+_delays = dict()
+_delays_max = 1024
+
+def tclock():
+    """ Returns the current time in seconds of the clock used to 
+    timestamp scheduled tasks (monotonic if available)
+
+    """
+    return _clock()
+
+def tdelaysec(sdate):
+    """ Returns the number of seconds of a relative time string 
+    ( e.g. format '5m' or '10s'), or None if the string is not a relative 
+    time. Parsed strings are memoized.
+
+    :param sdate : relative time string 
+    :type sdate : str 
+
+    """
+    try:
+        return _delays[sdate]
+    except KeyError:
+        pass
+
+    m = _rerel.match(sdate)
+    if not m:
+        return None
+
+    value = float(m.groupdict()['time'])
+    units = m.groupdict()['units']
+    if units == 'h':
+        delay = value * 3600
+    elif units == 'm':
+        delay = value * 60
+    elif units == 's':
+        delay = value
+    elif units == 'ms':
+        delay = value / 1e3
+    else:
+        delay = value / 1e6
+
+    if len(_delays) >= _delays_max:
+        _delays.clear()
+
+    _delays[sdate] = delay
+    return delay
+
+def stabssec(sdate, base = None):
+    """ Same as stabsformat, but returns the date in seconds of the 
+    tclock() clock instead of a datetime object.
+    If the date is a relative time and the base parameter is given
+    (in seconds of the tclock() clock), the returned date will be 
+    base + sdate. If base is None, the current time will be used instead.
+
+    :param sdate : string date  
+    :type sdate : str 
+
+    """
+    now = tclock()
+
+    # No date given, return current time
+    if not sdate:
+        return now
+
+    # Relative time is given
+    delay = tdelaysec(sdate)
+    if delay is not None:
+        if base is None:
+            base = now
+
+        return base + delay
+
+    # Absolute date is given
+    if _reabs.match(sdate):
+        date = datetime.datetime.strptime(sdate, _strf)
+        return now + tdiffsec(date, tnow())
+
+    return None
+
 def compute_delay_ms(timestamp2, timestamp1):
     d1 = datetime.datetime.fromtimestamp(float(timestamp1))
     d2 = datetime.datetime.fromtimestamp(float(timestamp2))
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#
+#    NEPI, a framework to manage network experiments
+#    Copyright (C) 2014 INRIA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from nepi.data.processing.ccn import parser as ccn_parser
+from nepi.data.processing.ccn.parser import MESSAGE_TYPES
+
+import networkx
+import numpy
+import os
+import unittest
+
+# Logs of a consumer (0), a router (1) and a producer (2) connected in
+# a line: 0 -- 1 -- 2
+LOGS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
+
+BUNNY = "ccnx:/test/bunny.ts"
+CHUNK0 = "ccnx:/test/bunny.ts/%FD%05/=00"
+CHUNK1 = "ccnx:/test/bunny.ts/%FD%05/%01"
+CHUNK2 = "ccnx:/test/bunny.ts/%FD%05/%02"
+
+NONCE0 = "412A74-0844-0008-50AA-F6EAD4"
+NONCE1 = "412A74-0844-0008-50AA-F6EAD5"
+
+def create_graph():
+    graph = networkx.Graph()
+    graph.add_node(0, ips = ["10.0.0.1"])
+    graph.add_node(1, ips = ["10.0.0.2"])
+    graph.add_node(2, ips = ["10.0.0.3"])
+    return graph
+
+class CCNParserTestCase(unittest.TestCase):
+    def test_annotate_cn_graph(self):
+        graph = ccn_parser.annotate_cn_graph(LOGS_DIR, create_graph(),
+                nprocs = 2)
+
+        self.assertEquals(ccn_parser.ccn_consumers(graph), [0])
+        self.assertEquals(ccn_parser.ccn_producers(graph), [2])
+        self.assertEquals(sorted(map(sorted, graph.edges())),
+                [[0, 1], [1, 2]])
+
+        histories = dict((nid, ccn_parser.load_content_history(
+            graph.node[nid]["history"])) for nid in graph.nodes())
+
+        def counts(nid):
+            history = histories[nid]
+            return dict((MESSAGE_TYPES[code], count) for code, count in
+                    enumerate(numpy.bincount(history["message_type"],
+                        minlength = len(MESSAGE_TYPES))) if count)
+
+        # Local and control messages are discarded, and so are the
+        # messages through released faces
+        self.assertEquals(counts(0), dict(interest_to = 2,
+            content_from = 2))
+        self.assertEquals(counts(1), dict(interest_from = 2,
+            interest_to = 2, content_from = 2, content_to = 2,
+            interest_dupnonce = 1, interest_expiry = 1))
+        self.assertEquals(counts(2), dict(interest_from = 2,
+            content_to = 2))
+
+        # Content digests are removed
+        self.assertEquals(sorted(histories[0]["content_names"]),
+                [BUNNY, CHUNK1, CHUNK0])
+        self.assertEquals(sorted(histories[1]["content_names"]),
+                [BUNNY, CHUNK1, CHUNK2, CHUNK0])
+
+        history = histories[1]
+        self.assertEquals(history["nid"], 1)
+        self.assertEquals(sorted(history["peers"]), [0, 2])
+        self.assertEquals(sorted(history["nonces"]), ["", NONCE0, NONCE1])
+
+        first = [history[name][0] for name in ["timestamp", "size"]]
+        self.assertEquals(first, [1374181938.830000, 39])
+        self.assertEquals(history["content_names"][
+            history["content_name"][0]], BUNNY)
+        self.assertEquals(history["peers"][history["peer"][0]], 0)
+        self.assertEquals(history["nonces"][history["nonce"][0]], NONCE0)
+
+    def test_process_content_history(self):
+        (graph, content_names, interest_expiry_count, 
+                interest_dupnonce_count, interest_count, content_count) = \
+                        ccn_parser.process_content_history_logs(LOGS_DIR,
+                                create_graph())
+
+        self.assertEquals(interest_expiry_count, 1)
+        self.assertEquals(interest_dupnonce_count, 1)
+        self.assertEquals(interest_count, 4)
+        self.assertEquals(content_count, 4)
+
+        # The first content chunk is mapped to the first interest
+        self.assertEquals(sorted(content_names), [BUNNY, CHUNK1, CHUNK2])
+
+        bunny = content_names[BUNNY]
+        self.assertEquals(bunny["interest"], {
+            NONCE0: [(1374181938.830000, 0, 1), (1374181938.840000, 1, 2)]})
+        self.assertEquals(bunny["content"], [(1374181938.850000, 2, 1),
+            (1374181938.868682, 1, 0)])
+        self.assertEquals(bunny["consumer_history"], [
+            (1374181938.812750, "interest_to"),
+            (1374181938.868682, "content_from")])
+        self.assertEquals(bunny["lapse"], (1374181938.812750, 
+            1374181938.868682))
+        self.assertEquals(bunny["rtt"], 55.932)
+
+        chunk1 = content_names[CHUNK1]
+        self.assertEquals(chunk1["interest"], {
+            NONCE1: [(1374181938.880000, 0, 1), (1374181938.885000, 1, 2)]})
+        self.assertEquals(chunk1["content"], [(1374181938.890000, 2, 1),
+            (1374181938.901000, 1, 0)])
+        self.assertEquals(chunk1["rtt"], 30.0)
+
+        # Expired interests were never sent by the consumer
+        chunk2 = content_names[CHUNK2]
+        self.assertEquals(chunk2["interest"], {})
+        self.assertEquals(chunk2["content"], [])
+        self.assertEquals(chunk2["consumer_history"], [])
+        self.assertEquals(chunk2["lapse"], (None, None))
+        self.assertEquals(chunk2["rtt"], -1)
+
+if __name__ == '__main__':
+    unittest.main()
+
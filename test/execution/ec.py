@@ -20,12 +20,28 @@
 
 
 from nepi.execution.ec import ExperimentController, ECState 
-from nepi.execution.scheduler import TaskStatus
+from nepi.execution.resource import ResourceManager, ResourceState
+from nepi.execution.scheduler import Task, TaskStatus, SchedulerType, \
+        TimerWheelScheduler
+from nepi.util import eventloop
 
 import datetime
+import functools
+import threading
 import time
 import unittest
 
+class LazyResource(ResourceManager):
+    """ Stops after 'finish' without informing the EC, like RMs that
+    only update their state when it is queried """
+    finish = None
+
+    @property
+    def state(self):
+        if self.finish and time.time() >= self.finish:
+            return max(self._state, ResourceState.STOPPED)
+        return self._state
+
 class ExecuteControllersTestCase(unittest.TestCase):
     def test_schedule_print(self):
         def myfunc():
@@ -90,6 +106,119 @@ class ExecuteControllersTestCase(unittest.TestCase):
 
         self.assertEquals(task.status, TaskStatus.ERROR)
 
+    def test_schedule_wheel(self):
+        ec = ExperimentController(scheduler_type = SchedulerType.WHEEL)
+        self.assertTrue(isinstance(ec._scheduler, TimerWheelScheduler))
+
+        schedule_time = datetime.datetime.now()
+        
+        tid1 = ec.schedule("2s", datetime.datetime.now, track = True)
+        tid2 = ec.schedule("1s", datetime.datetime.now, track = True)
+
+        while True:
+            task = ec.get_task(tid1)
+            if task.status != TaskStatus.NEW:
+                break
+
+            time.sleep(1)
+
+        task1 = ec.get_task(tid1)
+        task2 = ec.get_task(tid2)
+        self.assertEquals(task2.status, TaskStatus.DONE)
+        self.assertTrue(task2.result < task1.result)
+
+        delta = task1.result - schedule_time
+        self.assertTrue(delta > datetime.timedelta(seconds = 2))
+        self.assertTrue(delta < datetime.timedelta(seconds = 3))
+
+        ec.shutdown()
+
+    def test_wait_state_change(self):
+        ec = ExperimentController()
+
+        guids = []
+        for i in xrange(3):
+            guid = ec._guid_generator.next(None)
+            ec._resources[guid] = ResourceManager(ec, guid)
+            guids.append(guid)
+
+        for guid in guids:
+            rm = ec.get_resource(guid)
+            ec.schedule("1s", rm.set_ready)
+
+        start = datetime.datetime.now()
+        ec.wait_deployed(guids)
+        delta = datetime.datetime.now() - start
+
+        # The waiting thread must be awaken by the state change, 
+        # not by a polling timeout
+        self.assertTrue(delta < datetime.timedelta(seconds = 2))
+        self.assertTrue(all([ec.state(guid) == ResourceState.READY \
+                for guid in guids]))
+        self.assertEquals(ec._state_listeners, [])
+
+        ec.shutdown()
+
+    def test_wait_lazy_state(self):
+        ec = ExperimentController()
+
+        guids = []
+        finish = time.time() + 1
+        for i in xrange(40):
+            guid = ec._guid_generator.next(None)
+            rm = LazyResource(ec, guid)
+            rm.finish = finish
+            ec._resources[guid] = rm
+            guids.append(guid)
+
+        start = datetime.datetime.now()
+        ec.wait_finished(guids)
+        delta = datetime.datetime.now() - start
+
+        # All the pending RMs are queried on each timeout, not one 
+        # at a time
+        self.assertTrue(delta < datetime.timedelta(seconds = 3))
+
+        ec.shutdown()
+
+    def test_coroutine_serialized(self):
+        ec = ExperimentController()
+
+        guid = ec._guid_generator.next(None)
+        rm = ResourceManager(ec, guid)
+        ec._resources[guid] = rm
+
+        self.assertEquals(ec._task_key(Task(0, rm.deploy)), guid)
+        self.assertEquals(ec._task_key(Task(0, 
+            functools.partial(rm.deploy))), guid)
+        self.assertEquals(ec._task_key(Task(0, lambda: None)), None)
+        self.assertEquals(ec._task_key(Task(0, lambda: None, key = guid)), 
+                guid)
+
+        lock = threading.Lock()
+        running = [0]
+        concurrent = [0]
+
+        def steps():
+            for i in xrange(3):
+                yield eventloop.sleep(0.01)
+
+                with lock:
+                    running[0] += 1
+                    concurrent[0] = max(concurrent[0], running[0])
+                time.sleep(0.05)
+                with lock:
+                    running[0] -= 1
+
+        futures = [rm.run_coroutine(steps()) for i in xrange(4)]
+        for future in futures:
+            future.result(30)
+
+        # Steps of coroutines of a same RM are not executed concurrently
+        self.assertEquals(concurrent[0], 1)
+
+        ec.shutdown()
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -23,6 +23,7 @@ from nepi.execution.attribute import Attribute
 from nepi.execution.ec import ExperimentController, FailureLevel 
 from nepi.execution.resource import ResourceManager, ResourceState, \
         clsinit_copy, ResourceAction
+from nepi.util.timefuncs import tnow, tdiffsec
 
 import random
 import time
@@ -133,6 +134,29 @@ class ErrorApplication(ResourceManager):
             time.sleep(random.random() * 2)
             raise RuntimeError, "NOT A REAL ERROR. JUST TESTING"
 
+class CountingApplication(ResourceManager):
+    _rtype = "CountingApplication"
+
+    def __init__(self, ec, guid):
+        super(CountingApplication, self).__init__(ec, guid)
+        self.evaluations = 0
+
+    def start_with_conditions(self):
+        self.evaluations += 1
+        super(CountingApplication, self).start_with_conditions()
+
+class LazyApplication(ResourceManager):
+    _rtype = "LazyApplication"
+
+    @property
+    def state(self):
+        # Like LinuxApplication, the application only finds out it 
+        # finished when the state is queried
+        if self._state == ResourceState.STARTED and \
+                tdiffsec(tnow(), self.start_time) > 1:
+            self.set_stopped()
+        return self._state
+
 class ResourceFactoryTestCase(unittest.TestCase):
     def test_add_resource_factory(self):
         from nepi.execution.resource import ResourceFactory
@@ -159,6 +183,29 @@ class ResourceFactoryTestCase(unittest.TestCase):
         populate_factory()
 
 class ResourceManagerTestCase(unittest.TestCase):
+    def test_attribute_copy_on_write(self):
+        ec = ExperimentController()
+
+        rm1 = MyResource(ec, 1)
+        rm2 = MyResource(ec, 2)
+
+        # Instances share the class attributes until they are modified
+        self.assertEquals(rm1.get("my_attr"), None)
+        self.assertFalse(rm1.has_changed("my_attr"))
+        self.assertTrue(rm1._attrs.peek("my_attr") is 
+                MyResource._attributes["my_attr"])
+
+        rm1.set("my_attr", "cool")
+        self.assertEquals(rm1.get("my_attr"), "cool")
+        self.assertTrue(rm1.has_changed("my_attr"))
+
+        self.assertEquals(rm2.get("my_attr"), None)
+        self.assertFalse(rm2.has_changed("my_attr"))
+        self.assertEquals(MyResource._attributes["my_attr"].value, None)
+
+        self.assertEquals(len(rm1._attrs.values()), 
+                len(MyResource._attributes))
+
     def test_register_condition(self):
         ec = ExperimentController()
         rm = ResourceManager(ec, 15)
@@ -412,6 +459,67 @@ class ResourceManagerTestCase(unittest.TestCase):
         
         ec.shutdown()
 
+    def test_condition_evaluated_on_state_change(self):
+        from nepi.execution.resource import ResourceFactory
+        
+        ResourceFactory.register_type(CountingApplication)
+
+        ec = ExperimentController()
+
+        app1 = ec.register_resource("CountingApplication")
+        app2 = ec.register_resource("CountingApplication")
+
+        ec.register_condition(app2, ResourceAction.START, app1, 
+                ResourceState.STOPPED)
+
+        ec.deploy()
+
+        ec.wait_started(app1)
+
+        # app2 must not be re-evaluated while app1 does not change state
+        time.sleep(3)
+        ec.stop(app1)
+
+        ec.wait_started(app2)
+        
+        rmapp1 = ec.get_resource(app1)
+        rmapp2 = ec.get_resource(app2)
+
+        self.assertTrue(rmapp2.start_time > rmapp1.stop_time)
+        self.assertTrue(tdiffsec(rmapp2.start_time, rmapp1.stop_time) < 0.5)
+
+        # While app1 does not change state, app2 is only re-evaluated 
+        # every reschedule delay, by a single chain of evaluations
+        self.assertTrue(rmapp2.evaluations <= 10)
+        
+        ec.shutdown()
+
+    def test_condition_on_lazy_state(self):
+        from nepi.execution.resource import ResourceFactory
+        
+        ResourceFactory.register_type(LazyApplication)
+
+        ec = ExperimentController()
+
+        app1 = ec.register_resource("LazyApplication")
+        app2 = ec.register_resource("LazyApplication")
+
+        ec.register_condition(app2, ResourceAction.START, app1, 
+                ResourceState.STOPPED)
+
+        ec.deploy()
+
+        # app1 never informs that it stopped, the condition must be 
+        # re-evaluated anyway
+        ec.wait_started(app2)
+        
+        rmapp1 = ec.get_resource(app1)
+        rmapp2 = ec.get_resource(app2)
+
+        self.assertTrue(rmapp2.start_time > rmapp1.stop_time)
+        
+        ec.shutdown()
+
     def ztest_set_with_condition(self):
         # TODO!!!
         pass
@@ -169,6 +169,90 @@ class RunnerTestCase(unittest.TestCase):
                 wait_time = 0)
 
         self.assertEquals(runs, 10)
+
+    def test_runner_parallel(self):
+        node_count = 4
+        app_count = 2
+
+        ec = ExperimentController(exp_id = "parallel-test")
+       
+        # Add simulated nodes and applications
+        nodes = list()
+        apps = list()
+        ifaces = list()
+
+        for i in xrange(node_count):
+            node = ec.register_resource("dummy::Node")
+            nodes.append(node)
+            
+            iface = ec.register_resource("dummy::Interface")
+            ec.register_connection(node, iface)
+            ifaces.append(iface)
+
+            for i in xrange(app_count):
+                app = ec.register_resource("dummy::Application")
+                ec.register_connection(node, app)
+                apps.append(app)
+
+        link = ec.register_resource("dummy::Link")
+
+        for iface in ifaces:
+            ec.register_connection(link, iface)
+
+        def compute_metric_callback(ec, run):
+            return run
+
+        metrics = []
+        def evaluate_convergence_callback(ec, run, samples):
+            metrics[:] = samples
+            return False
+
+        rnr = ExperimentRunner()
+        runs = rnr.run(ec, min_runs = 5, max_runs = 10, wait_guids = apps, 
+                wait_time = 0, 
+                compute_metric_callback = compute_metric_callback,
+                evaluate_convergence_callback = evaluate_convergence_callback,
+                parallel = 4)
+
+        self.assertEquals(runs, 10)
+        self.assertEquals(sorted(metrics), range(1, 11))
+
+    def t_runner_parallel_failure(self, compute_metric_callback, expected):
+        ec = ExperimentController(exp_id = "parallel-failure-test")
+
+        node = ec.register_resource("dummy::Node")
+        app = ec.register_resource("dummy::Application")
+        ec.register_connection(node, app)
+
+        rnr = ExperimentRunner()
+
+        try:
+            rnr.run(ec, min_runs = 2, max_runs = 2, wait_guids = [app], 
+                    wait_time = 0, 
+                    compute_metric_callback = compute_metric_callback,
+                    parallel = 2)
+        except RuntimeError, e:
+            self.assertTrue(str(e).find(expected) > -1, str(e))
+        else:
+            self.fail("Failed runs were not reported")
+
+    def test_runner_parallel_unpicklable(self):
+        # The metric can't be sent to the parent, the run fails with
+        # the pickling error
+        def compute_metric_callback(ec, run):
+            return lambda: run
+
+        self.t_runner_parallel_failure(compute_metric_callback, 
+                "PicklingError")
+
+    def test_runner_parallel_lost_result(self):
+        # The process exits with code 0 without reporting, the parent
+        # does not wait forever
+        def compute_metric_callback(ec, run):
+            os._exit(0)
+
+        self.t_runner_parallel_failure(compute_metric_callback, 
+                "exited with code 0 without reporting a result")
                        
 if __name__ == '__main__':
     unittest.main()
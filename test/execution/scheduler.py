@@ -18,9 +18,11 @@
 #
 # Author: Alina Quereilhac <alina.quereilhac@inria.fr>
 
-from nepi.execution.scheduler import HeapScheduler, Task, TaskStatus
-from nepi.util.timefuncs import tnow, stabsformat
+from nepi.execution.scheduler import HeapScheduler, TimerWheelScheduler, \
+        Task, TaskStatus
+from nepi.util.timefuncs import tclock, stabssec
 
+import time
 import unittest
 
 class SchedulerTestCase(unittest.TestCase):
@@ -36,9 +38,9 @@ class SchedulerTestCase(unittest.TestCase):
 
         scheduler = HeapScheduler()
         
-        t1 = tnow()
-        t2 = stabsformat("2s")
-        t3 = stabsformat("3s")
+        t1 = tclock()
+        t2 = stabssec("2s")
+        t3 = stabssec("3s")
     
         tsk1 = Task(t1, first)
         tsk2 = Task(t2, second)
@@ -59,6 +61,90 @@ class SchedulerTestCase(unittest.TestCase):
         tsk = scheduler.next()
         self.assertEquals(tsk.callback(), 3)
 
+    def test_peek(self):
+        scheduler = HeapScheduler()
+
+        tsk1 = Task(stabssec("1s"), lambda: 1)
+        tsk2 = Task(stabssec("2s"), lambda: 2)
+
+        scheduler.schedule(tsk2)
+        scheduler.schedule(tsk1)
+
+        # Peeking does not remove the task from the queue
+        self.assertEquals(scheduler.peek(), tsk1)
+        self.assertEquals(scheduler.peek(), tsk1)
+
+        # Removed tasks are skipped
+        scheduler.remove(tsk1.id)
+        self.assertEquals(scheduler.peek(), tsk2)
+        self.assertEquals(scheduler.next(), tsk2)
+        self.assertEquals(scheduler.peek(), None)
+        self.assertEquals(scheduler.next(), None)
+
+    def test_compaction(self):
+        scheduler = HeapScheduler(compact_ratio = 0.5, compact_min = 10)
+        
+        tasks = [Task(stabssec("%ds" % i), lambda: None) \
+                for i in xrange(100)]
+        scheduler.schedule_many(tasks)
+        self.assertEquals(len(scheduler.pending), 100)
+
+        for tsk in tasks[:60]:
+            scheduler.remove(tsk.id)
+
+        # Removed entries are purged from the heap once they exceed 
+        # half of its size
+        self.assertTrue(len(scheduler._queue) < 50)
+        self.assertEquals(len(scheduler.pending), 40)
+
+        for tsk in tasks[60:]:
+            self.assertEquals(scheduler.next(), tsk)
+
+        self.assertEquals(scheduler.next(), None)
+
+class TimerWheelSchedulerTestCase(unittest.TestCase):
+    def test_task_order(self):
+        scheduler = TimerWheelScheduler(resolution = 0.01, slots = 8, 
+                levels = 2)
+
+        # Tasks in the first level, the second level and the overflow heap
+        delays = ["0s", "0.5s", "0.05s", "2s", "0.01s", "0.3s", "0s"]
+        tasks = [Task(stabssec(delay), lambda: None) for delay in delays]
+        scheduler.schedule_many(tasks)
+
+        expected = sorted(tasks, key = lambda t: (t.timestamp, t.id))
+        
+        for tsk in expected:
+            self.assertEquals(scheduler.peek(), tsk)
+            self.assertEquals(scheduler.next(), tsk)
+
+        self.assertEquals(scheduler.next(), None)
+
+    def test_expire(self):
+        scheduler = TimerWheelScheduler(resolution = 0.01, slots = 8, 
+                levels = 2)
+
+        tsk1 = Task(stabssec("0.2s"), lambda: 1)
+        tsk2 = Task(stabssec("0.5s"), lambda: 2)
+        tsk3 = Task(stabssec("0.1s"), lambda: 3)
+
+        scheduler.schedule(tsk1)
+        scheduler.schedule(tsk2)
+        scheduler.schedule(tsk3)
+        scheduler.remove(tsk3.id)
+
+        time.sleep(0.3)
+
+        # tsk1 was cascaded from the second level and is now due
+        self.assertEquals(scheduler.peek(), tsk1)
+        self.assertTrue(scheduler.peek().timestamp <= tclock())
+        self.assertEquals(scheduler.next(), tsk1)
+        self.assertEquals(scheduler.peek(), tsk2)
+        self.assertTrue(scheduler.peek().timestamp > tclock())
+
+        scheduler.remove(tsk2.id)
+        self.assertEquals(scheduler.next(), None)
+        self.assertEquals(len(scheduler.pending), 0)
 
 if __name__ == '__main__':
     unittest.main()
@@ -335,6 +335,41 @@ main (void)
         os.remove(f1.name)
         shutil.rmtree(dirpath)
 
+    @skipIfNotAlive
+    def t_async_deploy(self, host, user):
+
+        ec = ExperimentController(exp_id = "test-async-deploy", 
+                async_deploy = True)
+        
+        node = ec.register_resource("linux::Node")
+        ec.set(node, "hostname", host)
+        ec.set(node, "username", user)
+        ec.set(node, "cleanExperiment", True)
+        ec.set(node, "cleanProcesses", True)
+
+        apps = []
+        for i in xrange(10):
+            app = ec.register_resource("linux::Application")
+            ec.set(app, "code", "echo 'HOLA %d'" % i)
+            ec.set(app, "build", "echo 'BUILD' > ${APP_HOME}/build")
+            ec.set(app, "command", "bash ${APP_HOME}/code ; cat ${APP_HOME}/build")
+            ec.register_connection(app, node)
+            apps.append(app)
+
+        ec.deploy()
+
+        ec.wait_finished(apps)
+
+        self.assertTrue(ec.state(node) == ResourceState.STARTED)
+
+        for i, app in enumerate(apps):
+            self.assertTrue(ec.state(app) == ResourceState.STOPPED)
+
+            stdout = ec.trace(app, "stdout")
+            self.assertEquals(stdout, "HOLA %d\nBUILD\n" % i)
+
+        ec.shutdown()
+
     def test_stdout_fedora(self):
         self.t_stdout(self.fedora_host, self.fedora_user)
 
@@ -371,6 +406,15 @@ main (void)
     def test_code_ubuntu(self):
         self.t_code(self.ubuntu_host, self.ubuntu_user)
 
+    def test_async_deploy_fedora(self):
+        self.t_async_deploy(self.fedora_host, self.fedora_user)
+
+    def test_async_deploy_ubuntu(self):
+        self.t_async_deploy(self.ubuntu_host, self.ubuntu_user)
+
+    def test_async_deploy_localhost(self):
+        self.t_async_deploy("localhost", None)
+
     @skipInteractive
     def test_xterm_ubuntu(self):
         """ Interactive test. Should not run automatically """
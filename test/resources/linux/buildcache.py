@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#
+#    NEPI, a framework to manage network experiments
+#    Copyright (C) 2013 INRIA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Alina Quereilhac <alina.quereilhac@inria.fr>
+
+
+from nepi.resources.linux.buildcache import BuildCache
+from nepi.util.eventloop import run_coroutine
+
+from test_utils import skipIfNotAlive, create_node
+
+import os
+import shutil
+import tempfile
+import unittest
+
+class BuildCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.fedora_host = "nepi2.pl.sophia.inria.fr"
+        self.fedora_user = "inria_nepi"
+
+        self.ubuntu_host = "roseval.pl.sophia.inria.fr"
+        self.ubuntu_user = "inria_nepi"
+
+    @skipIfNotAlive
+    def t_store_restore(self, host, user):
+        node, ec = create_node(host, user)
+        node.find_home()
+        node.mkdir(node.bin_dir)
+
+        store_dir = tempfile.mkdtemp()
+        cache = BuildCache(store_dir = store_dir)
+
+        key = cache.key(node, "my app", "make && make install")
+        self.assertTrue(key.startswith("my_app-"))
+        self.assertEquals(key, cache.key(node, "my app", 
+            "make && make install"))
+        self.assertNotEquals(key, cache.key(node, "my app", "make"))
+
+        build_dir = os.path.join(node.bin_dir, "buildcache-test")
+        node.mkdir(build_dir, clean = True)
+        node.execute("echo 'Hello, world!' > %s/hello" % build_dir)
+
+        # Nothing cached yet
+        node.execute("rm -f %s" % cache.archive_path(node, key))
+        self.assertEquals(cache.restore(node, key), None)
+
+        self.assertTrue(cache.store(node, key, [build_dir]))
+        self.assertTrue(os.path.exists(os.path.join(store_dir, 
+            "%s.tar.gz" % key)))
+
+        # Restored from the archive on the node
+        node.execute("rm -rf %s" % build_dir)
+        self.assertEquals(cache.restore(node, key), "node")
+        (out, err), proc = node.execute("cat %s/hello" % build_dir)
+        self.assertEquals(out.strip(), "Hello, world!")
+
+        # Same from a coroutine
+        node.execute("rm -rf %s" % build_dir)
+        self.assertEquals(run_coroutine(cache.restore_async(node, 
+            key)).result(), "node")
+
+        # Restored from the controller store
+        node.execute("rm -rf %s %s" % (build_dir, 
+            cache.archive_path(node, key)))
+        self.assertEquals(cache.restore(node, key), "controller")
+        (out, err), proc = node.execute("cat %s/hello" % build_dir)
+        self.assertEquals(out.strip(), "Hello, world!")
+
+        node.execute("rm -rf %s %s" % (build_dir,
+            cache.archive_path(node, key)))
+        shutil.rmtree(store_dir)
+
+    def test_store_restore_fedora(self):
+        self.t_store_restore(self.fedora_host, self.fedora_user)
+
+    def test_store_restore_ubuntu(self):
+        self.t_store_restore(self.ubuntu_host, self.ubuntu_user)
+
+    def test_store_restore_localhost(self):
+        self.t_store_restore("localhost", None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+#
+#    NEPI, a framework to manage network experiments
+#    Copyright (C) 2013 INRIA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Alina Quereilhac <alina.quereilhac@inria.fr>
+
+
+from nepi.resources.linux.distribution import ArtifactDistributor
+from nepi.util import execfuncs
+from nepi.util.eventloop import Return, run_coroutine, sleep
+
+from test_utils import skipIfAnyNotAlive, create_node
+
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+class DummyProc(object):
+    def __init__(self, returncode):
+        self.returncode = returncode
+
+    def poll(self):
+        return self.returncode
+
+class DummyNode(object):
+    """ Stands for a LinuxNode, keeping the files it receives in a 
+    dictionary. Relays are resolved through the nodes registry """
+
+    def __init__(self, hostname, nodes, localhost = False, gateway = None,
+            transfers = None):
+        self.attrs = dict(hostname = hostname, username = "user", 
+                port = None, gateway = gateway)
+        self.localhost = localhost
+        self.files = dict()
+        self.nodes = nodes
+        # { source: [ongoing transfers, maximum] }, None is the controller
+        self.transfers = transfers
+        nodes[hostname] = self
+
+    def get(self, name):
+        return self.attrs[name]
+
+    def info(self, msg):
+        pass
+
+    warning = error = info
+
+    def execute(self, command, retry = 3):
+        m = re.match("md5sum < (.*)", command)
+        if m:
+            return (self.files.get(m.group(1), ""), ""), DummyProc(0)
+
+        m = re.match(r"scp .* (\S+) user@(\S+):(\S+)", command)
+        if m:
+            (src, host, dst) = m.groups()
+            self.nodes[host].files[dst] = self.files[src]
+            return ("", ""), DummyProc(0)
+
+        raise RuntimeError, "Unexpected command %s" % command
+
+    def execute_async(self, command, retry = 3):
+        if command.startswith("scp"):
+            yield self.transfer(self.get("hostname"))
+        raise Return(self.execute(command, retry = retry))
+
+    def transfer(self, source):
+        # Transfers take a while, so they overlap
+        counts = self.transfers.setdefault(source, [0, 0])
+        counts[0] += 1
+        counts[1] = max(counts)
+        yield sleep(0.1)
+        counts[0] -= 1
+
+    def upload(self, src, dst):
+        self.files[dst] = execfuncs.ldigest(src)
+        return ("", ""), DummyProc(0)
+
+    def upload_async(self, src, dst):
+        yield self.transfer(None)
+        raise Return(self.upload(src, dst))
+
+class ArtifactDistributorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.fedora_host = "nepi2.pl.sophia.inria.fr"
+        self.fedora_user = "inria_nepi"
+
+        self.ubuntu_host = "roseval.pl.sophia.inria.fr"
+        self.ubuntu_user = "inria_nepi"
+
+    @skipIfAnyNotAlive
+    def t_distribute(self, user1, host1, user2, host2):
+        node1, ec1 = create_node(host1, user1)
+        node2, ec2 = create_node(host2, user2)
+
+        f = tempfile.NamedTemporaryFile(delete=False)
+        f.write("Hello, world!" * 1000)
+        f.close()
+
+        dsts = []
+        for node in [node1, node2]:
+            if node.localhost:
+                dst = tempfile.mkdtemp()
+            else:
+                node.find_home()
+                dst = os.path.join(node.home_dir, "distribution-test")
+                node.mkdir(dst, clean = True)
+            dsts.append(dst)
+
+        distributor = ArtifactDistributor(f.name, fanout = 1)
+        
+        # The first node gets the file from the controller, and relays
+        # it to the second one
+        self.assertEquals(distributor.distribute(node1, dsts[0]), None)
+        source = distributor.distribute(node2, dsts[1])
+        if not (node1.localhost or node2.localhost):
+            self.assertEquals(source, host1)
+
+        self.assertEquals(len(distributor.hops), 2)
+
+        # The file is already there, nothing to transfer
+        distributor.distribute(node2, dsts[1])
+        self.assertEquals(len(distributor.hops), 2)
+
+        path = os.path.join(dsts[1], os.path.basename(f.name))
+        (out, err), proc = node2.execute("cat %s" % path)
+        self.assertEquals(out, "Hello, world!" * 1000)
+
+        os.remove(f.name)
+        for node, dst in zip([node1, node2], dsts):
+            if node.localhost:
+                shutil.rmtree(dst)
+
+    def test_distribute(self):
+        self.t_distribute(self.fedora_user, self.fedora_host,
+                self.ubuntu_user, self.ubuntu_host)
+
+    def test_distribute_localhost(self):
+        self.t_distribute(None, "localhost", None, "localhost")
+
+    def test_acquire_source(self):
+        f = tempfile.NamedTemporaryFile()
+        f.write("Hello, world!")
+        f.flush()
+
+        nodes = dict()
+        holder1 = DummyNode("holder1", nodes)
+        holder2 = DummyNode("holder2", nodes)
+        node = DummyNode("node", nodes)
+        local = DummyNode("local", nodes, localhost = True)
+        behind = DummyNode("behind", nodes, gateway = "gw")
+
+        distributor = ArtifactDistributor(f.name, fanout = 2)
+
+        # Without holders the file comes from the controller
+        self.assertEquals(distributor._acquire_source(node), None)
+
+        # Holders relay the file, the least busy one first
+        distributor._add_holder(holder1, "/h1", None, None)
+        self.assertEquals(distributor._acquire_source(node), 
+                (holder1, "/h1"))
+
+        distributor._add_holder(holder2, "/h2", None, None)
+        self.assertEquals(distributor._acquire_source(node), 
+                (holder2, "/h2"))
+
+        sources = [distributor._acquire_source(node) for i in xrange(2)]
+        self.assertEquals(sorted(sources), 
+                sorted([(holder1, "/h1"), (holder2, "/h2")]))
+
+        # When all holders are busy, the controller serves the file
+        self.assertEquals(distributor._acquire_source(node), None)
+
+        # Nodes that can't relay wait for the controller
+        future1 = distributor._acquire_source_async(local)
+        future2 = distributor._acquire_source_async(behind)
+        self.assertFalse(future1.done())
+
+        distributor._release_source((holder1, "/h1"))
+        self.assertFalse(future1.done())
+
+        distributor._release_source(None)
+        self.assertTrue(future1.done())
+        self.assertEquals(future1.result(), None)
+        self.assertFalse(future2.done())
+
+        # Waiting nodes that can relay get a holder as soon as one is free
+        self.assertEquals(distributor._acquire_source_async(node).result(1),
+                (holder1, "/h1"))
+
+        future3 = distributor._acquire_source_async(node)
+        self.assertFalse(future3.done())
+
+        distributor._release_source((holder2, "/h2"))
+        self.assertEquals(future3.result(1), (holder2, "/h2"))
+
+        distributor._release_source(None)
+        self.assertEquals(future2.result(1), None)
+
+    def test_distribute_async(self):
+        f = tempfile.NamedTemporaryFile()
+        f.write("Hello, world!")
+        f.flush()
+
+        nodes = dict()
+        transfers = dict()
+        targets = [DummyNode("node%d" % i, nodes, transfers = transfers) 
+                for i in xrange(7)]
+        targets.append(DummyNode("local", nodes, localhost = True, 
+            transfers = transfers))
+
+        distributor = ArtifactDistributor(f.name, fanout = 2)
+        
+        futures = [run_coroutine(distributor.distribute_async(node, "/dst"))
+                for node in targets]
+        sources = [future.result(5) for future in futures]
+
+        path = os.path.join("/dst", os.path.basename(f.name))
+        for node in targets:
+            self.assertEquals(node.files[path], distributor.digest)
+
+        # The first nodes get the file from the controller, and relay
+        # it to the other ones. Sources serve at most 'fanout' nodes
+        # at a time
+        self.assertEquals(sources[:2], [None, None])
+        self.assertEquals(sources[-1], None)
+        self.assertTrue(sources[2] in ["node0", "node1"])
+        self.assertTrue(sources[3] in ["node0", "node1"])
+        self.assertTrue(len([s for s in sources if s]) >= 4)
+
+        for source, (ongoing, maximum) in transfers.iteritems():
+            self.assertEquals(ongoing, 0)
+            self.assertTrue(maximum <= 2)
+
+        self.assertEquals(len(distributor.hops), len(targets))
+        self.assertEquals(distributor._serving[None], 0)
+
+        # The file is already there
+        self.assertEquals(run_coroutine(distributor.distribute_async(
+            targets[0], "/dst")).result(5), None)
+        self.assertEquals(len(distributor.hops), len(targets))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -52,6 +52,45 @@ class LinuxNodeTestCase(unittest.TestCase):
 
         self.assertTrue(out.find(expected) > 0)
 
+    @skipIfNotAlive
+    def t_agent(self, host, user):
+        node, ec = create_node(host, user)
+        node.set("useAgent", True)
+        
+        node.find_home()
+        app_home = os.path.join(node.exp_home, "my-app")
+        node.mkdir(app_home, clean = True)
+
+        node.start_agent()
+        self.assertTrue(node.agent)
+
+        try:
+            (out, err), proc = node.execute("echo HOLA; exit 2")
+            self.assertEquals(out.strip(), "HOLA")
+            self.assertEquals(proc.poll(), 2)
+
+            # Many commands pipelined over the agent channel
+            futures = [node.execute_async("echo %d" % i) for i in xrange(20)]
+            outs = [f.result(30)[0][0].strip() for f in futures]
+            self.assertEquals(outs, map(str, xrange(20)))
+
+            node.upload("HOLA", os.path.join(app_home, "hola.txt"), 
+                    text = True)
+            (out, err), proc = node.check_output(app_home, "hola.txt")
+            self.assertEquals(out, "HOLA")
+
+            node.run("sleep 30", app_home)
+            pid, ppid = node.getpid(app_home)
+            self.assertEquals(node.status(pid, ppid), ProcStatus.RUNNING)
+
+            node.kill(pid, ppid)
+            self.assertEquals(node.status(pid, ppid), ProcStatus.FINISHED)
+        finally:
+            node.stop_agent()
+            node.rmdir(app_home)
+
+        self.assertFalse(node.agent)
+
     @skipIfNotAlive
     def t_run(self, host, user):
         node, ec = create_node(host, user)
@@ -335,6 +374,153 @@ main (void)
         
         self.assertTrue(out.find(os.path.basename(f2.name)) > -1)
 
+    @skipIfNotAlive
+    def t_upload_unchanged(self, host, user):
+        node, ec = create_node(host, user)
+
+        node.find_home()
+        app_home = os.path.join(node.exp_home, "my-app")
+        node.mkdir(app_home, clean = True)
+
+        f = tempfile.NamedTemporaryFile(delete=False)
+        f.write("Hello, world!")
+        f.close()
+
+        dst = os.path.join(app_home, "hello")
+
+        # First upload copies the file
+        (out, err), proc = node.upload(f.name, dst)
+        self.assertTrue(proc is not None)
+
+        # The content did not change, nothing is copied
+        (out, err), proc = node.upload(f.name, dst)
+        self.assertEquals(proc, None)
+
+        # A new node instance checks the digest on the host
+        node2, ec2 = create_node(host, user)
+        node2.find_home()
+        (out, err), proc = node2.upload(f.name, dst, overwrite = False)
+        self.assertEquals(proc, None)
+
+        # Stale files are refreshed, even if they should not 
+        # be overwritten
+        with open(f.name, "w") as fd:
+            fd.write("Bye, world!")
+
+        (out, err), proc = node2.upload(f.name, dst, overwrite = False)
+        self.assertTrue(proc is not None)
+        
+        (out, err), proc = node.execute("cat %s" % dst)
+        self.assertEquals(out, "Bye, world!")
+
+        # Files removed from the host are uploaded again
+        (out, err), proc = node.upload(f.name, dst)
+        self.assertEquals(proc, None)
+
+        node.mkdir(app_home, clean = True)
+        (out, err), proc = node.upload(f.name, dst)
+        self.assertTrue(proc is not None)
+
+        # Paths with spaces are checked too
+        dst = os.path.join(app_home, "hello world")
+        (out, err), proc = node.upload(f.name, dst)
+        self.assertTrue(proc is not None)
+
+        node3, ec3 = create_node(host, user)
+        node3.find_home()
+        (out, err), proc = node3.upload(f.name, dst)
+        self.assertEquals(proc, None)
+
+        os.remove(f.name)
+
+    @skipIfNotAlive
+    def t_fetch(self, host, user):
+        node, ec = create_node(host, user)
+
+        node.find_home()
+        app_home = os.path.join(node.exp_home, "my-app")
+        node.mkdir(app_home, clean = True)
+
+        src = os.path.join(app_home, "trace")
+        node.execute("seq 1 100000 > %s" % src)
+        (content, err), proc = node.execute("cat %s" % src)
+
+        dst = tempfile.mktemp()
+
+        count = node.fetch(src, dst)
+        self.assertEquals(count, len(content))
+        self.assertEquals(open(dst).read(), content)
+        self.assertFalse(os.path.exists("%s.part" % dst))
+
+        # Only the missing bytes of a partial file are fetched
+        with open("%s.part" % dst, "w") as f:
+            f.write(content[:1000])
+
+        count = node.fetch(src, dst)
+        self.assertEquals(count, len(content) - 1000)
+        self.assertEquals(open(dst).read(), content)
+
+        # Partial files that don't match the source are discarded
+        with open("%s.part" % dst, "w") as f:
+            f.write("x" * 1000)
+
+        count = node.fetch(src, dst)
+        self.assertEquals(count, len(content))
+        self.assertEquals(open(dst).read(), content)
+
+        with open("%s.part" % dst, "w") as f:
+            f.write(content + "x")
+
+        count = node.fetch(src, dst)
+        self.assertEquals(count, len(content))
+        self.assertEquals(open(dst).read(), content)
+
+        os.remove(dst)
+
+    @skipIfNotAlive
+    def t_follow(self, host, user):
+        node, ec = create_node(host, user)
+
+        node.find_home()
+        app_home = os.path.join(node.exp_home, "my-app")
+        node.mkdir(app_home, clean = True)
+
+        path = os.path.join(app_home, "trace")
+        node.execute("echo 'Hello, world!' > %s" % path)
+
+        # Skip the first line
+        follower = node.follow(path, offset = len("Hello, world!\n"))
+
+        chunks = []
+        follower.start(chunks.append)
+
+        node.execute("echo 'Bye, world!' >> %s" % path)
+
+        for i in xrange(10):
+            if follower.offset == len("Hello, world!\nBye, world!\n"):
+                break
+            time.sleep(1)
+
+        follower.stop()
+
+        self.assertEquals("".join(chunks), "Bye, world!\n")
+
+        # The tail process is gone from the host
+        (out, err), proc = node.execute("pgrep -f '[t]ail -c .* -F %s'" % path)
+        self.assertEquals(out.strip(), "")
+
+    def test_follow_fedora(self):
+        self.t_follow(self.fedora_host, self.fedora_user)
+
+    def test_follow_localhost(self):
+        self.t_follow("localhost", None)
+
+    def test_fetch_fedora(self):
+        self.t_fetch(self.fedora_host, self.fedora_user)
+
+    def test_fetch_localhost(self):
+        self.t_fetch("localhost", None)
+
     def test_execute_fedora(self):
         self.t_execute(self.fedora_host, self.fedora_user)
 
@@ -388,12 +574,83 @@ main (void)
         """ Interactive test. Should not run automatically """
         self.t_xterm(self.ubuntu_host, self.ubuntu_user)
 
+    def test_agent_fedora(self):
+        self.t_agent(self.fedora_host, self.fedora_user)
+
+    def test_agent_ubuntu(self):
+        self.t_agent(self.ubuntu_host, self.ubuntu_user)
+
+    def test_agent_localhost(self):
+        self.t_agent("localhost", None)
+
     def test_copy_files_fedora(self):
         self.t_copy_files(self.fedora_host, self.fedora_user)
 
     def test_copy_files_ubuntu(self):
         self.t_copy_files(self.ubuntu_host, self.ubuntu_user)
 
+    def test_upload_unchanged_fedora(self):
+        self.t_upload_unchanged(self.fedora_host, self.fedora_user)
+
+    def test_upload_unchanged_localhost(self):
+        self.t_upload_unchanged("localhost", None)
+
+    def test_digest_cache(self):
+        from nepi.util import execfuncs
+
+        f = tempfile.NamedTemporaryFile(delete=False)
+        f.write("Hello, world!")
+        f.close()
+
+        digest = execfuncs.ldigest(f.name)
+        self.assertTrue(f.name in execfuncs._digests)
+
+        execfuncs.forget_digest(f.name)
+        self.assertFalse(f.name in execfuncs._digests)
+
+        # Entries of removed files are pruned when the cache is full
+        maxsize = execfuncs._digests_max
+        execfuncs._digests_max = 2
+        try:
+            execfuncs.ldigest(f.name)
+            os.remove(f.name)
+
+            g = tempfile.NamedTemporaryFile()
+            g.write("Hello, world!")
+            g.flush()
+            execfuncs.ldigest(g.name)
+            execfuncs.ldigest(__file__)
+
+            self.assertFalse(f.name in execfuncs._digests)
+            self.assertEquals(execfuncs.ldigest(g.name), digest)
+            self.assertTrue(len(execfuncs._digests) <= 2)
+            g.close()
+        finally:
+            execfuncs._digests_max = maxsize
+
+    def test_digest_async(self):
+        from nepi.util import execfuncs
+
+        f = tempfile.NamedTemporaryFile()
+        f.write("Hello, world!")
+        f.flush()
+
+        # Hashed by a worker thread
+        execfuncs.forget_digest(f.name)
+        future = execfuncs.ldigest_async(f.name)
+        digest = future.result(5)
+        self.assertEquals(digest, execfuncs.ldigest(f.name))
+
+        # Cached digests are returned right away
+        future = execfuncs.ldigest_async(f.name)
+        self.assertTrue(future.done())
+        self.assertEquals(future.result(), digest)
+
+        f.close()
+
+        future = execfuncs.ldigest_async(f.name)
+        self.assertRaises(OSError, future.result, 5)
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -827,6 +827,54 @@ class LinuxNS3SimulationTest(unittest.TestCase):
 
         ec.shutdown()
     
+    @skipIfNotAlive
+    def t_build_cache(self, host, user = None, identity = None):
+        ec = ExperimentController(exp_id = "test-ns3-build-cache")
+        
+        node = ec.register_resource("linux::Node")
+        ec.set(node, "hostname", host)
+        if host != "localhost":
+            ec.set(node, "username", user)
+            ec.set(node, "identity", identity)
+
+        simu = ec.register_resource("linux::ns3::Simulation")
+        ec.set(simu, "ns3Version", "ns-3.20")
+        ec.set(simu, "buildMode", "optimized")
+        ec.register_connection(simu, node)
+
+        rm = ec.get_resource(simu)
+        rm.node.find_home()
+        rm._set_defaults()
+
+        # The ns-3 build is cached by default
+        location = "${BIN}/ns-3/ns-3.20/optimized/build"
+        self.assertEquals(rm.get("cachedPaths"), location)
+        self.assertEquals(rm.build_cache_paths, [os.path.join(
+            rm.node.bin_dir, "ns-3/ns-3.20/optimized/build")])
+
+        key = rm.build_cache_key
+        self.assertTrue(key.startswith("ns-3.20-optimized-"))
+        self.assertEquals(key, rm.build_cache_key)
+
+        # The key changes with the build mode
+        ec.set(simu, "buildMode", "debug")
+        ec.set(simu, "build", None)
+        ec.set(simu, "cachedPaths", None)
+        rm._set_defaults()
+
+        self.assertEquals(rm.get("cachedPaths"), 
+                "${BIN}/ns-3/ns-3.20/debug/build")
+        self.assertTrue(rm.build_cache_key.startswith("ns-3.20-debug-"))
+        self.assertNotEquals(rm.build_cache_key, key)
+
+        # Paths set by the user are kept
+        ec.set(simu, "cachedPaths", "${BIN}/my-ns-3")
+        rm._set_defaults()
+        self.assertEquals(rm.build_cache_paths, [os.path.join(
+            rm.node.bin_dir, "my-ns-3")])
+
+        ec.shutdown()
+
     def test_p2p_ping_fedora(self):
         self.t_p2p_ping(self.fedora_host, self.fedora_user, self.fedora_identity)
 
@@ -881,6 +929,12 @@ class LinuxNS3SimulationTest(unittest.TestCase):
     def test_dce_local(self):
         self.t_dce("localhost")
 
+    def test_build_cache_fedora(self):
+        self.t_build_cache(self.fedora_host, self.fedora_user, self.fedora_identity)
+
+    def test_build_cache_local(self):
+        self.t_build_cache("localhost")
+
 
 if __name__ == '__main__':
     unittest.main()
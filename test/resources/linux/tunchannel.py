@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+#
+#    NEPI, a framework to manage network experiments
+#    Copyright (C) 2013 INRIA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Alina Quereilhac <alina.quereilhac@inria.fr>
+
+
+import nepi
+
+import imp
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+# tunchannel is not part of the nepi package, it is uploaded to the
+# nodes together with the scripts that use it
+tunchannel = imp.load_source("tunchannel_script", 
+        os.path.join(os.path.dirname(nepi.__file__), "resources", "linux",
+            "scripts", "tunchannel.py"))
+
+class TunChannelTestCase(unittest.TestCase):
+    """ Forwards packets between two tunnel endpoints connected over UDP
+    on the loopback. The TUN/TAP devices are emulated with datagram
+    socket pairs, which preserve packet boundaries like the devices do """
+
+    def t_forward(self, use_epoll, with_pi = False, ether_mode = False,
+            cipher_key = None, stats = (None, None)):
+        TERMINATE = []
+        SUSPEND = []
+
+        # devices[i] = (end used by the test, end used by the forwarder)
+        devices = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+                for i in xrange(2)]
+
+        remotes = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                for i in xrange(2)]
+        for sock in remotes:
+            sock.bind(("127.0.0.1", 0))
+        remotes[0].connect(remotes[1].getsockname())
+        remotes[1].connect(remotes[0].getsockname())
+
+        threads = []
+        for (local, tun), remote, path in zip(devices, remotes, stats):
+            thread = threading.Thread(target = tunchannel.tun_fwd,
+                    args = (tun, remote, with_pi, ether_mode, cipher_key,
+                        True, TERMINATE, SUSPEND),
+                    kwargs = dict(stderr = None, use_epoll = use_epoll,
+                        stats = path, stats_interval = 0.1))
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+
+        try:
+            if ether_mode:
+                header = "\x00" * 12 + "\x86\xdd"
+                pi = "\x00\x00\x86\xdd"
+            else:
+                header = ""
+                pi = "\x00\x00\x08\x00"
+
+            packets = [header + ("%05d" % i) * (1 + i % 200) 
+                    for i in xrange(200)]
+
+            for src, dst in [(0, 1), (1, 0)]:
+                sender = devices[src][0]
+                receiver = devices[dst][0]
+                receiver.settimeout(5)
+
+                for packet in packets:
+                    if with_pi:
+                        sender.send(pi + packet)
+                    else:
+                        sender.send(packet)
+
+                    received = receiver.recv(4096)
+                    if with_pi:
+                        self.assertEquals(received[:4], pi)
+                        received = received[4:]
+
+                    self.assertEquals(received, packet)
+        finally:
+            TERMINATE.append(None)
+            for thread in threads:
+                thread.join(5)
+
+        return packets
+
+    def t_stats(self, use_epoll):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            stats = [os.path.join(tmpdir, "stats%d" % i) for i in (1, 2)]
+            packets = self.t_forward(use_epoll, stats = stats)
+            nbytes = sum(map(len, packets))
+
+            for path in stats:
+                f = open(path)
+                lines = f.read().splitlines()
+                f.close()
+
+                columns = lines[0].split()
+                self.assertEquals(columns, ["#", "time", "queue"] + 
+                        list(tunchannel.STATS_COLUMNS))
+                self.assertTrue(len(lines) > 1)
+
+                # The last line holds the final counters
+                last = dict(zip(columns[1:], map(float, lines[-1].split())))
+
+                # Each forwarder read all the packets from its device
+                # and from the remote end, and forwarded all of them
+                for prefix in ("tun_rx", "remote_tx", "remote_rx", "tun_tx"):
+                    self.assertEquals(last[prefix + "_packets"], len(packets))
+                    self.assertEquals(last[prefix + "_bytes"], nbytes)
+
+                self.assertEquals(last["remote_tx_drops"], 0)
+                self.assertEquals(last["remote_rx_drops"], 0)
+                self.assertEquals(last["fw_queue"], 0)
+                self.assertEquals(last["bk_queue"], 0)
+                self.assertTrue(last["wakeups"] > 0)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_forward_parallel(self):
+        TERMINATE = []
+        SUSPEND = []
+        queues = 3
+
+        devices = [[socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+            for q in xrange(queues)] for i in xrange(2)]
+
+        remotes = [[socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            for q in xrange(queues)] for i in xrange(2)]
+        for q in xrange(queues):
+            for sock in (remotes[0][q], remotes[1][q]):
+                sock.bind(("127.0.0.1", 0))
+            remotes[0][q].connect(remotes[1][q].getsockname())
+            remotes[1][q].connect(remotes[0][q].getsockname())
+
+        threads = []
+        for i in xrange(2):
+            thread = threading.Thread(target = tunchannel.tun_fwd_parallel,
+                    args = ([tun for (local, tun) in devices[i]], remotes[i],
+                        TERMINATE, SUSPEND),
+                    kwargs = dict(stderr = None, with_pi = False,
+                        ether_mode = False, cipher_key = None, udp = True))
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+
+        try:
+            # Packets sent on a queue go through the forwarder of that 
+            # queue, and are received on the same queue at the other end
+            for q in xrange(queues):
+                sender = devices[0][q][0]
+                receiver = devices[1][q][0]
+                receiver.settimeout(5)
+
+                for i in xrange(50):
+                    packet = "queue %d packet %d" % (q, i)
+                    sender.send(packet)
+                    self.assertEquals(receiver.recv(4096), packet)
+        finally:
+            TERMINATE.append(None)
+            for thread in threads:
+                thread.join(10)
+
+        # The forwarder processes are terminated
+        for thread in threads:
+            self.assertFalse(thread.isAlive())
+
+    def test_forward_epoll(self):
+        self.t_forward(True)
+
+    def test_forward_select(self):
+        self.t_forward(False)
+
+    def test_forward_epoll_pi(self):
+        self.t_forward(True, with_pi = True)
+
+    def test_forward_epoll_pi_ether(self):
+        self.t_forward(True, with_pi = True, ether_mode = True)
+
+    def test_stats_epoll(self):
+        self.t_stats(True)
+
+    def test_stats_select(self):
+        self.t_stats(False)
+
+    def test_forward_epoll_cipher(self):
+        try:
+            import Crypto.Cipher
+        except ImportError:
+            print "Skipping test: python-crypto is not installed"
+            return
+
+        self.t_forward(True, cipher_key = "secret")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+#
+#    NEPI, a framework to manage network experiments
+#    Copyright (C) 2014 INRIA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from nepi.resources.ns3 import ns3server
+from nepi.resources.ns3.ns3server import NS3WrapperMessage, \
+        FRAMED_HANDSHAKE, encode_frame, decode_frames
+
+import base64
+import cPickle
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+class DummyWrapper(object):
+    """ Replaces the NS3Wrapper, which requires the ns-3 libraries """
+
+    def __init__(self):
+        self.logger = logging.getLogger("DummyWrapper")
+        self.values = dict()
+
+    def set(self, uuid, name, value):
+        self.values[(uuid, name)] = value
+        return value
+
+    def get(self, uuid, name):
+        return self.values[(uuid, name)]
+
+    def shutdown(self):
+        pass
+
+def encode_msg(msg_type, args, kwargs):
+    return "|".join(map(lambda item: base64.b64encode(cPickle.dumps(item)),
+        [msg_type, args, kwargs]))
+
+def decode_reply(reply):
+    return cPickle.loads(base64.b64decode(reply.strip()))
+
+class NS3ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.socket_name = os.path.join(self.tmpdir, "ns3.sock")
+
+        self.sock = ns3server.open_socket(self.socket_name)
+        self.sock.listen(5)
+
+        self.server = threading.Thread(target = ns3server.serve,
+                args = (DummyWrapper(), self.sock))
+        self.server.setDaemon(True)
+        self.server.start()
+
+    def tearDown(self):
+        if self.server.isAlive():
+            conn = self.connect()
+            conn.sendall("%s\n" % encode_msg(NS3WrapperMessage.SHUTDOWN,
+                [], {}))
+            conn.recv(1024)
+            conn.close()
+
+        self.server.join(5)
+        shutil.rmtree(self.tmpdir)
+
+    def connect(self):
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(self.socket_name)
+        conn.settimeout(5)
+        return conn
+
+    def recv_frames(self, conn, count):
+        frames = []
+        buf = ""
+
+        while len(frames) < count:
+            chunk = conn.recv(1024)
+            self.assertTrue(chunk)
+
+            new, buf = decode_frames(buf + chunk)
+            frames.extend(new)
+
+        self.assertEquals(buf, "")
+        return frames
+
+    def test_frames(self):
+        msg = (NS3WrapperMessage.SET, ["uuid", "name", "x" * 100], {})
+        data = encode_frame(7, msg) + encode_frame(8, msg)
+
+        # Partial frames are kept in the buffer
+        frames, rest = decode_frames(data[:10])
+        self.assertEquals(frames, [])
+        self.assertEquals(rest, data[:10])
+
+        half = len(data) / 2
+        frames, rest = decode_frames(data[:half + 1])
+        self.assertEquals(frames, [("7", list(msg))])
+
+        # Several frames in a single read
+        frames, rest = decode_frames(rest + data[half + 1:])
+        self.assertEquals(frames, [("8", list(msg))])
+        self.assertEquals(rest, "")
+
+        frames, rest = decode_frames(data)
+        self.assertEquals(frames, [("7", list(msg)), ("8", list(msg))])
+        self.assertEquals(rest, "")
+
+    def test_legacy(self):
+        conn = self.connect()
+        conn.sendall("%s\n" % encode_msg(NS3WrapperMessage.SET,
+            ["uuid", "name", 3], {}))
+
+        reply = ""
+        while True:
+            chunk = conn.recv(1024)
+            if not chunk:
+                break
+            reply += chunk
+
+        self.assertEquals(decode_reply(reply), 3)
+
+    def test_pipelined(self):
+        conn = self.connect()
+
+        # Handshake and the first frames in a single write
+        conn.sendall("%s\n" % FRAMED_HANDSHAKE +
+            encode_frame(1, [NS3WrapperMessage.SET, ["uuid", "a", 1], {}]) +
+            encode_frame(2, [NS3WrapperMessage.SET, ["uuid", "b", 2], {}]))
+
+        # Frames split in several writes
+        data = encode_frame(3, [NS3WrapperMessage.GET, ["uuid", "a"], {}]) + \
+            encode_frame(4, [NS3WrapperMessage.GET, ["uuid", "c"], {}])
+        for i in xrange(0, len(data), 7):
+            conn.sendall(data[i:i + 7])
+            time.sleep(0.01)
+
+        frames = self.recv_frames(conn, 4)
+
+        self.assertEquals([msg_id for msg_id, items in frames],
+                ["1", "2", "3", "4"])
+        self.assertEquals(frames[2][1], [(True, 1)])
+
+        # Errors are replied, and the connection stays open
+        ok, err = frames[3][1][0]
+        self.assertFalse(ok)
+        self.assertTrue("KeyError" in err)
+
+        conn.sendall(encode_frame(5, [NS3WrapperMessage.GET, ["uuid", "b"],
+            {}]))
+        self.assertEquals(self.recv_frames(conn, 1), [("5", [(True, 2)])])
+
+    def test_slow_handshake(self):
+        # A connection that doesn't send its first line doesn't block
+        # the other ones
+        idle = self.connect()
+
+        start = time.time()
+        self.test_legacy()
+        self.assertTrue(time.time() - start < 1)
+
+        idle.close()
+
+    def test_relay(self):
+        command = [sys.executable, "-u", ns3server.__file__.replace(".pyc", ".py"),
+                "-S", self.socket_name, "-R"]
+        proc = subprocess.Popen(command,
+                stdin = subprocess.PIPE,
+                stdout = subprocess.PIPE)
+
+        proc.stdin.write("%s\n" % FRAMED_HANDSHAKE +
+            encode_frame(1, [NS3WrapperMessage.SET, ["uuid", "a", 1], {}]) +
+            encode_frame(2, [NS3WrapperMessage.GET, ["uuid", "a"], {}]))
+        proc.stdin.flush()
+
+        frames = []
+        buf = ""
+        while len(frames) < 2:
+            chunk = os.read(proc.stdout.fileno(), 1024)
+            self.assertTrue(chunk)
+
+            new, buf = decode_frames(buf + chunk)
+            frames.extend(new)
+
+        self.assertEquals(frames, [("1", [(True, 1)]), ("2", [(True, 1)])])
+
+        # The relay exits when its input is closed
+        proc.stdin.close()
+        self.assertEquals(proc.wait(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
+
@@ -416,6 +416,17 @@ class NS3WrapperTest(unittest.TestCase):
 
         wrapper.set(chan, "Delay", "0s")
 
+        # Change and read many attributes within a single event
+        results = wrapper.batch([
+            ("set", None, [chan, "Delay", "1s"], dict()),
+            ("set", None, [ping, "Interval", "2s"], dict()),
+            ("get", None, [chan, "Delay"], dict()),
+            ("get", None, [ping, "Interval"], dict()),
+            ])
+
+        self.assertEquals(len(results), 4)
+        self.assertTrue(all([ok for (ok, result) in results]))
+
         # wait until simulation is over
         wrapper.shutdown()
 
@@ -424,6 +435,43 @@ class NS3WrapperTest(unittest.TestCase):
         
         # TODO: Add assertions !!
 
+    def test_batch(self):
+        wrapper = NS3Wrapper()
+
+        # uuids are chosen by the client, so operations can refer
+        # to objects created in the same batch
+        n1 = "uuid-node-1"
+        ipv41 = "uuid-ipv4-1"
+        ops = [
+            ("create", n1, ["Node"], dict()),
+            ("create", ipv41, ["Ipv4L3Protocol"], dict()),
+            ("invoke", None, [n1, "AggregateObject", ipv41], dict()),
+            ("invoke", None, [n1, "GetId"], dict()),
+            ]
+
+        results = wrapper.batch(ops)
+        
+        self.assertEquals(len(results), 4)
+        self.assertTrue(all([ok for (ok, result) in results]))
+        self.assertEquals(results[0], (True, n1))
+        self.assertEquals(results[3], (True, 0))
+        self.assertTrue(wrapper.get_object(ipv41))
+
+        # Execution stops at the first error
+        ops = [
+            ("create", n1, ["Node"], dict()),
+            ("create", "uuid-node-2", ["Node"], dict()),
+            ]
+
+        results = wrapper.batch(ops)
+
+        self.assertFalse(results[0][0])
+        self.assertTrue(results[0][1].find("Duplicated uuid") > -1)
+        self.assertEquals(results[1], (False, "Not executed"))
+        self.assertEquals(wrapper.get_object("uuid-node-2"), None)
+
+        wrapper.shutdown()
+
 if __name__ == '__main__':
     unittest.main()
 
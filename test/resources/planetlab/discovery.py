@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+#
+#    NEPI, a framework to manage network experiments
+#    Copyright (C) 2013 INRIA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Alina Quereilhac <alina.quereilhac@inria.fr>
+
+
+from nepi.resources.planetlab.discovery import NodeDiscoverer, \
+        get_discoverer, reset_discoverer
+
+import sys
+import threading
+import time
+import unittest
+
+class DummyPLCAPI(object):
+    """ Keeps the blacklisted and reserved hosts like PLCAPI, without
+    contacting any PLC """
+    def __init__(self, nodes):
+        self._nodes = nodes
+        self._blacklist = set()
+        self._reserved = set()
+        self._lock = threading.Lock()
+
+    def get_nodes(self, node_ids, fields):
+        return [dict(node_id = node_id, hostname = self._nodes[node_id])
+                for node_id in node_ids]
+
+    def blacklist_host(self, node_id):
+        with self._lock:
+            self._blacklist.add(node_id)
+
+    def unavailable(self):
+        with self._lock:
+            return self._blacklist | self._reserved
+
+    def reserve_available(self, node_ids):
+        with self._lock:
+            for node_id in node_ids:
+                if node_id not in self._blacklist | self._reserved:
+                    self._reserved.add(node_id)
+                    return node_id
+        return None
+
+# Modules loaded by populate_factory are not bound to their package
+discovery = sys.modules[NodeDiscoverer.__module__]
+
+class DummyProc(object):
+    def __init__(self, returncode):
+        self.returncode = returncode
+
+PING_OUTPUT = """PING 127.0.0.1 (127.0.0.1) 56(84) bytes of data.
+
+--- 127.0.0.1 ping statistics ---
+3 packets transmitted, %d received, %d%% packet loss, time 400ms
+"""
+
+class NodeDiscovererTestCase(unittest.TestCase):
+    def setUp(self):
+        self._lexec = discovery.lexec
+
+    def tearDown(self):
+        discovery.lexec = self._lexec
+
+    def fake_lexec(self, received, returncode):
+        commands = []
+        def lexec(command):
+            commands.append(command)
+            out = PING_OUTPUT % (received, 100 - received * 100 / 3)
+            return (out, ""), DummyProc(returncode)
+
+        discovery.lexec = lexec
+        return commands
+
+    def test_ping(self):
+        discoverer = NodeDiscoverer(DummyPLCAPI(dict()))
+
+        commands = self.fake_lexec(3, 0)
+        self.assertTrue(discoverer._ping("localhost"))
+        self.assertEquals(commands, ["ping -c3 -i0.2 -w2 127.0.0.1"])
+
+        # Some packets lost
+        self.fake_lexec(2, 1)
+        self.assertTrue(discoverer._ping("localhost"))
+
+        self.fake_lexec(1, 1)
+        self.assertFalse(discoverer._ping("localhost"))
+
+        self.fake_lexec(0, 1)
+        self.assertFalse(discoverer._ping("localhost"))
+
+        # ping failed
+        self.fake_lexec(3, 2)
+        self.assertFalse(discoverer._ping("localhost"))
+
+        # Hosts that don't resolve are not pinged
+        commands = self.fake_lexec(3, 0)
+        self.assertFalse(discoverer._ping(None))
+        self.assertFalse(discoverer._ping("invalid.invalid"))
+        self.assertEquals(commands, [])
+
+    def test_alive_expires(self):
+        nodes = dict((i, "node%d.pl.example.org" % i) for i in xrange(2))
+
+        plapi = DummyPLCAPI(nodes)
+        discoverer = get_discoverer(plapi)
+        discoverer._batch_delay = 0
+        discoverer._alive_timeout = 0.5
+
+        pinged = []
+        def ping(hostname):
+            pinged.append(hostname)
+            return False
+
+        discoverer._ping = ping
+
+        self.assertEquals(discoverer.choose([0]), None)
+        self.assertEquals(len(pinged), 1)
+
+        # The blacklist is reset but the node is still known to be dead
+        plapi._blacklist.clear()
+        self.assertEquals(discoverer.choose([0]), None)
+        self.assertEquals(len(pinged), 1)
+
+        # Results expire
+        time.sleep(0.6)
+        plapi._blacklist.clear()
+        self.assertEquals(discoverer.choose([0]), None)
+        self.assertEquals(len(pinged), 2)
+
+        # And are forgotten when the PLCAPI is released
+        plapi._blacklist.clear()
+        reset_discoverer(plapi)
+        self.assertEquals(discoverer.choose([0]), None)
+        self.assertEquals(len(pinged), 3)
+
+
+    def test_concurrent_choose(self):
+        nodes = dict((i, "node%d.pl.example.org" % i) for i in xrange(20))
+        dead = set([0, 1, 2, 3, 4, 5, 6, 7, 8, 9])
+
+        plapi = DummyPLCAPI(nodes)
+        discoverer = NodeDiscoverer(plapi, batch_delay = 0.1)
+
+        pinged = []
+        def ping(hostname):
+            pinged.append(hostname)
+            return int(hostname[4:].split(".")[0]) not in dead
+
+        discoverer._ping = ping
+
+        chosen = []
+        def choose():
+            chosen.append(discoverer.choose(nodes.keys()))
+
+        threads = [threading.Thread(target = choose) for i in xrange(12)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Only 10 nodes are alive, they are each chosen by only one RM
+        found = [node_id for node_id in chosen if node_id is not None]
+        self.assertEquals(len(found), 10)
+        self.assertEquals(set(found), set(nodes.keys()) - dead)
+        self.assertEquals(chosen.count(None), 2)
+
+        # Dead nodes are blacklisted, and every node is pinged once
+        self.assertEquals(plapi._blacklist, dead)
+        self.assertEquals(len(pinged), len(set(pinged)))
+
+        # Previous results are reused
+        self.assertEquals(discoverer.choose(list(dead)), None)
+        self.assertEquals(len(pinged), 20)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#
+#    NEPI, a framework to manage network experiments
+#    Copyright (C) 2013 INRIA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Alina Quereilhac <alina.quereilhac@inria.fr>
+
+from nepi.util.eventloop import Return, ProcessLoop, spawn, sleep, gather, \
+        run_coroutine
+
+import os
+import resource
+import threading
+import time
+import unittest
+
+class EventLoopTestCase(unittest.TestCase):
+    def test_spawn(self):
+        future = spawn(["cat"], input = "HOLA" * 10000)
+        (out, err), proc = future.result(10)
+
+        self.assertEquals(out, "HOLA" * 10000)
+        self.assertEquals(proc.returncode, 0)
+
+        future = spawn("echo ERROR >&2; exit 3", shell = True)
+        (out, err), proc = future.result(10)
+
+        self.assertEquals(err.strip(), "ERROR")
+        self.assertEquals(proc.returncode, 3)
+
+        future = spawn(["/nonexistent/command"])
+        self.assertRaises(OSError, future.result, 10)
+
+        # A child process keeps the pipes open after the process exits
+        start = time.time()
+        future = spawn("(sleep 10 &) ; echo HOLA", shell = True)
+        (out, err), proc = future.result(10)
+
+        self.assertEquals(out.strip(), "HOLA")
+        self.assertTrue(time.time() - start < 5)
+
+    def test_concurrent(self):
+        # All the processes are driven by the same loop thread
+        nthreads = threading.active_count()
+
+        start = time.time()
+        futures = [spawn(["sleep", "1"]) for i in xrange(50)]
+        results = gather(futures).result(30)
+
+        self.assertEquals(len(results), 50)
+        self.assertTrue(time.time() - start < 10)
+        self.assertTrue(threading.active_count() <= nthreads + 1)
+
+    def test_coroutine(self):
+        def child(value):
+            yield sleep(0.1)
+            raise Return(value * 2)
+
+        def parent():
+            (out, err), proc = yield spawn(["echo", "2"])
+            value = yield child(int(out))
+            values = yield [child(value), child(value + 1)]
+
+            try:
+                yield spawn(["/nonexistent/command"])
+            except OSError:
+                values.append("ERROR")
+
+            raise Return(values)
+
+        future = run_coroutine(parent())
+        self.assertEquals(future.result(10), [8, 10, "ERROR"])
+
+        def failing():
+            yield sleep(0.1)
+            raise RuntimeError, "FAILED"
+
+        future = run_coroutine(failing())
+        self.assertRaises(RuntimeError, future.result, 10)
+
+    def test_high_fds(self):
+        # select can not handle file descriptors >= FD_SETSIZE (1024)
+        (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard != resource.RLIM_INFINITY and hard < 1200:
+            print "Skipping test: can't open more than %d files" % hard
+            return
+
+        resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, 1200), hard))
+
+        fds = []
+        try:
+            while not fds or fds[-1] < 1030:
+                fds.append(os.open(os.devnull, os.O_RDONLY))
+
+            loop = ProcessLoop()
+            future = loop.spawn(["echo", "HOLA"])
+            (out, err), proc = future.result(10)
+
+            self.assertEquals(out.strip(), "HOLA")
+        finally:
+            for fd in fds:
+                os.close(fd)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+    def test_fork(self):
+        # The parent loop thread is running
+        spawn(["true"]).result(10)
+
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                (out, err), proc = spawn(["echo", "HOLA"]).result(5)
+                if out.strip() == "HOLA":
+                    status = 0
+            finally:
+                os._exit(status)
+
+        (pid, status) = os.waitpid(pid, 0)
+
+        # The child got its own loop
+        self.assertEquals(status, 0)
+
+    def test_loop_failure(self):
+        loop = ProcessLoop()
+
+        def fail():
+            raise RuntimeError, "FAILED"
+
+        expire = loop._expire
+        loop._expire = fail
+
+        # Pending futures fail with the error of the loop
+        future = loop.sleep(10)
+        self.assertRaises(RuntimeError, future.result, 10)
+
+        # A new loop thread is started for new operations
+        loop._expire = expire
+        future = loop.spawn(["echo", "HOLA"])
+        (out, err), proc = future.result(10)
+        self.assertEquals(out.strip(), "HOLA")
+
+
+if __name__ == '__main__':
+    unittest.main()
+
@@ -19,9 +19,11 @@
 # Author: Alina Quereilhac <alina.quereilhac@inria.fr>
 
 
-from nepi.util.parallel import ParallelRun
+from nepi.util.parallel import ParallelRun, KeyedParallelRun
 
 import datetime
+import threading
+import time
 import unittest
 
 class ParallelRunTestCase(unittest.TestCase):
@@ -85,6 +87,89 @@ class ParallelRunTestCase(unittest.TestCase):
         
         self.assertRaises(RuntimeError, runner.sync)
 
+class KeyedParallelRunTestCase(unittest.TestCase):
+    def test_run_serialized(self):
+        runner = KeyedParallelRun(maxthreads = 8)
+        runner.start()
+
+        lock = threading.Lock()
+        running = dict()
+        overlaps = []
+        order = dict()
+
+        def work(key, i):
+            with lock:
+                if running.get(key):
+                    overlaps.append(key)
+                running[key] = True
+                order.setdefault(key, []).append(i)
+
+            time.sleep(0.01)
+
+            with lock:
+                running[key] = False
+
+        for i in xrange(10):
+            for key in xrange(4):
+                runner.put(key, work, key, i)
+
+        runner.destroy()
+
+        # Tasks with the same key never overlap and keep FIFO order
+        self.assertEquals(overlaps, [])
+        for key in xrange(4):
+            self.assertEquals(order[key], range(10))
+
+        stats = runner.stats()
+        self.assertEquals(stats["queued"], 0)
+        self.assertEquals(stats["busy"], 0)
+        self.assertEquals(stats["workers"], 0)
+        self.assertEquals(sum(stats["latency"]), 40)
+        self.assertEquals(sum(stats["duration"]), 40)
+
+    def test_run_grow(self):
+        runner = KeyedParallelRun(maxthreads = 4)
+        runner.start()
+
+        event = threading.Event()
+
+        for x in xrange(10):
+            runner.put(None, event.wait)
+
+        time.sleep(0.5)
+        
+        # Unkeyed tasks run in parallel, up to maxthreads workers
+        stats = runner.stats()
+        self.assertEquals(stats["workers"], 4)
+        self.assertEquals(stats["busy"], 4)
+        self.assertEquals(stats["queued"], 6)
+
+        event.set()
+        runner.destroy()
+
+    def test_run_error(self):
+        count = [0]
+
+        def inc(count):
+            count[0] += 1
+ 
+        def error():
+            raise RuntimeError()
+
+        runner = KeyedParallelRun(maxthreads = 4)
+        runner.start()
+       
+        for x in xrange(4):
+            runner.put(1, inc, count)
+
+        runner.put(1, error)
+       
+        runner.destroy()
+      
+        self.assertEquals(count[0], 4)
+        
+        self.assertRaises(RuntimeError, runner.sync)
+
 if __name__ == '__main__':
     unittest.main()
 
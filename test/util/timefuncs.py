@@ -18,6 +18,7 @@
 #
 # Author: Lucia Guevgeozian <lucia.guevgeozian_odizzio@inria.fr>
 
+from nepi.util.timefuncs import tclock, tdelaysec, stabssec, tsformat, tnow
 from test_utils import skipIfNotPythonVersion
 
 import datetime
@@ -36,6 +37,23 @@ class TimeFuncTestCase(unittest.TestCase):
 
         self.assertEquals(seconds1, seconds2)
 
+    def test_delay_seconds(self):
+        self.assertEquals(tdelaysec("0.5s"), 0.5)
+        self.assertEquals(tdelaysec("2m"), 120)
+        self.assertEquals(tdelaysec("1h"), 3600)
+        self.assertEquals(tdelaysec("10ms"), 0.01)
+        self.assertEquals(tdelaysec("20120807124732894211"), None)
+
+        self.assertEquals(stabssec("2s", base = 10), 12)
+
+        now = tclock()
+        self.assertTrue(now <= stabssec(None) <= tclock())
+
+        # Absolute dates are converted to the tclock clock
+        sdate = tsformat(tnow() + datetime.timedelta(seconds = 10))
+        delta = stabssec(sdate) - tclock()
+        self.assertTrue(9 < delta <= 10)
+
 
 if __name__ == '__main__':
     unittest.main()